@@ -0,0 +1,168 @@
+'''
+This file contains an embedded copy of the tables 'person' and 'country' used to answer the analytics queries in-process.
+The copy is stored in DuckDB (a columnar database, well suited to aggregations scanning whole tables) or in SQLite when DuckDB
+is not installed, while all the writes keep going to the primary database, which then forwards the new people to the copy.
+'''
+import os
+import threading
+import pandas as pd
+import sqlalchemy
+from sqlalchemy import MetaData, Table, Column, Integer, String, BINARY, select
+from database import Session
+from db_management.db_entities import Base, Person, Country, derived_columns
+from db_management.summaries import SUMMARY_TABLES, rebuild_summaries, update_summaries
+
+# Tables of the copy: same names and columns of the entities, so that the queries built with Person and Country can be executed on it.
+# The generated columns of the primary database are plain columns here, filled when the rows are copied (see derived_columns).
+# The summary tables (see db_management/summaries.py) are created with the same definitions of the primary database.
+metadata = MetaData()
+person_table = Table("person", metadata,
+                     Column("id", Integer, primary_key=True, autoincrement=False),
+                     Column("first_name", String(30), nullable=False),
+                     Column("last_name", String(30), nullable=False),
+                     Column("email", String(254), nullable=False),
+                     Column("gender", String(20), nullable=False),
+                     Column("ip_address", String(39), nullable=False),
+                     Column("email_domain", String(254)),
+                     Column("ip_first_octet", Integer),
+                     Column("ip_packed", BINARY(16), index=True))
+country_table = Table("country", metadata,
+                      Column("id", Integer, primary_key=True, autoincrement=False),
+                      Column("country", String(2), nullable=False),
+                      Column("person_id", Integer, nullable=False))
+
+PERSON_COLUMNS = ["id", "first_name", "last_name", "email", "gender", "ip_address"]
+
+def _insert_with_executemany(connection, table, frame):
+    connection.execute(table.insert(), frame.astype(object).where(frame.notna(), None).to_dict("records"))
+
+def _insert_with_duckdb_scan(connection, table, frame):
+    # DuckDB reads the Dataframe directly (a single columnar scan instead of one parameter set for each row)
+    driver_connection = connection.connection.driver_connection
+    driver_connection.register("new_rows", frame)
+    try:
+        columns = ", ".join(frame.columns)
+        connection.exec_driver_sql(f"INSERT INTO {table.name} ({columns}) SELECT {columns} FROM new_rows")
+    finally:
+        driver_connection.unregister("new_rows")
+
+def get_analytics_url(backend, path):
+    '''
+        This function builds the url of the embedded database.
+
+        PARAMETERS
+        backend -> 'duckdb' or 'sqlite'. If DuckDB (i.e., the packages duckdb and duckdb-engine) is not installed, SQLite is used.
+        path -> The path of the database file.
+    '''
+    if backend == "duckdb":
+        try:
+            import duckdb_engine # Registers the dialect 'duckdb' in sqlalchemy
+            return f"duckdb:///{path}"
+        except ImportError:
+            backend = "sqlite"
+            path = os.path.splitext(path)[0] + ".db"
+    if backend == "sqlite":
+        return f"sqlite:///{path}"
+    raise ValueError(f"Unknown analytics backend '{backend}'")
+
+class AnalyticsReplica:
+    '''
+        This class manages the embedded copy of the data. The copy is rebuilt from the primary database when the api starts
+        and then updated with the people created through the api (see create_new_people in api_functionalities.py).
+        Each process of the api has its own copy: the file is created when the process starts and removed when it stops if 'temporary'.
+    '''
+    def __init__(self, engine, temporary=False):
+        self.engine = engine
+        self.temporary = temporary
+        self._insert = _insert_with_duckdb_scan if engine.dialect.name == "duckdb" else _insert_with_executemany
+        self._last_country_id = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        '''
+            This function creates the copy selected in the .env file ('analytics_backend' equal to 'duckdb' or 'sqlite').
+
+            RETURNS
+            An AnalyticsReplica, or None if no analytics backend is configured.
+        '''
+        backend = os.environ.get('analytics_backend', 'none').lower()
+        if backend == "none":
+            return None
+        path = os.environ.get('analytics_path', 'analytics.duckdb' if backend == "duckdb" else 'analytics.db')
+        # Every worker of the api rebuilds its copy when it starts, so the workers cannot share the same file (DuckDB allows a single
+        # process to open it, and a worker would overwrite the copy used by the others): the id of the process is added to the name
+        root, extension = os.path.splitext(path)
+        return cls(sqlalchemy.create_engine(get_analytics_url(backend, f"{root}.{os.getpid()}{extension}")), temporary=True)
+
+    def load_from(self, source, chunk_size=100000, max_id=None):
+        '''
+            This function replaces the content of the copy with the data of the primary database.
+
+            PARAMETERS
+            source -> A sqlalchemy engine (or connection) of the primary database.
+            chunk_size -> The number of rows fetched from the primary database at a time.
+            max_id -> If given, only the people with an id up to max_id are copied (see catch_up.py).
+
+            RETURNS
+            The number of people copied.
+        '''
+        with self._lock:
+            metadata.drop_all(self.engine)
+            metadata.create_all(self.engine)
+            Base.metadata.drop_all(self.engine, tables=SUMMARY_TABLES)
+            Base.metadata.create_all(self.engine, tables=SUMMARY_TABLES)
+            n_people = 0
+            people_query = select(*[getattr(Person, c) for c in PERSON_COLUMNS]).order_by(Person.id)
+            countries_query = select(Country.id, Country.country, Country.person_id).order_by(Country.id)
+            if max_id is not None:
+                people_query = people_query.where(Person.id <= max_id)
+                countries_query = countries_query.where(Country.person_id <= max_id)
+            with Session(bind=source) as session:
+                result = session.execute(people_query, execution_options={"yield_per": chunk_size})
+                for rows in result.partitions():
+                    people = derived_columns(pd.DataFrame.from_records(rows, columns=PERSON_COLUMNS))
+                    with self.engine.begin() as connection:
+                        self._insert(connection, person_table, people)
+                    n_people += len(people)
+
+                result = session.execute(countries_query, execution_options={"yield_per": chunk_size})
+                for rows in result.partitions():
+                    countries = pd.DataFrame.from_records(rows, columns=["id", "country", "person_id"])
+                    with self.engine.begin() as connection:
+                        self._insert(connection, country_table, countries)
+                    self._last_country_id = int(countries["id"].iloc[-1])
+            with self.engine.begin() as connection:
+                rebuild_summaries(connection)
+            return n_people
+
+    def append(self, people):
+        '''
+            This function adds to the copy the people already stored in the primary database.
+
+            PARAMETERS
+            people -> A Pandas Dataframe with columns id, first_name, last_name, email, gender, ip_address and country (one row for each
+                      pair <person, country>, a missing country being None).
+        '''
+        if len(people) == 0:
+            return
+        persons = people.drop_duplicates("id")
+        people_countries = people[people["country"].notna()]
+        with self._lock:
+            country_ids = range(self._last_country_id + 1, self._last_country_id + 1 + len(people_countries))
+            countries = pd.DataFrame({"id": country_ids, "country": people_countries["country"].to_numpy(), "person_id": people_countries["id"].to_numpy()})
+            with self.engine.begin() as connection:
+                self._insert(connection, person_table, derived_columns(persons[PERSON_COLUMNS].reset_index(drop=True)))
+                if len(countries):
+                    self._insert(connection, country_table, countries)
+                update_summaries(connection, people)
+            self._last_country_id += len(countries)
+
+    def dispose(self):
+        self.engine.dispose()
+        if self.temporary:
+            path = self.engine.url.database
+            # Along with the files of the write-ahead log and of the journal, if any
+            for filename in (path, path + ".wal", path + "-wal", path + "-shm", path + "-journal"):
+                if os.path.exists(filename):
+                    os.remove(filename)
@@ -1,14 +1,38 @@
 '''
 This file defines the api to use the required functionalities.
 '''
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Query, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
+from starlette.routing import Match
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
 from dotenv import load_dotenv
-import sqlalchemy
+import numpy as np
+import json
 import os
 import api_functionalities
+import column_store
+import associations
+import sketches
+import ip_index
+import search_index
+import dedup
+import catch_up
+import jobs
+import formats
+import export
+import parameters
+from parameters import MAX_PAGE_SIZE, MAX_SEARCH_LENGTH
+from database import Database, read_your_writes_var
+from cache import ResultCache, cached
+import metrics
+import logging_config
+import uuid
 import pandas as pd
 import ipaddress
 import re
+import time
+import asyncio
 import logging
 
 app = FastAPI()
@@ -16,12 +40,260 @@ app = FastAPI()
 # Load database connection parameters
 load_dotenv()
 pd.set_option("display.precision", 2)
-db_connection_data = {"host":os.environ.get('db_hostname'),
-                        "db_name":os.environ.get('db_name'),
-                        "user":os.environ.get('db_user'),
-                        "psw":os.environ.get('db_psw')}
-engine = sqlalchemy.create_engine(f'mysql+mysqldb://{db_connection_data["user"]}:{db_connection_data["psw"]}@{db_connection_data["host"]}/{db_connection_data["db_name"]}') # Connect to database
-logging.basicConfig(filename=os.path.join("logs",'logs.log'), encoding='utf-8', level=logging.DEBUG)
+database = Database.from_env() # Connect to database (synchronous or asynchronous engine, depending on the .env file)
+# Logs are written as JSON lines by a background thread (see logging_config.py)
+logging_config.setup_logging_from_env(os.path.join("logs", "logs.log"), separate_files={"slow_queries": os.path.join("logs", "slow_queries.log")})
+access_logger = logging.getLogger("api.access")
+
+# Metrics of the queries (queries slower than 'slow_query_threshold' seconds are written to logs/slow_queries.log)
+metrics.configure_slow_query_log(float(os.environ.get('slow_query_threshold', 0.5)))
+metrics.instrument_engine(database.engine if database.engine is not None else database.async_engine.sync_engine, "primary")
+if database.analytics is not None:
+    metrics.instrument_engine(database.analytics.engine, "analytics")
+if database.replicas is not None:
+    for replica in database.replicas.replicas:
+        metrics.instrument_engine(replica.engine, replica.name)
+
+def route_of(request):
+    '''
+        This function returns the path of the route matching a request (e.g., '/get_people'), to be used as label of the metrics.
+    '''
+    for route in request.app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    route = route_of(request)
+    in_progress = metrics.REQUESTS_IN_PROGRESS.labels(request.method, route)
+    in_progress.inc()
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        metrics.REQUEST_LATENCY.labels(request.method, route, str(status)).observe(time.perf_counter() - start)
+        in_progress.dec()
+
+@app.middleware("http")
+async def log_requests(request: Request, call_next):
+    # The id of the request (given by the client or generated) is added to all the logs written while processing it
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex
+    endpoint = route_of(request)
+    request_id_token = logging_config.request_id_var.set(request_id)
+    endpoint_token = logging_config.endpoint_var.set(endpoint)
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        access_logger.info("request processed", extra={"method": request.method, "status": status, "duration": time.perf_counter() - start})
+        logging_config.request_id_var.reset(request_id_token)
+        logging_config.endpoint_var.reset(endpoint_token)
+
+@app.middleware("http")
+async def pin_reads_to_primary(request: Request, call_next):
+    # With the header 'X-Read-Your-Writes: true' the reads of the request are executed on the primary database instead of the read
+    # replicas, the column store and the analytics copy, which may not contain the writes just made (see database.py)
+    token = read_your_writes_var.set(request.headers.get("x-read-your-writes", "").lower() in ("true", "1"))
+    try:
+        return await call_next(request)
+    finally:
+        read_your_writes_var.reset(token)
+
+@app.get("/metrics")
+async def get_metrics():
+    '''
+        Returns the metrics of the api in the Prometheus text format.
+    '''
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+# The in-memory copies of the data (analytics copy, column store, sketches, search index and email filter) are loaded up to the same id
+# and then catch up with the people created by the other workers every 'catch_up_interval' seconds (see catch_up.py)
+catch_up_interval = float(os.environ.get('catch_up_interval', 5))
+people_catch_up = None
+
+@app.on_event("startup")
+async def start_catch_up():
+    global people_catch_up
+    if catch_up_interval > 0:
+        try:
+            people_catch_up = await database.run(catch_up.CatchUp.from_engine, float(os.environ.get('catch_up_gap_timeout', 60)))
+        except Exception as e:
+            logging.error(e)
+
+def loaded_up_to():
+    # The id up to which the copies are loaded (None to load all the people, if there is no catch-up)
+    return people_catch_up.watermark if people_catch_up is not None else None
+
+# In-memory column store used to answer the analytics without querying the database (it can be disabled from the .env file).
+# If there is a snapshot of the store (written by initialize_db.py), the workers memory-map it instead of loading the whole database
+use_column_store = os.environ.get('use_column_store', 'true').lower() == 'true'
+snapshot_path = os.environ.get('snapshot_path', 'snapshot')
+store = None
+
+@app.on_event("startup")
+async def load_analytics_copy():
+    try:
+        n_people = await database.load_analytics(loaded_up_to())
+        if n_people is not None:
+            logging.info(f"Analytics copy loaded with {n_people} people")
+    except Exception as e:
+        # If the copy cannot be loaded, the analytics are executed on the primary database
+        logging.error(e)
+        database.analytics = None
+
+@app.on_event("startup")
+async def load_column_store():
+    global store
+    if use_column_store:
+        try:
+            if snapshot_path:
+                store = await database.run(column_store.ColumnStore.restore, snapshot_path, max_id=loaded_up_to())
+            else:
+                store = await database.run(column_store.ColumnStore.from_engine, max_id=loaded_up_to())
+            logging.info(f"Column store loaded with {store.size} people")
+        except Exception as e:
+            # If the store cannot be loaded, every request falls back to the database
+            logging.error(e)
+
+# Sketches of the email domains (see sketches.py), saved to a file when the api stops and restored at the next start
+use_sketches = os.environ.get('use_sketches', 'true').lower() == 'true'
+sketches_path = os.environ.get('sketches_path', 'domain_sketches.npz')
+domain_sketches = None
+
+@app.on_event("startup")
+async def load_sketches():
+    global domain_sketches
+    if use_sketches:
+        try:
+            domain_sketches = await database.run(sketches.DomainSketches.restore, sketches_path, max_id=loaded_up_to())
+            logging.info(f"Domain sketches loaded with {domain_sketches.n_people} people")
+        except Exception as e:
+            logging.error(e)
+
+@app.on_event("shutdown")
+async def save_sketches():
+    if domain_sketches is not None:
+        try:
+            await run_in_threadpool(domain_sketches.save, sketches_path)
+        except Exception as e:
+            logging.error(e)
+
+# Trigram index used to search people by name or email (see search_index.py), built from the database at every start
+use_search_index = os.environ.get('use_search_index', 'true').lower() == 'true'
+people_index = None
+
+@app.on_event("startup")
+async def load_search_index():
+    global people_index
+    if use_search_index:
+        try:
+            people_index = await database.run(search_index.TrigramIndex.from_engine, max_id=loaded_up_to())
+            logging.info(f"Search index loaded with {people_index.size} people")
+        except Exception as e:
+            # If the index cannot be built, the search falls back to the database
+            logging.error(e)
+
+# Bloom filter of the emails in the database (see dedup.py), used to skip the duplicate check of most new emails
+use_email_filter = os.environ.get('use_email_filter', 'true').lower() == 'true'
+email_filter = None
+
+@app.on_event("startup")
+async def load_email_filter():
+    global email_filter
+    if use_email_filter:
+        try:
+            email_filter = await database.run(dedup.BloomFilter.from_engine, float(os.environ.get('email_filter_error_rate', 0.01)),
+                                          max_id=loaded_up_to())
+            logging.info(f"Email filter loaded with {email_filter.size} emails")
+        except Exception as e:
+            # If the filter cannot be built, every email is looked up in the database
+            logging.error(e)
+
+catch_up_task = None
+
+async def catch_up_copies():
+    while True:
+        await asyncio.sleep(catch_up_interval)
+        try:
+            n_people = await database.run(api_functionalities.catch_up_people, people_catch_up, store, database.analytics, domain_sketches,
+                                          people_index, email_filter)
+            if n_people:
+                result_cache.bump_version()
+        except Exception as e:
+            logging.error(e)
+
+@app.on_event("startup")
+async def start_catch_up_copies():
+    global catch_up_task
+    if people_catch_up is not None:
+        catch_up_task = asyncio.create_task(catch_up_copies())
+
+# Health checks of the read replicas (see read_replicas.py), executed periodically in the background
+replica_health_checks = None
+
+async def check_replicas(replicas):
+    while True:
+        await asyncio.sleep(replicas.health_check_interval)
+        try:
+            await run_in_threadpool(replicas.check_health)
+        except Exception as e:
+            logging.error(e)
+
+@app.on_event("startup")
+async def start_replica_health_checks():
+    global replica_health_checks
+    if database.replicas is not None:
+        replica_health_checks = asyncio.create_task(check_replicas(database.replicas))
+
+@app.on_event("shutdown")
+async def close_database():
+    if replica_health_checks is not None:
+        replica_health_checks.cancel()
+    if catch_up_task is not None:
+        catch_up_task.cancel()
+    await database.dispose()
+    associations.shutdown_executor()
+    job_manager.shutdown()
+
+async def query(function, *args, **kwargs):
+    '''
+        This function executes an analytics functionality: on the column store (in the threadpool, without any connection to
+        the database) if it is available, on the embedded analytics copy, on a read replica or on the primary database otherwise.
+        The column store contains the people created by the other processes only after the next catch-up (see catch_up.py), so the reads
+        pinned to the primary database skip it.
+    '''
+    if store is not None and not read_your_writes_var.get():
+        return await run_in_threadpool(function, None, *args, store=store, **kwargs)
+    return await database.run_analytics(function, *args, **kwargs)
+
+# Formats of the parameters used to create a person (the same used in the database)
+EMAIL_REGEX = re.compile(r"^[a-zA-Z0-9][a-zA-Z0-9._-]*@[a-zA-Z0-9]+[\[.]?[a-zA-Z0-9-]+]*\.[a-zA-Z]{2,4}$")
+PERSON_FIELDS = ("first_name", "last_name", "email", "gender", "ip_address", "country")
+INVALID_PARAMETER_MESSAGES = {
+    "first_name": "Invalid parameter 'first_name'. This parameter cannot be empty and should be a string of at most 30 characters long.",
+    "last_name": "Invalid parameter 'last_name'. This parameter cannot be empty and should be a string of at most 30 characters long.",
+    "email": "Invalid parameter 'email'. This parameter cannot be empty, should be a string of at most 254 characters long and should meet the usual email format requirements.",
+    "gender": "Invalid parameter 'gender'. This parameter cannot be empty and should be a string of at most 20 characters.",
+    "ip_address": "Invalid parameter 'ip_address'. This parameter cannot be empty and should represent a valid IPv4 or IPv6 address.",
+    "country": "Invalid parameter 'country'. This parameter cannot be empty and should be a string of at most 2 characters long."}
+MAX_BATCH_SIZE = 10000
+
+# Background jobs executing the heavy analytics in a pool of processes (see jobs.py)
+job_manager = jobs.JobManager.from_env()
+MAX_JOB_WAIT = 60
+
+# Cache of the responses of the analytics endpoints, invalidated by every write
+result_cache = ResultCache(max_entries=int(os.environ.get('cache_max_entries', 256)),
+                           max_bytes=int(os.environ.get('cache_max_bytes', 64 * 1024 * 1024)))
 
 def validate_ip_address(ip_address):
     '''
@@ -35,90 +307,275 @@ def validate_ip_address(ip_address):
     '''
     try:
         ipaddress.ip_address(ip_address) #Raise a ValueError exception if the given ip_address is not valid
-        return True
+        return len(ip_address) <= 39 # Longest IPv6 address (addresses with a scope, e.g. 'fe80::1%eth0', may not fit in the database)
     except ValueError:
         return False
 
+def validate_people(people):
+    '''
+        This function checks the format of the parameters of many people at once (with vectorized operations over the columns).
+
+        PARAMETERS
+        people -> A Pandas DataFrame with a string column for each field of PERSON_FIELDS.
+
+        RETURNS
+        A NumPy array containing, for each person, the error message of the first invalid parameter (None if the person is valid).
+    '''
+    lengths = {field: people[field].str.len() for field in PERSON_FIELDS}
+    ip_addresses = people["ip_address"]
+    valid_ip = ip_index.encode_ipv4(ip_addresses) >= 0
+    # Only the addresses that are not plain IPv4 addresses (e.g., IPv6) are checked one by one
+    others = np.flatnonzero(~valid_ip & (lengths["ip_address"] > 0).to_numpy())
+    valid_ip[others] = [validate_ip_address(ip) for ip in ip_addresses.iloc[others]]
+
+    conditions = [(lengths["first_name"] == 0) | (lengths["first_name"] > 30),
+                  (lengths["last_name"] == 0) | (lengths["last_name"] > 30),
+                  (lengths["email"] == 0) | (lengths["email"] > 254) | ~people["email"].str.match(EMAIL_REGEX),
+                  (lengths["gender"] == 0) | (lengths["gender"] > 20),
+                  ~valid_ip,
+                  (lengths["country"] == 0) | (lengths["country"] > 2)]
+    messages = [INVALID_PARAMETER_MESSAGES[field] for field in PERSON_FIELDS]
+    return np.select([np.asarray(c, dtype=bool) for c in conditions], messages, default=None)
+
 @app.get("/create_person")
-def create_person(first_name: str, last_name: str, email: str, gender: str, ip_address: str, country: str):
+async def create_person(first_name: str, last_name: str, email: str, gender: str, ip_address: str, country: str):
     # Checking formats to ensure that the given parameters are acceptable before putting them in the database
     if not first_name or len(first_name) > 30 :
-        return "Invalid parameter 'first_name'. This parameter cannot be empty and should be a string of at most 30 characters long."
+        return INVALID_PARAMETER_MESSAGES["first_name"]
     elif not last_name or len(last_name) > 30 :
-        return "Invalid parameter 'last_name'. This parameter cannot be empty and should be a string of at most 30 characters long."
-    elif not email or len(email) > 254 or not re.match(r"^[a-zA-Z0-9][a-zA-Z0-9._-]*@[a-zA-Z0-9]+[\[.]?[a-zA-Z0-9-]+]*\.[a-zA-Z]{2,4}$", email):
-        return "Invalid parameter 'email'. This parameter cannot be empty, should be a string of at most 254 characters long and should meet the usual email format requirements."
+        return INVALID_PARAMETER_MESSAGES["last_name"]
+    elif not email or len(email) > 254 or not EMAIL_REGEX.match(email):
+        return INVALID_PARAMETER_MESSAGES["email"]
     elif not gender or len(gender) > 20 :
-        return "Invalid parameter 'gender'. This parameter cannot be empty and should be a string of at most 20 characters."
+        return INVALID_PARAMETER_MESSAGES["gender"]
     elif not ip_address or not validate_ip_address(ip_address) :
-        return "Invalid parameter 'ip_address'. This parameter cannot be empty and should represent a valid IPv4 address."
+        return INVALID_PARAMETER_MESSAGES["ip_address"]
     elif not country or len(country) > 2 :
-        return "Invalid parameter 'country'. This parameter cannot be empty and should be a string of at most 2 characters long."
+        return INVALID_PARAMETER_MESSAGES["country"]
     
     try:
-        api_functionalities.create_new_person(engine, first_name, last_name, email, gender, ip_address, country)
+        _, created = await database.run(api_functionalities.create_new_person, first_name, last_name, email, gender, ip_address, country, store=store,
+                                        replica=database.analytics, sketches=domain_sketches, search_index=people_index, email_filter=email_filter,
+                                        catch_up=people_catch_up)
+        if not created:
+            return "A person with the same email already exists."
+        result_cache.bump_version()
         return "Person created successfully."
     except Exception as e:
         logging.error(e)
         raise HTTPException(status_code=500)
 
+@app.post("/create_people")
+async def create_people(request: Request):
+    '''
+        Creates many people at once. The body is either a JSON array of objects or NDJSON (one object for each line,
+        with content type 'application/x-ndjson'), each object having the same parameters of /create_person.
+        Valid people are inserted in a single transaction, and the result of each row is returned in the same order of the body
+        ('accepted', 'rejected' if not valid, or 'duplicate' if a person with the same email already exists).
+    '''
+    body = await request.body()
+    try:
+        if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+            records = [json.loads(line) for line in body.decode("utf-8").splitlines() if line.strip()]
+        else:
+            records = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="The body should be a JSON array or NDJSON.")
+    if not isinstance(records, list) or not all(isinstance(r, dict) for r in records):
+        raise HTTPException(status_code=400, detail="The body should contain a list of JSON objects.")
+    if len(records) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"At most {MAX_BATCH_SIZE} people can be created with a single request.")
+
+    # Missing parameters are considered empty, and so are the values that are not strings (e.g., numbers or booleans), which are not
+    # converted to strings: as in /create_person, the people with one of them are rejected
+    people = pd.DataFrame({field: [record.get(field) if isinstance(record.get(field), str) else "" for record in records]
+                           for field in PERSON_FIELDS}, dtype=object).astype(str)
+    errors = validate_people(people)
+    accepted = np.flatnonzero(errors == None)
+
+    try:
+        ids, created = await database.run(api_functionalities.create_new_people, people.iloc[accepted], store, database.analytics, domain_sketches,
+                                          people_index, email_filter, people_catch_up) if len(accepted) else ([], [])
+        if np.any(created):
+            result_cache.bump_version()
+    except Exception as e:
+        logging.error(e)
+        raise HTTPException(status_code=500)
+
+    results = [{"index": i, "status": "rejected", "error": error} for i, error in enumerate(errors)]
+    for i, id, new in zip(accepted, ids, created):
+        # Duplicates (people whose email already exists) are returned with the id of the existing person, so that retries are idempotent
+        results[i] = {"index": int(i), "status": "accepted" if new else "duplicate", "id": int(id)}
+    return results
+
 @app.get("/get_people_by_country")
-def get_people_by_country(country: str):
+@cached(result_cache)
+async def get_people_by_country(country: str):
     # Checking formats to ensure that the given parameters are acceptable before putting them in the database
-    if not country or len(country) > 2 :
-        return "Invalid parameter 'country'. This parameter cannot be empty and should be a string of at most 2 characters long."
+    error = parameters.check_country(country)
+    if error is not None:
+        return error
     try:
-        df = api_functionalities.get_people_by_country(engine, country)
-        if df is not None:
-            return df.to_dict()
-        else:
-            return "No result found in the database."
+        return formats.shape_result("get_people_by_country", await query(api_functionalities.get_people_by_country, country))
     except Exception as e:
         logging.error(e)
         raise HTTPException(status_code=500)
     
-@app.get("/get_people_count_by_country")
-def get_people_count_by_country():
+@app.get("/get_people")
+@cached(result_cache)
+async def get_people(country: str = None, gender: str = None, domain: str = None, ip_prefix: str = None,
+                     after_id: int = Query(0, ge=0), limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE)):
+    '''
+        Returns a page of people matching the given filters. To obtain the next page, pass the returned 'next_cursor' as 'after_id'.
+    '''
+    if country is not None and (not country or len(country) > 2) :
+        return INVALID_PARAMETER_MESSAGES["country"]
+    try:
+        people, next_cursor = await database.run_read(api_functionalities.get_people, country, gender, domain, ip_prefix, after_id, limit)
+        return {"people": people, "next_cursor": next_cursor}
+    except Exception as e:
+        logging.error(e)
+        raise HTTPException(status_code=500)
+
+@app.get("/export_people")
+async def export_people(format: str = "csv", country: str = None, gender: str = None, domain: str = None, ip_prefix: str = None,
+                        chunk_size: int = Query(export.DEFAULT_CHUNK_SIZE, ge=1, le=export.MAX_CHUNK_SIZE)):
+    '''
+        Exports the people matching the given filters, with a row for each of their countries, as 'csv', 'ndjson' or 'parquet'.
+        The rows are read from the database with a server-side cursor and sent in chunks of 'chunk_size' rows as they are read.
+    '''
+    if format not in export.MEDIA_TYPES:
+        return f"Invalid parameter 'format'. This parameter should be one of {', '.join(export.MEDIA_TYPES)}."
+    if country is not None and (not country or len(country) > 2) :
+        return INVALID_PARAMETER_MESSAGES["country"]
+    query = export.people_query(country, gender, domain, ip_prefix)
+    # The generators are consumed by StreamingResponse in the threadpool, one chunk at a time
+    chunks = database.stream_read(export.read_chunks, query, chunk_size, read_your_writes=read_your_writes_var.get())
+    return StreamingResponse(export.encode(chunks, format), media_type=export.MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="people.{format}"'})
+
+@app.get("/search_people")
+@cached(result_cache)
+async def search_people(q: str, limit: int = Query(20, ge=1, le=parameters.MAX_SEARCH_RESULTS), min_similarity: float = Query(0.3, gt=0, le=1)):
+    '''
+        Returns the people whose first name, last name or email are similar to the given text (e.g., a part of the name or
+        of the email, possibly with small typos), sorted by similarity.
+    '''
+    error = parameters.check_search_text(q)
+    if error is not None:
+        return error
     try:
-        df = api_functionalities.get_people_count_by_country(engine)
-        if df is not None:
-            return df.to_dict()
+        if people_index is not None:
+            df = await run_in_threadpool(api_functionalities.search_people, None, q, limit, min_similarity, index=people_index)
         else:
-            return "No result found in the database."
+            df = await database.run_analytics(api_functionalities.search_people, q, limit, min_similarity)
+        return formats.shape_result("search_people", df)
+    except Exception as e:
+        logging.error(e)
+        raise HTTPException(status_code=500)
+
+@app.get("/get_people_count_by_country")
+@cached(result_cache)
+async def get_people_count_by_country():
+    try:
+        return formats.shape_result("get_people_count_by_country", await query(api_functionalities.get_people_count_by_country))
     except Exception as e:
         logging.error(e)
         raise HTTPException(status_code=500)
 
 @app.get("/get_people_gender_distribution")
-def get_people_gender_distribution():
+@cached(result_cache)
+async def get_people_gender_distribution():
     try:
-        df = api_functionalities.get_people_gender_distribution(engine)
-        if df is not None:
-            return df.to_dict()
-        else:
-            return "No result found in the database."
+        return formats.shape_result("get_people_gender_distribution", await query(api_functionalities.get_people_gender_distribution))
     except Exception as e:
         logging.error(e)
         raise HTTPException(status_code=500)
 
 @app.get("/get_ip_address_distribution_by_class")
-def get_ip_address_distribution_by_class():
+@cached(result_cache)
+async def get_ip_address_distribution_by_class():
+    try:
+        return formats.shape_result("get_ip_address_distribution_by_class", await query(api_functionalities.get_ip_address_distribution_by_class))
+    except Exception as e:
+        logging.error(e)
+        raise HTTPException(status_code=500)
+
+@app.get("/get_ip_address_distribution")
+@cached(result_cache)
+async def get_ip_address_distribution(by: str = "8"):
+    '''
+        Returns the distribution of the ip addresses by IPv4 network ('by' equal to '8' or '16'), by class ('class') or by range
+        ('range': private, public, loopback, ... for both IPv4 and IPv6).
+    '''
+    error = parameters.check_ip_distribution(by)
+    if error is not None:
+        return error
+    try:
+        return formats.shape_result("get_ip_address_distribution", await query(api_functionalities.get_ip_address_distribution, by))
+    except Exception as e:
+        logging.error(e)
+        raise HTTPException(status_code=500)
+
+@app.get("/get_people_by_network")
+@cached(result_cache)
+async def get_people_by_network(network: str, limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE)):
+    '''
+        Returns the number of people whose ip address belongs to a network in CIDR notation (e.g., '10.0.0.0/8' or '2001:db8::/32'),
+        along with the first 'limit' of them sorted by ip address.
+    '''
+    error = parameters.check_network(network)
+    if error is not None:
+        return error
+    try:
+        return formats.shape_result("get_people_in_network", await query(api_functionalities.get_people_in_network, network, limit))
+    except Exception as e:
+        logging.error(e)
+        raise HTTPException(status_code=500)
+
+@app.get("/get_most_common_domain")
+@cached(result_cache)
+async def get_most_common_domain():
+    try:
+        return formats.shape_result("get_most_common_domain", await query(api_functionalities.get_most_common_domain))
+    except Exception as e:
+        logging.error(e)
+        raise HTTPException(status_code=500)
+
+@app.get("/get_top_domains")
+@cached(result_cache)
+async def get_top_domains(k: int = Query(10, ge=1, le=100)):
+    '''
+        Returns the k most common email domains estimated by the sketches, with a lower and an upper bound of the number of people
+        of each domain.
+    '''
+    if domain_sketches is None:
+        return "The domain sketches are not available."
     try:
-        df = api_functionalities.get_ip_address_distribution_by_class(engine)
-        if df is not None:
-            return df.to_dict()
+        top_domains = domain_sketches.top_domains_with_bounds(k)
+        if top_domains:
+            return {"n_people": domain_sketches.n_people, "top_domains": top_domains}
         else:
             return "No result found in the database."
     except Exception as e:
         logging.error(e)
         raise HTTPException(status_code=500)
 
-@app.get("/get_most_common_domain")
-def get_most_common_domain():
+@app.get("/get_distinct_domains")
+@cached(result_cache)
+async def get_distinct_domains(by: str = "country"):
+    '''
+        Returns the estimated number of distinct email domains of each country ('by' equal to 'country') or of each gender ('by' equal
+        to 'gender'), along with the relative standard error of the estimates.
+    '''
+    if by not in ("country", "gender"):
+        return "Invalid parameter 'by'. This parameter should be 'country' or 'gender'."
+    if domain_sketches is None:
+        return "The domain sketches are not available."
     try:
-        domains, count = api_functionalities.get_most_common_domain(engine)
-        if domains:
-            return f"The most commons domains are {domains} which occurr {count} times each."
+        distinct_domains = domain_sketches.distinct_domains(by)
+        if distinct_domains:
+            return {"distinct_domains": distinct_domains, "relative_error": getattr(domain_sketches, f"domains_by_{by}").relative_error()}
         else:
             return "No result found in the database."
     except Exception as e:
@@ -126,63 +583,121 @@ def get_most_common_domain():
         raise HTTPException(status_code=500)
 
 @app.get("/get_country_domain_correlation")
-def get_country_domain_correlation():
+@cached(result_cache)
+async def get_country_domain_correlation():
     try:
-        correlation = api_functionalities.get_country_domain_correlation(engine)
-        if correlation is not None:
-            return "The correlation between Country and Domain is {:.3f}".format(correlation)
-        else:
-            return "No result found in the database."  
+        return formats.shape_result("get_country_domain_correlation", await query(api_functionalities.get_country_domain_correlation))
     except Exception as e:
         logging.error(e)
         raise HTTPException(status_code=500)
 
 @app.get("/get_gender_domain_correlation")
-def get_gender_domain_correlation():
+@cached(result_cache)
+async def get_gender_domain_correlation():
     try:
-        correlation = api_functionalities.get_gender_domain_correlation(engine)
-        if correlation is not None:
-            return "The correlation between Gender and Domain is {:.3f}".format(correlation)
-        else:
-            return "No result found in the database." 
+        return formats.shape_result("get_gender_domain_correlation", await query(api_functionalities.get_gender_domain_correlation))
     except Exception as e:
         logging.error(e)
         raise HTTPException(status_code=500)
 
 @app.get("/get_common_email_patterns")
-def get_common_email_patterns():
+@cached(result_cache)
+async def get_common_email_patterns(details: bool = False):
+    '''
+        Returns the most common email pattern. If 'details' is True, the number of emails matching each pattern is returned as well,
+        both in total and for each domain.
+    '''
     try:
-        pattern = api_functionalities.get_common_email_patterns(engine)
-        if pattern:
-            return f"The most common email pattern is: {pattern}."
-        elif pattern is None:
-            return "No result found in the database."
-        else:
-            return "None of the analysed patterns is present in the database."
+        pattern_counts = await query(api_functionalities.get_email_pattern_counts)
+        pattern = api_functionalities.get_common_email_patterns(None, pattern_counts=pattern_counts)
+        if details and pattern_counts is not None:
+            return {"most_common": pattern or [],
+                    "counts": pattern_counts.sum().to_dict(),
+                    "counts_by_domain": pattern_counts.to_dict(orient="index")}
+        return formats.shape_result("get_common_email_patterns", pattern)
     except Exception as e:
         logging.error(e)
         raise HTTPException(status_code=500)
 
 @app.get("/get_gender_country_correlation")
-def get_gender_country_correlation():
+@cached(result_cache)
+async def get_gender_country_correlation():
     try:
-        correlation = api_functionalities.get_gender_country_correlation(engine)
-        if correlation is not None:
-            return "The correlation between Gender and Country is {:.3f}".format(correlation)
-        else:
-            return "No result found in the database." 
+        return formats.shape_result("get_gender_country_correlation", await query(api_functionalities.get_gender_country_correlation))
+    except Exception as e:
+        logging.error(e)
+        raise HTTPException(status_code=500)
+
+@app.get("/get_association_matrix")
+@cached(result_cache)
+async def get_association_matrix(attributes: str = ",".join(associations.ATTRIBUTES), bootstrap: int = Query(0, ge=0, le=parameters.MAX_BOOTSTRAP),
+                                 confidence: float = Query(0.95, gt=0, lt=1)):
+    '''
+        Returns the correlation (Cramer's V) between each pair of the given attributes (comma separated, among country, gender,
+        domain, ip_class and tld). If 'bootstrap' is greater than 0, the confidence intervals are computed with that number of
+        bootstrap replicates.
+    '''
+    attributes = list(dict.fromkeys(a.strip() for a in attributes.split(",") if a.strip()))
+    error = parameters.check_attributes(attributes)
+    if error is not None:
+        return error
+    try:
+        return formats.shape_result("get_association_matrix", await query(api_functionalities.get_association_matrix, attributes, bootstrap, confidence))
     except Exception as e:
         logging.error(e)
         raise HTTPException(status_code=500)
 
 @app.get("/get_gender_distribution_by_country")
-def get_gender_distribution_by_country():
+@cached(result_cache)
+async def get_gender_distribution_by_country():
     try:
-        df = api_functionalities.get_gender_distribution_by_country(engine)
-        if df is not None:
-            return df.to_dict()
-        else:
-            return "No result found in the database."
+        return formats.shape_result("get_gender_distribution_by_country", await query(api_functionalities.get_gender_distribution_by_country))
+    except Exception as e:
+        logging.error(e)
+        raise HTTPException(status_code=500)
+
+@app.post("/jobs")
+async def submit_job(request: Request):
+    '''
+        Submits a job executing an analytics functionality in the background. The body is a JSON object with the name of the
+        functionality ('function', e.g. 'get_common_email_patterns'), its parameters ('arguments', an object, optional) and
+        an optional 'timeout' in seconds.
+        Returns the id of the job, to be used with /jobs/{job_id}. If an identical job is pending or running, its id is returned.
+    '''
+    try:
+        body = json.loads(await request.body())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="The body should be a JSON object.")
+    if not isinstance(body, dict):
+        raise HTTPException(status_code=400, detail="The body should be a JSON object.")
+    try:
+        job = job_manager.submit(body.get("function"), body.get("arguments", {}), body.get("timeout"), read_your_writes_var.get())
+    except jobs.JobError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except jobs.TooManyJobs as e:
+        raise HTTPException(status_code=429, detail=str(e))
     except Exception as e:
         logging.error(e)
         raise HTTPException(status_code=500)
+    return job.to_dict(with_result=False)
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = Query(0, ge=0, le=MAX_JOB_WAIT)):
+    '''
+        Returns the status of a job ('pending', 'running', 'done', 'failed', 'timeout' or 'cancelled') and, when it is done,
+        its result. If 'wait' is given, waits at most 'wait' seconds for the end of the job before answering (long polling).
+    '''
+    job = await job_manager.wait(job_id, wait)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found (the results are kept only for a limited time).")
+    return Response(content=formats.to_json(job.to_dict()), media_type=formats.MEDIA_TYPES["json"])
+
+@app.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    '''
+        Cancels a job that has not started yet.
+    '''
+    job = job_manager.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found (the results are kept only for a limited time).")
+    return job.to_dict(with_result=False)
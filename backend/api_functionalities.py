@@ -2,29 +2,46 @@
 This file contains the implementation of the required functionalities.
 '''
 
-from db_management.db_entities import Person, Country
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy import func
+from db_management.db_entities import Person, Country, CountryCount, GenderCount, CountryGenderCount, DomainCount, IpFirstOctetCount
+import db_management.summaries as summaries
+from contingency import SparseContingencyTable
+from associations import AttributeCodes, association_matrix
+import email_patterns
+from ip_index import packed_ip_addresses, packed_ip_address, network_range, SPECIAL_RANGES
+from search_index import TrigramIndex
+from database import Session, offload
+from metrics import instrumented, stage
+from sqlalchemy import func, select, insert, case, or_
+from sqlalchemy.exc import IntegrityError
+import contextlib
+import threading
 import pandas as pd
-import scipy.stats as stats
 import numpy as np
- 
 
+# Maximum number of people read by the search without the index (see search_people)
+SEARCH_FALLBACK_ROWS = 10000
+# SQLite allows a single writer: the writes of this process wait for each other on this lock instead of retrying with the increasing
+# sleeps of the busy handler of SQLite, which delay some of many concurrent writes by seconds
+_sqlite_write_lock = threading.Lock()
+
+@stage("statistics")
 def compute_cramer_V_correlation(contingency_table):
     '''
         This function allows to compute the correlation between nominal variables.
         PARAMETERS
-        contingency_table -> A Pandas Dataframe representing a contingency table
+        contingency_table -> A SparseContingencyTable (or a NumPy matrix) representing a contingency table
         
         RETURNS
         A value between 0 and 1 where 1 means full correlation and 0 no correlation.
     '''
+    if not isinstance(contingency_table, SparseContingencyTable):
+        contingency_table = SparseContingencyTable.from_dense(contingency_table)
 
-    # Compute Chi-square statistic
-    chi2 = stats.chi2_contingency(contingency_table, correction=False)[0]
+    # Compute Chi-square statistic (only the non-zero cells are visited)
+    chi2 = contingency_table.chi2()
     
     # Compute number of observations
-    n = np.sum(contingency_table)
+    n = contingency_table.n
     k = contingency_table.shape[1]
     r = contingency_table.shape[0]
     
@@ -40,71 +57,299 @@ def compute_cramer_V_correlation(contingency_table):
     return 1
     
 
-def create_new_person(engine, first_name, last_name, email, gender, ip_address, country):
+def _correlation_from_counts(results):
     '''
-        This function allows to create a new person and insert it into the database.
+        This function computes the correlation (Cramer-V method) of a contingency table given by its non-zero cells, i.e. a list of
+        triples <row value, column value, count>.
+    '''
+    rows, columns, counts = zip(*results)
+    return compute_cramer_V_correlation(SparseContingencyTable.from_counts(rows, columns, counts))
+
+def _insert_people(connection, people):
+    '''
+        This function inserts people and their countries using a single multi-row statement for each table.
+        The ids are generated by the database (autoincrement) and read back from the insert of the people, so that the countries can
+        reference them without locking the table: with RETURNING where supported (e.g., SQLite and MariaDB), otherwise (MySQL) from
+        LAST_INSERT_ID(), the id of the first row of the insert, since the rows of a single INSERT ... VALUES statement receive
+        consecutive ids (with the default auto_increment_increment = 1, whatever the innodb_autoinc_lock_mode).
         PARAMETERS
-        engine -> A sqlalchemy engine to interact with the database.
-        first_name, last_name, email, gender, ip_address, country -> The information concerning the new person (each being a string).
-    ''' 
-    
+        connection -> A sqlalchemy connection (or session) with an active transaction.
+        people -> A Pandas Dataframe with columns first_name, last_name, email, gender, ip_address and country (already formatted,
+                  without duplicated emails).
+        RETURNS
+        A NumPy array containing the ids assigned to the new people.
+    '''
+    persons = offload(_person_rows, people)
+    bind = connection.get_bind() if hasattr(connection, "get_bind") else connection
+    if bind.dialect.insert_executemany_returning:
+        # The returned rows are not guaranteed to follow the order of the people, so the ids are matched by email
+        ids_by_email = dict(connection.execute(insert(Person.__table__).returning(Person.email, Person.id), persons).all())
+        ids = people["email"].map(ids_by_email).to_numpy(dtype=np.int64)
+    else:
+        result = connection.execute(insert(Person.__table__).values(persons))
+        # LAST_INSERT_ID() is the id of the first row, while SQLite (before 3.35, without RETURNING) gives the id of the last one
+        first_id = result.lastrowid - len(people) + 1 if bind.dialect.name == "sqlite" else result.lastrowid
+        ids = first_id + np.arange(len(people), dtype=np.int64)
+
+    countries = pd.DataFrame({"person_id": ids, "country": people["country"].to_numpy()})
+    connection.execute(insert(Country.__table__), countries.to_dict("records"))
+    return ids
+
+def _person_rows(people):
+    '''
+        This function returns the rows of the table 'person' of the given people, as dictionaries.
+    '''
+    return people[["first_name", "last_name", "email", "gender", "ip_address"]].assign(ip_packed=packed_ip_addresses(people["ip_address"]))\
+               .to_dict("records")
+
+def _format_people(people):
+    '''
+        This function formats the strings of new people as the ones already in the database, to keep format consistency.
+    '''
+    return pd.DataFrame({"first_name": people["first_name"].str.title(), # Put first letter in upper case and everything else lower case
+                         "last_name": people["last_name"].str.title(),   # Put first letter in upper case and everything else lower case
+                         "email": people["email"].str.lower(),           # Lower case
+                         "gender": people["gender"].str.title(),         # Put first letter in upper case and everything else lower case
+                         "ip_address": people["ip_address"],
+                         "country": people["country"].str.upper()})      # Upper case
+
+def _existing_emails(connection, emails, email_filter=None, chunk_size=1000):
+    '''
+        This function looks up in the database the emails of some people.
+        PARAMETERS
+        connection -> A sqlalchemy connection (or session).
+        emails -> A Pandas Series of emails (lower case).
+        email_filter -> An optional BloomFilter of the emails in the database (see dedup.py): the emails that it surely does not
+                        contain are not looked up.
+        RETURNS
+        A dictionary {email: id} of the emails already in the database.
+    '''
+    emails = emails.drop_duplicates()
+    if email_filter is not None:
+        emails = emails[email_filter.might_contain(emails)]
+    existing = {}
+    for start in range(0, len(emails), chunk_size):
+        chunk = emails.iloc[start:start + chunk_size].tolist()
+        existing.update(connection.execute(select(Person.email, Person.id).where(Person.email.in_(chunk))).all())
+    return existing
+
+@instrumented
+def create_new_people(engine, people, store=None, replica=None, sketches=None, search_index=None, email_filter=None, catch_up=None):
+    '''
+        This function allows to create new people and insert them into the database in a single transaction.
+        People whose email is already in the database (or in a previous row of the Dataframe) are duplicates and are not inserted.
+        PARAMETERS
+        engine -> A sqlalchemy engine (or connection) to interact with the database.
+        people -> A Pandas Dataframe with columns first_name, last_name, email, gender, ip_address and country (each being a string).
+        store -> An optional ColumnStore that is updated with the new people once they have been stored in the database.
+        replica -> An optional AnalyticsReplica (see analytics.py) that is updated in the same way.
+        sketches -> Optional DomainSketches (see sketches.py) that are updated in the same way.
+        search_index -> An optional TrigramIndex (see search_index.py) that is updated in the same way.
+        email_filter -> An optional BloomFilter of the emails in the database (see dedup.py), used to skip the lookup of most
+                        new emails and updated in the same way.
+        catch_up -> An optional CatchUp of the copies (see catch_up.py), told about the new people so that it does not append them again.
+        RETURNS
+        A NumPy array containing the id of each person (the id of the existing person for the duplicates) and a NumPy array
+        of booleans, True for the people that have been created (both in the same order of the rows of the Dataframe).
+    '''
+
     ''' N.B. Checks on the type and format of the parameters are performed immediately when the request is done to the api (see api.py).
         The only exception is that strings are modified to be compliant with the format already used in the database, to make new ones consistent with
         the rest. '''
-    
+
     # Format strings before putting them in the database to keep format consistency
-    first_name = first_name.title() # Put first letter in upper case and everything else lower case
-    last_name = last_name.title()   # Put first letter in upper case and everything else lower case
-    email = email.lower()           # Lower case
-    gender = gender.title()         # Put first letter in upper case and everything else lower case
-    country = country.upper()       # Upper case
-
-    # Create a new instance of Person and push it to the database
-    new_person = Person(id = None, first_name = first_name, last_name = last_name, email = email, gender = gender, ip_address = ip_address)
-    new_country = Country(id = None, person_id = None, country=country)
-    
-    Session = sessionmaker(engine, expire_on_commit = False)
-    
-    ''' expire_on_commit False allows to keep the object active even after commit so that the id assigned automatically by the database is available
-        In this case, even if the person is inserted and the country is not due to some error, it is not probably a major issue. However, if it is
-        considered of major importance, a transaction could be used to rollback in case one of the two operations fail. '''
-    with Session() as session:
-            session.add(new_person)
-            session.commit()
-            new_country.person_id= new_person.id
-            session.add(new_country)
-            session.commit()
+    people = offload(_format_people, people)
+
+    # People, countries and summary tables are updated in the same transaction: if one of the operations fails, nothing is stored
+    write_lock = _sqlite_write_lock if engine.dialect.name == "sqlite" else contextlib.nullcontext()
+    for attempt in range(2):
+        try:
+            with write_lock, stage("query"), Session(bind=engine) as session, session.begin():
+                # The filter only knows the emails inserted by this process: if another process inserted one of the emails,
+                # the unique index rejects the transaction and it is repeated looking up all the emails in the database
+                existing = _existing_emails(session, people["email"], email_filter if attempt == 0 else None)
+                created = (~people["email"].isin(list(existing)) & ~people["email"].duplicated()).to_numpy()
+                new_people = people[created]
+                new_ids = _insert_people(session, new_people) if len(new_people) else np.zeros(0, dtype=np.int64)
+                if len(new_people):
+                    summaries.add_summary_counts(session.connection(), offload(summaries.count_summaries, new_people))
+                if catch_up is not None:
+                    # Before the commit, otherwise the catch-up could read the new people and append them to the copies as well
+                    catch_up.add(new_ids)
+            break
+        except IntegrityError:
+            if attempt == 1:
+                raise
+
+    ids = people["email"].map({**existing, **dict(zip(new_people["email"], new_ids))}).to_numpy(dtype=np.int64)
+    offload(_append_to_copies, new_people.assign(id=new_ids), store, replica, sketches, search_index, email_filter)
+    return ids, created
+
+def _append_to_copies(people, store=None, replica=None, sketches=None, search_index=None, email_filter=None):
+    '''
+        This function appends people already stored in the database to the in-memory copies of the data that are given.
+    '''
+    if len(people) == 0:
+        return
+    if store is not None:
+        store.append(people)
+    if replica is not None:
+        replica.append(people)
+    if sketches is not None:
+        sketches.update(people)
+    if search_index is not None:
+        search_index.append(people)
+    if email_filter is not None:
+        email_filter.add(people["email"])
+
+@instrumented
+def catch_up_people(engine, catch_up, store=None, replica=None, sketches=None, search_index=None, email_filter=None):
+    '''
+        This function appends to the in-memory copies of the data the people created by the other processes (see catch_up.py).
+        PARAMETERS
+        engine -> A sqlalchemy engine (or connection) to interact with the database.
+        catch_up -> The CatchUp of the copies.
+        store, replica, sketches, search_index, email_filter -> The copies, as in create_new_people.
+        RETURNS
+        The number of people appended.
+    '''
+    with stage("query"):
+        people = catch_up.new_people(engine)
+    offload(_append_to_copies, people, store, replica, sketches, search_index, email_filter)
+    return int(people["id"].nunique())
+
+@instrumented
+def create_new_person(engine, first_name, last_name, email, gender, ip_address, country, store=None, replica=None, sketches=None, search_index=None, email_filter=None,
+                      catch_up=None):
+    '''
+        This function allows to create a new person and insert it into the database.
+        PARAMETERS
+        engine -> A sqlalchemy engine (or connection) to interact with the database.
+        first_name, last_name, email, gender, ip_address, country -> The information concerning the new person (each being a string).
+        store -> An optional ColumnStore that is updated with the new person once it has been stored in the database.
+        replica -> An optional AnalyticsReplica (see analytics.py) that is updated in the same way.
+        sketches -> Optional DomainSketches (see sketches.py) that are updated in the same way.
+        search_index -> An optional TrigramIndex (see search_index.py) that is updated in the same way.
+        email_filter -> An optional BloomFilter of the emails in the database (see create_new_people).
+        catch_up -> An optional CatchUp of the copies (see create_new_people).
+        RETURNS
+        The id of the person and True if it has been created, False if a person with the same email already exists
+        (in which case its id is returned).
+    ''' 
+
+    ''' N.B. A single person is not written through create_new_people: the same steps are done on plain Python values, since the
+        Dataframes built for one row (formatting, derived columns, summaries) cost many times the insert itself. '''
+
+    # Format strings before putting them in the database to keep format consistency (as in create_new_people)
+    person = {"first_name": first_name.title(), "last_name": last_name.title(), "email": email.lower(), "gender": gender.title(),
+              "ip_address": ip_address}
+    country = country.upper()
+
+    write_lock = _sqlite_write_lock if engine.dialect.name == "sqlite" else contextlib.nullcontext()
+    for attempt in range(2):
+        try:
+            with write_lock, stage("query"), Session(bind=engine) as session, session.begin():
+                # As in create_new_people, the filter is not trusted again after a violation of the unique index
+                id = None
+                if attempt == 1 or email_filter is None or email_filter.might_contain([person["email"]])[0]:
+                    id = session.execute(select(Person.id).where(Person.email == person["email"])).scalar()
+                if id is not None:
+                    return id, False
+                result = session.execute(insert(Person.__table__).values(**person, ip_packed=packed_ip_address(ip_address)))
+                id = result.inserted_primary_key[0]
+                session.execute(insert(Country.__table__).values(person_id=id, country=country))
+                summaries.add_person_to_summaries(session.connection(), person["email"], person["gender"], ip_address, country)
+                if catch_up is not None:
+                    # Before the commit (see create_new_people)
+                    catch_up.add([id])
+            break
+        except IntegrityError:
+            if attempt == 1:
+                raise
+
+    offload(lambda: _append_to_copies(pd.DataFrame({"id": [id], **{key: [value] for key, value in person.items()}, "country": [country]}),
+                                      store, replica, sketches, search_index, email_filter))
+    return id, True
     
-def get_people_by_country(engine, country):
+@instrumented
+def get_people_by_country(engine, country, store=None):
     '''
         This function allows to obtain the list of users given a country.
         PARAMETERS
-        engine -> A sqlalchemy engine to interact with the database.
+        engine -> A sqlalchemy engine (or connection) to interact with the database.
         country -> A string representing a country.
+        store -> An optional ColumnStore. If given, the data is read from the store instead of the database.
         RETURNS
         A Pandas Dataframe containing the information of all people from the specified country.
     '''
     country = country.upper() # Put country in upper case
 
-    Session = sessionmaker(engine)
-    with Session() as session:
-        results = session.query(Person, id == Country.person_id).join(Country).filter(Country.country == country).all()
+    if store is not None:
+        with stage("store"):
+            df = store.people_by_country(country)
+        return df if len(df) != 0 else None
+
+    with stage("query"), Session(bind=engine) as session:
+        results = session.query(Person).join(Country).filter(Country.country == country).all()
     if len(results) != 0:
-        return pd.DataFrame.from_records([p[0].to_dict() for p in results])
+        return offload(_people_frame, results)
     return None
 
-def get_people_count_by_country(engine):
+def _people_frame(people, columns=None):
+    '''
+        This function returns a Pandas Dataframe with the information of the given people (instances of Person).
+    '''
+    return pd.DataFrame.from_records([p.to_dict() for p in people], columns=columns)
+
+@instrumented
+def get_people(engine, country=None, gender=None, domain=None, ip_prefix=None, after_id=0, limit=100):
+    '''
+        This function allows to obtain a page of people matching some filters, using keyset pagination: people are sorted by id
+        and each page starts after the last id of the previous one, so that the cost of a page does not depend on its position.
+        PARAMETERS
+        engine -> A sqlalchemy engine (or connection) to interact with the database.
+        country, gender, domain, ip_prefix -> Optional filters (email domain and exact prefix of the ip address), combined in AND.
+        after_id -> The id after which the page starts (the cursor returned with the previous page, 0 for the first page).
+        limit -> The maximum number of people in the page.
+        RETURNS
+        A list of dictionaries (one for each person) and the cursor of the next page (None if this is the last page).
+    '''
+    query = select(Person.id, Person.first_name, Person.last_name, Person.email, Person.gender, Person.ip_address)\
+                .where(Person.id > after_id)
+    if country:
+        # A subquery is used instead of a join so that a person with many countries is returned only once
+        query = query.where(Person.id.in_(select(Country.person_id).where(Country.country == country.upper())))
+    if gender:
+        query = query.where(Person.gender == gender.title())
+    if domain:
+        query = query.where(Person.email_domain == domain.lower())
+    if ip_prefix:
+        query = query.where(Person.ip_address.startswith(ip_prefix, autoescape=True))
+    # One more row is requested to know whether there is a next page
+    query = query.order_by(Person.id).limit(limit + 1)
+
+    with stage("query"), Session(bind=engine) as session:
+        people = session.execute(query).mappings().all()
+    next_cursor = people[limit - 1]["id"] if len(people) > limit else None
+    return [dict(p) for p in people[:limit]], next_cursor
+
+@instrumented
+def get_people_count_by_country(engine, store=None):
     '''
         This function allows to obtain the number of users for each country.
         PARAMETERS
-        engine -> A sqlalchemy engine to interact with the database.
-        country -> A string representing a country.
+        engine -> A sqlalchemy engine (or connection) to interact with the database.
+        store -> An optional ColumnStore. If given, the data is read from the store instead of the database.
         RETURNS
         An integer representing the count of all people for each country.
     '''
-    Session = sessionmaker(engine)
-    with Session() as session:        
-        count = session.query(Country.country,func.count("*")).select_from(Person).join(Country).group_by(Country.country).all()
+    if store is not None:
+        with stage("store"):
+            count = store.count_by("country")
+    else:
+        # The counts are read from the summary table (see db_management/summaries.py)
+        with stage("query"), Session(bind=engine) as session:        
+            count = session.query(CountryCount.country, CountryCount.count).filter(CountryCount.count > 0).all()
     
     if len(count) != 0:
         df = pd.DataFrame.from_records([{"Country":p[0], "Count": p[1]} for p in count])
@@ -112,19 +357,23 @@ def get_people_count_by_country(engine):
     else:
         return None
 
-def get_people_gender_distribution(engine):
+@instrumented
+def get_people_gender_distribution(engine, store=None):
     '''
         This function allows to obtain the distribution of people over genders.
         PARAMETERS
-        engine -> A sqlalchemy engine to interact with the database.
+        engine -> A sqlalchemy engine (or connection) to interact with the database.
+        store -> An optional ColumnStore. If given, the data is read from the store instead of the database.
         RETURNS
         A Pandas Dataframe containing the information concerning the gender distribution.
     '''
     
-    Session = sessionmaker(engine)
-    
-    with Session() as session:        
-        results = session.query(Person.gender,func.count("*")).group_by(Person.gender).all()
+    if store is not None:
+        with stage("store"):
+            results = store.count_by("gender")
+    else:
+        with stage("query"), Session(bind=engine) as session:        
+            results = session.query(GenderCount.gender, GenderCount.count).filter(GenderCount.count > 0).all()
     if len(results) != 0:
         df = pd.DataFrame.from_records([{"Gender":p[0], "Count": p[1]} for p in results])
         df["Distribution (%)"] = df["Count"] / df["Count"].sum() * 100
@@ -132,33 +381,35 @@ def get_people_gender_distribution(engine):
     else:
         return None
 
-def get_ip_address_distribution_by_class(engine):
+@instrumented
+def get_ip_address_distribution_by_class(engine, store=None):
     '''
         This function allows to obtain the distribution of ip addresses over classes.
         PARAMETERS
-        engine -> A sqlalchemy engine to interact with the database.
+        engine -> A sqlalchemy engine (or connection) to interact with the database.
+        store -> An optional ColumnStore. If given, the data is read from the store instead of the database.
         RETURNS
         A Pandas Dataframe containing the information concerning the ip address class distribution.
     '''
     
-    Session = sessionmaker(engine)
-    
-    with Session() as session:        
-        results = session.query(Person.ip_address).all()
-    if len(results) != 0:
-        class_count = {"A": 0, "B": 0, "C": 0, "D": 0, "E": 0,}
-        for result in results:
-            first_number = int(result[0].split(".")[0])
-            if 0 <= first_number <= 127: 
-                class_count["A"]+=1
-            elif 128 <= first_number <= 191: 
-                class_count["B"]+=1
-            elif 192 <= first_number <= 223: 
-                class_count["C"]+=1
-            elif 224 <= first_number <= 239: 
-                class_count["D"]+=1
-            if 240 <= first_number <= 255: 
-                class_count["E"]+=1
+    if store is not None:
+        with stage("store"):
+            first_number_count = store.ip_first_octet_counts()
+    else:
+        # Retrieve the number of ip addresses for each value of the first number (IPv6 addresses have no first number and are excluded)
+        with stage("query"), Session(bind=engine) as session:        
+            results = session.query(IpFirstOctetCount.first_octet, IpFirstOctetCount.count).all()
+        first_number_count = np.zeros(256, dtype=np.int64)
+        for first_number, count in results:
+            first_number_count[first_number] = count
+
+    if first_number_count.sum() != 0:
+        # Classes are defined by the range of the first number: A [0-127], B [128-191], C [192-223], D [224-239], E [240-255]
+        class_count = {"A": first_number_count[0:128].sum(),
+                       "B": first_number_count[128:192].sum(),
+                       "C": first_number_count[192:224].sum(),
+                       "D": first_number_count[224:240].sum(),
+                       "E": first_number_count[240:256].sum()}
 
         df = pd.DataFrame(index = ["A", "B", "C", "D", "E"])
         df["Count"] = class_count.values()
@@ -168,30 +419,131 @@ def get_ip_address_distribution_by_class(engine):
     else:
         return None
 
-def get_most_common_domain(engine):
+@instrumented
+def get_ip_address_distribution(engine, by, store=None):
+    '''
+        This function allows to obtain the distribution of ip addresses over networks or ranges.
+        PARAMETERS
+        engine -> A sqlalchemy engine (or connection) to interact with the database.
+        by -> '8' or '16' (IPv4 networks with a prefix of 8 or 16 bits), 'class' (IPv4 classes) or 'range' (private, public,
+              loopback, ... see ip_index.SPECIAL_RANGES, both IPv4 and IPv6).
+        store -> An optional ColumnStore. If given, the data is read from the store instead of the database.
+        RETURNS
+        A Pandas Dataframe containing the number of addresses of each network (or range) and their distribution.
+    '''
+    if by == "class":
+        return get_ip_address_distribution_by_class(engine, store=store)
+
+    if store is not None:
+        with stage("store"):
+            counts = store.ip_range_counts() if by == "range" else store.ip_prefix_counts(int(by))
+    elif by == "8":
+        with stage("query"), Session(bind=engine) as session:
+            results = session.query(IpFirstOctetCount.first_octet, IpFirstOctetCount.count).filter(IpFirstOctetCount.count > 0).all()
+        counts = pd.Series({f"{first_octet}.0.0.0/8": count for first_octet, count in sorted(results)}, dtype=np.int64)
+    elif by == "16":
+        # The first two numbers of an IPv4 address are the bytes 13 and 14 of its key (IPv4 addresses are mapped into ::ffff:0:0/96)
+        first, last = network_range("0.0.0.0/0")
+        query = select(func.substr(Person.ip_packed, 13, 2), func.count()).where(Person.ip_packed.between(first, last))\
+                    .group_by(func.substr(Person.ip_packed, 13, 2))
+        with stage("query"), Session(bind=engine) as session:
+            results = session.execute(query).all()
+        counts = pd.Series({f"{prefix[0]}.{prefix[1]}.0.0/16": count for prefix, count in sorted(results)}, dtype=np.int64)
+    else:
+        # All the ranges are counted with a single scan, with a conditional sum for each of them (the ranges do not overlap)
+        columns = [func.sum(case((or_(*[Person.ip_packed.between(*network_range(n)) for n in networks]), 1), else_=0))
+                   for networks in SPECIAL_RANGES.values()]
+        with stage("query"), Session(bind=engine) as session:
+            total, *range_counts = session.execute(select(func.count(Person.ip_packed), *columns)).one()
+        counts = pd.Series(dict(zip(SPECIAL_RANGES, [c or 0 for c in range_counts])), dtype=np.int64)
+        counts["public"] = total - counts.sum()
+
+    if counts.sum() != 0:
+        df = pd.DataFrame({"Count": counts})
+        df["Distribution (%)"] = df["Count"] / df["Count"].sum() * 100
+        return df.sort_values("Count", ascending=False, kind="stable")
+    else:
+        return None
+
+@instrumented
+def get_people_in_network(engine, network, limit=100, store=None):
+    '''
+        This function allows to obtain the people whose ip address belongs to a network (e.g., '10.0.0.0/8' or '2001:db8::/32').
+        The addresses are found through an index (on the column 'ip_packed' or on the column store) in logarithmic time.
+        PARAMETERS
+        engine -> A sqlalchemy engine (or connection) to interact with the database.
+        network -> A string representing a network in CIDR notation (raises ValueError if not valid).
+        limit -> The maximum number of people returned.
+        store -> An optional ColumnStore. If given, the data is read from the store instead of the database.
+        RETURNS
+        The number of people in the network and a Pandas Dataframe containing the first 'limit' of them (sorted by ip address).
+    '''
+    if store is not None:
+        with stage("store"):
+            return store.people_in_network(network, limit)
+
+    first, last = network_range(network)
+    in_network = Person.ip_packed.between(first, last)
+    with stage("query"), Session(bind=engine) as session:
+        count = session.execute(select(func.count()).where(in_network)).scalar()
+        results = session.query(Person).filter(in_network).order_by(Person.ip_packed).limit(limit).all()
+    return count, offload(_people_frame, results, ["id", "first_name", "last_name", "email", "gender", "ip_address"])
+
+@instrumented
+def search_people(engine, query, limit=20, min_similarity=0.3, index=None):
+    '''
+        This function allows to search people by (partial) name or email, tolerating small typos.
+        PARAMETERS
+        engine -> A sqlalchemy engine (or connection) to interact with the database.
+        query -> The text to search.
+        limit -> The maximum number of people returned.
+        min_similarity -> The minimum similarity of the people returned (see search_index.py).
+        index -> An optional TrigramIndex. If given, the people are searched in the index instead of the database.
+        RETURNS
+        A Pandas Dataframe with columns id, first_name, last_name, email and score, sorted by score.
+    '''
+    if index is not None:
+        with stage("search_index"):
+            return index.search(query, limit, min_similarity)
+
+    # Without the index, the people containing at least a word of the query are read with a (slow) LIKE scan, without
+    # tolerating typos, and ranked as in the index
+    words = query.lower().split()
+    conditions = [field.contains(word, autoescape=True) for word in words for field in (func.lower(Person.first_name), func.lower(Person.last_name), Person.email)]
+    with stage("query"), Session(bind=engine) as session:
+        results = session.execute(select(Person.id, Person.first_name, Person.last_name, Person.email)
+                                  .where(or_(*conditions)).limit(SEARCH_FALLBACK_ROWS)).all()
+    return offload(_search_rows, results, query, limit, min_similarity)
+
+def _search_rows(rows, query, limit, min_similarity):
+    '''
+        This function searches people among the given rows (id, first_name, last_name, email) as the TrigramIndex does.
+    '''
+    matches = TrigramIndex()
+    matches.append(pd.DataFrame.from_records(rows, columns=["id", "first_name", "last_name", "email"]), merge=True)
+    return matches.search(query, limit, min_similarity)
+
+@instrumented
+def get_most_common_domain(engine, store=None):
     '''
         This function allows to obtain the most common email domain.
         PARAMETERS
-        engine -> A sqlalchemy engine to interact with the database.
+        engine -> A sqlalchemy engine (or connection) to interact with the database.
+        store -> An optional ColumnStore. If given, the data is read from the store instead of the database.
         RETURNS
         A list of the most common domains along with the maximum frequency.
     '''
     
-    Session = sessionmaker(engine)
-    
-    # Retrieve all emails from the database
-    with Session() as session:     
-        results = session.query(Person.email).all()
-    
-    if len(results) != 0:
-        domains_count = {}
-        for result in results:
-            domain = result[0].split("@")[1]
-            if domain in domains_count.keys():
-                domains_count[domain] += 1
-            else:
-                domains_count[domain] = 1
+    if store is not None:
+        with stage("store"):
+            domains_count = dict(store.count_by("domain"))
+    else:
+        # Retrieve the number of people for each domain
+        with stage("query"), Session(bind=engine) as session:     
+            results = session.query(DomainCount.domain, DomainCount.count).filter(DomainCount.count > 0).all()
+        domains_count = dict(results)
 
+    if len(domains_count) != 0:
         max_count = max(domains_count.values())
         most_common_domains = [domain for domain, count in domains_count.items() if count == max_count]
 
@@ -199,97 +551,102 @@ def get_most_common_domain(engine):
     else:
         return None, None
 
-def get_country_domain_correlation(engine):
+@instrumented
+def get_country_domain_correlation(engine, store=None):
     '''
         This function allows to obtain the country-domain correlation.
         PARAMETERS
-        engine -> A sqlalchemy engine to interact with the database.
+        engine -> A sqlalchemy engine (or connection) to interact with the database.
+        store -> An optional ColumnStore. If given, the data is read from the store instead of the database.
         RETURNS
         The correlation between country and domain computed using Cramer-V method.
     '''
     
-    Session = sessionmaker(engine)
-    
-    # Retrieve email and country for each person
-    with Session() as session:     
-        results = session.query(Person.email, Country.country).join(Country).all()
+    if store is not None:
+        with stage("store"):
+            contingency_table = store.contingency_table("domain", "country")
+        return compute_cramer_V_correlation(contingency_table) if contingency_table.n != 0 else None
+
+    # Retrieve the number of people for each pair <domain, country> (i.e., the non-zero cells of the contingency table)
+    with stage("query"), Session(bind=engine) as session:     
+        results = session.query(Person.email_domain, Country.country, func.count("*")).join(Country).group_by(Person.email_domain, Country.country).all()
     
     if len(results) != 0:
-        # Modify the returned data to obtain the pairs <domain, country>
-        df = pd.DataFrame.from_records([{"Domain":r[0], "Country": r[1]} for r in results])
-        df["Domain"] = [d.split("@")[1] for d in df["Domain"]]
-
-        contingency_table = pd.crosstab(df["Domain"], df["Country"]).to_numpy()
-
-        return compute_cramer_V_correlation(contingency_table)
+        return offload(_correlation_from_counts, results)
     else:
         return None
 
-def get_gender_domain_correlation(engine):
+@instrumented
+def get_gender_domain_correlation(engine, store=None):
     '''
         This function allows to obtain the gender-domain correlation.
         PARAMETERS
-        engine -> A sqlalchemy engine to interact with the database.
+        engine -> A sqlalchemy engine (or connection) to interact with the database.
+        store -> An optional ColumnStore. If given, the data is read from the store instead of the database.
         RETURNS
         The correlation between country and domain computed using Cramer-V method.
     '''
     
-    Session = sessionmaker(engine)
-    
-    # Retrieve email and gender for each person
-    with Session() as session:     
-        results = session.query(Person.email, Person.gender).all()
+    if store is not None:
+        with stage("store"):
+            contingency_table = store.contingency_table("domain", "gender")
+        return compute_cramer_V_correlation(contingency_table) if contingency_table.n != 0 else None
+
+    # Retrieve the number of people for each pair <domain, gender> (i.e., the non-zero cells of the contingency table)
+    with stage("query"), Session(bind=engine) as session:     
+        results = session.query(Person.email_domain, Person.gender, func.count("*")).group_by(Person.email_domain, Person.gender).all()
     
     if len(results) != 0:
-        # Modify the returned data to obtain the pairs <domain, gender>
-        df = pd.DataFrame.from_records([{"Domain":r[0], "Gender": r[1]} for r in results])
-        df["Domain"] = [d.split("@")[1] for d in df["Domain"]]
-
-        contingency_table = pd.crosstab(df["Domain"], df["Gender"]).to_numpy()
-
-        return compute_cramer_V_correlation(contingency_table)
+        return offload(_correlation_from_counts, results)
     else:
         return None
     
-def get_common_email_patterns(engine):
+@instrumented
+def get_email_pattern_counts(engine, store=None, catalogue_file=None):
+    '''
+        This function allows to obtain the number of emails matching each pattern (e.g., first_name.last_name, flast_name, first_namel) for each domain.
+        The patterns are defined in a catalogue (see email_patterns.py).
+        PARAMETERS
+        engine -> A sqlalchemy engine (or connection) to interact with the database
+        store -> An optional ColumnStore. If given, the data is read from the store instead of the database.
+        catalogue_file -> An optional path of the catalogue of patterns (the default one is used if not given).
+        RETURNS
+        A Pandas Dataframe with a row for each domain and a column for each pattern.
+    '''
+    
+    if store is not None:
+        with stage("store"):
+            first_names, last_names, emails = store.person_columns("first_name", "last_name", "email")
+        df = pd.DataFrame({"first_name": first_names, "last_name": last_names, "email": emails})
+    else:
+        # Retrieve first_name, last_name and email for each person
+        with stage("query"), Session(bind=engine) as session:     
+            results = session.execute(select(Person.first_name, Person.last_name, Person.email)).all()
+        df = offload(pd.DataFrame.from_records, results, columns=["first_name", "last_name", "email"])
+    
+    if len(df) != 0:
+        return offload(email_patterns.count_email_patterns, df, email_patterns.load_catalogue(catalogue_file))
+    else:
+        return None
+
+@instrumented
+def get_common_email_patterns(engine, store=None, pattern_counts=None):
     '''
         This function allows to obtain the most common email patterns (e.g., first_name.last_name, flast_name, first_namel).
         PARAMETERS
-        engine -> A sqlalchemy engine to interact with the database
+        engine -> A sqlalchemy engine (or connection) to interact with the database
+        store -> An optional ColumnStore. If given, the data is read from the store instead of the database.
+        pattern_counts -> An optional Dataframe returned by get_email_pattern_counts, to avoid computing it again.
         RETURNS
         The most common email patterns.
     '''
     
-    Session = sessionmaker(engine)
+    if pattern_counts is None:
+        pattern_counts = get_email_pattern_counts(engine, store)
     
-    # Retrieve first_name, last_name and email for each person
-    with Session() as session:     
-        results = session.query(Person.first_name, Person.last_name, Person.email).all()
-    
-    if len(results) != 0:
-        # Modify the returned data to obtain the tuple <first_name, last_name, email>
-        df = pd.DataFrame.from_records([{"first_name":r[0], "last_name": r[1], "email": r[2]} for r in results])
-        df["email"] = [d.split("@")[0] for d in df["email"]]
-
-        df["first_name"] = df["first_name"].str.lower()
-        df["last_name"] = df["last_name"].str.lower()
-        # Remove " ", "-", '.' and "'" from surname
-        df["last_name"] = df.apply(lambda x: x["last_name"].replace(' ','').replace('.','').replace('-','').replace("'",'') , axis=1)
-        
-        # Compute most common email patterns
-        df['firstlast'] = df.apply(lambda x: x["email"].startswith(x["first_name"]+x["last_name"]), axis=1)
-        df['lastfirst'] = df.apply(lambda x: x["email"].startswith(x["last_name"]+x["first_name"]), axis=1)
-        df['first.last'] = df.apply(lambda x: x["email"].startswith(x["first_name"]+'.'+x["last_name"]), axis=1)
-        df['last.first'] = df.apply(lambda x: x["email"].startswith(x["last_name"]+'.'+x["first_name"]), axis=1)
-        df['flast'] = df.apply(lambda x: x["email"].startswith(x["first_name"][0]+x["last_name"]), axis=1)
-        df['f.last'] = df.apply(lambda x: x["email"].startswith(x["first_name"][0]+'.'+x["last_name"]), axis=1)
-        df['firstl'] = df.apply(lambda x: x["email"].startswith(x["first_name"]+x["last_name"][0]) and not x["firstlast"], axis=1)
-        df['first.l'] = df.apply(lambda x: x["email"].startswith(x["first_name"]+'.'+x["last_name"][0]) and not x['first.last'], axis=1)
-        df['first'] = df.apply(lambda x: x["email"].startswith(x["first_name"]) and not x['first.last'] and not x['firstlast'] and not x['firstl'] and not x['first.l'], axis=1)
-        df['last'] = df.apply(lambda x: x["email"].startswith(x["last_name"]) and not x['last.first'] and not x['lastfirst'], axis=1)
-
+    if pattern_counts is not None:
         # Obtain most common patterns
-        occurrences = df.iloc[:,3:].sum().sort_values(ascending=False) 
+        occurrences = pattern_counts.sum().sort_values(ascending=False) 
         max_value = occurrences.max()
         if max_value == 0:
             return 0
@@ -304,50 +661,89 @@ def get_common_email_patterns(engine):
     else:
         return None
 
-def get_gender_country_correlation(engine):
+@instrumented
+def get_gender_country_correlation(engine, store=None):
     '''
         This function allows to obtain the gender-country correlation.
         PARAMETERS
-        engine -> A sqlalchemy engine to interact with the database.
+        engine -> A sqlalchemy engine (or connection) to interact with the database.
+        store -> An optional ColumnStore. If given, the data is read from the store instead of the database.
         RETURNS
         The correlation between country and domain computed using Cramer-V method.
     '''
     
-    Session = sessionmaker(engine)
-    
-    # Retrieve country and gender for each person
-    with Session() as session:     
-        results = session.query(Person.gender, Country.country).join(Country).all()
+    if store is not None:
+        with stage("store"):
+            contingency_table = store.contingency_table("gender", "country")
+        return compute_cramer_V_correlation(contingency_table) if contingency_table.n != 0 else None
 
-    if len(results) != 0:
-        df = pd.DataFrame.from_records([{"Gender": r[0], "Country": r[1] } for r in results])
+    # Retrieve the number of people for each pair <gender, country> (i.e., the non-zero cells of the contingency table)
+    with stage("query"), Session(bind=engine) as session:     
+        results = session.query(CountryGenderCount.gender, CountryGenderCount.country, CountryGenderCount.count).filter(CountryGenderCount.count > 0).all()
 
-        contingency_table = pd.crosstab(df["Gender"], df["Country"]).to_numpy()
-
-        return compute_cramer_V_correlation(contingency_table)
+    if len(results) != 0:
+        return offload(_correlation_from_counts, results)
     else:
         return None
 
-def get_gender_distribution_by_country(engine):
+@instrumented
+def get_gender_distribution_by_country(engine, store=None):
     '''
         This function allows to obtain the gender distribution over countries.
         PARAMETERS
-        engine -> A sqlalchemy engine to interact with the database.
+        engine -> A sqlalchemy engine (or connection) to interact with the database.
+        store -> An optional ColumnStore. If given, the data is read from the store instead of the database.
         RETURNS
         A Pandas Dataframe containing the information concerning the gender distribution.
     '''
     
-    Session = sessionmaker(engine)
-    
-    with Session() as session:        
-        results = session.query(Country.country,Person.gender,func.count("*")).join(Country).group_by(Country.country,Person.gender).all()
+    if store is not None:
+        with stage("store"):
+            results = store.count_by("country", "gender")
+    else:
+        with stage("query"), Session(bind=engine) as session:        
+            results = session.query(CountryGenderCount.country, CountryGenderCount.gender, CountryGenderCount.count).filter(CountryGenderCount.count > 0).all()
     
     if len(results) != 0:
-        df = pd.DataFrame.from_records([{"Country": p[0], "Gender": p[1], "Count": p[2]} for p in results])
-        counts = df.groupby("Country")['Count'].sum()
+        return offload(_gender_distribution_by_country, results)
+    else:
+        return None
+
+def _gender_distribution_by_country(results):
+    '''
+        This function computes the gender distribution of each country from the triples <country, gender, count>.
+    '''
+    df = pd.DataFrame.from_records([{"Country": p[0], "Gender": p[1], "Count": p[2]} for p in results])
+    counts = df.groupby("Country")['Count'].sum()
 
-        df["Distribution (%)"] = df.apply(lambda x: x["Count"]/counts[x["Country"]]* 100, axis=1)
+    df["Distribution (%)"] = df.apply(lambda x: x["Count"]/counts[x["Country"]]* 100, axis=1)
 
-        return df.sort_values("Country")
+    return df.sort_values("Country")
+
+@instrumented
+def get_association_matrix(engine, attributes, n_bootstrap=0, confidence=0.95, store=None):
+    '''
+        This function allows to obtain the correlation between each pair of a set of attributes, reading the attributes only once.
+        PARAMETERS
+        engine -> A sqlalchemy engine (or connection) to interact with the database.
+        attributes -> A list of attributes among country, gender, domain, ip_class and tld (top level domain of the email).
+        n_bootstrap -> The number of bootstrap replicates used to compute the confidence intervals (0 to skip them).
+        confidence -> The confidence level of the intervals.
+        store -> An optional ColumnStore. If given, the data is read from the store instead of the database.
+        RETURNS
+        A Pandas Dataframe with the correlation (Cramer-V method) of each pair of attributes and a dictionary with the confidence
+        interval of each pair (None, None if there is no data).
+    '''
+    if store is not None:
+        with stage("store"):
+            codes = AttributeCodes.from_store(store)
     else:
-        return None
+        # A single query returns all the attributes (a row for each pair <person, country>, people without a country included)
+        with stage("query"), Session(bind=engine) as session:
+            results = session.execute(select(Person.id, Country.country, Person.gender, Person.email_domain, Person.ip_first_octet).outerjoin(Country)).all()
+        codes = offload(lambda: AttributeCodes.from_frame(pd.DataFrame.from_records(results, columns=["id", "country", "gender", "email_domain", "ip_first_octet"])))
+
+    if len(codes.person_row) == 0:
+        return None, None
+    with stage("statistics"):
+        return offload(association_matrix, codes, list(attributes), n_bootstrap, confidence)
@@ -0,0 +1,204 @@
+'''
+This file contains the computation of the association matrix (Cramer's V) between all the pairs of a set of categorical attributes
+(country, gender, email domain, ip address class and top level domain), along with bootstrap confidence intervals.
+The attributes are read once and encoded as integers; the bootstrap resamples each contingency table from a multinomial
+distribution (only the non-zero cells can be drawn), computing the Cramer's V of many replicates at once with NumPy.
+The replicates are spread across a pool of processes.
+'''
+import os
+import multiprocessing
+import concurrent.futures
+import numpy as np
+import pandas as pd
+from contingency import SparseContingencyTable
+
+ATTRIBUTES = ("country", "gender", "domain", "ip_class", "tld")
+# First number of the first address of the classes B, C, D and E
+IP_CLASS_BOUNDARIES = [128, 192, 224, 240]
+# Maximum number of values (replicates x non-zero cells) resampled at once, to bound the memory used by the bootstrap
+BOOTSTRAP_BATCH_CELLS = 2000000
+# Below this number of values the bootstrap is computed in the current process (the pool would only add overhead)
+PARALLEL_MIN_CELLS = 5000000
+
+_executor = None
+
+def bootstrap_processes():
+    '''
+        This function returns the number of processes used for the bootstrap, which can be set with 'bootstrap_processes'
+        in the .env file (default: the number of CPUs).
+    '''
+    return int(os.environ.get('bootstrap_processes', os.cpu_count() or 1))
+
+def get_executor():
+    '''
+        This function returns the pool of processes used for the bootstrap, creating it when first needed.
+    '''
+    global _executor
+    if _executor is None:
+        # Started with 'spawn' as the workers of the jobs (see jobs.py): forking the api process would copy its threads in an
+        # inconsistent state
+        _executor = concurrent.futures.ProcessPoolExecutor(max_workers=bootstrap_processes(), mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(cancel_futures=True)
+        _executor = None
+
+def ip_class_codes(first_octets):
+    '''
+        This function converts the first numbers of the ip addresses into the codes of their classes (0 for A, ..., 4 for E).
+        Missing values (i.e., IPv6 addresses), represented by negative numbers, are encoded as -1.
+    '''
+    first_octets = np.asarray(first_octets, dtype=np.int64)
+    return np.where(first_octets >= 0, np.searchsorted(IP_CLASS_BOUNDARIES, first_octets, side="right"), -1)
+
+class AttributeCodes:
+    '''
+        This class contains the integer codes of the categorical attributes, with a row for each pair <person, country>
+        (as in the left outer join between 'person' and 'country').
+        As in the functions computing a single correlation, the pairs involving the country use all the rows of people having a country,
+        while the other pairs use a single row for each person.
+    '''
+    def __init__(self, codes, person_row):
+        self.codes = codes
+        self.person_row = person_row
+
+    @classmethod
+    def from_frame(cls, frame):
+        '''
+            This function encodes the attributes read from the database.
+
+            PARAMETERS
+            frame -> A Pandas Dataframe with columns id, country, gender, email_domain and ip_first_octet (left outer join of 'person' and 'country').
+        '''
+        domain_codes, domains = pd.factorize(frame["email_domain"])
+        codes = {"country": pd.factorize(frame["country"])[0],
+                 "gender": pd.factorize(frame["gender"])[0],
+                 "domain": domain_codes,
+                 "ip_class": ip_class_codes(pd.to_numeric(frame["ip_first_octet"]).fillna(-1)),
+                 "tld": cls._tld_codes(domain_codes, domains)}
+        return cls(codes, ~frame["id"].duplicated().to_numpy())
+
+    @classmethod
+    def from_store(cls, store):
+        '''
+            This function reads the codes of the attributes from a ColumnStore.
+        '''
+        columns = store.join_columns("country", "gender", "domain", "ip", "person_row")
+        codes = {"country": columns["country"],
+                 "gender": columns["gender"],
+                 "domain": columns["domain"],
+                 "ip_class": ip_class_codes(np.where(columns["ip"] >= 0, columns["ip"] >> 24, -1)),
+                 "tld": cls._tld_codes(columns["domain"], store.dictionaries["domain"].values)}
+        return cls(codes, columns["person_row"])
+
+    @staticmethod
+    def _tld_codes(domain_codes, domains):
+        # The top level domain is computed once for each distinct domain
+        tld_of_domain, _ = pd.factorize(pd.Series(list(domains), dtype=object).str.rsplit(".", n=1).str[-1])
+        tld_of_domain = np.append(tld_of_domain, -1) # Index -1 (missing domain) is mapped to -1
+        return tld_of_domain[np.asarray(domain_codes)]
+
+    def contingency_table(self, row_attribute, column_attribute):
+        rows, columns = self.codes[row_attribute], self.codes[column_attribute]
+        mask = rows >= 0 if "country" in (row_attribute, column_attribute) else self.person_row.copy()
+        mask &= (rows >= 0) & (columns >= 0)
+        return SparseContingencyTable.from_codes(rows[mask], columns[mask])
+
+def cramer_v_replicates(rows, columns, counts, n_replicates, seed):
+    '''
+        This function computes the Cramer's V (with bias correction, as compute_cramer_V_correlation) of bootstrap replicates of a table.
+
+        PARAMETERS
+        rows, columns, counts -> The non-zero cells of the contingency table (see SparseContingencyTable).
+        n_replicates -> The number of replicates.
+        seed -> The seed of the random generator.
+
+        RETURNS
+        A NumPy array with the Cramer's V of each replicate.
+    '''
+    random = np.random.default_rng(seed)
+    n = int(counts.sum())
+    probabilities = counts / n
+    # Cells sorted by row (and by column) so that the sums can be computed with np.add.reduceat
+    row_order = np.argsort(rows, kind="stable")
+    row_starts = np.flatnonzero(np.r_[True, np.diff(rows[row_order]) != 0])
+    column_order = np.argsort(columns, kind="stable")
+    column_starts = np.flatnonzero(np.r_[True, np.diff(columns[column_order]) != 0])
+    _, cell_rows = np.unique(rows, return_inverse=True)
+    _, cell_columns = np.unique(columns, return_inverse=True)
+
+    values = np.empty(n_replicates)
+    batch_size = max(1, BOOTSTRAP_BATCH_CELLS // len(counts))
+    for start in range(0, n_replicates, batch_size):
+        samples = random.multinomial(n, probabilities, size=min(batch_size, n_replicates - start)).astype(np.float64)
+        row_sums = np.add.reduceat(samples[:, row_order], row_starts, axis=1)
+        column_sums = np.add.reduceat(samples[:, column_order], column_starts, axis=1)
+        expected = row_sums[:, cell_rows] * column_sums[:, cell_columns] / n
+        with np.errstate(divide="ignore", invalid="ignore"):
+            chi2 = np.where(samples > 0, samples ** 2 / expected, 0).sum(axis=1) - n
+            # Rows and columns without observations are dropped, as it happens for the original table
+            r = (row_sums > 0).sum(axis=1)
+            k = (column_sums > 0).sum(axis=1)
+            phi2_tilde = np.maximum(0, chi2 / n - (k - 1) * (r - 1) / (n - 1))
+            k_tilde = k - (k - 1) ** 2 / (n - 1)
+            r_tilde = r - (r - 1) ** 2 / (n - 1)
+            cramer_v = np.sqrt(phi2_tilde / np.minimum(k_tilde - 1, r_tilde - 1))
+        values[start:start + len(samples)] = np.where((k_tilde == 1) | (r_tilde == 1), 1, cramer_v)
+    return values
+
+def association_matrix(attribute_codes, attributes, n_bootstrap=0, confidence=0.95, seed=None, parallel=True):
+    '''
+        This function computes the association matrix of a set of attributes.
+
+        PARAMETERS
+        attribute_codes -> An AttributeCodes.
+        attributes -> A list of names of attributes (see ATTRIBUTES).
+        n_bootstrap -> The number of bootstrap replicates used to compute the confidence intervals (0 to skip them).
+        confidence -> The confidence level of the intervals.
+        seed -> An optional seed of the bootstrap.
+        parallel -> If False, the bootstrap is always computed in the current process.
+
+        RETURNS
+        A tuple (matrix, intervals): matrix is a Pandas Dataframe with the Cramer's V of each pair of attributes, while intervals
+        is a dictionary {(attribute 1, attribute 2): (lower bound, upper bound)} (empty if n_bootstrap is 0).
+        Pairs without data have correlation NaN (and no interval).
+    '''
+    # Imported here since api_functionalities imports this file
+    from api_functionalities import compute_cramer_V_correlation
+
+    matrix = pd.DataFrame(1.0, index=attributes, columns=attributes)
+    tables = {}
+    for i, a in enumerate(attributes):
+        for b in attributes[i + 1:]:
+            table = attribute_codes.contingency_table(a, b)
+            if table.n > 1:
+                tables[(a, b)] = table
+            matrix.loc[a, b] = matrix.loc[b, a] = float(compute_cramer_V_correlation(table)) if table.n != 0 else np.nan
+
+    intervals = {}
+    if n_bootstrap > 0 and tables:
+        seeds = np.random.SeedSequence(seed).spawn(len(tables))
+        total_cells = n_bootstrap * sum(table.nnz for table in tables.values())
+        if parallel and bootstrap_processes() > 1 and total_cells >= PARALLEL_MIN_CELLS:
+            # Each pair is split in chunks of replicates, so that all the processes are used even with few pairs
+            executor = get_executor()
+            n_chunks = max(1, bootstrap_processes() // len(tables))
+            chunk_sizes = [len(chunk) for chunk in np.array_split(np.arange(n_bootstrap), n_chunks) if len(chunk)]
+            futures = {pair: [executor.submit(cramer_v_replicates, table.rows, table.columns, table.counts, size, chunk_seed)
+                              for size, chunk_seed in zip(chunk_sizes, pair_seed.spawn(len(chunk_sizes)))]
+                       for (pair, table), pair_seed in zip(tables.items(), seeds)}
+            replicates = {pair: np.concatenate([f.result() for f in pair_futures]) for pair, pair_futures in futures.items()}
+        else:
+            replicates = {pair: cramer_v_replicates(table.rows, table.columns, table.counts, n_bootstrap, pair_seed)
+                          for (pair, table), pair_seed in zip(tables.items(), seeds)}
+        # The Cramer's V of the resampled tables is biased upwards (the resampling adds noise to tables that are often sparse),
+        # so the percentile interval is shifted by the bias estimated with the bootstrap itself
+        alpha = (1 - confidence) / 2
+        for (a, b), values in replicates.items():
+            bias = values.mean() - matrix.loc[a, b]
+            lower, upper = np.clip(np.quantile(values, [alpha, 1 - alpha]) - bias, 0, 1)
+            intervals[(a, b)] = (float(lower), float(upper))
+    return matrix, intervals
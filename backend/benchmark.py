@@ -0,0 +1,254 @@
+'''
+This file contains a benchmark of the functionalities in api_functionalities.py and of the loading of the data (initialize_db.py).
+For each requested size, a synthetic dataset (see synthetic_data.py) is written to csv files and loaded into a local SQLite database,
+then every functionality is executed both on the database and on the column store. Wall time, peak memory and rows/sec are saved
+in a JSON file, which can be compared with the one of a previous version to find regressions.
+
+Example: python benchmark.py --rows 10000 100000 1000000 --compare benchmark_results/previous.json
+'''
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import sqlalchemy
+import api_functionalities
+import associations
+import initialize_db
+from column_store import ColumnStore
+from search_index import TrigramIndex
+from synthetic_data import SyntheticDataGenerator
+
+DEFAULT_ROWS = [10000, 100000, 1000000]
+# Above this number of people export_data_to_db (which creates an ORM object for each row) is not executed
+DEFAULT_EXPORT_LIMIT = 100000
+# Number of people inserted by each execution of create_new_people
+WRITE_BATCH_SIZE = 1000
+# A function is reported as a regression when its wall time grows more than this ratio
+DEFAULT_REGRESSION_THRESHOLD = 1.2
+
+def measure(function, repeat=3, setup=None):
+    '''
+        This function measures the execution of a function.
+
+        PARAMETERS
+        function -> A function without parameters (or with the result of setup as only parameter, if setup is given).
+        repeat -> The number of timed executions (the fastest one is reported).
+        setup -> An optional function without parameters executed (and not timed) before each execution, whose result is passed to function.
+
+        RETURNS
+        A dictionary with the wall time in seconds and the peak memory in bytes allocated by Python (measured with tracemalloc
+        in an additional execution, so that tracing does not slow down the timed ones).
+    '''
+    if setup is None:
+        setup, call = (lambda: None), (lambda argument: function())
+    else:
+        call = function
+
+    wall_times = []
+    for _ in range(repeat):
+        argument = setup()
+        start = time.perf_counter()
+        call(argument)
+        wall_times.append(time.perf_counter() - start)
+
+    argument = setup()
+    tracemalloc.start()
+    try:
+        call(argument)
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"wall_time": min(wall_times), "peak_memory": peak_memory}
+
+def read_benchmarks(engine, store, index, country):
+    '''
+        This function returns the read functionalities to measure, as tuples (name, backend, function without parameters).
+        Each functionality supporting the column store is measured on both the backends, and the search on the database and on
+        the trigram index.
+    '''
+    benchmarks = [("get_people", "database", lambda: api_functionalities.get_people(engine, country=country, limit=100)),
+                  ("ColumnStore.from_engine", "database", lambda: ColumnStore.from_engine(engine)),
+                  ("TrigramIndex.from_engine", "database", lambda: TrigramIndex.from_engine(engine))]
+    functionalities = {"get_people_by_country": lambda s: api_functionalities.get_people_by_country(engine, country, store=s),
+                       "get_people_count_by_country": lambda s: api_functionalities.get_people_count_by_country(engine, store=s),
+                       "get_people_gender_distribution": lambda s: api_functionalities.get_people_gender_distribution(engine, store=s),
+                       "get_ip_address_distribution_by_class": lambda s: api_functionalities.get_ip_address_distribution_by_class(engine, store=s),
+                       "get_ip_address_distribution(by=range)": lambda s: api_functionalities.get_ip_address_distribution(engine, "range", store=s),
+                       "get_ip_address_distribution(by=8)": lambda s: api_functionalities.get_ip_address_distribution(engine, "8", store=s),
+                       "get_ip_address_distribution(by=16)": lambda s: api_functionalities.get_ip_address_distribution(engine, "16", store=s),
+                       "get_people_in_network": lambda s: api_functionalities.get_people_in_network(engine, "10.0.0.0/8", store=s),
+                       "get_most_common_domain": lambda s: api_functionalities.get_most_common_domain(engine, store=s),
+                       "get_country_domain_correlation": lambda s: api_functionalities.get_country_domain_correlation(engine, store=s),
+                       "get_gender_domain_correlation": lambda s: api_functionalities.get_gender_domain_correlation(engine, store=s),
+                       "get_email_pattern_counts": lambda s: api_functionalities.get_email_pattern_counts(engine, store=s),
+                       "get_common_email_patterns": lambda s: api_functionalities.get_common_email_patterns(engine, store=s),
+                       "get_gender_country_correlation": lambda s: api_functionalities.get_gender_country_correlation(engine, store=s),
+                       "get_gender_distribution_by_country": lambda s: api_functionalities.get_gender_distribution_by_country(engine, store=s),
+                       "get_association_matrix": lambda s: api_functionalities.get_association_matrix(engine, associations.ATTRIBUTES, store=s)}
+    for name, functionality in functionalities.items():
+        benchmarks.append((name, "database", lambda f=functionality: f(None)))
+        benchmarks.append((name, "column_store", lambda f=functionality: f(store)))
+    # A part of the last name of a person, with a typo (the search tolerates it, see search_index.py)
+    query = str(store.person_columns("last_name")[0][0])[:6] + "x"
+    benchmarks.append(("search_people", "database", lambda: api_functionalities.search_people(engine, query)))
+    benchmarks.append(("search_people", "search_index", lambda: api_functionalities.search_people(engine, query, index=index)))
+    contingency_table = store.contingency_table("domain", "country")
+    benchmarks.append(("compute_cramer_V_correlation", "column_store", lambda: api_functionalities.compute_cramer_V_correlation(contingency_table)))
+    return benchmarks
+
+def benchmark_size(n_people, work_dir, generator, repeat=3, export_limit=DEFAULT_EXPORT_LIMIT):
+    '''
+        This function runs all the benchmarks on a synthetic dataset.
+
+        PARAMETERS
+        n_people -> The number of people of the dataset.
+        work_dir -> The folder where the csv files and the SQLite databases are created.
+        generator -> The SyntheticDataGenerator used to create the data.
+        repeat -> The number of timed executions of each function.
+        export_limit -> The maximum number of people for which export_data_to_db is measured.
+
+        RETURNS
+        A list of dictionaries, one for each measured function.
+    '''
+    persons_data_file = os.path.join(work_dir, f"persons_{n_people}.csv")
+    countries_data_file = os.path.join(work_dir, f"countries_{n_people}.csv")
+    start = time.perf_counter()
+    _, n_countries = generator.write_csv(n_people, persons_data_file, countries_data_file)
+    print(f"[{n_people} people] Synthetic data generated in {time.perf_counter() - start:.1f}s ({n_countries} countries)")
+
+    results = []
+    def record(name, backend, measures, processed_rows):
+        result = {"rows": n_people, "function": name, "backend": backend, **measures,
+                  "rows_per_sec": processed_rows / measures["wall_time"] if measures["wall_time"] > 0 else None}
+        results.append(result)
+        print(f"[{n_people} people] {name} ({backend}): {result['wall_time']:.4f}s, {result['peak_memory'] / 2**20:.1f} MiB")
+
+    def new_database(name):
+        path = os.path.join(work_dir, f"{name}_{n_people}.db")
+        if os.path.exists(path):
+            os.remove(path)
+        return sqlalchemy.create_engine(f"sqlite:///{path}")
+
+    # Loading of the data (each execution needs an empty database, created in the setup)
+    engines = []
+    def empty_database():
+        engines.append(new_database(f"bulk_{len(engines)}"))
+        return engines[-1]
+    measures = measure(lambda engine: initialize_db.bulk_export_data_to_db(engine, persons_data_file, countries_data_file),
+                       repeat=1, setup=empty_database)
+    record("bulk_export_data_to_db", "database", measures, n_people + n_countries)
+    for engine in engines[1:]:
+        engine.dispose()
+        os.remove(engine.url.database)
+    engine = engines[0]
+
+    if n_people <= export_limit:
+        # N.B. keep_default_na is set to 'False' since in the data there is a country named 'NA' which otherwise is considered as NaN
+        data = {"person": pd.read_csv(persons_data_file, sep=",", keep_default_na=False),
+                "country": pd.read_csv(countries_data_file, sep=",", keep_default_na=False)}
+        export_engines = []
+        def empty_export_database():
+            export_engines.append(new_database(f"export_{len(export_engines)}"))
+            return export_engines[-1]
+        measures = measure(lambda export_engine: initialize_db.export_data_to_db(export_engine, data), repeat=1, setup=empty_export_database)
+        record("export_data_to_db", "database", measures, n_people + n_countries)
+        for export_engine in export_engines:
+            export_engine.dispose()
+            os.remove(export_engine.url.database)
+
+    store = ColumnStore.from_engine(engine)
+    index = TrigramIndex.from_engine(engine)
+    country = pd.read_csv(countries_data_file, sep=",", keep_default_na=False, usecols=["country"])["country"].mode()[0]
+    for name, backend, function in read_benchmarks(engine, store, index, country):
+        record(name, backend, measure(function, repeat), n_people)
+
+    # Writes are measured last since they change the data
+    next_id = [n_people + 1]
+    def new_people():
+        people = generator.people(next_id[0], WRITE_BATCH_SIZE).drop(columns="id")
+        next_id[0] += WRITE_BATCH_SIZE
+        return people.assign(country=generator.sample_countries(WRITE_BATCH_SIZE))
+    for backend, s in (("database", None), ("column_store", store)):
+        record("create_new_people", backend, measure(lambda people: api_functionalities.create_new_people(engine, people, store=s), repeat, setup=new_people), WRITE_BATCH_SIZE)
+        record("create_new_person", backend, measure(lambda people: api_functionalities.create_new_person(engine, *people.iloc[0], store=s), repeat, setup=new_people), 1)
+
+    engine.dispose()
+    for data_file in (persons_data_file, countries_data_file, engine.url.database):
+        os.remove(data_file)
+    return results
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_results(results, previous_results, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    '''
+        This function compares the wall times of two executions of the benchmark.
+
+        PARAMETERS
+        results, previous_results -> The lists of results of the two executions (as saved in the JSON files).
+        threshold -> The ratio between the wall times above which a function is reported as a regression.
+
+        RETURNS
+        A Pandas Dataframe with a row for each function measured in both the executions.
+    '''
+    keys = ["rows", "function", "backend"]
+    current = pd.DataFrame(results)[keys + ["wall_time"]]
+    previous = pd.DataFrame(previous_results)[keys + ["wall_time"]]
+    df = current.merge(previous, on=keys, suffixes=("", "_previous"))
+    df["ratio"] = df["wall_time"] / df["wall_time_previous"]
+    df["regression"] = df["ratio"] > threshold
+    return df.sort_values(["rows", "ratio"], ascending=[True, False])
+
+def run_benchmark(rows=DEFAULT_ROWS, work_dir="benchmark_results", output=None, repeat=3, export_limit=DEFAULT_EXPORT_LIMIT, seed=0):
+    '''
+        This function runs the benchmark for each size and saves the results in a JSON file.
+
+        RETURNS
+        A dictionary with the results and the information on the environment where they were measured.
+    '''
+    os.makedirs(work_dir, exist_ok=True)
+    generator = SyntheticDataGenerator(seed=seed)
+    report = {"date": datetime.datetime.now().isoformat(timespec="seconds"),
+              "git_commit": _git_commit(),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "libraries": {"numpy": np.__version__, "pandas": pd.__version__, "sqlalchemy": sqlalchemy.__version__},
+              "repeat": repeat,
+              "results": []}
+    for n_people in rows:
+        report["results"].extend(benchmark_size(n_people, work_dir, generator, repeat, export_limit))
+
+    output = output or os.path.join(work_dir, f"benchmark_{datetime.datetime.now():%Y%m%d_%H%M%S}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved in {output}")
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the functionalities on synthetic datasets of increasing size.")
+    parser.add_argument("--rows", type=int, nargs="+", default=DEFAULT_ROWS, help="number of people of each dataset (e.g., 10000 100000 10000000)")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed executions of each function (the fastest one is reported)")
+    parser.add_argument("--work-dir", default="benchmark_results", help="folder for the synthetic data, the SQLite databases and the results")
+    parser.add_argument("--output", help="path of the JSON file with the results")
+    parser.add_argument("--export-limit", type=int, default=DEFAULT_EXPORT_LIMIT, help="maximum number of people for which export_data_to_db is measured")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic data generator")
+    parser.add_argument("--compare", help="JSON file of a previous execution to compare the results with")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD, help="wall time ratio reported as a regression (with --compare)")
+    args = parser.parse_args()
+
+    report = run_benchmark(args.rows, args.work_dir, args.output, args.repeat, args.export_limit, args.seed)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            previous_report = json.load(f)
+        comparison = compare_results(report["results"], previous_report["results"], args.threshold)
+        print(comparison.to_string(index=False))
+        print(f"{int(comparison['regression'].sum())} regressions (wall time more than {args.threshold}x the one of {previous_report.get('git_commit')})")
@@ -0,0 +1,121 @@
+'''
+This file contains the cache used to store the responses of the analytics endpoints.
+Responses are cached until the data changes: every successful write bumps a data version, which invalidates all the entries.
+Each response carries an ETag derived from the data version, so that clients polling an endpoint receive '304 Not Modified'
+(without any computation) as long as the data does not change. Responses are encoded in the format requested by the client
+(see formats.py), which is part of the key of the cache.
+N.B. The data version is kept in memory, so each uvicorn worker has its own cache and only sees the writes it handles itself.
+The ETag also contains an id drawn when the cache is created, so that the same ETag is never sent by two workers (or by the same
+worker before and after a restart) for responses computed on different data: a client switching worker gets the full response.
+The requests with the header X-Read-Your-Writes (see database.py) are always computed again.
+'''
+import functools
+import hashlib
+import inspect
+import threading
+import uuid
+from collections import OrderedDict
+from fastapi import Request, Response, HTTPException
+import formats
+from database import read_your_writes_var
+
+class ResultCache:
+    '''
+        This class implements a LRU cache of rendered responses, bounded both in number of entries and in total size.
+    '''
+    def __init__(self, max_entries=256, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.data_version = 0
+        self.instance_id = uuid.uuid4().hex[:12] # Different in each process, since the data versions restart from 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def bump_version(self):
+        '''
+            This function must be called after every successful write: all the cached responses become stale.
+        '''
+        with self._lock:
+            self.data_version += 1
+            self._entries.clear()
+            self._size = 0
+
+    def etag(self, key, version):
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:16]
+        return f'"{self.instance_id}-{version}-{digest}"'
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry, version):
+        body = entry[0]
+        with self._lock:
+            if version != self.data_version or len(body) > self.max_bytes:
+                return # The data changed while the response was computed, or the response is too large to be cached
+            if key in self._entries:
+                self._size -= len(self._entries.pop(key)[0])
+            self._entries[key] = entry
+            self._size += len(body)
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False) # Least recently used entry
+                self._size -= len(evicted[0])
+
+    async def respond(self, request, key, compute):
+        '''
+            This function returns the response for a request, using the cache when possible.
+
+            PARAMETERS
+            request -> The FastAPI request (used to read the headers If-None-Match and Accept, and the parameter 'format').
+            key -> A hashable key identifying the endpoint and its arguments.
+            compute -> A coroutine function without parameters returning the content of the response.
+
+            RETURNS
+            A FastAPI Response (with status 304 if the client already has the current version of the response).
+        '''
+        try:
+            format = formats.negotiate(request)
+        except formats.UnsupportedFormat as e:
+            raise HTTPException(status_code=406, detail=str(e))
+        key = (key, format)
+        if read_your_writes_var.get():
+            # The reads pinned to the primary database are not cached: the cache of this process is invalidated by the writes handled
+            # by the other processes only after the next catch-up (see catch_up.py), so it may not contain the writes the client wants to read
+            body, media_type = formats.render(await compute(), format)
+            return Response(content=body, media_type=media_type, headers={"Cache-Control": "no-cache", "Vary": "Accept"})
+        version = self.data_version
+        etag = self.etag(key, version)
+        headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+
+        entry = self.get(key)
+        if entry is None:
+            entry = formats.render(await compute(), format)
+            self.put(key, entry, version)
+        body, media_type = entry
+        return Response(content=body, media_type=media_type, headers=headers)
+
+def cached(cache):
+    '''
+        This decorator caches the responses of an asynchronous endpoint, using its name and arguments as key.
+        The decorated function gets an additional 'request' parameter, which FastAPI fills with the current request, and the
+        optional parameter 'format' (see formats.py), read from the request by ResultCache.respond.
+    '''
+    def decorator(endpoint):
+        signature = inspect.signature(endpoint)
+
+        @functools.wraps(endpoint)
+        async def wrapper(request: Request, format: str = None, **kwargs):
+            key = (endpoint.__name__, tuple(sorted(kwargs.items())))
+            return await cache.respond(request, key, lambda: endpoint(**kwargs))
+
+        request_parameter = inspect.Parameter("request", inspect.Parameter.KEYWORD_ONLY, annotation=Request)
+        format_parameter = inspect.Parameter("format", inspect.Parameter.KEYWORD_ONLY, annotation=str, default=None)
+        wrapper.__signature__ = signature.replace(parameters=[request_parameter] + [p.replace(kind=inspect.Parameter.KEYWORD_ONLY) for p in signature.parameters.values()] + [format_parameter])
+        return wrapper
+    return decorator
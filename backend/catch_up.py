@@ -0,0 +1,89 @@
+'''
+This file keeps the in-memory copies of the data of a process (column store, sketches, search index, email filter and analytics copy)
+up to date with the people created by the other processes (e.g., the other workers of the api), which append the new people only
+to their own copies.
+The copies are loaded up to the same id (the greatest one when the process starts, the watermark); then the people with a greater id
+are read periodically from the database and the ones not in the copies yet are appended.
+The ids are assigned when the rows are inserted, but the transactions of the other processes may be committed in a different order:
+a missing id below an id already read may still appear, so the watermark does not move past it until 'gap_timeout' seconds have
+passed (the ids of the transactions rolled back are never used).
+'''
+import threading
+import time
+import numpy as np
+import pandas as pd
+from sqlalchemy import select, func
+from database import Session
+from db_management.db_entities import Person, Country
+
+class CatchUp:
+    '''
+        This class keeps the watermark of the copies of a process and the ids greater than the watermark already in the copies.
+    '''
+    def __init__(self, watermark=0, gap_timeout=60.0):
+        self.watermark = watermark
+        self.gap_timeout = gap_timeout
+        self._known = set() # Ids greater than the watermark already in the copies (or used by a transaction of this process)
+        self._gaps = {} # First missing id of each gap -> (last missing id, time when the gap has been found)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_engine(cls, engine, gap_timeout=60.0):
+        '''
+            This function creates the catch-up of copies to be loaded with all the people currently in the database.
+
+            PARAMETERS
+            engine -> A sqlalchemy engine (or connection) to interact with the database.
+            gap_timeout -> The number of seconds after which a missing id is considered rolled back.
+        '''
+        with Session(bind=engine) as session:
+            watermark = session.execute(select(func.coalesce(func.max(Person.id), 0))).scalar()
+        return cls(int(watermark), gap_timeout)
+
+    def add(self, ids):
+        '''
+            This function records the ids of the people appended to the copies by this process, so that they are not appended again.
+            It must be called before the transaction inserting them is committed (i.e., before the other processes can read them).
+        '''
+        with self._lock:
+            self._known.update(int(id) for id in ids if id > self.watermark)
+
+    def new_people(self, engine):
+        '''
+            This function reads the people of the database not in the copies yet and moves the watermark forward.
+
+            PARAMETERS
+            engine -> A sqlalchemy engine (or connection) to interact with the database.
+
+            RETURNS
+            A Pandas DataFrame with columns id, first_name, last_name, email, gender, ip_address and country (one row for each pair
+            <person, country>, a missing country being None), ordered by id.
+        '''
+        query = select(Person.id, Person.first_name, Person.last_name, Person.email, Person.gender, Person.ip_address, Country.country)\
+                    .outerjoin(Country).where(Person.id > self.watermark).order_by(Person.id)
+        with Session(bind=engine) as session:
+            result = session.execute(query)
+            people = pd.DataFrame.from_records(result.all(), columns=list(result.keys()))
+        ids = people["id"].to_numpy(dtype=np.int64)
+        with self._lock:
+            people = people[~np.isin(ids, np.fromiter(self._known, dtype=np.int64, count=len(self._known)))]
+            self._known.update(ids.tolist())
+            self._advance(time.monotonic())
+        return people.reset_index(drop=True)
+
+    def _advance(self, now):
+        # The watermark moves through the consecutive known ids and the gaps found more than gap_timeout seconds ago. Every gap is timed
+        # from when it has been found (even if a gap before it blocks the watermark), and the ids of a gap partly filled afterwards
+        # keep that time
+        gaps, watermark, blocked, previous = {}, self.watermark, False, self.watermark
+        for id in sorted(self._known):
+            if id > previous + 1:
+                found = next((found for start, (end, found) in self._gaps.items() if start <= previous + 1 <= end), now)
+                gaps[previous + 1] = (id - 1, found)
+                blocked = blocked or now - found < self.gap_timeout
+            if not blocked:
+                watermark = id
+            previous = id
+        self.watermark = watermark
+        self._known = {id for id in self._known if id > watermark}
+        self._gaps = {start: gap for start, gap in gaps.items() if start > watermark}
@@ -0,0 +1,527 @@
+'''
+This file contains an in-memory column store holding the data of the tables 'person' and 'country'.
+The store is loaded once from the database and then kept up to date by the functions that insert new people,
+so that the analytics can be computed directly on NumPy arrays without querying the database.
+The store can also be written to a snapshot (a directory of fixed-width column files and a manifest) that the workers of the api
+memory-map read-only: the operating system keeps a single copy of the pages for all the processes, and loading a snapshot does not read
+the data until it is used.
+'''
+import os
+import json
+import time
+import logging
+import uuid
+import threading
+import numpy as np
+import pandas as pd
+from sqlalchemy import select
+from database import Session
+from db_management.db_entities import Person, Country
+from db_management.summaries import count_people
+from contingency import SparseContingencyTable
+from ip_index import encode_ip, IpRangeIndex, network_range, prefix_counts, range_counts
+
+SNAPSHOT_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+# Attributes of strings written to the snapshot through a dictionary, since few distinct values are repeated many times
+# (the other attributes of strings, e.g. the emails, are almost all distinct and are written as they are)
+SNAPSHOT_DICTIONARY_COLUMNS = ("first_name", "last_name")
+
+def encode_strings(values):
+    '''
+        This function converts a sequence of strings into a NumPy array of fixed-width UTF-8 bytes (None is encoded as b'').
+    '''
+    values = pd.Series(values, dtype=object).fillna("")
+    try:
+        # Fast path for ASCII strings (NumPy encodes fixed-width unicode strings as ASCII only)
+        return values.to_numpy(dtype="U").astype("S") if len(values) else np.zeros(0, dtype="S1")
+    except UnicodeEncodeError:
+        encoded = values.str.encode("utf-8")
+        return np.array(encoded.tolist(), dtype=f"S{max(encoded.str.len().max(), 1)}")
+
+def decode_strings(values):
+    '''
+        This function converts a NumPy array of UTF-8 bytes (see encode_strings) back into an array of strings.
+    '''
+    try:
+        return values.astype("U").astype(object)
+    except UnicodeDecodeError:
+        return pd.Series(values.astype(object)).str.decode("utf-8").to_numpy(dtype=object)
+
+class MappedStrings:
+    '''
+        This class represents an attribute of strings of a snapshot: fixed-width UTF-8 values, possibly dictionary encoded
+        (the value of the i-th row is values[codes[i]], -1 is None). The strings are decoded only for the rows that are read.
+    '''
+    def __init__(self, values, codes=None):
+        self.values = values
+        self.codes = codes
+        self._dictionary = None
+
+    def __len__(self):
+        return len(self.values if self.codes is None else self.codes)
+
+    def __getitem__(self, rows):
+        if self.codes is None:
+            return decode_strings(self.values[rows])
+        if self._dictionary is None:
+            # The dictionary is small, so it is decoded once (with None at the end for the code -1)
+            self._dictionary = np.append(decode_strings(self.values), None)
+        return self._dictionary[self.codes[rows]]
+
+def _concatenate(base, tail):
+    # Rows of the snapshot (if any) followed by the rows appended in memory
+    if base is None:
+        return tail
+    base = base[:]
+    return np.concatenate([base, tail]) if len(tail) else base
+
+def _split(parts):
+    # The rows of the snapshot and the rows appended in memory of some columns (see ColumnStore._parts), as a list of segments
+    # (first row, list of arrays): concatenating them would copy all the memory-mapped rows of the snapshot into the memory of the
+    # process at every read
+    bases, tails = [base for base, _ in parts], [tail for _, tail in parts]
+    if bases[0] is None:
+        return [(0, tails)]
+    segments = [(0, [base[:] for base in bases])]
+    if len(tails[0]):
+        segments.append((len(bases[0]), tails))
+    return segments
+
+def _combine(arrays):
+    # Concatenation of the results computed on each segment (see ColumnStore._segments), without copying a single one
+    return arrays[0] if len(arrays) == 1 else np.concatenate(arrays)
+
+def _take(base, tail, rows):
+    # Same as _concatenate(base, tail)[rows], reading only the given rows of the snapshot
+    if base is None:
+        return tail[rows]
+    if len(tail) == 0:
+        return base[rows]
+    in_base = rows < len(base)
+    values = np.empty(len(rows), dtype=tail.dtype)
+    values[in_base] = base[rows[in_base]]
+    values[~in_base] = tail[rows[~in_base] - len(base)]
+    return values
+
+class CategoryDictionary:
+    '''
+        This class implements a dictionary encoding: each distinct value of a categorical attribute is mapped to an integer code.
+    '''
+    def __init__(self, values=()):
+        self.values = list(values)
+        self.codes = {value: code for code, value in enumerate(self.values)}
+
+    def __len__(self):
+        return len(self.values)
+
+    def encode(self, values):
+        '''
+            This function converts a sequence of values into their codes, adding to the dictionary the values never seen before.
+
+            PARAMETERS
+            values -> A sequence of strings (None is encoded as -1).
+
+            RETURNS
+            A NumPy array containing the codes.
+        '''
+        local_codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+        mapping = np.empty(len(uniques) + 1, dtype=np.int32)
+        mapping[-1] = -1 # pd.factorize uses -1 for missing values
+        for i, value in enumerate(uniques):
+            code = self.codes.get(value)
+            if code is None:
+                code = len(self.values)
+                self.codes[value] = code
+                self.values.append(value)
+            mapping[i] = code
+        return mapping[local_codes]
+
+    def decode(self, codes):
+        '''
+            This function converts a sequence of codes back into the corresponding values.
+        '''
+        return np.asarray(self.values, dtype=object)[codes]
+
+class ColumnStore:
+    '''
+        This class keeps the joined 'person'/'country' data in memory as a set of NumPy arrays (one for each attribute).
+        Categorical attributes (country, gender, email domain) are dictionary encoded, while ip addresses are also stored as integers
+        (IPv4 addresses only) and as 16 bytes keys (IPv4 and IPv6, see ip_index.py), indexed to answer range queries.
+        Arrays are preallocated and grown geometrically so that new people can be appended in place.
+        A store loaded from a snapshot reads the rows of the snapshot from the memory-mapped files (read-only) and keeps in memory
+        only the rows appended afterwards.
+        As in the join between 'person' and 'country', a person has one row for each of its countries: the column 'person_row'
+        marks the first row of each person so that the attributes of the person alone are not counted more than once.
+    '''
+    # Attributes that are dictionary encoded
+    CATEGORICAL = ("country", "gender", "domain")
+    # Attributes stored as plain arrays (the strings are kept to return the people themselves)
+    COLUMNS = {"id": np.int64, "first_name": object, "last_name": object, "email": object, "ip_address": object, "ip": np.int64,
+               "ip_key": "S16", "ip_version": np.int8, "country": np.int32, "gender": np.int32, "domain": np.int32, "person_row": bool}
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self._last_id = None
+        self.dictionaries = {name: CategoryDictionary() for name in self.CATEGORICAL}
+        self._columns = {name: np.empty(capacity, dtype=dtype) for name, dtype in self.COLUMNS.items()}
+        self._base = {} # Columns of the snapshot (memory-mapped), followed by the first 'size - base_size' rows of _columns
+        self._base_size = 0
+        self._ip_index = None # Built when first needed, then the rows appended are added to it
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_engine(cls, engine, chunk_size=100000, max_id=None):
+        '''
+            This function creates a new column store loading all people from the database.
+
+            PARAMETERS
+            engine -> A sqlalchemy engine (or connection) to interact with the database.
+            chunk_size -> The number of rows fetched from the database at a time.
+            max_id -> If given, only the people with an id up to max_id are loaded (see catch_up.py).
+
+            RETURNS
+            A ColumnStore containing the data of the tables 'person' and 'country'.
+        '''
+        store = cls()
+        store.update_from_engine(engine, chunk_size, max_id)
+        return store
+
+    def update_from_engine(self, engine, chunk_size=100000, max_id=None):
+        '''
+            This function appends the people of the database not in the store yet (i.e., with a greater id than the last one),
+            up to max_id if given.
+        '''
+        query = select(Person.id, Person.first_name, Person.last_name, Person.email, Person.gender, Person.ip_address, Country.country)\
+                    .outerjoin(Country).order_by(Person.id)
+        if self._last_id is not None:
+            query = query.where(Person.id > int(self._last_id))
+        if max_id is not None:
+            query = query.where(Person.id <= max_id)
+        with Session(bind=engine) as session:
+            result = session.execute(query, execution_options={"yield_per": chunk_size})
+            for rows in result.partitions():
+                self.append(pd.DataFrame.from_records(rows, columns=list(result.keys())))
+
+    @property
+    def n_people(self):
+        return sum(int(np.count_nonzero(person_row)) for _, (person_row,) in self._segments("person_row"))
+
+    def _grow(self, min_capacity):
+        capacity = len(self._columns["id"])
+        if capacity >= min_capacity:
+            return
+        while capacity < min_capacity:
+            capacity *= 2
+        size = self.size - self._base_size
+        for name, column in self._columns.items():
+            new_column = np.empty(capacity, dtype=column.dtype)
+            new_column[:size] = column[:size]
+            self._columns[name] = new_column
+
+    def append(self, people):
+        '''
+            This function appends new people to the store.
+
+            PARAMETERS
+            people -> A Pandas DataFrame with columns id, first_name, last_name, email, gender, ip_address and country.
+                      A missing country (i.e., a person without a row in the table 'country') is represented by None.
+                      The rows of the same person must be consecutive.
+        '''
+        n = len(people)
+        if n == 0:
+            return
+        ids = people["id"].to_numpy(dtype=np.int64)
+        emails = people["email"].to_numpy(dtype=object)
+        ip_keys, ip_versions = encode_ip(people["ip_address"])
+        # IPv4 addresses are the last 32 bits of their keys
+        ipv4 = np.where(ip_versions == 4, ip_keys.view(">u8")[1::2] & 0xFFFFFFFF, -1).astype(np.int64)
+        with self._lock:
+            person_row = np.ones(n, dtype=bool)
+            person_row[1:] = ids[1:] != ids[:-1]
+            person_row[0] = ids[0] != self._last_id
+            new_values = {"id": ids,
+                          "person_row": person_row,
+                          "first_name": people["first_name"].to_numpy(dtype=object),
+                          "last_name": people["last_name"].to_numpy(dtype=object),
+                          "email": emails,
+                          "ip_address": people["ip_address"].to_numpy(dtype=object),
+                          "ip": ipv4,
+                          "ip_key": ip_keys,
+                          "ip_version": ip_versions,
+                          "country": self.dictionaries["country"].encode(people["country"]),
+                          "gender": self.dictionaries["gender"].encode(people["gender"]),
+                          "domain": self.dictionaries["domain"].encode(pd.Series(emails).str.split("@").str[1])}
+            size = self.size - self._base_size # Rows already appended after the snapshot
+            self._grow(size + n)
+            for name, values in new_values.items():
+                self._columns[name][size:size + n] = values
+            self._last_id = ids[-1]
+            self.size += n # Readers only look at the first 'size' rows, so the new rows become visible all at once
+            if self._ip_index is not None:
+                # Added to the delta of the index (see ip_index.IpRangeIndex), instead of sorting all the addresses again
+                rows = np.flatnonzero(person_row & (ip_versions > 0))
+                self._ip_index.append(ip_keys[rows], rows + (self.size - n))
+
+    def person_columns(self, *names):
+        '''
+            This function returns the values of the given columns, with a single row for each person.
+
+            RETURNS
+            A list of NumPy arrays (one for each column).
+        '''
+        segments = [[column[person_row] for column in columns] for _, (person_row, *columns) in self._segments("person_row", *names)]
+        return [_combine(list(values)) for values in zip(*segments)]
+
+    def _parts(self, *names):
+        # The rows of the snapshot and the rows appended in memory of the given columns (called with the lock held)
+        size = self.size - self._base_size
+        return [(self._base.get(name), self._columns[name][:size]) for name in names]
+
+    def _segments(self, *names):
+        # The values of the given columns in segments to be processed separately (see _split)
+        with self._lock:
+            return _split(self._parts(*names))
+
+    def join_columns(self, *names):
+        '''
+            This function returns the values of the given columns, with a row for each pair <person, country> (as in the left outer
+            join between 'person' and 'country'). The rows of the snapshot are copied along with the ones appended afterwards,
+            so the functions of the store process them separately (see _segments).
+
+            RETURNS
+            A dictionary {name: NumPy array}.
+        '''
+        with self._lock:
+            parts = self._parts(*names)
+        return {name: _concatenate(*part) for name, part in zip(names, parts)}
+
+    def _codes(self, *attributes):
+        '''
+            This function returns the codes of the given categorical attributes.
+            If the country is among the attributes, there is a row for each pair <person, country> and people without a country are excluded,
+            to be consistent with the inner join used by the database queries. Otherwise, there is a single row for each person.
+        '''
+        if "country" not in attributes:
+            return self.person_columns(*attributes)
+        segments = []
+        for _, codes in self._segments(*attributes):
+            mask = codes[attributes.index("country")] >= 0
+            segments.append([c[mask] for c in codes])
+        return [_combine(list(codes)) for codes in zip(*segments)]
+
+    def count_by(self, *attributes):
+        '''
+            This function counts the number of people for each combination of values of the given categorical attributes.
+
+            PARAMETERS
+            attributes -> One or more names of categorical attributes (e.g., "country", "gender").
+
+            RETURNS
+            A list of tuples (value_1, ..., value_n, count), only for the combinations that occur at least once.
+        '''
+        codes = self._codes(*attributes)
+        sizes = [len(self.dictionaries[attribute]) for attribute in attributes]
+        combined = np.zeros(len(codes[0]), dtype=np.int64)
+        for c, size in zip(codes, sizes):
+            combined = combined * size + c
+        counts = np.bincount(combined, minlength=int(np.prod(sizes)))
+        nonzero = np.flatnonzero(counts)
+        keys = np.unravel_index(nonzero, sizes)
+        values = [self.dictionaries[attribute].decode(key) for attribute, key in zip(attributes, keys)]
+        return list(zip(*values, counts[nonzero].tolist()))
+
+    def contingency_table(self, row_attribute, column_attribute):
+        '''
+            This function computes the contingency table of two categorical attributes.
+
+            RETURNS
+            A SparseContingencyTable where rows and columns correspond to the values observed for the two attributes.
+        '''
+        rows, columns = self._codes(row_attribute, column_attribute)
+        return SparseContingencyTable.from_codes(rows, columns, len(self.dictionaries[row_attribute]), len(self.dictionaries[column_attribute]))
+
+    def ip_first_octet_counts(self):
+        '''
+            This function counts the IPv4 addresses by their first number.
+
+            RETURNS
+            A NumPy array of 256 elements, where the i-th element is the number of addresses starting with i.
+        '''
+        ips = self.person_columns("ip")[0]
+        return np.bincount(ips[ips >= 0] >> 24, minlength=256)
+
+    def ip_prefix_counts(self, prefix_length):
+        '''
+            This function counts the IPv4 addresses by network (e.g., by /8 or /16, see ip_index.prefix_counts).
+        '''
+        return prefix_counts(self.person_columns("ip")[0], prefix_length)
+
+    def ip_range_counts(self):
+        '''
+            This function counts the addresses by class of ranges (private, public, ..., see ip_index.range_counts).
+        '''
+        return range_counts(*self.person_columns("ip_key", "ip_version"))
+
+    def ip_index(self):
+        '''
+            This function returns the IpRangeIndex of the addresses of the people (the rows of the index are rows of the store).
+        '''
+        with self._lock:
+            if self._ip_index is None:
+                keys, rows = [], []
+                for first_row, (person_row, ip_versions, ip_keys) in _split(self._parts("person_row", "ip_version", "ip_key")):
+                    segment_rows = np.flatnonzero(person_row & (ip_versions > 0))
+                    keys.append(ip_keys[segment_rows])
+                    rows.append(segment_rows + first_row)
+                self._ip_index = IpRangeIndex(_combine(keys), _combine(rows))
+            return self._ip_index
+
+    def people_in_network(self, network, limit=None):
+        '''
+            This function returns the people whose ip address belongs to a network.
+
+            PARAMETERS
+            network -> A network in CIDR notation (see ip_index.network_range).
+            limit -> The maximum number of people returned.
+
+            RETURNS
+            The number of people in the network and a Pandas DataFrame with the same columns of Person.to_dict() (sorted by address).
+        '''
+        first, last = network_range(network)
+        index = self.ip_index()
+        rows = index.lookup(first, last, limit)
+        return index.count(first, last), self._people(rows)
+
+    def _people(self, rows):
+        names = ("id", "first_name", "last_name", "email", "gender", "ip_address")
+        with self._lock:
+            parts = self._parts(*names)
+        columns = {name: _take(*part, rows) for name, part in zip(names, parts)}
+        columns["gender"] = self.dictionaries["gender"].decode(columns["gender"])
+        return pd.DataFrame(columns)
+
+    def people_by_country(self, country):
+        '''
+            This function returns the people from a given country.
+
+            RETURNS
+            A Pandas DataFrame with the same columns of Person.to_dict().
+        '''
+        code = self.dictionaries["country"].codes.get(country)
+        if code is None:
+            return pd.DataFrame(columns=["id", "first_name", "last_name", "email", "gender", "ip_address"])
+        rows = [np.flatnonzero(countries == code) + first_row for first_row, (countries,) in self._segments("country")]
+        return self._people(_combine(rows))
+
+    def save(self, path):
+        '''
+            This function writes the store to a snapshot, i.e. a directory containing:
+            - a file for each attribute (NumPy .npy format, fixed-width values): the integers, the codes of the categorical
+              attributes and of SNAPSHOT_DICTIONARY_COLUMNS, and the UTF-8 bytes of the other strings;
+            - a file with the values of each dictionary;
+            - the manifest (manifest.json), with the number of rows, the last id and the file of each attribute.
+            The files of each snapshot have a different name and the manifest is replaced atomically as the last step, so the
+            snapshot can be refreshed while the api is using the previous one (the processes that mapped the previous files keep
+            reading them until they load the snapshot again).
+
+            PARAMETERS
+            path -> The directory of the snapshot (created if it does not exist).
+        '''
+        with self._lock:
+            size, last_id = self.size, self._last_id
+            parts = self._parts(*self.COLUMNS)
+            dictionaries = {name: list(dictionary.values) for name, dictionary in self.dictionaries.items()}
+        os.makedirs(path, exist_ok=True)
+        generation = uuid.uuid4().hex[:12]
+
+        def write(name, values):
+            filename = f"{name}.{generation}.npy"
+            with open(os.path.join(path, filename), "wb") as file:
+                np.save(file, values, allow_pickle=False)
+            return filename
+
+        manifest = {"version": SNAPSHOT_VERSION, "created_at": time.time(), "n_rows": size,
+                    "last_id": None if last_id is None else int(last_id), "columns": {}, "dictionaries": {}}
+        for (name, dtype), part in zip(self.COLUMNS.items(), parts):
+            values = _concatenate(*part)
+            if name in SNAPSHOT_DICTIONARY_COLUMNS:
+                codes, uniques = pd.factorize(pd.Series(values, dtype=object))
+                manifest["columns"][name] = {"encoding": "dictionary", "file": write(name, codes.astype(np.int32)),
+                                             "dictionary": write(f"{name}.dictionary", encode_strings(uniques))}
+            elif dtype is object:
+                manifest["columns"][name] = {"encoding": "strings", "file": write(name, encode_strings(values))}
+            else:
+                manifest["columns"][name] = {"encoding": "plain", "file": write(name, values)}
+        for name, values in dictionaries.items():
+            manifest["dictionaries"][name] = write(f"{name}.dictionary", encode_strings(values))
+
+        temporary_filename = os.path.join(path, MANIFEST_FILE + ".tmp")
+        with open(temporary_filename, "w") as file:
+            json.dump(manifest, file, indent=2)
+        os.replace(temporary_filename, os.path.join(path, MANIFEST_FILE))
+        # The files of the previous snapshots are removed (on Linux, a process that mapped them keeps the data until it unmaps it)
+        for filename in os.listdir(path):
+            if filename.endswith(".npy") and f".{generation}." not in filename:
+                try:
+                    os.remove(os.path.join(path, filename))
+                except OSError as e: # E.g., on Windows a file cannot be removed while it is mapped
+                    logging.warning(f"Cannot remove the file {filename} of a previous snapshot: {e}")
+
+    @classmethod
+    def load(cls, path):
+        '''
+            This function loads a snapshot written by save(), memory-mapping its files read-only.
+
+            RETURNS
+            A ColumnStore. Raises ValueError if the snapshot is not valid.
+        '''
+        with open(os.path.join(path, MANIFEST_FILE)) as file:
+            manifest = json.load(file)
+        if manifest.get("version") != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported version of the snapshot {path}: {manifest.get('version')}.")
+
+        def mapped(filename):
+            return np.load(os.path.join(path, filename), mmap_mode="r", allow_pickle=False)
+
+        store = cls()
+        n_rows = manifest["n_rows"]
+        for name, dtype in cls.COLUMNS.items():
+            column = manifest["columns"][name]
+            if column["encoding"] == "dictionary":
+                values = MappedStrings(mapped(column["dictionary"]), mapped(column["file"]))
+            elif column["encoding"] == "strings":
+                values = MappedStrings(mapped(column["file"]))
+            else:
+                values = mapped(column["file"])
+                if values.dtype != np.dtype(dtype):
+                    raise ValueError(f"Invalid type of the attribute '{name}' in the snapshot {path}: {values.dtype}.")
+            if len(values) != n_rows:
+                raise ValueError(f"Invalid length of the attribute '{name}' in the snapshot {path}: {len(values)} instead of {n_rows}.")
+            store._base[name] = values
+        for name in cls.CATEGORICAL:
+            store.dictionaries[name] = CategoryDictionary(decode_strings(mapped(manifest["dictionaries"][name])))
+        store.size = store._base_size = n_rows
+        store._last_id = manifest["last_id"]
+        return store
+
+    @classmethod
+    def restore(cls, engine, path, max_id=None):
+        '''
+            This function loads a snapshot and appends the people inserted in the database afterwards.
+            If the snapshot does not exist or does not match the database (e.g., the database has been initialized again), the store
+            is loaded from the whole database.
+
+            PARAMETERS
+            engine -> A sqlalchemy engine (or connection) to interact with the database.
+            path -> The directory of the snapshot written by save().
+            max_id -> If given, only the people with an id up to max_id are loaded (see catch_up.py).
+        '''
+        store = cls.load(path) if os.path.exists(os.path.join(path, MANIFEST_FILE)) else None
+        if store is not None:
+            store.update_from_engine(engine, max_id=max_id)
+            with Session(bind=engine) as session:
+                n_people = count_people(session, max_id)
+            if n_people == store.n_people:
+                return store
+        return cls.from_engine(engine, max_id=max_id)
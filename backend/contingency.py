@@ -0,0 +1,123 @@
+'''
+This file contains a sparse representation of contingency tables, used to compute the Chi-square statistic
+between categorical variables with many distinct values (e.g., the email domain).
+'''
+import numpy as np
+import pandas as pd
+
+# Above this number of cells the counts are accumulated sorting the keys instead of using a dense np.bincount
+DENSE_ACCUMULATION_LIMIT = 1 << 20
+
+class SparseContingencyTable:
+    '''
+        This class represents a contingency table storing only the cells with a non-zero count (coordinate format).
+        Rows and columns without any observation are dropped, as it happens for a table computed with pd.crosstab.
+    '''
+    def __init__(self, rows, columns, counts, shape):
+        self.rows = rows
+        self.columns = columns
+        self.counts = counts
+        self.shape = shape
+
+    @classmethod
+    def from_codes(cls, row_codes, column_codes, n_rows=None, n_columns=None):
+        '''
+            This function builds the table from the integer codes of the two variables (one pair of codes for each observation).
+
+            PARAMETERS
+            row_codes, column_codes -> NumPy arrays of non negative integers having the same length.
+            n_rows, n_columns -> The number of possible codes for each variable (computed from the codes if not given).
+
+            RETURNS
+            A SparseContingencyTable.
+        '''
+        row_codes = np.asarray(row_codes, dtype=np.int64)
+        column_codes = np.asarray(column_codes, dtype=np.int64)
+        if len(row_codes) == 0:
+            return cls(np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), (0, 0))
+        n_rows = int(row_codes.max()) + 1 if n_rows is None else n_rows
+        n_columns = int(column_codes.max()) + 1 if n_columns is None else n_columns
+
+        keys = row_codes * n_columns + column_codes
+        if n_rows * n_columns <= DENSE_ACCUMULATION_LIMIT:
+            counts = np.bincount(keys, minlength=n_rows * n_columns)
+            keys = np.flatnonzero(counts)
+            counts = counts[keys]
+        else:
+            keys, counts = np.unique(keys, return_counts=True)
+        rows, columns = np.divmod(keys, n_columns)
+        return cls._from_cells(rows, columns, counts)
+
+    @classmethod
+    def _from_cells(cls, rows, columns, counts):
+        # Renumber rows and columns so that only the observed ones are kept
+        observed_rows, rows = np.unique(rows, return_inverse=True)
+        observed_columns, columns = np.unique(columns, return_inverse=True)
+        return cls(rows, columns, np.asarray(counts, dtype=np.int64), (len(observed_rows), len(observed_columns)))
+
+    @classmethod
+    def from_values(cls, row_values, column_values):
+        '''
+            This function builds the table from the values of the two variables (one pair of values for each observation).
+        '''
+        row_codes, row_uniques = pd.factorize(pd.Series(row_values, dtype=object))
+        column_codes, column_uniques = pd.factorize(pd.Series(column_values, dtype=object))
+        return cls.from_codes(row_codes, column_codes, len(row_uniques), len(column_uniques))
+
+    @classmethod
+    def from_counts(cls, row_values, column_values, counts):
+        '''
+            This function builds the table from already aggregated data (e.g., the result of a GROUP BY query),
+            where each distinct pair of values occurs once along with its count.
+        '''
+        rows, _ = pd.factorize(pd.Series(row_values, dtype=object))
+        columns, _ = pd.factorize(pd.Series(column_values, dtype=object))
+        return cls._from_cells(rows, columns, counts)
+
+    @classmethod
+    def from_dense(cls, table):
+        '''
+            This function builds the table from a dense matrix of counts.
+        '''
+        table = np.asarray(table)
+        rows, columns = np.nonzero(table)
+        return cls._from_cells(rows, columns, table[rows, columns])
+
+    @property
+    def n(self):
+        '''
+            The number of observations.
+        '''
+        return int(self.counts.sum())
+
+    @property
+    def nnz(self):
+        '''
+            The number of non-zero cells.
+        '''
+        return len(self.counts)
+
+    def row_sums(self):
+        return np.bincount(self.rows, weights=self.counts, minlength=self.shape[0])
+
+    def column_sums(self):
+        return np.bincount(self.columns, weights=self.counts, minlength=self.shape[1])
+
+    def chi2(self):
+        '''
+            This function computes the Chi-square statistic (without continuity correction) of the table.
+            Since sum((O-E)^2/E) = sum(O^2/E) - n and O^2/E is zero for the empty cells, only the non-zero cells are visited.
+        '''
+        n = self.n
+        if n == 0:
+            return 0.0
+        expected = self.row_sums()[self.rows] * self.column_sums()[self.columns] / n
+        return max(0.0, float(np.sum(self.counts.astype(np.float64) ** 2 / expected)) - n)
+
+    def to_dense(self):
+        '''
+            This function converts the table to a dense NumPy matrix (only for small tables).
+        '''
+        table = np.zeros(self.shape, dtype=np.int64)
+        table[self.rows, self.columns] = self.counts
+        return table
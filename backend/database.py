@@ -0,0 +1,218 @@
+'''
+This file manages the connection to the database: the creation of the engines from the settings in the .env file, the session factory
+shared by all the functionalities and the execution of the functionalities from the asynchronous endpoints of the api.
+The writes are executed on the primary database, while the read-only functionalities can be executed on read replicas (see read_replicas.py).
+'''
+import os
+import contextvars
+import sqlalchemy
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.util import await_only
+from fastapi.concurrency import run_in_threadpool
+from read_replicas import ReadReplicaSet, NoReplicaAvailable
+
+# Single session factory used by all the functionalities. The engine (or connection) is given when a session is created,
+# e.g. 'with Session(bind=engine) as session:'. expire_on_commit False allows to use the objects even after commit.
+Session = sessionmaker(expire_on_commit=False)
+
+# True if the reads of the current request must be executed on the primary database, which may be ahead of the replicas and of the
+# in-memory copies of the data (e.g., to read the people just created). Set by the api from the header X-Read-Your-Writes
+read_your_writes_var = contextvars.ContextVar("read_your_writes", default=False)
+
+# True while a functionality is executed by Database.run on the thread of the event loop (asynchronous engine, see offload)
+_on_event_loop = contextvars.ContextVar("on_event_loop", default=False)
+
+def offload(function, *args, **kwargs):
+    '''
+        This function executes a CPU-bound stage of a functionality (e.g., the Dataframes and the statistics computed on the rows read).
+        When the functionality is executed by Database.run with the asynchronous engine, i.e. on the thread of the event loop, the stage
+        is executed in the threadpool and awaited, so that the event loop keeps serving the other requests meanwhile; otherwise it
+        is executed directly.
+
+        RETURNS
+        The result of the function.
+    '''
+    if not _on_event_loop.get():
+        return function(*args, **kwargs)
+    return await_only(run_in_threadpool(_off_event_loop, function, *args, **kwargs))
+
+def _off_event_loop(function, *args, **kwargs):
+    # The threadpool copies the context of the event loop: the nested stages are executed directly
+    _on_event_loop.set(False)
+    return function(*args, **kwargs)
+
+def get_connection_data():
+    '''
+        This function reads the database connection parameters from the environment (i.e., the .env file).
+    '''
+    return {"host":os.environ.get('db_hostname'),
+            "db_name":os.environ.get('db_name'),
+            "user":os.environ.get('db_user'),
+            "psw":os.environ.get('db_psw')}
+
+def get_pool_options(url):
+    '''
+        This function reads the connection pool settings from the environment.
+        SQLite databases do not use a pool of network connections, so no option is returned for them.
+    '''
+    if url.startswith("sqlite"):
+        return {}
+    return {"pool_size": int(os.environ.get('db_pool_size', 5)),
+            "max_overflow": int(os.environ.get('db_max_overflow', 10)),
+            "pool_recycle": int(os.environ.get('db_pool_recycle', 3600)),
+            "pool_pre_ping": True}
+
+def get_database_url(driver="mysqldb"):
+    '''
+        This function builds the url of the MySQL database defined in the .env file.
+
+        PARAMETERS
+        driver -> The name of the DBAPI driver (e.g., 'mysqldb', or 'asyncmy'/'aiomysql' for the asynchronous engine).
+    '''
+    db_connection_data = get_connection_data()
+    return f'mysql+{driver}://{db_connection_data["user"]}:{db_connection_data["psw"]}@{db_connection_data["host"]}/{db_connection_data["db_name"]}'
+
+def create_engine_from_env():
+    '''
+        This function creates the synchronous engine used to connect to the database.
+        The url can be overridden with 'db_url' (e.g., 'sqlite:///local.db' for a local setup without any database server).
+    '''
+    url = os.environ.get('db_url') or get_database_url()
+    return sqlalchemy.create_engine(url, **get_pool_options(url))
+
+def create_async_engine_from_env():
+    '''
+        This function creates the asynchronous engine used to connect to the database.
+        The url can be overridden with 'db_async_url' (e.g., 'sqlite+aiosqlite:///local.db' to test it locally).
+    '''
+    # Imported here so that the synchronous code (e.g., initialize_db.py) does not need the asyncio dependencies
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    url = os.environ.get('db_async_url') or get_database_url(os.environ.get('db_async_driver', 'asyncmy'))
+    return create_async_engine(url, **get_pool_options(url))
+
+class Database:
+    '''
+        This class allows the asynchronous endpoints to execute the functionalities, which are written with synchronous sqlalchemy code.
+        - In synchronous mode, each functionality is executed in the threadpool with the synchronous engine.
+        - In asynchronous mode, each functionality is executed with AsyncConnection.run_sync: the functionality receives a connection whose
+          operations are awaited on the event loop, so that no thread is blocked while waiting for the database. The functionality
+          itself runs on the thread of the event loop, so its CPU-bound stages are executed in the threadpool (see offload).
+        In both cases the functionality receives, as first parameter, something that can be used as bind of a Session.
+        If an AnalyticsReplica is given (see analytics.py), the analytics can be executed on it instead of the primary database.
+        If a ReadReplicaSet is given, the other read-only functionalities (and the analytics, if there is no AnalyticsReplica) are
+        executed on the read replicas.
+    '''
+    def __init__(self, engine=None, async_engine=None, analytics=None, replicas=None):
+        self.engine = engine
+        self.async_engine = async_engine
+        self.analytics = analytics
+        self.replicas = replicas
+        self._sync_engine = engine
+
+    @property
+    def sync_engine(self):
+        '''
+            The synchronous engine of the primary database. With the asynchronous engine, it is created when first needed (e.g., to
+            stream the rows of a query from a generator consumed in the threadpool, which AsyncConnection.run_sync does not allow).
+        '''
+        if self._sync_engine is None:
+            self._sync_engine = create_engine_from_env()
+        return self._sync_engine
+
+    @classmethod
+    def from_env(cls):
+        '''
+            This function creates the engine selected in the .env file ('db_async = "true"' for the asynchronous one).
+        '''
+        # Imported here since analytics.py uses the session factory defined in this file
+        from analytics import AnalyticsReplica
+
+        if os.environ.get('db_async', 'false').lower() == 'true':
+            return cls(async_engine=create_async_engine_from_env(), analytics=AnalyticsReplica.from_env(), replicas=ReadReplicaSet.from_env())
+        return cls(engine=create_engine_from_env(), analytics=AnalyticsReplica.from_env(), replicas=ReadReplicaSet.from_env())
+
+    async def run(self, function, *args, **kwargs):
+        '''
+            This function executes a functionality, passing it the bind to use as first parameter.
+        '''
+        if self.async_engine is not None:
+            async with self.async_engine.connect() as connection:
+                return await connection.run_sync(self._run_on_event_loop, function, *args, **kwargs)
+        return await run_in_threadpool(function, self.engine, *args, **kwargs)
+
+    @staticmethod
+    def _run_on_event_loop(connection, function, *args, **kwargs):
+        token = _on_event_loop.set(True)
+        try:
+            return function(connection, *args, **kwargs)
+        finally:
+            _on_event_loop.reset(token)
+
+    async def run_read(self, function, *args, **kwargs):
+        '''
+            This function executes a read-only functionality on a read replica, or on the primary database if there is no available
+            replica or if the reads of the current request are pinned to the primary database (see read_your_writes_var).
+            A read that fails because the replica is unreachable is executed again on the primary database.
+        '''
+        if self.replicas is not None and not read_your_writes_var.get():
+            try:
+                return await run_in_threadpool(self.replicas.run, function, *args, **kwargs)
+            except NoReplicaAvailable:
+                pass
+        return await self.run(function, *args, **kwargs)
+
+    def stream_read(self, function, *args, read_your_writes=False, **kwargs):
+        '''
+            This function executes a read-only functionality returning a generator (e.g., the chunks of an export) on a read replica or
+            on the primary database, as run_read, with a synchronous engine. The rows are read while the generator is consumed, so a
+            replica failing after the first chunk interrupts the generator instead of being replaced by the primary database.
+
+            PARAMETERS
+            read_your_writes -> If True, the primary database is used (the generator may be consumed in another context, so the value of
+                                read_your_writes_var is given explicitly).
+        '''
+        replica = None
+        if self.replicas is not None and not read_your_writes:
+            try:
+                replica = self.replicas.acquire()
+            except NoReplicaAvailable:
+                pass
+        if replica is None:
+            yield from function(self.sync_engine, *args, **kwargs)
+            return
+        error = None
+        try:
+            yield from function(replica.engine, *args, **kwargs)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.replicas.release(replica, error)
+
+    async def run_analytics(self, function, *args, **kwargs):
+        '''
+            This function executes a read-only functionality on the embedded analytics copy, or on the read replicas (or the primary
+            database) if there is none. The copy contains the people created by the other processes only after the next catch-up (see
+            catch_up.py), so pinned reads skip it.
+        '''
+        if self.analytics is not None and not read_your_writes_var.get():
+            return await run_in_threadpool(function, self.analytics.engine, *args, **kwargs)
+        return await self.run_read(function, *args, **kwargs)
+
+    async def load_analytics(self, max_id=None):
+        '''
+            This function copies the data of the primary database (up to max_id, if given) into the embedded analytics copy (if any).
+        '''
+        if self.analytics is not None:
+            return await self.run(self.analytics.load_from, max_id=max_id)
+
+    async def dispose(self):
+        if self.async_engine is not None:
+            await self.async_engine.dispose()
+        if self._sync_engine is not None:
+            self._sync_engine.dispose()
+        if self.analytics is not None:
+            self.analytics.dispose()
+        if self.replicas is not None:
+            self.replicas.dispose()
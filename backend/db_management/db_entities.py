@@ -3,36 +3,61 @@ This file contains the classes that are mapped to the database entities.
 A Declarative Mapping modality is used to define the objects' model and the database metadata that describe SQL tables.
 '''
 
-from sqlalchemy import String, Column, Integer, CheckConstraint, ForeignKey
+from sqlalchemy import String, Column, Integer, CheckConstraint, ForeignKey, Computed, BINARY
 from sqlalchemy.orm import relationship, DeclarativeBase, mapped_column
+import functools
+import re
+import pandas as pd
+from ip_index import packed_ip_addresses, packed_ip_address
 
 class Base(DeclarativeBase):
     pass
 
+# First number of the addresses starting with 1 to 3 digits followed by a '.' (i.e., matching '^[0-9]{1,3}[.]'), NULL for the others
+# (e.g., IPv6 addresses, also the ones with an embedded IPv4 address such as '::ffff:1.2.3.4'). SQLite has no regular expressions, so
+# the text before the first '.' is checked by removing all the digits from it. derived_columns applies the same rule in Python
+_IP_PREFIX = "SUBSTR(ip_address, 1, INSTR(ip_address, '.') - 1)"
+_IP_PREFIX_WITHOUT_DIGITS = functools.reduce(lambda text, digit: f"REPLACE({text}, '{digit}', '')", "0123456789", _IP_PREFIX)
+IP_FIRST_OCTET_REGEX = r"^([0-9]{1,3})\."
+IP_FIRST_OCTET_EXPRESSION = f"CASE WHEN INSTR(ip_address, '.') BETWEEN 2 AND 4 AND {_IP_PREFIX_WITHOUT_DIGITS} = '' THEN CAST({_IP_PREFIX} AS UNSIGNED) END"
+
 class Person(Base):
     '''
         This class represents objects that will be stored in the table 'person' of the database
     '''
     __tablename__ = "person" # Name of the database table
+    # The email constraint uses RLIKE, which is available in MySQL only (it is skipped when the tables are created in a local SQLite database)
+    __table_args__ = (CheckConstraint("email RLIKE '^[a-zA-Z0-9][a-zA-Z0-9._-]*@[a-zA-Z0-9]+[[.]?[a-zA-Z0-9-]+]*\\.[a-zA-Z]{2,4}$'", name = "chk_person_email").ddl_if(dialect="mysql"),)
 
     # Defining table attributes
     id = mapped_column(Integer, autoincrement=True, primary_key=True)
     first_name  = mapped_column(String(30), nullable=False)
     last_name   = mapped_column(String(30), nullable=False)
-    email  = mapped_column(String(254), CheckConstraint("email RLIKE '^[a-zA-Z0-9][a-zA-Z0-9._-]*@[a-zA-Z0-9]+[[.]?[a-zA-Z0-9-]+]*\\.[a-zA-Z]{2,4}$'", name = "chk_person_email"), nullable=False)
+    email  = mapped_column(String(254), nullable=False, unique=True, index=True) # Unique index: a person is identified by its email (see dedup.py)
     gender   = mapped_column(String(20), nullable=False)
-    ip_address  = mapped_column(String(15), nullable=False)
+    ip_address  = mapped_column(String(39), nullable=False) # Long enough for IPv6 addresses
+
+    # Stored generated columns computed by the database, so that aggregations on the email domain and on the ip address class
+    # can be done with indexed GROUP BY queries (see db_management/migrations.py for databases created before these columns)
+    email_domain = mapped_column(String(254), Computed("SUBSTR(email, INSTR(email, '@') + 1)", persisted=True), index=True)
+    ip_first_octet = mapped_column(Integer, Computed(IP_FIRST_OCTET_EXPRESSION, persisted=True), index=True)
+
+    # Ip address encoded as 16 bytes (IPv4 addresses are mapped into IPv6, see ip_index.py), so that the index answers range queries
+    # such as 'all the addresses in 10.0.0.0/8'. It is computed by the application (see derived_columns and migrations.fill_packed_ip_addresses)
+    ip_packed = mapped_column(BINARY(16), index=True)
 
     # Defining 1-to-1 relationship between Person instance and Country instance
     country = relationship("Country", back_populates="person", uselist = False)
 
-    def __init__(self, id, first_name, last_name, email, gender, ip_address):
+    def __init__(self, id, first_name, last_name, email, gender, ip_address, ip_packed=None):
         self.id = id
         self.first_name = first_name
         self.last_name = last_name
         self.email = email
         self.gender = gender
         self.ip_address = ip_address
+        # The packed address can be given when it has been computed for many people at once (see initialize_db.export_data_to_db)
+        self.ip_packed = ip_packed if ip_packed is not None else packed_ip_address(ip_address)
 
     def to_dict(self):
         '''
@@ -55,8 +80,8 @@ class Country(Base):
     __tablename__ = "country"
 
     id = mapped_column(Integer, autoincrement=True, primary_key=True)
-    country  = mapped_column(String(2), nullable=False)
-    person_id = mapped_column(Integer, ForeignKey("person.id", name = "fk_person_country", ondelete='CASCADE', onupdate='CASCADE'), nullable = False) # Definining foreign key constraint
+    country  = mapped_column(String(2), nullable=False, index=True)
+    person_id = mapped_column(Integer, ForeignKey("person.id", name = "fk_person_country", ondelete='CASCADE', onupdate='CASCADE'), nullable = False, index=True) # Definining foreign key constraint
 
     # Defining 1-to-1 relationship between Country instance and Person instance
     person = relationship("Person", back_populates="country")
@@ -66,4 +91,83 @@ class Country(Base):
         self.person_id = person_id
         self.country = country
     
-    # Function to_dict has not been defined since it was not needed in the analysis
\ No newline at end of file
+    # Function to_dict has not been defined since it was not needed in the analysis
+
+def derived_columns(people):
+    '''
+        This function computes in Python the values of the generated columns of the table 'person' (e.g., for new people not
+        stored in the database yet), along with the column ip_packed (always computed by the application).
+
+        PARAMETERS
+        people -> A Pandas Dataframe with the columns email and ip_address.
+
+        RETURNS
+        The Dataframe with the additional columns email_domain, ip_first_octet and ip_packed.
+    '''
+    # As SUBSTR(email, INSTR(email, '@') + 1): the part after the first '@' (the whole email if there is none)
+    email_domain = people["email"].str.split("@", n=1).str[-1]
+    # As IP_FIRST_OCTET_EXPRESSION: the number of 1 to 3 digits before the first '.', NULL if the address does not start with it
+    ip_first_octet = pd.to_numeric(people["ip_address"].str.extract(IP_FIRST_OCTET_REGEX, expand=False)).astype("Int64")
+    return people.assign(email_domain=email_domain, ip_first_octet=ip_first_octet, ip_packed=packed_ip_addresses(people["ip_address"]))
+
+def derived_values(email, ip_address):
+    '''
+        This function computes the same values of derived_columns for a single person (without the overhead of a Dataframe).
+
+        RETURNS
+        A dictionary with the keys email_domain, ip_first_octet (None if not defined) and ip_packed (None if not valid).
+    '''
+    ip_first_octet = re.match(IP_FIRST_OCTET_REGEX, ip_address)
+    return {"email_domain": email.split("@", 1)[-1],
+            "ip_first_octet": int(ip_first_octet.group(1)) if ip_first_octet else None,
+            "ip_packed": packed_ip_address(ip_address)}
+
+# Summary tables: small aggregates of the tables 'person' and 'country', updated in the same transaction of every insert
+# (see db_management/summaries.py) so that the analytics read a few hundred rows instead of scanning the whole tables.
+# As in the queries on the join between 'person' and 'country', a person is counted once for each of its countries.
+
+class CountryCount(Base):
+    '''
+        This class represents the number of people for each country.
+    '''
+    __tablename__ = "country_count"
+
+    country = mapped_column(String(2), primary_key=True)
+    count = mapped_column(Integer, nullable=False)
+
+class GenderCount(Base):
+    '''
+        This class represents the number of people for each gender.
+    '''
+    __tablename__ = "gender_count"
+
+    gender = mapped_column(String(20), primary_key=True)
+    count = mapped_column(Integer, nullable=False)
+
+class CountryGenderCount(Base):
+    '''
+        This class represents the number of people for each pair <country, gender>.
+    '''
+    __tablename__ = "country_gender_count"
+
+    country = mapped_column(String(2), primary_key=True)
+    gender = mapped_column(String(20), primary_key=True)
+    count = mapped_column(Integer, nullable=False)
+
+class DomainCount(Base):
+    '''
+        This class represents the number of people for each email domain.
+    '''
+    __tablename__ = "domain_count"
+
+    domain = mapped_column(String(254), primary_key=True)
+    count = mapped_column(Integer, nullable=False)
+
+class IpFirstOctetCount(Base):
+    '''
+        This class represents the number of IPv4 addresses for each value of their first number (from which the class is derived).
+    '''
+    __tablename__ = "ip_first_octet_count"
+
+    first_octet = mapped_column(Integer, primary_key=True, autoincrement=False)
+    count = mapped_column(Integer, nullable=False)
@@ -0,0 +1,175 @@
+'''
+This file contains the migrations needed to update a database created with a previous version of the entities in db_entities.py.
+Tables that do not exist yet are created directly by Base.metadata.create_all(), so migrations only need to update existing tables.
+'''
+import logging
+import sqlalchemy
+from sqlalchemy import select, update, bindparam
+from sqlalchemy.schema import CreateColumn
+from db_management.db_entities import Base, Person, Country
+from db_management.summaries import SUMMARY_TABLES, rebuild_summaries
+from ip_index import packed_ip_addresses
+
+def add_missing_columns(engine, table):
+    '''
+        This function adds to an existing table the columns defined in the entities but missing in the database.
+
+        PARAMETERS
+        engine -> A sqlalchemy engine to interact with the database.
+        table -> The sqlalchemy Table to update.
+
+        RETURNS
+        The list of the names of the columns that have been added.
+    '''
+    existing_columns = {c["name"] for c in sqlalchemy.inspect(engine).get_columns(table.name)}
+    added = []
+    with engine.begin() as connection:
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+            column_ddl = str(CreateColumn(column).compile(dialect=engine.dialect))
+            if engine.dialect.name == "sqlite" and column.computed is not None:
+                # SQLite cannot add stored generated columns to an existing table, but virtual ones can be added and indexed as well
+                column_ddl = column_ddl.replace("STORED", "VIRTUAL")
+            connection.execute(sqlalchemy.text(f"ALTER TABLE {table.name} ADD COLUMN {column_ddl}"))
+            added.append(column.name)
+            logging.info(f"Column '{column.name}' added to table '{table.name}'")
+    return added
+
+def widen_string_columns(engine, table):
+    '''
+        This function increases the length of the string columns that are shorter in the database than in the entities
+        (e.g., 'ip_address', widened to store IPv6 addresses). SQLite does not enforce the lengths, so it is not updated.
+
+        RETURNS
+        The list of the names of the columns that have been widened.
+    '''
+    if engine.dialect.name not in ("mysql", "postgresql"):
+        return []
+    existing_columns = {c["name"]: c for c in sqlalchemy.inspect(engine).get_columns(table.name)}
+    widened = []
+    with engine.begin() as connection:
+        for column in table.columns:
+            existing = existing_columns.get(column.name)
+            length = getattr(column.type, "length", None)
+            existing_length = getattr(existing["type"], "length", None) if existing else None
+            if column.computed is not None or not length or not existing_length or existing_length >= length:
+                continue
+            column_type = column.type.compile(dialect=engine.dialect)
+            if engine.dialect.name == "mysql":
+                statement = f"ALTER TABLE {table.name} MODIFY {column.name} {column_type}{'' if column.nullable else ' NOT NULL'}"
+            else:
+                statement = f"ALTER TABLE {table.name} ALTER COLUMN {column.name} TYPE {column_type}"
+            connection.execute(sqlalchemy.text(statement))
+            widened.append(column.name)
+            logging.info(f"Column '{column.name}' of table '{table.name}' widened from {existing_length} to {length} characters")
+    return widened
+
+def fill_packed_ip_addresses(engine, chunk_size=50000):
+    '''
+        This function computes the column 'ip_packed' of the people where it is missing (e.g., after the column has been added,
+        or after a bulk load, which only inserts the columns of the csv file).
+
+        PARAMETERS
+        engine -> A sqlalchemy engine to interact with the database.
+        chunk_size -> The number of people updated in each transaction (when the values are computed in Python).
+
+        RETURNS
+        The number of people updated.
+    '''
+    table = Person.__table__
+    if engine.dialect.name == "mysql":
+        # MySQL computes the same encoding with INET6_ATON (IPv4 addresses are mapped into ::ffff:0:0/96 first)
+        with engine.begin() as connection:
+            filled = connection.execute(sqlalchemy.text("UPDATE person SET ip_packed = INET6_ATON(IF(IS_IPV4(ip_address), "
+                                                        "CONCAT('::ffff:', ip_address), ip_address)) WHERE ip_packed IS NULL")).rowcount
+    else:
+        filled = 0
+        last_id = 0
+        statement = update(table).where(table.c.id == bindparam("person_id")).values(ip_packed=bindparam("packed"))
+        while True:
+            with engine.begin() as connection:
+                rows = connection.execute(select(table.c.id, table.c.ip_address).where(table.c.ip_packed == None, table.c.id > last_id)
+                                          .order_by(table.c.id).limit(chunk_size)).all()
+                if not rows:
+                    break
+                values = [{"person_id": id, "packed": packed} for (id, _), packed in zip(rows, packed_ip_addresses([r[1] for r in rows]))
+                          if packed is not None]
+                if values:
+                    connection.execute(statement, values)
+            filled += len(values)
+            last_id = rows[-1][0]
+    if filled:
+        logging.info(f"Column 'ip_packed' computed for {filled} people")
+    return filled
+
+def redefine_ip_first_octet(engine):
+    '''
+        This function redefines the generated column 'ip_first_octet' of the databases created when it was computed from any text
+        before the first '.' (0 for addresses such as '::ffff:1.2.3.4', or an error with the strict mode of MySQL).
+        MySQL modifies the column, while the other databases drop it (along with its index): it is then added again by
+        add_missing_columns and its index by create_missing_indexes.
+
+        PARAMETERS
+        engine -> A sqlalchemy engine to interact with the database.
+
+        RETURNS
+        True if the column has been redefined (the summary table ip_first_octet_count must then be rebuilt).
+    '''
+    column = Person.__table__.c["ip_first_octet"]
+    existing = {c["name"]: c for c in sqlalchemy.inspect(engine).get_columns(Person.__tablename__)}.get(column.name)
+    # Only the current expression checks the digits before the first '.' (with REPLACE)
+    if existing is None or existing.get("computed") is None or "replace" in str(existing["computed"]["sqltext"]).lower():
+        return False
+    with engine.begin() as connection:
+        if engine.dialect.name == "mysql":
+            column_ddl = str(CreateColumn(column).compile(dialect=engine.dialect))
+            connection.execute(sqlalchemy.text(f"ALTER TABLE {Person.__tablename__} MODIFY COLUMN {column_ddl}"))
+        else:
+            for index in Person.__table__.indexes:
+                if column.name in index.columns:
+                    connection.execute(sqlalchemy.text(f"DROP INDEX IF EXISTS {index.name}"))
+            connection.execute(sqlalchemy.text(f"ALTER TABLE {Person.__tablename__} DROP COLUMN {column.name}"))
+    logging.info(f"Column '{column.name}' of table '{Person.__tablename__}' redefined")
+    return True
+
+def create_missing_indexes(engine, table):
+    '''
+        This function creates the indexes defined in the entities but missing in the database.
+        A unique index cannot be created while the table contains duplicates: in that case the error is logged and the other
+        indexes are created anyway (the duplicates can be removed with 'initialize_db.py --remove-duplicates').
+
+        RETURNS
+        The list of the names of the indexes that could not be created.
+    '''
+    failed = []
+    for index in table.indexes:
+        try:
+            index.create(engine, checkfirst=True)
+        except sqlalchemy.exc.IntegrityError as e:
+            logging.error(f"Index '{index.name}' of table '{table.name}' not created: {e.orig}")
+            failed.append(index.name)
+    return failed
+
+def migrate(engine):
+    '''
+        This function updates the schema of an existing database to the current version of the entities.
+
+        PARAMETERS
+        engine -> A sqlalchemy engine to interact with the database.
+    '''
+    missing_summary_tables = [t.name for t in SUMMARY_TABLES if not sqlalchemy.inspect(engine).has_table(t.name)]
+    Base.metadata.create_all(engine) # Creates the missing tables
+    redefined = redefine_ip_first_octet(engine)
+    for table in (Person.__table__, Country.__table__):
+        add_missing_columns(engine, table)
+        widen_string_columns(engine, table)
+        create_missing_indexes(engine, table)
+    fill_packed_ip_addresses(engine)
+    if missing_summary_tables or redefined:
+        # The summary tables have just been created (or the first numbers of the ip addresses have changed), so they are filled
+        # with the data already in the database
+        with engine.begin() as connection:
+            rebuild_summaries(connection)
+        logging.info(f"Summary tables {missing_summary_tables or [t.name for t in SUMMARY_TABLES]} filled")
+    logging.info("Database schema updated successfully")
@@ -0,0 +1,157 @@
+'''
+This file contains the functions used to maintain the summary tables defined in db_entities.py (number of people for each country,
+gender, pair <country, gender>, email domain and first number of the ip address).
+The summary tables are rebuilt from the tables 'person' and 'country' after the data is loaded, and updated incrementally in the same
+transaction that inserts new people, so that they are always consistent with the data.
+'''
+import logging
+from collections import namedtuple, Counter
+from sqlalchemy import select, func, insert, update, delete, and_
+from sqlalchemy.dialects import mysql, sqlite, postgresql
+from db_management.db_entities import Person, Country, CountryCount, GenderCount, CountryGenderCount, DomainCount, IpFirstOctetCount, derived_columns, derived_values
+
+# For each summary table: the entity, the key columns (along with the column of the people Dataframe they are computed from)
+# and the query computing the content of the table from the tables 'person' and 'country'
+Summary = namedtuple("Summary", ["entity", "keys", "query"])
+SUMMARIES = [Summary(CountryCount, {"country": "country"},
+                     select(Country.country, func.count()).select_from(Person).join(Country).group_by(Country.country)),
+             Summary(GenderCount, {"gender": "gender"},
+                     select(Person.gender, func.count()).group_by(Person.gender)),
+             Summary(CountryGenderCount, {"country": "country", "gender": "gender"},
+                     select(Country.country, Person.gender, func.count()).select_from(Person).join(Country).group_by(Country.country, Person.gender)),
+             Summary(DomainCount, {"domain": "email_domain"},
+                     select(Person.email_domain, func.count()).group_by(Person.email_domain)),
+             Summary(IpFirstOctetCount, {"first_octet": "ip_first_octet"},
+                     select(Person.ip_first_octet, func.count()).where(Person.ip_first_octet != None).group_by(Person.ip_first_octet))]
+
+SUMMARY_TABLES = [summary.entity.__table__ for summary in SUMMARIES]
+
+def rebuild_summaries(connection):
+    '''
+        This function recomputes the content of all the summary tables from the tables 'person' and 'country'.
+
+        PARAMETERS
+        connection -> A sqlalchemy connection (or session) with an active transaction.
+    '''
+    for summary in SUMMARIES:
+        table = summary.entity.__table__
+        connection.execute(delete(table))
+        connection.execute(insert(table).from_select([*summary.keys, "count"], summary.query))
+
+def _upsert_counts(connection, table, keys, rows):
+    '''
+        This function adds the given counts to the rows of a summary table, creating the rows that do not exist yet.
+    '''
+    dialect = connection.dialect.name
+    if dialect == "mysql":
+        statement = mysql.insert(table).values(rows)
+        connection.execute(statement.on_duplicate_key_update(count=table.c["count"] + statement.inserted["count"]))
+    elif dialect in ("sqlite", "postgresql"):
+        statement = (sqlite if dialect == "sqlite" else postgresql).insert(table).values(rows)
+        connection.execute(statement.on_conflict_do_update(index_elements=keys, set_={"count": table.c["count"] + statement.excluded["count"]}))
+    else:
+        # Databases without an upsert statement supported by sqlalchemy: the row is inserted only if the update does not find it
+        for row in rows:
+            condition = and_(*[table.c[key] == row[key] for key in keys])
+            if connection.execute(update(table).where(condition).values(count=table.c["count"] + row["count"])).rowcount == 0:
+                connection.execute(insert(table).values(row))
+
+def update_summaries(connection, people):
+    '''
+        This function updates the summary tables after the insertion of new people.
+
+        PARAMETERS
+        connection -> The sqlalchemy connection used to insert the people (the update is part of the same transaction).
+        people -> A Pandas Dataframe with columns email, gender, ip_address and country (one row for each pair <person, country>,
+                  a missing country being None). With a column id, the people appearing in more than one row are counted once
+                  in the summaries that do not depend on the country.
+    '''
+    add_summary_counts(connection, count_summaries(people))
+
+def count_summaries(people):
+    '''
+        This function computes the counts that new people add to the summary tables, without accessing the database (so that it can
+        be executed apart from the transaction, see database.offload).
+
+        PARAMETERS
+        people -> A Pandas Dataframe as in update_summaries.
+
+        RETURNS
+        A list of pairs <summary, rows>, the rows being dictionaries with the key columns and the count.
+    '''
+    if len(people) == 0:
+        return []
+    people = derived_columns(people)
+    persons = people.drop_duplicates("id") if "id" in people.columns else people
+    # The counts are computed on lists of Python values (as passed to the database driver), NULL values excluded: for the few people
+    # of a write this is much faster than a groupby, and it shortens the transaction, which holds the locks of the summary rows
+    summary_counts = []
+    for summary in SUMMARIES:
+        rows = people if "country" in summary.keys else persons
+        columns = [rows[column].astype(object).where(rows[column].notna(), None).tolist() for column in summary.keys.values()]
+        counts = Counter(key for key in zip(*columns) if None not in key)
+        if counts:
+            summary_counts.append((summary, [{**dict(zip(summary.keys, key)), "count": count} for key, count in counts.items()]))
+    return summary_counts
+
+def add_summary_counts(connection, summary_counts):
+    '''
+        This function adds the counts computed by count_summaries to the summary tables.
+
+        PARAMETERS
+        connection -> The sqlalchemy connection used to insert the people (the update is part of the same transaction).
+        summary_counts -> The list of pairs <summary, rows> returned by count_summaries.
+    '''
+    for summary, rows in summary_counts:
+        _upsert_counts(connection, summary.entity.__table__, list(summary.keys), rows)
+
+def add_person_to_summaries(connection, email, gender, ip_address, country):
+    '''
+        This function updates the summary tables after the insertion of a single person (as update_summaries, without the overhead
+        of a Dataframe).
+
+        PARAMETERS
+        connection -> The sqlalchemy connection used to insert the person (the update is part of the same transaction).
+        email, gender, ip_address, country -> The values stored for the person (country None if it has no country).
+    '''
+    person = {"gender": gender, "country": country, **derived_values(email, ip_address)}
+    for summary in SUMMARIES:
+        key = {key: person[column] for key, column in summary.keys.items()}
+        if None not in key.values():
+            _upsert_counts(connection, summary.entity.__table__, list(summary.keys), [{**key, "count": 1}])
+
+def count_people(connection, max_id=None):
+    '''
+        This function returns the number of people in the database (with an id up to max_id, if given).
+        The summary table of the genders contains a row for each person, so it gives the number of people cheaply: only the people
+        with an id greater than max_id are counted.
+
+        PARAMETERS
+        connection -> A sqlalchemy connection (or session).
+        max_id -> An optional id.
+    '''
+    n_people = connection.execute(select(func.coalesce(func.sum(GenderCount.count), 0))).scalar()
+    if max_id is not None:
+        n_people -= connection.execute(select(func.count()).select_from(Person).where(Person.id > max_id)).scalar()
+    return n_people
+
+def verify_summaries(connection):
+    '''
+        This function compares the summary tables with the aggregates computed from the tables 'person' and 'country'.
+
+        PARAMETERS
+        connection -> A sqlalchemy connection (or session).
+
+        RETURNS
+        A dictionary with the number of wrong (or missing) rows of each summary table: all the values are 0 if the tables are consistent.
+    '''
+    errors = {}
+    for summary in SUMMARIES:
+        table = summary.entity.__table__
+        stored = {tuple(row[:-1]): row[-1] for row in connection.execute(select(*[table.c[key] for key in summary.keys], table.c["count"]))}
+        expected = {tuple(row[:-1]): row[-1] for row in connection.execute(summary.query)}
+        stored = {key: count for key, count in stored.items() if count != 0}
+        errors[table.name] = sum(stored.get(key) != expected.get(key) for key in stored.keys() | expected.keys())
+        if errors[table.name]:
+            logging.warning(f"Summary table '{table.name}' has {errors[table.name]} wrong rows")
+    return errors
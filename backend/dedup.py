@@ -0,0 +1,288 @@
+'''
+This file contains the detection of duplicate people:
+- on insert, a person is a duplicate if a person with the same email already exists (the column 'email' has a unique index).
+  A Bloom filter of the emails in the database answers "surely not present" for most new emails, so that only the few emails
+  that may be present are looked up in the database;
+- in bulk, likely duplicates among the existing people (same person with a slightly different name or email) are found with
+  MinHash signatures of the trigrams of their normalized name and email, grouped with Locality Sensitive Hashing (LSH):
+  only the people sharing a band of their signatures are compared, instead of all the pairs.
+'''
+import math
+import threading
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from sqlalchemy import select, delete, func
+from database import Session
+from db_management.db_entities import Person, Country
+from db_management.summaries import rebuild_summaries
+from search_index import trigrams
+from sketches import hash_values
+
+# Number of people whose signatures are computed at once (bounds the memory used by the vectorized computation)
+MINHASH_CHUNK_SIZE = 2000
+# People in the same LSH bucket are compared only with the following MAX_BUCKET_NEIGHBORS people of the bucket, so that
+# very common values (e.g., a frequent name) do not produce a quadratic number of pairs
+MAX_BUCKET_NEIGHBORS = 50
+# Capacity of the first filter of a BloomFilter
+DEFAULT_CAPACITY = 1000000
+
+class BloomFilter:
+    '''
+        This class implements a scalable Bloom filter: when the number of items exceeds the capacity of the last filter, a new
+        filter with twice the capacity (and a lower error rate) is added, so that the false positive rate stays bounded by
+        'error_rate' however many items are added. There are no false negatives.
+    '''
+    def __init__(self, capacity=DEFAULT_CAPACITY, error_rate=0.01):
+        self.error_rate = error_rate
+        self.size = 0
+        self._filters = [] # Tuples (bits, number of bits, number of hash functions, capacity, number of items)
+        self._next_capacity = max(int(capacity), 1)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_engine(cls, engine, error_rate=0.01, chunk_size=100000, max_id=None):
+        '''
+            This function creates the filter of the emails of all the people of the database (up to max_id, if given).
+        '''
+        query = select(Person.email)
+        if max_id is not None:
+            query = query.where(Person.id <= max_id)
+        with Session(bind=engine) as session:
+            result = session.execute(query, execution_options={"yield_per": chunk_size})
+            emails = [email for rows in result.partitions() for (email,) in rows]
+        # The first filter has room for the people that will be created after the start (at least the default capacity, otherwise
+        # a small database would start with tiny filters, whose error rates add up to more than 'error_rate' before they grow)
+        bloom_filter = cls(capacity=max(2 * len(emails), DEFAULT_CAPACITY), error_rate=error_rate)
+        bloom_filter.add(emails)
+        return bloom_filter
+
+    def _add_filter(self):
+        # The error rates of the filters form a geometric series (error_rate / 2, error_rate / 4, ...), whose sum is error_rate
+        error_rate = self.error_rate / 2 ** (len(self._filters) + 1)
+        n_bits = max(64, math.ceil(-self._next_capacity * math.log(error_rate) / math.log(2) ** 2))
+        n_hashes = max(1, round(n_bits / self._next_capacity * math.log(2)))
+        self._filters.append([np.zeros((n_bits + 7) // 8, dtype=np.uint8), n_bits, n_hashes, self._next_capacity, 0])
+        self._next_capacity *= 2
+
+    @staticmethod
+    def _positions(hashes, n_bits, n_hashes):
+        # Bit of each item for each hash function, with the double hashing of Kirsch and Mitzenmacher: h1 + i * h2
+        h1 = hashes & np.uint64(0xFFFFFFFF)
+        h2 = (hashes >> np.uint64(32)) | np.uint64(1)
+        return (h1[None, :] + np.arange(n_hashes, dtype=np.uint64)[:, None] * h2[None, :]) % np.uint64(n_bits)
+
+    def add(self, values):
+        '''
+            This function adds a sequence of items (strings) to the filter.
+        '''
+        hashes = hash_values(values)
+        with self._lock:
+            start = 0
+            while start < len(hashes):
+                if not self._filters or self._filters[-1][4] >= self._filters[-1][3]:
+                    self._add_filter()
+                bits, n_bits, n_hashes, capacity, count = self._filters[-1]
+                batch = hashes[start:start + capacity - count]
+                positions = self._positions(batch, n_bits, n_hashes).ravel()
+                np.bitwise_or.at(bits, positions >> np.uint64(3), np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+                self._filters[-1][4] += len(batch)
+                start += len(batch)
+            self.size += len(hashes)
+
+    def might_contain(self, values):
+        '''
+            This function returns a NumPy array of booleans, False for the items that have surely never been added to the filter.
+        '''
+        hashes = hash_values(values)
+        found = np.zeros(len(hashes), dtype=bool)
+        with self._lock:
+            filters = [tuple(f[:3]) for f in self._filters]
+        for bits, n_bits, n_hashes in filters:
+            positions = self._positions(hashes, n_bits, n_hashes)
+            found |= ((bits[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1).astype(bool).all(axis=0)
+        return found
+
+def normalize_names(first_names, last_names):
+    '''
+        This function normalizes the names of the people: lower case, without accents and without characters other than letters.
+    '''
+    names = pd.Series(first_names, dtype=object).fillna("") + " " + pd.Series(last_names, dtype=object).fillna("").to_numpy()
+    names = names.str.normalize("NFKD").str.encode("ascii", "ignore").str.decode("ascii").str.lower()
+    return names.str.replace(r"[^a-z ]+", "", regex=True).str.split().str.join(" ")
+
+def normalize_emails(emails):
+    '''
+        This function normalizes the emails: lower case, and the local part without tags ('+...') and without separators
+        ('.', '_' and '-'), which are often ignored or changed (e.g., 'john.doe+shop@mail.com' becomes 'johndoe@mail.com').
+    '''
+    parts = pd.Series(emails, dtype=object).fillna("").str.lower().str.rsplit("@", n=1, expand=True).reindex(columns=[0, 1])
+    local = parts[0].str.split("+", n=1).str[0].str.replace(r"[._-]+", "", regex=True)
+    return local.str.cat(parts[1].fillna(""), sep="@")
+
+def minhash_signatures(texts, n_permutations=64, seed=0):
+    '''
+        This function computes the MinHash signature of the set of trigrams of each text: the fraction of equal values
+        in the signatures of two texts is an unbiased estimate of the Jaccard similarity of their sets of trigrams.
+
+        PARAMETERS
+        texts -> A sequence of strings.
+        n_permutations -> The length of the signatures (number of hash functions).
+        seed -> The seed used to choose the hash functions.
+
+        RETURNS
+        A NumPy array with a row (the signature) for each text.
+    '''
+    # Multiply-shift hash functions: the high 32 bits of a * x + b (modulo 2^64), with a odd
+    random = np.random.default_rng(seed)
+    a = random.integers(0, 1 << 63, size=n_permutations, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    b = random.integers(0, 1 << 63, size=n_permutations, dtype=np.uint64)
+    texts = pd.Series(texts, dtype=object)
+    signatures = np.empty((len(texts), n_permutations), dtype=np.uint32)
+    for start in range(0, len(texts), MINHASH_CHUNK_SIZE):
+        positions, codes = trigrams(texts.iloc[start:start + MINHASH_CHUNK_SIZE])
+        # The hashes are computed once for each distinct trigram of the chunk (far fewer than the trigrams)
+        distinct_codes, inverse = np.unique(codes, return_inverse=True)
+        distinct_hashes = ((a[:, None] * distinct_codes.astype(np.uint64)[None, :] + b[:, None]) >> np.uint64(32)).astype(np.uint32)
+        # Each text has at least one trigram (because of the padding) and the positions are sorted, so each text is a
+        # contiguous segment of the trigrams and the minimum of each segment is computed with np.minimum.reduceat
+        # (take returns a C-contiguous array, on which reduceat is several times faster than on the result of fancy indexing)
+        starts = np.flatnonzero(np.r_[True, positions[1:] != positions[:-1]])
+        signatures[start:start + len(starts)] = np.minimum.reduceat(distinct_hashes.take(inverse.ravel(), axis=1), starts, axis=1).T
+    return signatures
+
+def lsh_candidate_pairs(signatures, n_bands=16):
+    '''
+        This function finds the pairs of texts whose signatures are equal in at least one band (a group of consecutive values).
+        With b bands of r values, a pair with Jaccard similarity s is found with probability 1 - (1 - s^r)^b.
+
+        RETURNS
+        A NumPy array with a row <i, j> (i < j) for each pair of rows of the signatures.
+    '''
+    n, n_permutations = signatures.shape
+    rows_per_band = n_permutations // n_bands
+    multipliers = np.random.default_rng(0).integers(1, 1 << 63, size=rows_per_band, dtype=np.uint64) | np.uint64(1)
+    pairs = []
+    for band in range(n_bands):
+        # Key of the band of each signature (a hash of its values), the signatures with the same key are in the same bucket
+        values = signatures[:, band * rows_per_band:(band + 1) * rows_per_band].astype(np.uint64)
+        keys = (values * multipliers).sum(axis=1) # Wraps around modulo 2^64
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        for distance in range(1, MAX_BUCKET_NEIGHBORS + 1):
+            same_bucket = np.flatnonzero(keys[distance:] == keys[:-distance])
+            if len(same_bucket) == 0:
+                break
+            pairs.append(np.column_stack([order[same_bucket], order[same_bucket + distance]]))
+    return _unique_pairs(np.concatenate(pairs) if pairs else np.zeros((0, 2), dtype=np.int64), n)
+
+def _unique_pairs(pairs, n):
+    # Each pair is kept once, as <i, j> with i < j (sorting and dropping the adjacent duplicates is faster than np.unique on large arrays)
+    pairs = np.sort(pairs.astype(np.int64), axis=1)
+    keys = np.sort(pairs[:, 0] * n + pairs[:, 1])
+    keys = keys[np.r_[True, keys[1:] != keys[:-1]]] if len(keys) else keys
+    return np.column_stack([keys // n, keys % n])
+
+def find_duplicates(people, threshold=0.7, n_permutations=64, n_bands=16):
+    '''
+        This function finds the likely duplicates among a set of people.
+        Two people are likely duplicates if they have the same normalized email, or if the estimated Jaccard similarity of the
+        trigrams of their normalized name and email is at least 'threshold'.
+
+        PARAMETERS
+        people -> A Pandas Dataframe with columns id, first_name, last_name and email.
+        threshold -> The minimum similarity of two duplicates.
+        n_permutations, n_bands -> The length of the MinHash signatures and the number of bands used by LSH (n_bands should
+                                   divide n_permutations; more bands find more pairs with a lower similarity, but are slower).
+
+        RETURNS
+        A Pandas Dataframe with columns id_1, id_2 (id_1 < id_2) and similarity, with a row for each pair of likely duplicates.
+    '''
+    if len(people) < 2:
+        # No pair to compare (the string functions below would also fail on the empty columns of an empty database)
+        return pd.DataFrame({"id_1": np.zeros(0, dtype=np.int64), "id_2": np.zeros(0, dtype=np.int64), "similarity": np.zeros(0)})
+    people = people.reset_index(drop=True)
+    names = normalize_names(people["first_name"], people["last_name"])
+    emails = normalize_emails(people["email"])
+    # The name and the local part of the email are compared together, so that the same person is found even if only one of them changed
+    signatures = minhash_signatures(names + " " + emails, n_permutations)
+    # People with the same normalized email are always compared, also when LSH misses them (e.g., very different names)
+    email_codes = pd.factorize(emails)[0]
+    first_of_email = pd.Series(np.arange(len(emails))).groupby(email_codes).transform("min").to_numpy()
+    email_pairs = np.flatnonzero(first_of_email != np.arange(len(emails)))
+    pairs = _unique_pairs(np.concatenate([lsh_candidate_pairs(signatures, n_bands),
+                                          np.column_stack([first_of_email[email_pairs], email_pairs])]), len(people))
+
+    similarity = np.empty(len(pairs))
+    for start in range(0, len(pairs), MINHASH_CHUNK_SIZE):
+        chunk = pairs[start:start + MINHASH_CHUNK_SIZE]
+        similarity[start:start + len(chunk)] = (signatures[chunk[:, 0]] == signatures[chunk[:, 1]]).mean(axis=1)
+    similarity[email_codes[pairs[:, 0]] == email_codes[pairs[:, 1]]] = 1.0
+    selected = similarity >= threshold
+    pairs, similarity = pairs[selected], similarity[selected]
+
+    ids = people["id"].to_numpy()
+    id_1, id_2 = ids[pairs[:, 0]], ids[pairs[:, 1]]
+    duplicates = pd.DataFrame({"id_1": np.minimum(id_1, id_2), "id_2": np.maximum(id_1, id_2), "similarity": similarity})
+    return duplicates.sort_values(["id_1", "id_2"], ignore_index=True)
+
+def duplicate_groups(duplicates):
+    '''
+        This function groups the people that are duplicates of each other (directly or through other people).
+
+        PARAMETERS
+        duplicates -> The output of find_duplicates.
+
+        RETURNS
+        A Pandas Series with the group of each person appearing in the pairs (indexed by id), numbered from 0 by smallest id.
+    '''
+    ids, edges = np.unique(duplicates[["id_1", "id_2"]].to_numpy(), return_inverse=True)
+    edges = edges.reshape(-1, 2)
+    graph = coo_matrix((np.ones(len(edges)), (edges[:, 0], edges[:, 1])), shape=(len(ids), len(ids)))
+    _, labels = connected_components(graph, directed=False)
+    # Groups renumbered in order of their first id (ids are sorted, so the first occurrence of each label is its smallest id)
+    _, first = np.unique(labels, return_index=True)
+    renumbered = np.empty(len(first), dtype=np.int64)
+    renumbered[np.argsort(first)] = np.arange(len(first))
+    return pd.Series(renumbered[labels], index=pd.Index(ids, name="id"), name="group")
+
+def find_duplicates_in_database(engine, threshold=0.7, chunk_size=100000):
+    '''
+        This function finds the likely duplicates among all the people of the database (see find_duplicates).
+
+        RETURNS
+        A Pandas Dataframe with columns group, id, first_name, last_name, email and ip_address, with a row for each person having
+        at least a likely duplicate, sorted by group and id.
+    '''
+    query = select(Person.id, Person.first_name, Person.last_name, Person.email, Person.ip_address).order_by(Person.id)
+    with Session(bind=engine) as session:
+        result = session.execute(query, execution_options={"yield_per": chunk_size})
+        people = pd.concat([pd.DataFrame.from_records(rows, columns=list(result.keys())) for rows in result.partitions()]
+                           or [pd.DataFrame(columns=list(result.keys()))], ignore_index=True)
+    groups = duplicate_groups(find_duplicates(people, threshold))
+    people = people[people["id"].isin(groups.index)]
+    return people.assign(group=groups.loc[people["id"]].to_numpy())[["group", *people.columns]].sort_values(["group", "id"], ignore_index=True)
+
+def remove_duplicate_emails(engine, chunk_size=10000):
+    '''
+        This function deletes the people having the same email (ignoring the case) of a person with a smaller id, along with
+        their countries, and rebuilds the summary tables in the same transaction. It is needed before the unique index on the
+        column 'email' can be created on a database with duplicates.
+
+        RETURNS
+        The number of people deleted.
+    '''
+    first_ids = select(func.lower(Person.email).label("email"), func.min(Person.id).label("first_id"))\
+                    .group_by(func.lower(Person.email)).having(func.count() > 1).subquery()
+    query = select(Person.id).join(first_ids, func.lower(Person.email) == first_ids.c.email).where(Person.id > first_ids.c.first_id)
+    with engine.begin() as connection:
+        ids = connection.execute(query).scalars().all()
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            # The countries are deleted explicitly, since SQLite does not enforce the ON DELETE CASCADE by default
+            connection.execute(delete(Country).where(Country.person_id.in_(chunk)))
+            connection.execute(delete(Person).where(Person.id.in_(chunk)))
+        if ids:
+            rebuild_summaries(connection)
+    return len(ids)
@@ -0,0 +1,114 @@
+'''
+This file contains the engine used to detect the patterns of the emails (e.g., first_name.last_name, flast_name, first_namel).
+The patterns are not defined in the code but in a catalogue (email_patterns.json by default), where each pattern has:
+    - name -> The name of the pattern (e.g., "first.last").
+    - template -> The beginning of the local part of the email, built with the fields {first} (first name), {last} (last name),
+                  {f} (first letter of the first name) and {l} (first letter of the last name), e.g. "{first}.{last}".
+    - exclude -> An optional list of patterns (defined before this one) that must not match for this pattern to match
+                 (e.g., "firstl" excludes "firstlast", otherwise every firstlast email would be also a firstl email).
+As in the previous version, an email matches a pattern if its local part starts with the pattern, so it can be followed by other characters.
+'''
+import json
+import os
+import string
+import numpy as np
+import pandas as pd
+
+DEFAULT_CATALOGUE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "email_patterns.json")
+TEMPLATE_FIELDS = ("first", "last", "f", "l")
+# Number of emails processed at a time, to bound the memory used by the fixed width string arrays
+CHUNK_SIZE = 50000
+
+_catalogue_cache = {}
+
+def load_catalogue(path=None):
+    '''
+        This function loads the catalogue of patterns. The catalogue is read again only when the file changes.
+
+        PARAMETERS
+        path -> The path of the catalogue (if None, the one defined by 'email_patterns_file' in the .env file or the default one).
+
+        RETURNS
+        A list of patterns, each one being a dictionary with the keys name, template and exclude.
+    '''
+    path = path or os.environ.get("email_patterns_file") or DEFAULT_CATALOGUE_FILE
+    modification_time = os.path.getmtime(path)
+    cached = _catalogue_cache.get(path)
+    if cached is not None and cached[0] == modification_time:
+        return cached[1]
+
+    with open(path, encoding="utf-8") as f:
+        catalogue = json.load(f)
+    names = set()
+    for pattern in catalogue:
+        for _, field, _, _ in string.Formatter().parse(pattern["template"]):
+            if field is not None and field not in TEMPLATE_FIELDS:
+                raise ValueError(f"Unknown field '{field}' in the template of the email pattern '{pattern['name']}'")
+        pattern.setdefault("exclude", [])
+        for excluded in pattern["exclude"]:
+            if excluded not in names:
+                raise ValueError(f"The email pattern '{pattern['name']}' excludes '{excluded}', which is not defined before it")
+        names.add(pattern["name"])
+
+    _catalogue_cache[path] = (modification_time, catalogue)
+    return catalogue
+
+def _build_prefixes(template, fields):
+    '''
+        This function builds, for each person, the prefix corresponding to a template by concatenating whole columns.
+    '''
+    prefix = pd.Series("", index=fields["first"].index)
+    for literal, field, _, _ in string.Formatter().parse(template):
+        prefix = prefix + literal
+        if field is not None:
+            prefix = prefix + fields[field]
+    return prefix.to_numpy(dtype=str)
+
+def match_email_patterns(first_names, last_names, local_parts, catalogue):
+    '''
+        This function checks which patterns are matched by each email. All the patterns are evaluated together on arrays of strings,
+        without any loop over the people in Python.
+
+        PARAMETERS
+        first_names, last_names -> Pandas Series containing the first and last name of each person.
+        local_parts -> A Pandas Series containing the part of the email before '@' for each person.
+        catalogue -> The list of patterns (see load_catalogue).
+
+        RETURNS
+        A NumPy matrix of booleans with a row for each pattern and a column for each person.
+    '''
+    first_names = first_names.fillna("").str.lower()
+    # Remove " ", "-", '.' and "'" from surname
+    last_names = last_names.fillna("").str.lower().str.replace(r"[ .\-']", "", regex=True)
+    fields = {"first": first_names, "last": last_names, "f": first_names.str[:1], "l": last_names.str[:1]}
+
+    prefixes = np.stack([_build_prefixes(pattern["template"], fields) for pattern in catalogue])
+    matches = np.char.startswith(local_parts.fillna("").to_numpy(dtype=str)[np.newaxis, :], prefixes)
+
+    # Exclusions are applied in the order of the catalogue, so that a pattern excludes the final result of the previous ones
+    positions = {pattern["name"]: i for i, pattern in enumerate(catalogue)}
+    for i, pattern in enumerate(catalogue):
+        for excluded in pattern["exclude"]:
+            matches[i] &= ~matches[positions[excluded]]
+    return matches
+
+def count_email_patterns(people, catalogue):
+    '''
+        This function counts the emails matching each pattern for each domain.
+
+        PARAMETERS
+        people -> A Pandas DataFrame with columns first_name, last_name and email.
+        catalogue -> The list of patterns (see load_catalogue).
+
+        RETURNS
+        A Pandas DataFrame with a row for each domain and a column for each pattern.
+    '''
+    emails = people["email"].str.split("@", n=1, expand=True)
+    domain_codes, domains = pd.factorize(emails[1])
+    counts = np.zeros((len(catalogue), len(domains)), dtype=np.int64)
+    for start in range(0, len(people), CHUNK_SIZE):
+        chunk = slice(start, start + CHUNK_SIZE)
+        matches = match_email_patterns(people["first_name"].iloc[chunk], people["last_name"].iloc[chunk], emails[0].iloc[chunk], catalogue)
+        for i in range(len(catalogue)):
+            counts[i] += np.bincount(domain_codes[chunk][matches[i]], minlength=len(domains))
+    return pd.DataFrame(counts.T, index=pd.Index(domains, name="Domain"), columns=[pattern["name"] for pattern in catalogue])
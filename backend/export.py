@@ -0,0 +1,132 @@
+'''
+This file contains the export of the people: the rows of the join between 'person' and 'country' (a row for each pair <person, country>,
+or a single row with an empty country for the people without a country) are read with a server-side cursor and encoded in chunks, so
+that the export of the whole dataset uses a constant amount of memory and its first bytes are sent as soon as the first chunk is read.
+The supported formats are:
+- csv: a header followed by a line for each row;
+- ndjson: a JSON object for each line;
+- parquet: Apache Parquet, with a row group for each chunk (written with pyarrow, imported only when this format is requested).
+'''
+import io
+import csv
+import pandas as pd
+from sqlalchemy import select
+from db_management.db_entities import Person, Country
+
+COLUMNS = ["id", "first_name", "last_name", "email", "gender", "ip_address", "country"]
+MEDIA_TYPES = {"csv": "text/csv; charset=utf-8",
+               "ndjson": "application/x-ndjson",
+               "parquet": "application/vnd.apache.parquet"}
+DEFAULT_CHUNK_SIZE = 10000
+MAX_CHUNK_SIZE = 100000
+
+def people_query(country=None, gender=None, domain=None, ip_prefix=None):
+    '''
+        This function builds the query of the export, sorted by id.
+
+        PARAMETERS
+        country, gender, domain, ip_prefix -> Optional filters (as in get_people of api_functionalities.py), combined in AND.
+                                              If the country is given, only the rows of that country are returned.
+    '''
+    query = select(Person.id, Person.first_name, Person.last_name, Person.email, Person.gender, Person.ip_address, Country.country)\
+                .outerjoin(Country)
+    if country:
+        query = query.where(Country.country == country.upper())
+    if gender:
+        query = query.where(Person.gender == gender.title())
+    if domain:
+        query = query.where(Person.email_domain == domain.lower())
+    if ip_prefix:
+        query = query.where(Person.ip_address.startswith(ip_prefix, autoescape=True))
+    return query.order_by(Person.id)
+
+def read_chunks(engine, query, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+        This function reads the rows of a query in chunks, with a server-side cursor (stream_results): the database driver keeps at
+        most one chunk in memory, instead of all the rows as fetchall() or .all().
+
+        PARAMETERS
+        engine -> A synchronous sqlalchemy engine (or connection).
+        query -> The query (see people_query).
+        chunk_size -> The number of rows of each chunk.
+
+        RETURNS
+        A generator of lists of rows (tuples with the values of the columns of the query).
+    '''
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, yield_per=chunk_size).execute(query)
+        for rows in result.partitions():
+            yield rows
+
+class _Sink:
+    '''
+        This class is a file-like object collecting the bytes written by pyarrow, so that they can be sent as they are produced.
+    '''
+    def __init__(self):
+        self.closed = False
+        self._parts = []
+        self._position = 0
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+def _encode_parquet(chunks):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([("id", pa.int64()), ("first_name", pa.string()), ("last_name", pa.string()), ("email", pa.string()),
+                        ("gender", pa.string()), ("ip_address", pa.string()), ("country", pa.string())])
+    sink = _Sink()
+    with pq.ParquetWriter(sink, schema) as writer:
+        for chunk in chunks:
+            frame = pd.DataFrame.from_records(chunk, columns=COLUMNS)
+            writer.write_table(pa.Table.from_pandas(frame, schema=schema, preserve_index=False))
+            yield sink.take()
+    yield sink.take() # Metadata at the end of the file
+
+def encode(chunks, format="csv"):
+    '''
+        This function encodes the chunks of an export.
+
+        PARAMETERS
+        chunks -> An iterable of lists of rows with the values of COLUMNS (see read_chunks).
+        format -> One of the keys of MEDIA_TYPES.
+
+        RETURNS
+        A generator of bytes: the body of the response, a part for each chunk.
+    '''
+    if format == "parquet":
+        yield from _encode_parquet(chunks)
+        return
+    if format == "csv":
+        # The csv module writes the rows directly, without building a DataFrame for each chunk (None is written as an empty value)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(COLUMNS)
+        for chunk in chunks:
+            writer.writerows(chunk)
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue().encode("utf-8") # Only the header if there is no row
+        return
+    for chunk in chunks:
+        lines = pd.DataFrame.from_records(chunk, columns=COLUMNS).to_json(orient="records", lines=True, force_ascii=False)
+        # Older versions of Pandas do not end the last line with a newline
+        yield (lines if lines.endswith("\n") else lines + "\n").encode("utf-8")
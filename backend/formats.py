@@ -0,0 +1,204 @@
+'''
+This file contains the formats of the responses of the analytics endpoints, chosen with the parameter 'format' or with the header Accept:
+- json (default): the same content returned so far (a Dataframe as {column: {index: value}}), encoded with orjson;
+- records: a JSON array with an object for each row;
+- columns: a compact columnar JSON, {"columns": [...], "data": [[values of the first column], ...]};
+- arrow: Apache Arrow IPC stream (media type application/vnd.apache.arrow.stream);
+- parquet: Apache Parquet file (media type application/vnd.apache.parquet).
+The responses are built from the columns of the Dataframes (NumPy arrays or lists), without converting them to a dictionary for each row
+or cell first. Arrow and Parquet are produced with pyarrow, imported only when one of these formats is requested.
+Contents that are not tables (e.g., messages) are always returned as JSON.
+'''
+import io
+import orjson
+import pandas as pd
+
+JSON_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+MEDIA_TYPES = {"json": "application/json",
+               "records": "application/json",
+               "columns": "application/json",
+               "arrow": "application/vnd.apache.arrow.stream",
+               "parquet": "application/vnd.apache.parquet"}
+# Media types of the header Accept selecting a format
+ACCEPTED_MEDIA_TYPES = {"application/json": "json",
+                        "application/vnd.apache.arrow.stream": "arrow",
+                        "application/vnd.apache.parquet": "parquet",
+                        "application/x-parquet": "parquet"}
+
+class UnsupportedFormat(Exception):
+    pass
+
+def negotiate(request):
+    '''
+        This function returns the format of the response of a request: the parameter 'format' if given, otherwise the first
+        supported media type of the header Accept (by quality), otherwise 'json'.
+        Raises UnsupportedFormat if the parameter 'format' is not valid.
+    '''
+    format = request.query_params.get("format")
+    if format is not None:
+        if format not in MEDIA_TYPES:
+            raise UnsupportedFormat(f"Invalid parameter 'format'. This parameter should be one of {', '.join(MEDIA_TYPES)}.")
+        return format
+    accepted = []
+    for position, item in enumerate(request.headers.get("accept", "").split(",")):
+        media_type, *parameters = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for parameter in parameters:
+            if parameter.startswith("q="):
+                try:
+                    quality = float(parameter[2:])
+                except ValueError:
+                    pass
+        if media_type in ACCEPTED_MEDIA_TYPES and quality > 0:
+            accepted.append((-quality, position, ACCEPTED_MEDIA_TYPES[media_type]))
+    return min(accepted)[2] if accepted else "json"
+
+def _columns(df):
+    # The index is returned as a column only if it contains information (e.g., the countries of a distribution): an unnamed integer
+    # index contains only the positions of the rows (also when they are not in order, e.g. after sort_values)
+    if any(name is not None for name in df.index.names) or not pd.api.types.is_integer_dtype(df.index.dtype):
+        df = df.reset_index()
+    return df
+
+def _column_values(column):
+    # Numeric columns are serialized by orjson directly from the NumPy arrays, the others are converted to lists of Python objects
+    return column.to_numpy() if column.dtype.kind in "iufb" else column.astype(object).where(column.notna(), None).tolist()
+
+def _arrow_table(df):
+    import pyarrow as pa
+    return pa.Table.from_pandas(_columns(df).rename(columns=str), preserve_index=False)
+
+def _to_dict(df):
+    # Same result of DataFrame.to_dict(), built a column at a time
+    index = df.index.tolist()
+    return {column: dict(zip(index, values.tolist())) for column, values in df.items()}
+
+def to_json(content):
+    '''
+        This function encodes any content as JSON (a Dataframe as {column: {index: value}}, as with DataFrame.to_dict()).
+    '''
+    if isinstance(content, pd.DataFrame):
+        content = _to_dict(content)
+    return orjson.dumps(content, default=_default, option=JSON_OPTIONS)
+
+def to_records(df):
+    # Encoded by Pandas from the columns (without a dictionary for each row), with the floats rounded to 15 significant digits.
+    # Pandas escapes every '/' as '\/', which is removed as in the other formats (the escape of a '\' is '\\', so it is not affected)
+    content = _columns(df).rename(columns=str).to_json(orient="records", double_precision=15, force_ascii=False, date_format="iso")
+    return content.replace("\\/", "/").encode("utf-8")
+
+def to_columns(df):
+    columns = _columns(df)
+    return orjson.dumps({"columns": [str(c) for c in columns.columns], "data": [_column_values(column) for _, column in columns.items()]},
+                        default=_default, option=JSON_OPTIONS)
+
+def to_arrow(df):
+    import pyarrow as pa
+    table = _arrow_table(df)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def to_parquet(df):
+    import pyarrow.parquet as pq
+    buffer = io.BytesIO()
+    pq.write_table(_arrow_table(df), buffer)
+    return buffer.getvalue()
+
+ENCODERS = {"records": to_records, "columns": to_columns, "arrow": to_arrow, "parquet": to_parquet}
+
+def render(content, format="json"):
+    '''
+        This function encodes the content of a response.
+
+        PARAMETERS
+        content -> The value returned by an endpoint (a Pandas Dataframe for tables).
+        format -> One of the keys of MEDIA_TYPES.
+
+        RETURNS
+        The body of the response (bytes) and its media type.
+    '''
+    if format == "json" or not isinstance(content, pd.DataFrame):
+        return to_json(content), MEDIA_TYPES["json"]
+    return ENCODERS[format](content), MEDIA_TYPES[format]
+
+NO_RESULT_MESSAGE = "No result found in the database."
+
+def _table(df):
+    return df if df is not None else NO_RESULT_MESSAGE
+
+def _matches(df):
+    return df if len(df) else NO_RESULT_MESSAGE
+
+def _people_in_network(result):
+    count, df = result
+    return {"count": count, "people": df.to_dict("records")}
+
+def _most_common_domain(result):
+    domains, count = result
+    if domains:
+        return f"The most commons domains are {domains} which occurr {count} times each."
+    return NO_RESULT_MESSAGE
+
+def _correlation(attributes):
+    def shape(correlation):
+        if correlation is None:
+            return NO_RESULT_MESSAGE
+        return "The correlation between {} is {:.3f}".format(attributes, correlation)
+    return shape
+
+def _common_email_patterns(pattern):
+    if pattern:
+        return f"The most common email pattern is: {pattern}."
+    elif pattern is None:
+        return NO_RESULT_MESSAGE
+    return "None of the analysed patterns is present in the database."
+
+def _association_matrix(result):
+    matrix, intervals = result
+    if matrix is None:
+        return NO_RESULT_MESSAGE
+    return {"attributes": list(matrix.columns),
+            "matrix": matrix.astype(object).where(matrix.notna(), None).to_dict(),
+            "confidence_intervals": {f"{a}|{b}": list(interval) for (a, b), interval in intervals.items()}}
+
+# Content returned for the result of each functionality of api_functionalities.py, the same for the endpoints and the jobs
+RESULT_SHAPES = {"get_people_by_country": _table,
+                 "get_people_count_by_country": _table,
+                 "get_people_gender_distribution": _table,
+                 "get_ip_address_distribution_by_class": _table,
+                 "get_ip_address_distribution": _table,
+                 "get_people_in_network": _people_in_network,
+                 "search_people": _matches,
+                 "get_most_common_domain": _most_common_domain,
+                 "get_country_domain_correlation": _correlation("Country and Domain"),
+                 "get_gender_domain_correlation": _correlation("Gender and Domain"),
+                 "get_email_pattern_counts": _table,
+                 "get_common_email_patterns": _common_email_patterns,
+                 "get_gender_country_correlation": _correlation("Gender and Country"),
+                 "get_gender_distribution_by_country": _table,
+                 "get_association_matrix": _association_matrix}
+
+def shape_result(function_name, result):
+    '''
+        This function converts the result of a functionality of api_functionalities.py into the content of a response: a Pandas
+        Dataframe for tables, a JSON object for the other structured results and a message otherwise (e.g., when there is no data).
+
+        PARAMETERS
+        function_name -> The name of the functionality (a key of RESULT_SHAPES).
+        result -> The value returned by the functionality.
+    '''
+    return RESULT_SHAPES[function_name](result)
+
+def _default(value):
+    # Values not supported natively by orjson (e.g., Pandas timestamps or NumPy scalars of other types)
+    if isinstance(value, pd.DataFrame):
+        return _to_dict(value)
+    if value is pd.NA or value is pd.NaT:
+        return None
+    if hasattr(value, "item"):
+        return value.item()
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    raise TypeError(f"Type {type(value).__name__} is not JSON serializable")
@@ -2,12 +2,23 @@
     This file contains the methods used to initialize the database: create the tables and store the data present in the .csv files
 '''
 import logging
+import argparse
+import tempfile
+import time
 from dotenv import load_dotenv
 import os
 import pandas as pd
 import sqlalchemy
 from sqlalchemy.orm import Session
 import db_management.db_entities as db_entities
+import db_management.migrations as migrations
+import db_management.summaries as summaries
+import dedup
+import column_store
+from ip_index import packed_ip_addresses
+import logging_config
+
+DEFAULT_CHUNK_SIZE = 50000
 
 def export_data_to_db(engine, data):
     '''
@@ -27,57 +38,274 @@ def export_data_to_db(engine, data):
     persons = list()
     countries = list()
 
-    persons = [db_entities.Person(p[0], p[1], p[2], p[3], p[4], p[5]) for p in persons_tuples]
+    # The packed ip addresses are computed for all the people at once (see ip_index.py)
+    packed = packed_ip_addresses(data["person"]["ip_address"])
+    persons = [db_entities.Person(p[0], p[1], p[2], p[3], p[4], p[5], ip_packed) for p, ip_packed in zip(persons_tuples, packed)]
     countries = [db_entities.Country(c[0], c[1], c[2]) for c in countries_tuples]
     
     # Push everything to the database
     with Session(engine) as session:
         session.add_all(persons+countries)
+        session.flush()
+        summaries.rebuild_summaries(session) # Computed in the same transaction of the data
         session.commit()      
 
-def init_db():
+def _load_chunk_with_insert(connection, table, chunk):
+    # A single multi-row INSERT executed through executemany
+    connection.execute(sqlalchemy.insert(table), chunk.to_dict("records"))
+
+def _load_chunk_with_load_data(connection, table, chunk):
+    # The chunk is written to a temporary csv file and loaded by the MySQL server with LOAD DATA LOCAL INFILE
+    with tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False, encoding="utf-8", newline="") as f:
+        chunk.to_csv(f, index=False, header=False, lineterminator="\n")
+    try:
+        columns = ", ".join(chunk.columns)
+        path = f.name.replace("\\", "/")
+        connection.exec_driver_sql(f"LOAD DATA LOCAL INFILE '{path}' INTO TABLE {table.name} CHARACTER SET utf8mb4 "
+                                   f"FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' LINES TERMINATED BY '\\n' ({columns})")
+    finally:
+        os.remove(f.name)
+
+def bulk_load_table(engine, table, data_file, chunk_size=DEFAULT_CHUNK_SIZE, use_load_data=False):
+    '''
+    This function streams a csv file into a table of the database, reading and inserting at most chunk_size rows at a time.
+    Each chunk is committed in its own transaction. If the table already contains some rows (e.g., a previous load failed),
+    the load restarts after the last committed id, so the csv file is expected to be sorted by id.
+
+    PARAMETERS
+    engine -> A sqlalchemy engine to interact with the database.
+    table -> The sqlalchemy Table where data is inserted.
+    data_file -> The path of the csv file.
+    chunk_size -> The number of rows inserted in each transaction.
+    use_load_data -> If True and the database is MySQL, the chunks are loaded with LOAD DATA LOCAL INFILE instead of INSERT statements.
+
+    RETURNS
+    The number of rows inserted.
+    '''
+    load_chunk = _load_chunk_with_load_data if use_load_data and engine.dialect.name == "mysql" else _load_chunk_with_insert
+
+    with engine.connect() as connection:
+        last_id = connection.execute(sqlalchemy.select(sqlalchemy.func.max(table.c.id))).scalar() or 0
+    if last_id:
+        logging.info(f"Table '{table.name}' already contains data: resuming the load after id {last_id}")
+
+    loaded = 0
+    start = time.perf_counter()
+    # N.B. keep_default_na is set to 'False' since in the data there is a country named 'NA' which otherwise is considered as NaN
+    for chunk in pd.read_csv(data_file, sep=",", keep_default_na=False, chunksize=chunk_size):
+        chunk = chunk[chunk["id"] > last_id]
+        if chunk.empty:
+            continue
+        with engine.begin() as connection: # Commit at the end of each chunk
+            load_chunk(connection, table, chunk)
+        loaded += len(chunk)
+        elapsed = time.perf_counter() - start
+        logging.info(f"Table '{table.name}': {loaded} rows loaded up to id {chunk['id'].iloc[-1]} ({loaded / elapsed:.0f} rows/sec)")
+    return loaded
+
+def bulk_export_data_to_db(engine, persons_data_file, countries_data_file, chunk_size=DEFAULT_CHUNK_SIZE, use_load_data=False):
+    '''
+    This function allows to create the tables needed to store the data in the database and to export data from the csv files
+    to the relational database, without keeping the whole files in memory (see bulk_load_table).
+
+    PARAMETERS
+    engine -> A sqlalchemy engine to interact with the database.
+    persons_data_file, countries_data_file -> The paths of the csv files.
+    chunk_size -> The number of rows inserted in each transaction.
+    use_load_data -> If True and the database is MySQL, the chunks are loaded with LOAD DATA LOCAL INFILE.
+    '''
+    db_entities.Base.metadata.create_all(engine) #Creates tables
+
+    # Persons are loaded first since each country references a person
+    bulk_load_table(engine, db_entities.Person.__table__, persons_data_file, chunk_size, use_load_data)
+    bulk_load_table(engine, db_entities.Country.__table__, countries_data_file, chunk_size, use_load_data)
+
+    # The packed ip addresses and the summary tables are computed once at the end of the load (also when a previous load is resumed)
+    migrations.fill_packed_ip_addresses(engine, chunk_size)
+    with engine.begin() as connection:
+        summaries.rebuild_summaries(connection)
+
+def refresh_summaries(engine, verify_only=False):
+    '''
+    This function checks the summary tables against the tables 'person' and 'country' and, unless verify_only is True, rebuilds them.
+
+    PARAMETERS
+    engine -> A sqlalchemy engine to interact with the database.
+    verify_only -> If True, the summary tables are only checked.
+
+    RETURNS
+    True if the summary tables were consistent with the data.
+    '''
+    with engine.connect() as connection:
+        errors = summaries.verify_summaries(connection)
+    consistent = not any(errors.values())
+    logging.info(f"Summary tables {'consistent' if consistent else 'not consistent'} with the data: {errors}")
+    if not verify_only:
+        with engine.begin() as connection:
+            summaries.rebuild_summaries(connection)
+        logging.info("Summary tables rebuilt successfully")
+    return consistent
+
+def deduplicate(engine, report_file=None, remove=False, threshold=0.7):
+    '''
+    This function looks for duplicate people in the database (see dedup.py).
+
+    PARAMETERS
+    engine -> A sqlalchemy engine to interact with the database.
+    report_file -> If given, the likely duplicates (found with MinHash and LSH) are written to this csv file, one row for each
+                   person with the number of its group of duplicates. They are only reported, since they may be different people.
+    remove -> If True, the people with the same email of a person with a smaller id are deleted and the unique index on the
+              column 'email' is created (if missing).
+    threshold -> The minimum similarity of the likely duplicates.
+    '''
+    if remove:
+        removed = dedup.remove_duplicate_emails(engine)
+        logging.info(f"{removed} people with a duplicate email removed")
+        migrations.create_missing_indexes(engine, db_entities.Person.__table__)
+    if report_file:
+        start = time.perf_counter()
+        duplicates = dedup.find_duplicates_in_database(engine, threshold)
+        duplicates.to_csv(report_file, index=False)
+        n_groups = duplicates["group"].nunique()
+        logging.info(f"{n_groups} groups of likely duplicates ({len(duplicates)} people) written to '{report_file}' in {time.perf_counter() - start:.1f} seconds")
+
+def write_snapshot(engine, path):
+    '''
+    This function writes the snapshot of the data used by the api (see column_store.py), reading the data from the database.
+    It can be executed while the api is running: the workers keep using the previous snapshot until they are restarted.
+
+    PARAMETERS
+    engine -> A sqlalchemy engine to interact with the database.
+    path -> The directory of the snapshot.
+    '''
+    start = time.perf_counter()
+    store = column_store.ColumnStore.from_engine(engine)
+    store.save(path)
+    logging.info(f"Snapshot of {store.n_people} people written to '{path}' in {time.perf_counter() - start:.1f} seconds")
+
+def init_db(bulk=False, chunk_size=DEFAULT_CHUNK_SIZE, use_load_data=False, db_url=None, migrate=False, summaries_command=None,
+            duplicates_report=None, remove_duplicates=False, snapshot_only=False):
     '''
     This function manages the creation of the database and data transfer from cvs files to the relational database.
+
+    PARAMETERS
+    bulk -> If True, the csv files are streamed to the database in chunks (see bulk_export_data_to_db).
+    chunk_size -> The number of rows inserted in each transaction when bulk is True.
+    use_load_data -> If True, the chunks are loaded with LOAD DATA LOCAL INFILE (MySQL only).
+    db_url -> An optional sqlalchemy url (e.g., 'sqlite:///local.db') used instead of the MySQL database defined in the .env file
+              (it can also be set with 'db_url' in the .env file).
+    migrate -> If True, the schema of an existing database is updated to the current entities and no data is loaded.
+    summaries_command -> 'refresh' to rebuild the summary tables or 'verify' to only check them (no data is loaded).
+    duplicates_report, remove_duplicates -> Look for duplicate people (see deduplicate) instead of loading data.
+    snapshot_only -> If True, the snapshot of the data is written from the database (see write_snapshot) and no data is loaded.
+                     The snapshot is also written after loading the data, in the directory 'snapshot_path' of the .env file
+                     (no snapshot is written if it is empty).
     '''  
     persons_data_file = "../data/persons.csv"
     countries_data_file = "../data/countries.csv"
     
     load_dotenv() # Allows to load the variables present in the .env file
+    db_url = db_url or os.environ.get('db_url')
+    snapshot_path = os.environ.get('snapshot_path', 'snapshot')
     db_connection_data = {"host":os.environ.get('db_hostname'),
                           "db_name":os.environ.get('db_name'),
                           "user":os.environ.get('db_user'),
                           "psw":os.environ.get('db_psw')}
    
-    logging.basicConfig(filename=os.path.join("logs",'logs.log'), encoding='utf-8', level=logging.DEBUG)
+    logging_config.setup_logging_from_env(os.path.join("logs", "logs.log"))
 
     try:
-        # Connect to mysqldb
-        engine = sqlalchemy.create_engine(f'mysql+mysqldb://{db_connection_data["user"]}:{db_connection_data["psw"]}@{db_connection_data["host"]}')
-        
-        # Create the database
-        with engine.connect() as connection:
-            connection.execute(sqlalchemy.text(f"CREATE DATABASE IF NOT EXISTS {db_connection_data['db_name']}"))
-        
-        # From now on interact directly with the newly created database
-        engine = sqlalchemy.create_engine(f'mysql+mysqldb://{db_connection_data["user"]}:{db_connection_data["psw"]}@{db_connection_data["host"]}/{db_connection_data["db_name"]}')
+        if db_url:
+            # A local database (e.g., SQLite) is created automatically when connecting
+            engine = sqlalchemy.create_engine(db_url)
+        else:
+            # LOAD DATA LOCAL INFILE must be enabled explicitly on the client side
+            connect_args = {"local_infile": 1} if use_load_data else {}
+
+            # Connect to mysqldb
+            engine = sqlalchemy.create_engine(f'mysql+mysqldb://{db_connection_data["user"]}:{db_connection_data["psw"]}@{db_connection_data["host"]}')
+            
+            # Create the database
+            with engine.connect() as connection:
+                connection.execute(sqlalchemy.text(f"CREATE DATABASE IF NOT EXISTS {db_connection_data['db_name']}"))
+            
+            # From now on interact directly with the newly created database
+            engine = sqlalchemy.create_engine(f'mysql+mysqldb://{db_connection_data["user"]}:{db_connection_data["psw"]}@{db_connection_data["host"]}/{db_connection_data["db_name"]}', connect_args=connect_args)
         logging.info("Database created successfully")
     except sqlalchemy.exc.SQLAlchemyError as e:
         logging.error(e)
         return
 
-    # Load data from file into pandas dataframe
-    # N.B. keep_default_na is set to 'False' since in the data there is a country named 'NA' which otherwise is considered as NaN
-    persons_df = pd.read_csv(persons_data_file,sep=",", keep_default_na=False)
-    countries_df = pd.read_csv(countries_data_file,sep=",", keep_default_na=False)
-    
-    data = {"person": persons_df,
-            "country": countries_df}
-    try:
-        export_data_to_db(engine = engine, data = data)
-        logging.info("Data exported successfully from csv files to relational database")
-    except sqlalchemy.exc.SQLAlchemyError as e:
-        logging.error(e)
+    if migrate:
+        try:
+            migrations.migrate(engine)
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            logging.error(e)
         return
 
+    if summaries_command:
+        try:
+            return refresh_summaries(engine, verify_only=summaries_command == "verify")
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            logging.error(e)
+        return
+
+    if snapshot_only:
+        try:
+            write_snapshot(engine, snapshot_path or 'snapshot')
+        except (sqlalchemy.exc.SQLAlchemyError, OSError) as e:
+            logging.error(e)
+        return
+
+    if duplicates_report or remove_duplicates:
+        try:
+            deduplicate(engine, duplicates_report, remove_duplicates)
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            logging.error(e)
+        return
+
+    if bulk:
+        try:
+            bulk_export_data_to_db(engine, persons_data_file, countries_data_file, chunk_size, use_load_data)
+            logging.info("Data exported successfully from csv files to relational database")
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            # Committed chunks are kept: running the script again resumes the load from the last committed id
+            logging.error(e)
+            return
+    else:
+        # Load data from file into pandas dataframe
+        # N.B. keep_default_na is set to 'False' since in the data there is a country named 'NA' which otherwise is considered as NaN
+        persons_df = pd.read_csv(persons_data_file,sep=",", keep_default_na=False)
+        countries_df = pd.read_csv(countries_data_file,sep=",", keep_default_na=False)
+
+        data = {"person": persons_df,
+                "country": countries_df}
+        try:
+            export_data_to_db(engine = engine, data = data)
+            logging.info("Data exported successfully from csv files to relational database")
+        except sqlalchemy.exc.SQLAlchemyError as e:
+            logging.error(e)
+            return
+
+    if snapshot_path:
+        try:
+            write_snapshot(engine, snapshot_path)
+        except (sqlalchemy.exc.SQLAlchemyError, OSError) as e:
+            # The api loads the data from the database when there is no snapshot
+            logging.error(e)
+
 if __name__ == "__main__":
-    init_db()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Create the database and load the data from the csv files.")
+    parser.add_argument("--bulk", action="store_true", help="stream the csv files to the database in chunks, resuming an interrupted load")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="number of rows inserted in each transaction (with --bulk)")
+    parser.add_argument("--load-data", action="store_true", help="use LOAD DATA LOCAL INFILE to load the chunks (MySQL only, with --bulk)")
+    parser.add_argument("--db-url", help="sqlalchemy url of a local database (e.g., sqlite:///local.db) to use instead of MySQL")
+    parser.add_argument("--migrate", action="store_true", help="update the schema of an existing database (new columns and indexes) without loading data")
+    parser.add_argument("--summaries", choices=["refresh", "verify"], help="rebuild (or only verify) the summary tables without loading data")
+    parser.add_argument("--find-duplicates", metavar="REPORT_FILE", help="write the likely duplicate people to a csv file without loading data")
+    parser.add_argument("--remove-duplicates", action="store_true", help="delete the people with an email already used by a previous person and create the unique index on the emails")
+    parser.add_argument("--snapshot", action="store_true", help="write the snapshot used by the api ('snapshot_path' in the .env file) from the database without loading data")
+    args = parser.parse_args()
+    init_db(bulk=args.bulk, chunk_size=args.chunk_size, use_load_data=args.load_data, db_url=args.db_url, migrate=args.migrate,
+            summaries_command=args.summaries, duplicates_report=args.find_duplicates, remove_duplicates=args.remove_duplicates,
+            snapshot_only=args.snapshot)
\ No newline at end of file
@@ -0,0 +1,245 @@
+'''
+This file contains the integer encoding of the ip addresses and the index used to answer range (CIDR) queries.
+IPv4 and IPv6 addresses are encoded in the same way, as 16 bytes in network order (the 128 bit number of the address), with
+IPv4 addresses mapped into ::ffff:0:0/96 as in IPv6. The bytes sort as the numbers they represent, so the same encoding is used
+for the column 'ip_packed' of the database (a B-tree index on it answers range queries) and for the sorted array of IpRangeIndex.
+'''
+import ipaddress
+import re
+import threading
+import numpy as np
+import pandas as pd
+
+# Regular expression used to parse IPv4 addresses in a vectorized way
+IPV4_REGEX = r"^(\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3})$"
+# Prefix of the IPv4 addresses mapped into IPv6 (::ffff:0:0/96), added to the low 64 bits of the encoding
+IPV4_MAPPED = 0xFFFF << 32
+KEY_DTYPE = np.dtype("S16")
+# Maximum number of keys added to an IpRangeIndex kept out of its main sorted array
+MAX_DELTA_KEYS = 100000
+# Up to this number of addresses, encode_ip parses them one by one: the vectorized parsing costs about a millisecond whatever the number
+SMALL_INPUT = 16
+
+# Ranges with a special use (IANA registries), used to classify the addresses as private or public
+SPECIAL_RANGES = {"private": ["10.0.0.0/8", "172.16.0.0/12", "192.168.0.0/16", "fc00::/7"],
+                  "shared": ["100.64.0.0/10"],
+                  "loopback": ["127.0.0.0/8", "::1/128"],
+                  "link_local": ["169.254.0.0/16", "fe80::/10"],
+                  "multicast": ["224.0.0.0/4", "ff00::/8"],
+                  "reserved": ["0.0.0.0/8", "240.0.0.0/4", "::/128"]}
+
+def encode_ipv4(ip_addresses):
+    '''
+        This function converts a sequence of ip addresses into their integer representation.
+
+        PARAMETERS
+        ip_addresses -> A sequence of strings representing ip addresses.
+
+        RETURNS
+        A NumPy array of integers. Addresses that are not valid IPv4 addresses are encoded as -1.
+    '''
+    octets = pd.Series(ip_addresses, dtype=object).str.extract(IPV4_REGEX)
+    valid = octets.notna().all(axis=1).to_numpy()
+    encoded = np.full(len(octets), -1, dtype=np.int64)
+    if valid.any():
+        values = octets[valid].astype(np.int64).to_numpy()
+        valid_octets = (values <= 255).all(axis=1)
+        values = values[valid_octets]
+        rows = np.flatnonzero(valid)[valid_octets]
+        encoded[rows] = (values[:, 0] << 24) | (values[:, 1] << 16) | (values[:, 2] << 8) | values[:, 3]
+    return encoded
+
+def encode_address(ip_address):
+    '''
+        This function converts a single ip address into its 128 bit number, with the same rules of encode_ip.
+
+        PARAMETERS
+        ip_address -> A string representing an ip address.
+
+        RETURNS
+        A tuple (number, version), (0, 0) if the address is not valid.
+    '''
+    if not isinstance(ip_address, str):
+        return 0, 0
+    match = re.match(IPV4_REGEX, ip_address)
+    if match:
+        octets = [int(octet) for octet in match.groups()]
+        if max(octets) <= 255:
+            return IPV4_MAPPED | (octets[0] << 24) | (octets[1] << 16) | (octets[2] << 8) | octets[3], 4
+    try:
+        address = ipaddress.ip_address(ip_address)
+    except ValueError:
+        return 0, 0
+    return int(address) | (IPV4_MAPPED if address.version == 4 else 0), address.version
+
+def packed_ip_address(ip_address):
+    '''
+        This function converts an ip address into the value of the column 'ip_packed' (16 bytes, None if not valid).
+    '''
+    number, version = encode_address(ip_address)
+    return number.to_bytes(16, "big") if version else None
+
+def encode_ip(ip_addresses):
+    '''
+        This function converts a sequence of ip addresses (IPv4 or IPv6) into their 16 bytes encoding.
+        IPv4 addresses are converted in a vectorized way, while the others are parsed one by one with the module ipaddress.
+
+        PARAMETERS
+        ip_addresses -> A sequence of strings representing ip addresses.
+
+        RETURNS
+        A NumPy array of keys (dtype S16) and a NumPy array with the version of each address (4, 6, or 0 if the address is not valid,
+        in which case the key is 0).
+    '''
+    if len(ip_addresses) <= SMALL_INPUT:
+        encoded = [encode_address(ip_address) for ip_address in ip_addresses]
+        keys = np.array([number.to_bytes(16, "big") for number, _ in encoded], dtype=KEY_DTYPE)
+        return keys, np.array([version for _, version in encoded], dtype=np.int8)
+    ip_addresses = pd.Series(ip_addresses, dtype=object)
+    ipv4 = encode_ipv4(ip_addresses)
+    valid_ipv4 = ipv4 >= 0
+    # The high and low 64 bits of each address, in network (big-endian) order
+    halves = np.zeros((len(ipv4), 2), dtype=">u8")
+    halves[valid_ipv4, 1] = IPV4_MAPPED | ipv4[valid_ipv4]
+    versions = np.where(valid_ipv4, 4, 0).astype(np.int8)
+    for i in np.flatnonzero(~valid_ipv4):
+        try:
+            address = ipaddress.ip_address(ip_addresses.iloc[i])
+        except ValueError:
+            continue
+        number = int(address) | (IPV4_MAPPED if address.version == 4 else 0)
+        halves[i] = (number >> 64, number & 0xFFFFFFFFFFFFFFFF)
+        versions[i] = address.version
+    return halves.view(KEY_DTYPE).ravel(), versions
+
+def packed_ip_addresses(ip_addresses):
+    '''
+        This function converts a sequence of ip addresses into the values of the column 'ip_packed' (16 bytes, None if not valid).
+    '''
+    keys, versions = encode_ip(ip_addresses)
+    # NumPy drops the trailing zero bytes when the keys are converted to bytes, so they are added back
+    return [key.ljust(16, b"\x00") if version else None for key, version in zip(keys.tolist(), versions)]
+
+def network_range(network):
+    '''
+        This function returns the first and the last key of a network.
+
+        PARAMETERS
+        network -> A string representing a network in CIDR notation (e.g., '10.0.0.0/8' or '2001:db8::/32') or a single address.
+                   Host bits are ignored (e.g., '10.1.2.3/8' is the same as '10.0.0.0/8').
+
+        RETURNS
+        A tuple (first key, last key) of 16 bytes each. Raises ValueError if the network is not valid.
+    '''
+    network = ipaddress.ip_network(network.strip(), strict=False)
+    offset = IPV4_MAPPED if network.version == 4 else 0
+    return tuple((int(address) | offset).to_bytes(16, "big") for address in (network.network_address, network.broadcast_address))
+
+class IpRangeIndex:
+    '''
+        This class implements an index of the ip addresses: the keys are kept in a sorted array, so the addresses in a range
+        are found with two binary searches (logarithmic time) and are contiguous in the array.
+        The keys added afterwards are kept in a second small sorted array (delta), merged into the main one when it reaches
+        MAX_DELTA_KEYS keys, so that adding a few keys does not sort all of them again.
+    '''
+    def __init__(self, keys, rows):
+        '''
+            PARAMETERS
+            keys -> A NumPy array of keys (see encode_ip); invalid addresses must be excluded.
+            rows -> A NumPy array with the row (or id) associated to each key.
+        '''
+        order = np.argsort(keys, kind="stable")
+        # The sorted keys and rows of the main array and of the delta, replaced at once so that the readers do not need a lock
+        self._parts = ((keys[order], rows[order]), (keys[:0], rows[:0]))
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return sum(len(keys) for keys, _ in self._parts)
+
+    def append(self, keys, rows):
+        '''
+            This function adds keys to the index.
+
+            PARAMETERS
+            keys, rows -> As in the constructor.
+        '''
+        with self._lock:
+            (main_keys, main_rows), (delta_keys, delta_rows) = self._parts
+            delta_keys, delta_rows = np.concatenate([delta_keys, keys]), np.concatenate([delta_rows, rows])
+            order = np.argsort(delta_keys, kind="stable")
+            delta_keys, delta_rows = delta_keys[order], delta_rows[order]
+            if len(delta_keys) > MAX_DELTA_KEYS:
+                # The sorted delta is inserted into the main array (a single copy of it, instead of sorting all the keys)
+                positions = np.searchsorted(main_keys, delta_keys, side="right")
+                main_keys, main_rows = np.insert(main_keys, positions, delta_keys), np.insert(main_rows, positions, delta_rows)
+                delta_keys, delta_rows = delta_keys[:0], delta_rows[:0]
+            self._parts = ((main_keys, main_rows), (delta_keys, delta_rows))
+
+    @staticmethod
+    def _bounds(keys, first, last):
+        bounds = np.array([first, last], dtype=KEY_DTYPE)
+        return np.searchsorted(keys, bounds[0], side="left"), np.searchsorted(keys, bounds[1], side="right")
+
+    def count(self, first, last):
+        '''
+            This function returns the number of addresses between two keys (included).
+        '''
+        return sum(int(end - start) for start, end in (self._bounds(keys, first, last) for keys, _ in self._parts))
+
+    def lookup(self, first, last, limit=None):
+        '''
+            This function returns the rows of the addresses between two keys (included), sorted by address.
+        '''
+        found = []
+        for keys, rows in self._parts:
+            start, end = self._bounds(keys, first, last)
+            if limit is not None:
+                end = min(end, start + limit)
+            found.append((keys[start:end], rows[start:end]))
+        (main_keys, main_rows), (delta_keys, delta_rows) = found
+        if len(delta_keys) == 0:
+            return main_rows
+        order = np.argsort(np.concatenate([main_keys, delta_keys]), kind="stable")[:limit]
+        return np.concatenate([main_rows, delta_rows])[order]
+
+def prefix_counts(ipv4, prefix_length):
+    '''
+        This function counts the IPv4 addresses by network (e.g., by /8 or /16).
+
+        PARAMETERS
+        ipv4 -> A NumPy array with the integer representation of the addresses (see encode_ipv4, negative values are ignored).
+        prefix_length -> The length of the prefix of the networks (between 1 and 24).
+
+        RETURNS
+        A Pandas Series with the number of addresses of each network (e.g., '10.0.0.0/8'), sorted by network.
+    '''
+    prefixes = ipv4[ipv4 >= 0] >> (32 - prefix_length)
+    networks, counts = np.unique(prefixes, return_counts=True)
+    network_addresses = networks << (32 - prefix_length)
+    labels = pd.Series(network_addresses >> 24).astype(str)
+    for shift in (16, 8, 0):
+        labels = labels.str.cat(pd.Series((network_addresses >> shift) & 255).astype(str), sep=".")
+    return pd.Series(counts, index=(labels + f"/{prefix_length}").to_numpy(), dtype=np.int64)
+
+def range_counts(keys, versions):
+    '''
+        This function classifies the addresses according to SPECIAL_RANGES ('public' for all the others).
+
+        PARAMETERS
+        keys, versions -> The output of encode_ip (invalid addresses are ignored).
+
+        RETURNS
+        A Pandas Series with the number of addresses of each class of ranges.
+    '''
+    keys = keys[versions > 0]
+    unassigned = np.ones(len(keys), dtype=bool)
+    counts = {}
+    for name, networks in SPECIAL_RANGES.items():
+        in_range = np.zeros(len(keys), dtype=bool)
+        for network in networks:
+            first, last = np.array(network_range(network), dtype=KEY_DTYPE)
+            in_range |= (keys >= first) & (keys <= last)
+        counts[name] = int(np.count_nonzero(in_range & unassigned))
+        unassigned &= ~in_range
+    counts["public"] = int(np.count_nonzero(unassigned))
+    return pd.Series(counts, dtype=np.int64)
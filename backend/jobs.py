@@ -0,0 +1,289 @@
+'''
+This file contains the background jobs used to execute the heavy analytics without holding a worker of the api.
+A job executes one of the functionalities of api_functionalities.py (see JOB_FUNCTIONS) in a pool of processes, each with its own
+connection to the database, so that the CPU-bound work does not stall the other requests of the api (it does not hold the GIL
+of the api process). Clients submit a job, receive its id and poll (or long-poll) its status and result.
+- Each job has a timeout: the worker interrupts the functionality with SIGALRM when it expires (where available);
+- identical jobs (same functionality and arguments) submitted while one of them is pending or running share the same job;
+- the results are kept for 'result_ttl' seconds after the end of the job, then the job is forgotten.
+'''
+import os
+import time
+import uuid
+import json
+import math
+import signal
+import asyncio
+import inspect
+import logging
+import threading
+import concurrent.futures
+import multiprocessing
+from dotenv import load_dotenv
+
+# Read-only functionalities that can be executed as jobs
+JOB_FUNCTIONS = ("get_people_by_country", "get_people_count_by_country", "get_people_gender_distribution",
+                 "get_ip_address_distribution_by_class", "get_ip_address_distribution", "get_people_in_network", "search_people",
+                 "get_most_common_domain", "get_country_domain_correlation", "get_gender_domain_correlation", "get_email_pattern_counts",
+                 "get_common_email_patterns", "get_gender_country_correlation", "get_gender_distribution_by_country", "get_association_matrix")
+# Parameters of the functionalities that cannot be given by the clients (objects of the api process, files, ...)
+INTERNAL_PARAMETERS = ("engine", "store", "index", "pattern_counts", "catalogue_file")
+# Additional time given to a worker to report the timeout of a job before the job is considered timed out by the api
+TIMEOUT_GRACE = 5
+
+class JobError(Exception):
+    pass
+
+class TooManyJobs(Exception):
+    pass
+
+class JobTimeout(Exception):
+    pass
+
+# Engine of the primary database and read replicas of the worker process, created by _init_worker
+_engine = None
+_replicas = None
+
+def _init_worker():
+    global _engine, _replicas
+    # Imported here since the worker processes are started with 'spawn' and read the settings from the .env file again
+    from database import create_engine_from_env
+    from read_replicas import ReadReplicaSet
+    load_dotenv()
+    _engine = create_engine_from_env()
+    _replicas = ReadReplicaSet.from_env()
+
+def _raise_timeout(signum, frame):
+    raise JobTimeout()
+
+def _run(function_name, arguments, timeout, read_your_writes=False):
+    # Executed in the worker process: the functionalities are read-only, so they are executed on a read replica if there is one.
+    # The result is returned with the same content of the endpoint of the functionality (see formats.shape_result)
+    import api_functionalities
+    import formats
+    from read_replicas import NoReplicaAvailable
+    function = getattr(api_functionalities, function_name)
+    use_alarm = hasattr(signal, "SIGALRM") and timeout
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.alarm(math.ceil(timeout))
+    try:
+        if _replicas is not None and not read_your_writes:
+            try:
+                return formats.shape_result(function_name, _replicas.run(function, **arguments))
+            except NoReplicaAvailable:
+                pass
+        return formats.shape_result(function_name, function(_engine, **arguments))
+    finally:
+        if use_alarm:
+            signal.alarm(0)
+
+class Job:
+    '''
+        This class represents a job: a functionality with its arguments, its status and, once finished, its result or error.
+    '''
+    def __init__(self, function_name, arguments, key, timeout):
+        self.id = uuid.uuid4().hex
+        self.function_name = function_name
+        self.arguments = arguments
+        self.key = key
+        self.timeout = timeout
+        self.status = "pending" # pending, running, done, failed, timeout or cancelled
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.future = None
+
+    @property
+    def finished(self):
+        return self.finished_at is not None
+
+    def to_dict(self, with_result=True):
+        job = {"job_id": self.id, "function": self.function_name, "arguments": self.arguments, "status": self.status,
+               "timeout": self.timeout, "submitted_at": self.submitted_at, "started_at": self.started_at, "finished_at": self.finished_at}
+        if self.error is not None:
+            job["error"] = self.error
+        if with_result and self.status == "done":
+            job["result"] = self.result
+        return job
+
+class JobManager:
+    '''
+        This class executes the jobs in a pool of processes, created when the first job is submitted.
+    '''
+    def __init__(self, processes=2, timeout=300, result_ttl=600, max_jobs=100):
+        '''
+            PARAMETERS
+            processes -> The number of worker processes (i.e., of jobs executed at the same time).
+            timeout -> The maximum duration of a job in seconds (also the default timeout of the jobs).
+            result_ttl -> The number of seconds the result of a job is kept after the end of the job.
+            max_jobs -> The maximum number of pending or running jobs (further jobs are refused).
+        '''
+        self.processes = processes
+        self.timeout = timeout
+        self.result_ttl = result_ttl
+        self.max_jobs = max_jobs
+        self._executor = None
+        self._jobs = {}
+        self._in_flight = {} # Key of each pending or running job -> job
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        '''
+            This function creates the manager with the settings of the .env file ('job_processes', 'job_timeout',
+            'job_result_ttl' and 'job_max_pending').
+        '''
+        return cls(processes=int(os.environ.get('job_processes', 2)),
+                   timeout=float(os.environ.get('job_timeout', 300)),
+                   result_ttl=float(os.environ.get('job_result_ttl', 600)),
+                   max_jobs=int(os.environ.get('job_max_pending', 100)))
+
+    def _get_executor(self):
+        if self._executor is None:
+            # The workers are started with 'spawn': forking the api process would copy its threads (e.g., the one writing the logs) in
+            # an inconsistent state
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.processes, initializer=_init_worker,
+                                                                    mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    @staticmethod
+    def bind_arguments(function_name, arguments):
+        '''
+            This function checks the functionality and the arguments of a job (their values with parameters.check_arguments).
+
+            RETURNS
+            The arguments with the default values of the missing ones. Raises JobError if the job is not valid.
+        '''
+        import api_functionalities
+        import parameters
+        if function_name not in JOB_FUNCTIONS:
+            raise JobError(f"Invalid function. The function should be one of {', '.join(JOB_FUNCTIONS)}.")
+        if not isinstance(arguments, dict) or any(name in INTERNAL_PARAMETERS for name in arguments):
+            raise JobError(f"Invalid arguments. The arguments should be an object, without the parameters {', '.join(INTERNAL_PARAMETERS)}.")
+        signature = inspect.signature(getattr(api_functionalities, function_name))
+        try:
+            bound = signature.bind(None, **arguments)
+        except TypeError as e:
+            raise JobError(f"Invalid arguments for '{function_name}': {e}.")
+        bound.apply_defaults()
+        arguments = {name: value for name, value in bound.arguments.items() if name not in INTERNAL_PARAMETERS}
+        # The values are checked as the endpoints of the functionalities do, otherwise an invalid value would fail (or worse,
+        # return a wrong result) only in the worker
+        error = parameters.check_arguments(function_name, arguments)
+        if error is not None:
+            raise JobError(error)
+        return arguments
+
+    def submit(self, function_name, arguments, timeout=None, read_your_writes=False):
+        '''
+            This function submits a job, or returns the identical job already pending or running.
+
+            PARAMETERS
+            function_name -> The name of one of JOB_FUNCTIONS.
+            arguments -> A dictionary with the arguments of the functionality (JSON values).
+            timeout -> An optional timeout of the job in seconds, at most the timeout of the manager.
+            read_your_writes -> If True, the job reads from the primary database instead of the read replicas.
+
+            RETURNS
+            The Job. Raises JobError if the job is not valid and TooManyJobs if there are already 'max_jobs' jobs in progress.
+        '''
+        arguments = self.bind_arguments(function_name, arguments)
+        if timeout is not None and (not isinstance(timeout, (int, float)) or not 0 < timeout <= self.timeout):
+            raise JobError(f"Invalid timeout. The timeout should be a number of seconds between 0 and {self.timeout}.")
+        key = json.dumps([function_name, arguments, read_your_writes], sort_keys=True, default=str)
+        with self._lock:
+            self._purge()
+            job = self._in_flight.get(key)
+            if job is not None:
+                return job
+            if len(self._in_flight) >= self.max_jobs:
+                raise TooManyJobs(f"There are already {self.max_jobs} jobs in progress.")
+            job = Job(function_name, arguments, key, timeout or self.timeout)
+            self._jobs[job.id] = job
+            self._in_flight[key] = job
+            try:
+                job.future = self._get_executor().submit(_run, function_name, arguments, job.timeout, read_your_writes)
+            except concurrent.futures.process.BrokenProcessPool:
+                # A worker died (e.g., killed for lack of memory) and the pool cannot be used anymore, so a new one is created
+                self._executor.shutdown(wait=False)
+                self._executor = None
+                job.future = self._get_executor().submit(_run, function_name, arguments, job.timeout, read_your_writes)
+        job.future.add_done_callback(lambda future: self._finish(job, future))
+        return job
+
+    def _finish(self, job, future):
+        # Called when the future of the job completes (in a thread of the executor, or in the thread cancelling the job)
+        with self._lock:
+            if job.finished:
+                return
+            if future.cancelled():
+                job.status = "cancelled"
+            elif isinstance(future.exception(), JobTimeout):
+                job.status, job.error = "timeout", f"The job did not finish within {job.timeout} seconds."
+            elif future.exception() is not None:
+                logging.error(f"Job {job.id} ({job.function_name}) failed: {future.exception()!r}")
+                job.status, job.error = "failed", str(future.exception()) or type(future.exception()).__name__
+            else:
+                job.status, job.result = "done", future.result()
+            job.finished_at = time.time()
+            self._in_flight.pop(job.key, None)
+
+    def _purge(self):
+        # Jobs whose result has expired are forgotten (called with the lock held)
+        now = time.time()
+        for job_id in [id for id, job in self._jobs.items() if job.finished and now - job.finished_at > self.result_ttl]:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        '''
+            This function returns a job (None if it does not exist or its result has expired), updating its status.
+        '''
+        with self._lock:
+            self._purge()
+            job = self._jobs.get(job_id)
+            if job is None or job.finished:
+                return job
+            if job.future.running() and job.started_at is None:
+                # The executor does not notify when a job starts, so the time is the first one at which the job is seen running
+                job.status, job.started_at = "running", time.time()
+            if job.started_at is not None and time.time() - job.started_at > job.timeout + TIMEOUT_GRACE:
+                # The worker did not stop the job (e.g., it is blocked in a query): the job is reported as timed out, although
+                # its process stays busy until the functionality returns
+                job.status, job.error = "timeout", f"The job did not finish within {job.timeout} seconds."
+                job.finished_at = time.time()
+                self._in_flight.pop(job.key, None)
+        return job
+
+    async def wait(self, job_id, timeout):
+        '''
+            This function waits at most 'timeout' seconds for the end of a job (long polling), then returns it as get.
+        '''
+        job = self.get(job_id)
+        if job is not None and not job.finished and timeout > 0:
+            waiter = asyncio.wrap_future(job.future)
+            # The errors of the job are reported by its status: they are retrieved here only so that asyncio does not log them
+            waiter.add_done_callback(lambda future: future.cancelled() or future.exception())
+            # Unlike wait_for, wait neither raises the error of the job nor cancels it when the timeout expires, while the
+            # cancellation of the request (e.g., the client disconnected) is propagated
+            await asyncio.wait([waiter], timeout=timeout)
+        return self.get(job_id)
+
+    def cancel(self, job_id):
+        '''
+            This function cancels a pending job (running jobs cannot be interrupted).
+
+            RETURNS
+            The job (None if it does not exist).
+        '''
+        job = self.get(job_id)
+        if job is not None and not job.finished:
+            job.future.cancel() # Runs the callback that sets the status if the job had not started yet
+        return self.get(job_id)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
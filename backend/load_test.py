@@ -0,0 +1,458 @@
+'''
+This file contains a load test of the api (api.py): a configurable mix of requests (reads, writes with /create_person and the heavy
+analytics) is sent at a target rate (open loop: new requests start on schedule, even if the previous ones have not finished yet) or by
+a fixed number of concurrent clients (closed loop: each client sends a new request as soon as it receives the previous response).
+Throughput, latency percentiles and error rate of each route are saved in a JSON file, which can be compared with the one of a
+previous version to find regressions.
+By default the api is executed in the same process through the ASGI transport of httpx, backed by a copy of a local SQLite database
+(or by a synthetic one, see synthetic_data.py), so that every run starts from the same data; with --url the requests are sent to a
+running server instead.
+
+Example: python load_test.py --db local.db --rps 50 --duration 60 --compare load_test_results/previous.json
+'''
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import time
+import numpy as np
+import pandas as pd
+import httpx
+import sqlalchemy
+from dotenv import load_dotenv
+from benchmark import _git_commit
+from synthetic_data import SyntheticDataGenerator
+
+DEFAULT_DURATION = 30
+DEFAULT_WARMUP = 5
+DEFAULT_CONCURRENCY = 10
+# Number of people of the synthetic database created when no database is given
+DEFAULT_ROWS = 100000
+# Maximum number of requests in progress in the open loop: further requests are not sent and are counted as errors
+DEFAULT_MAX_IN_FLIGHT = 1000
+DEFAULT_TIMEOUT = 60
+# Number of people read at the beginning of the test to choose the parameters of the requests
+SAMPLE_SIZE = 1000
+PERCENTILES = (50, 95, 99)
+# A route is reported as a regression when its p95 latency grows more than this ratio (or its error rate grows)
+DEFAULT_REGRESSION_THRESHOLD = 1.2
+CREATED_MESSAGE = "Person created successfully."
+
+class TrafficSample:
+    '''
+        This class chooses the parameters of the requests among the values found in the data (countries, names, networks), so that
+        the reads do not always hit the same entries of the result cache, and creates new people with unique emails for the writes.
+    '''
+    def __init__(self, people, countries, seed=0):
+        '''
+            PARAMETERS
+            people -> A list of people (dictionaries as returned by /get_people).
+            countries -> A list of country codes.
+            seed -> The seed of the random choices.
+        '''
+        if not people or not countries:
+            raise ValueError("The database used by the load test should contain people and countries.")
+        self.people = people
+        self.countries = countries
+        self._random = random.Random(seed)
+        self._run_id = f"{int(time.time()):x}" # Emails of different runs against the same database do not collide
+        self._created = 0
+
+    @classmethod
+    async def from_api(cls, client, seed=0):
+        '''
+            This function reads the sample of people and the countries from the api.
+        '''
+        people = (await client.get("/get_people", params={"limit": SAMPLE_SIZE})).json()["people"]
+        counts = (await client.get("/get_people_count_by_country")).json()
+        countries = list(counts["Country"].values()) if isinstance(counts, dict) else []
+        return cls(people, countries, seed)
+
+    def choice(self, values):
+        return self._random.choice(values)
+
+    def person(self):
+        return self.choice(self.people)
+
+    def country(self):
+        return self.choice(self.countries)
+
+    def network(self):
+        # The /16 network of one of the people (IPv4), or a /8 network if the person has an IPv6 address
+        ip_address = self.person()["ip_address"]
+        if ":" in ip_address:
+            return "10.0.0.0/8"
+        a, b, _, _ = ip_address.split(".")
+        return f"{a}.{b}.0.0/16"
+
+    def search_text(self):
+        person = self.person()
+        return self.choice([person["first_name"], person["last_name"], f"{person['first_name']} {person['last_name']}"])
+
+    def new_person(self):
+        self._created += 1
+        person = self.person()
+        return {"first_name": person["first_name"], "last_name": person["last_name"],
+                "email": f"load.{self._run_id}.{self._created}@example.com", "gender": person["gender"],
+                "ip_address": f"10.{self._random.randrange(256)}.{self._random.randrange(256)}.{self._random.randrange(1, 255)}",
+                "country": self.country()}
+
+def _is_created(response):
+    return response.status_code < 400 and response.json() == CREATED_MESSAGE
+
+# Routes of the load test: name -> (category, function returning the path and the parameters of a request, optional check of the
+# response besides the status code). Every request is a GET, as /create_person.
+ROUTES = {
+    "get_people": ("read", lambda s: ("/get_people", {"country": s.country(), "limit": 100}), None),
+    "get_people_by_country": ("read", lambda s: ("/get_people_by_country", {"country": s.country()}), None),
+    "search_people": ("read", lambda s: ("/search_people", {"q": s.search_text()}), None),
+    "get_people_by_network": ("read", lambda s: ("/get_people_by_network", {"network": s.network()}), None),
+    "get_people_count_by_country": ("read", lambda s: ("/get_people_count_by_country", {}), None),
+    "get_people_gender_distribution": ("read", lambda s: ("/get_people_gender_distribution", {}), None),
+    "get_ip_address_distribution": ("read", lambda s: ("/get_ip_address_distribution", {"by": s.choice(["8", "range"])}), None),
+    "get_top_domains": ("read", lambda s: ("/get_top_domains", {"k": 10}), None),
+    "create_person": ("write", lambda s: ("/create_person", s.new_person()), _is_created),
+    "get_country_domain_correlation": ("analytics", lambda s: ("/get_country_domain_correlation", {}), None),
+    "get_gender_domain_correlation": ("analytics", lambda s: ("/get_gender_domain_correlation", {}), None),
+    "get_gender_country_correlation": ("analytics", lambda s: ("/get_gender_country_correlation", {}), None),
+    "get_gender_distribution_by_country": ("analytics", lambda s: ("/get_gender_distribution_by_country", {}), None),
+    "get_common_email_patterns": ("analytics", lambda s: ("/get_common_email_patterns", {}), None),
+    "get_association_matrix": ("analytics", lambda s: ("/get_association_matrix", {}), None),
+}
+
+# Predefined mixes: name of the route -> weight (the probability of each route is its weight divided by the sum of the weights)
+MIXES = {
+    "read": {name: 1 for name, (category, _, _) in ROUTES.items() if category == "read"},
+    "write": {"create_person": 1},
+    "analytics": {name: 1 for name, (category, _, _) in ROUTES.items() if category == "analytics"},
+    # 70% reads, 20% writes and 10% analytics
+    "mixed": {"get_people": 15, "get_people_by_country": 10, "search_people": 15, "get_people_by_network": 10,
+              "get_people_count_by_country": 5, "get_people_gender_distribution": 5, "get_ip_address_distribution": 5,
+              "get_top_domains": 5, "create_person": 20, "get_country_domain_correlation": 2, "get_gender_domain_correlation": 2,
+              "get_gender_country_correlation": 1, "get_gender_distribution_by_country": 1, "get_common_email_patterns": 2,
+              "get_association_matrix": 2},
+}
+
+def load_mix(mix):
+    '''
+        This function returns the mix of the load test.
+
+        PARAMETERS
+        mix -> The name of one of MIXES, or the path of a JSON file with an object {name of the route: weight} (routes in ROUTES).
+
+        RETURNS
+        A dictionary {name of the route: weight}. Raises ValueError if the mix is not valid.
+    '''
+    if mix in MIXES:
+        return dict(MIXES[mix])
+    if not os.path.isfile(mix):
+        raise ValueError(f"Unknown mix '{mix}'. The mix should be one of {', '.join(MIXES)} or a JSON file.")
+    with open(mix, encoding="utf-8") as f:
+        weights = json.load(f)
+    if not isinstance(weights, dict) or not weights or any(name not in ROUTES for name in weights) or \
+       any(not isinstance(w, (int, float)) or w < 0 for w in weights.values()) or sum(weights.values()) <= 0:
+        raise ValueError(f"Invalid mix '{mix}'. The file should contain an object with positive weights for the routes among {', '.join(ROUTES)}.")
+    return weights
+
+def prepare_database(work_dir, db=None, rows=DEFAULT_ROWS, seed=0):
+    '''
+        This function creates the SQLite database used by the api during the load test: a copy of the given database (the writes
+        of the test do not change the original one) or, if no database is given, a synthetic one. A snapshot of the data
+        (see column_store.py) is written next to it, as initialize_db.py does.
+
+        PARAMETERS
+        work_dir -> The folder where the database is created.
+        db -> The path of an existing SQLite database (optional).
+        rows -> The number of people of the synthetic database.
+        seed -> The seed of the synthetic data generator.
+
+        RETURNS
+        A tuple (path of the database, path of the snapshot).
+    '''
+    import initialize_db
+
+    path = os.path.join(work_dir, "load_test.db")
+    snapshot_path = os.path.join(work_dir, "snapshot")
+    if os.path.exists(path):
+        os.remove(path)
+    if db:
+        shutil.copyfile(db, path)
+        engine = sqlalchemy.create_engine(f"sqlite:///{path}")
+    else:
+        persons_data_file = os.path.join(work_dir, f"persons_{rows}.csv")
+        countries_data_file = os.path.join(work_dir, f"countries_{rows}.csv")
+        SyntheticDataGenerator(seed=seed).write_csv(rows, persons_data_file, countries_data_file)
+        engine = sqlalchemy.create_engine(f"sqlite:///{path}")
+        initialize_db.bulk_export_data_to_db(engine, persons_data_file, countries_data_file)
+        for data_file in (persons_data_file, countries_data_file):
+            os.remove(data_file)
+    initialize_db.write_snapshot(engine, snapshot_path)
+    engine.dispose()
+    return path, snapshot_path
+
+def configure_local_api(db_path, snapshot_path, work_dir):
+    '''
+        This function sets the environment of the api executed in the process of the load test, before api.py is imported: the other
+        settings of the .env file (column store, cache, ...) are kept, but the api uses the given database, without read replicas,
+        and its files (snapshot, sketches, analytics copy) are in the folder of the test, so that the ones of the real api are not
+        overwritten.
+    '''
+    load_dotenv()
+    os.environ["db_url"] = f"sqlite:///{os.path.abspath(db_path)}"
+    os.environ["db_async"] = "false"
+    os.environ["db_read_urls"] = ""
+    os.environ["snapshot_path"] = os.path.abspath(snapshot_path)
+    os.environ["sketches_path"] = os.path.abspath(os.path.join(work_dir, "domain_sketches.npz"))
+    os.environ["analytics_path"] = os.path.abspath(os.path.join(work_dir, "analytics.db"))
+
+class LoadGenerator:
+    '''
+        This class sends the requests of the load test and records the result of each of them.
+    '''
+    def __init__(self, client, sample, mix, seed=0, timeout=DEFAULT_TIMEOUT):
+        self.client = client
+        self.sample = sample
+        self.routes = list(mix)
+        self.weights = [mix[name] for name in self.routes]
+        self.timeout = timeout
+        self.results = [] # Tuples (route, start, latency, status code, error), with the times in seconds
+        self._random = random.Random(seed)
+
+    async def send(self, route, start=None):
+        '''
+            This function sends a request of a route and records its result.
+
+            PARAMETERS
+            route -> The name of the route (in ROUTES).
+            start -> The time (time.perf_counter) at which the request was scheduled: in the open loop the latency is measured from
+                     this time, so that a request delayed because the generator (or the event loop shared with the api) is busy is
+                     not reported as faster than it was.
+        '''
+        _, build, check = ROUTES[route]
+        path, params = build(self.sample)
+        start = time.perf_counter() if start is None else start
+        status, error = None, None
+        try:
+            response = await self.client.get(path, params=params, timeout=self.timeout)
+            status = response.status_code
+            if status >= 400:
+                error = f"HTTP {status}"
+            elif check is not None and not check(response):
+                error = "unexpected response"
+        except httpx.HTTPError as e:
+            error = type(e).__name__
+        self.results.append((route, start, time.perf_counter() - start, status, error))
+
+    def next_route(self):
+        return self._random.choices(self.routes, self.weights)[0]
+
+    async def closed_loop(self, concurrency, end):
+        '''
+            This function runs 'concurrency' clients, each sending a request as soon as it receives the previous response, until 'end'.
+        '''
+        async def client():
+            while time.perf_counter() < end:
+                await self.send(self.next_route())
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+
+    async def open_loop(self, rps, end, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        '''
+            This function starts requests at an average rate of 'rps' per second (Poisson arrivals) until 'end', regardless of the
+            responses, then waits for the requests in progress.
+        '''
+        tasks = set()
+        scheduled = time.perf_counter()
+        while True:
+            scheduled += self._random.expovariate(rps)
+            if scheduled >= end:
+                break
+            await asyncio.sleep(max(0, scheduled - time.perf_counter()))
+            route = self.next_route()
+            if len(tasks) >= max_in_flight:
+                self.results.append((route, scheduled, 0.0, None, "too many requests in progress"))
+                continue
+            task = asyncio.ensure_future(self.send(route, scheduled))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+
+def summarize(results, start, duration):
+    '''
+        This function computes the statistics of the requests started in the measured interval (after the warmup).
+
+        PARAMETERS
+        results -> The results recorded by LoadGenerator.
+        start -> The beginning of the measured interval (time.perf_counter).
+        duration -> The length of the measured interval in seconds.
+
+        RETURNS
+        A list of dictionaries, one for each route plus one for all the requests ('total'), with the number of requests, the
+        throughput (completed requests per second), the error rate and the latencies in milliseconds.
+    '''
+    df = pd.DataFrame(results, columns=["route", "start", "latency", "status", "error"])
+    df = df[(df["start"] >= start) & (df["start"] < start + duration)]
+    summary = []
+    for route, group in [*sorted(df.groupby("route")), ("total", df)]:
+        if len(group) == 0:
+            continue
+        latencies = group["latency"].to_numpy() * 1000
+        errors = int(group["error"].notna().sum())
+        statuses = group["status"].dropna().astype(int).value_counts().sort_index()
+        summary.append({"route": route,
+                        "category": ROUTES[route][0] if route in ROUTES else None,
+                        "requests": len(group),
+                        "throughput": (len(group) - errors) / duration,
+                        "errors": errors,
+                        "error_rate": errors / len(group),
+                        "latency_mean": float(latencies.mean()),
+                        **{f"latency_p{p}": float(np.percentile(latencies, p)) for p in PERCENTILES},
+                        "latency_max": float(latencies.max()),
+                        "status_codes": {str(code): int(count) for code, count in statuses.items()},
+                        "error_types": {str(e): int(count) for e, count in group["error"].dropna().value_counts().items()}})
+    return summary
+
+def compare_reports(results, previous_results, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    '''
+        This function compares the results of two load tests.
+
+        PARAMETERS
+        results, previous_results -> The lists of results of the two tests (as saved in the JSON files).
+        threshold -> The ratio between the p95 latencies above which a route is reported as a regression (a route is also a
+                     regression if its error rate grows).
+
+        RETURNS
+        A Pandas Dataframe with a row for each route present in both the tests.
+    '''
+    columns = ["route", "throughput", "error_rate", "latency_p50", "latency_p95", "latency_p99"]
+    current = pd.DataFrame(results)[columns]
+    previous = pd.DataFrame(previous_results)[columns]
+    df = current.merge(previous, on="route", suffixes=("", "_previous"))
+    df["p95_ratio"] = df["latency_p95"] / df["latency_p95_previous"]
+    df["regression"] = (df["p95_ratio"] > threshold) | (df["error_rate"] > df["error_rate_previous"])
+    return df.sort_values("p95_ratio", ascending=False)
+
+def print_summary(summary):
+    df = pd.DataFrame(summary)[["route", "requests", "throughput", "error_rate", "latency_p50", "latency_p95", "latency_p99", "latency_max"]]
+    print(df.to_string(index=False, float_format=lambda x: f"{x:.2f}"))
+
+async def _run(url, mix, rps, concurrency, duration, warmup, seed, timeout, max_in_flight):
+    if url:
+        transport, lifespan = None, None
+    else:
+        import api
+        transport = httpx.ASGITransport(app=api.app)
+        # The ASGI transport does not send the lifespan events, so the startup (column store, indexes, ...) and shutdown of the api
+        # are executed here
+        lifespan = api.app.router.lifespan_context(api.app)
+        await lifespan.__aenter__()
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    try:
+        async with httpx.AsyncClient(base_url=url or "http://load-test", transport=transport, limits=limits, timeout=timeout) as client:
+            sample = await TrafficSample.from_api(client, seed)
+            generator = LoadGenerator(client, sample, mix, seed, timeout)
+            start = time.perf_counter()
+            end = start + warmup + duration
+            if rps:
+                await generator.open_loop(rps, end, max_in_flight)
+            else:
+                await generator.closed_loop(concurrency, end)
+            return summarize(generator.results, start + warmup, duration)
+    finally:
+        if lifespan is not None:
+            await lifespan.__aexit__(None, None, None)
+
+def run_load_test(url=None, db=None, rows=DEFAULT_ROWS, mix="mixed", rps=None, concurrency=DEFAULT_CONCURRENCY, duration=DEFAULT_DURATION,
+                  warmup=DEFAULT_WARMUP, work_dir="load_test_results", output=None, seed=0, timeout=DEFAULT_TIMEOUT,
+                  max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+    '''
+        This function runs the load test and saves the results in a JSON file.
+
+        PARAMETERS
+        url -> The url of a running server. If not given, the api is executed in this process on a copy of 'db' (or on a synthetic
+               database of 'rows' people).
+        mix -> The name of a predefined mix or the path of a JSON file (see load_mix).
+        rps -> The target number of requests per second (open loop). If not given, 'concurrency' clients send the requests (closed loop).
+        duration, warmup -> The number of seconds measured, after 'warmup' seconds whose requests are not included in the results.
+        work_dir -> The folder for the database of the test and the results.
+        output -> The path of the JSON file with the results.
+        timeout -> The timeout of each request in seconds.
+        max_in_flight -> The maximum number of requests in progress in the open loop.
+
+        RETURNS
+        A dictionary with the results and the configuration of the test.
+    '''
+    weights = load_mix(mix)
+    os.makedirs(work_dir, exist_ok=True)
+    n_people = None
+    if not url:
+        start = time.perf_counter()
+        db_path, snapshot_path = prepare_database(work_dir, db, rows, seed)
+        with sqlalchemy.create_engine(f"sqlite:///{db_path}").connect() as connection:
+            n_people = connection.execute(sqlalchemy.text("SELECT COUNT(*) FROM person")).scalar()
+        print(f"Database of the test ready in {time.perf_counter() - start:.1f}s ({n_people} people)")
+        configure_local_api(db_path, snapshot_path, work_dir)
+
+    try:
+        summary = asyncio.run(_run(url, weights, rps, concurrency, duration, warmup, seed, timeout, max_in_flight))
+    finally:
+        if not url:
+            # Only the results are kept in the folder of the test
+            shutil.rmtree(snapshot_path, ignore_errors=True)
+            for data_file in (db_path, os.environ["sketches_path"], os.environ["analytics_path"]):
+                if os.path.exists(data_file):
+                    os.remove(data_file)
+    report = {"date": datetime.datetime.now().isoformat(timespec="seconds"),
+              "git_commit": _git_commit(),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "libraries": {"numpy": np.__version__, "pandas": pd.__version__, "sqlalchemy": sqlalchemy.__version__, "httpx": httpx.__version__},
+              "target": url or "in-process",
+              "people": n_people,
+              "mode": "open loop" if rps else "closed loop",
+              "rps": rps,
+              "concurrency": None if rps else concurrency,
+              "duration": duration,
+              "warmup": warmup,
+              "mix": weights,
+              "results": summary}
+
+    output = output or os.path.join(work_dir, f"load_test_{datetime.datetime.now():%Y%m%d_%H%M%S}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print_summary(summary)
+    print(f"Results saved in {output}")
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Send a mix of requests to the api and measure throughput, latency and errors of each route.")
+    parser.add_argument("--url", help="url of a running server (by default the api is executed in this process on a local SQLite database)")
+    parser.add_argument("--db", help="SQLite database copied and used by the api (by default a synthetic database is created)")
+    parser.add_argument("--rows", type=int, default=DEFAULT_ROWS, help="number of people of the synthetic database")
+    parser.add_argument("--mix", default="mixed", help=f"mix of requests: one of {', '.join(MIXES)} or a JSON file {{route: weight}}")
+    load = parser.add_mutually_exclusive_group()
+    load.add_argument("--rps", type=float, help="target number of requests per second (open loop)")
+    load.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="number of concurrent clients (closed loop, the default)")
+    parser.add_argument("--duration", type=float, default=DEFAULT_DURATION, help="number of seconds measured")
+    parser.add_argument("--warmup", type=float, default=DEFAULT_WARMUP, help="number of seconds before the measured ones")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_TIMEOUT, help="timeout of each request in seconds")
+    parser.add_argument("--max-in-flight", type=int, default=DEFAULT_MAX_IN_FLIGHT, help="maximum number of requests in progress (open loop)")
+    parser.add_argument("--work-dir", default="load_test_results", help="folder for the database of the test and the results")
+    parser.add_argument("--output", help="path of the JSON file with the results")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random choices and of the synthetic data generator")
+    parser.add_argument("--compare", help="JSON file of a previous execution to compare the results with")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD, help="p95 latency ratio reported as a regression (with --compare)")
+    args = parser.parse_args()
+
+    report = run_load_test(args.url, args.db, args.rows, args.mix, args.rps, args.concurrency, args.duration, args.warmup,
+                           args.work_dir, args.output, args.seed, args.timeout, args.max_in_flight)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            previous_report = json.load(f)
+        comparison = compare_reports(report["results"], previous_report["results"], args.threshold)
+        print(comparison.to_string(index=False, float_format=lambda x: f"{x:.2f}"))
+        print(f"{int(comparison['regression'].sum())} regressions (p95 latency more than {args.threshold}x the one of {previous_report.get('git_commit')}, or more errors)")
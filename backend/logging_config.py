@@ -0,0 +1,137 @@
+'''
+This file contains the configuration of the logs. Log records are put in a queue by the thread that produces them and written to
+the files by a background thread (QueueHandler/QueueListener), so that requests never wait for the file I/O.
+Each record is written as a line of JSON, along with the id and the endpoint of the request being processed (if any), and files
+are rotated when they reach a maximum size. The level can be set for each module (logger) from the .env file.
+'''
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+
+# Request being processed by the current thread/task (set by the api for each request)
+request_id_var = contextvars.ContextVar("request_id", default=None)
+endpoint_var = contextvars.ContextVar("endpoint", default=None)
+
+# Attributes added to the records (e.g., with logging.info(..., extra={"duration": 0.1})) that are written in the JSON lines
+EXTRA_FIELDS = ("request_id", "endpoint", "method", "status", "duration")
+
+class JsonFormatter(logging.Formatter):
+    '''
+        This class formats a log record as a line of JSON.
+    '''
+    def format(self, record):
+        entry = {"time": self.formatTime(record), "level": record.levelname, "logger": record.name, "message": record.getMessage()}
+        for field in EXTRA_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+class RequestContextFilter(logging.Filter):
+    '''
+        This filter adds to each record the id and the endpoint of the request being processed.
+        It is executed by the thread producing the record, where the context of the request is available.
+    '''
+    def filter(self, record):
+        if getattr(record, "request_id", None) is None:
+            record.request_id = request_id_var.get()
+        if getattr(record, "endpoint", None) is None:
+            record.endpoint = endpoint_var.get()
+        return True
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Unlike the default implementation, the message is not formatted here (it is formatted as JSON by the background thread):
+        # only the arguments and the traceback, which may not be safe to use from another thread, are converted to strings
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class _ExcludeLoggers(logging.Filter):
+    def __init__(self, names):
+        super().__init__()
+        self.filters = [logging.Filter(name) for name in names]
+
+    def filter(self, record):
+        return not any(f.filter(record) for f in self.filters)
+
+def _file_handler(filename, max_bytes, backup_count):
+    handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8")
+    handler.setFormatter(JsonFormatter())
+    return handler
+
+def parse_levels(levels):
+    '''
+        This function parses the levels of the modules written as 'module=LEVEL,module=LEVEL' (e.g., 'sqlalchemy.engine=WARNING,api.access=INFO').
+    '''
+    module_levels = {}
+    for item in (levels or "").split(","):
+        if "=" in item:
+            module, level = item.split("=", 1)
+            module_levels[module.strip()] = level.strip().upper()
+    return module_levels
+
+def setup_logging(filename, level="INFO", module_levels=None, max_bytes=10 * 1024 * 1024, backup_count=5, separate_files=None):
+    '''
+        This function configures the logs of the process.
+
+        PARAMETERS
+        filename -> The path of the main log file.
+        level -> The level of the root logger.
+        module_levels -> An optional dictionary with the level of some loggers (e.g., {"sqlalchemy.engine": "WARNING"}).
+        max_bytes, backup_count -> A log file is rotated when it reaches max_bytes, keeping backup_count old files.
+        separate_files -> An optional dictionary {logger name: path} of the loggers written in a dedicated file instead of the main one
+                          (e.g., {"slow_queries": "logs/slow_queries.log"}).
+
+        RETURNS
+        The QueueListener writing the records (stopped automatically when the process exits).
+    '''
+    separate_files = separate_files or {}
+    main_handler = _file_handler(filename, max_bytes, backup_count)
+    main_handler.addFilter(_ExcludeLoggers(separate_files))
+    handlers = [main_handler]
+    for name, separate_filename in separate_files.items():
+        handler = _file_handler(separate_filename, max_bytes, backup_count)
+        handler.addFilter(logging.Filter(name))
+        handlers.append(handler)
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = _QueueHandler(log_queue)
+    queue_handler.addFilter(RequestContextFilter())
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop) # Writes the records still in the queue
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level.upper())
+    for module, module_level in (module_levels or {}).items():
+        logging.getLogger(module).setLevel(module_level)
+    return listener
+
+def setup_logging_from_env(filename, separate_files=None):
+    '''
+        This function configures the logs with the settings in the .env file:
+        'log_level' (default INFO), 'log_levels' (levels of the modules, see parse_levels), 'log_max_bytes' and 'log_backup_count'.
+    '''
+    return setup_logging(filename,
+                         level=os.environ.get('log_level', 'INFO'),
+                         module_levels=parse_levels(os.environ.get('log_levels')),
+                         max_bytes=int(os.environ.get('log_max_bytes', 10 * 1024 * 1024)),
+                         backup_count=int(os.environ.get('log_backup_count', 5)),
+                         separate_files=separate_files)
@@ -0,0 +1,116 @@
+'''
+This file contains the Prometheus metrics of the api (exposed by the endpoint /metrics) and the instrumentation used to collect them:
+- latency and number of in-flight requests of each route;
+- duration, returned rows and connection pool waiting time of the queries, collected through sqlalchemy events;
+- duration of each stage of the functionalities in api_functionalities.py: 'query' (database), 'store' (column store),
+  'statistics' (Cramer's V) and 'processing' (the remaining time, i.e., the manipulation of the results with pandas/NumPy).
+Queries slower than a threshold are also logged with the logger 'slow_queries' (written to logs/slow_queries.log by the api).
+N.B. Metrics are kept in the memory of the process, so with more uvicorn workers each worker exposes its own values.
+'''
+import contextlib
+import contextvars
+import functools
+import logging
+import time
+from prometheus_client import Counter, Gauge, Histogram
+from sqlalchemy import event
+
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "Latency of the requests", ["method", "route", "status"])
+REQUESTS_IN_PROGRESS = Gauge("http_requests_in_progress", "Number of requests being processed", ["method", "route"])
+QUERY_DURATION = Histogram("db_query_duration_seconds", "Duration of the queries", ["database", "statement"])
+QUERY_ROWS = Histogram("db_query_rows", "Number of rows returned (or affected) by the queries", ["database", "statement"],
+                       buckets=(1, 10, 100, 1000, 10000, 100000, 1000000, float("inf")))
+SLOW_QUERIES = Counter("db_slow_queries_total", "Number of queries slower than the slow query threshold", ["database", "statement"])
+POOL_CHECKOUT_WAIT = Histogram("db_pool_checkout_wait_seconds", "Time waited to obtain a connection from the pool", ["database"])
+REPLICA_HEALTHY = Gauge("db_replica_healthy", "Whether a read replica is used (1) or excluded after a failure (0)", ["database"])
+FUNCTIONALITY_STAGE_DURATION = Histogram("functionality_stage_duration_seconds", "Duration of the stages of the functionalities",
+                                         ["functionality", "stage"])
+
+slow_query_logger = logging.getLogger("slow_queries")
+slow_query_threshold = 0.5 # Seconds
+
+# Functionality being executed, as a list [name, time spent in its stages] (set by the decorator instrumented and updated by stage)
+_current_functionality = contextvars.ContextVar("current_functionality", default=None)
+
+def configure_slow_query_log(threshold=0.5):
+    '''
+        This function sets the threshold (in seconds) above which a query is logged as slow.
+    '''
+    global slow_query_threshold
+    slow_query_threshold = threshold
+
+def _statement_type(statement):
+    words = statement.lstrip().split(None, 1)
+    return words[0].upper() if words else "UNKNOWN"
+
+def instrument_engine(engine, database="primary"):
+    '''
+        This function records the metrics of the queries executed with an engine.
+
+        PARAMETERS
+        engine -> A sqlalchemy engine (for an asynchronous engine, its sync_engine).
+        database -> The label identifying the database in the metrics (e.g., 'primary' or 'analytics').
+    '''
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - connection.info["query_start"].pop()
+        statement_type = _statement_type(statement)
+        QUERY_DURATION.labels(database, statement_type).observe(duration)
+        # Drivers that do not know the number of rows before they are fetched (e.g., sqlite3 for SELECT statements) return -1
+        if cursor.rowcount is not None and cursor.rowcount >= 0:
+            QUERY_ROWS.labels(database, statement_type).observe(cursor.rowcount)
+        if duration >= slow_query_threshold:
+            SLOW_QUERIES.labels(database, statement_type).inc()
+            slow_query_logger.warning(f"[{database}] {' '.join(statement.split())}", extra={"duration": duration})
+
+    # The pool has no event before a checkout, so the method waiting for a free connection is wrapped
+    pool = engine.pool
+    do_get = pool._do_get
+    def timed_do_get():
+        start = time.perf_counter()
+        try:
+            return do_get()
+        finally:
+            POOL_CHECKOUT_WAIT.labels(database).observe(time.perf_counter() - start)
+    pool._do_get = timed_do_get
+
+def instrumented(function):
+    '''
+        This decorator records the duration of a functionality (stage 'total') and allows to time its stages with stage().
+    '''
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        current = [function.__name__, 0.0]
+        token = _current_functionality.set(current)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - start
+            FUNCTIONALITY_STAGE_DURATION.labels(function.__name__, "total").observe(duration)
+            FUNCTIONALITY_STAGE_DURATION.labels(function.__name__, "processing").observe(max(0.0, duration - current[1]))
+            _current_functionality.reset(token)
+            # A functionality called by another one is a stage of the latter
+            parent = _current_functionality.get()
+            if parent is not None:
+                parent[1] += duration
+    return wrapper
+
+@contextlib.contextmanager
+def stage(name):
+    '''
+        This context manager (or decorator) records the duration of a stage of the functionality being executed (e.g., 'query').
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        current = _current_functionality.get()
+        if current is not None:
+            duration = time.perf_counter() - start
+            FUNCTIONALITY_STAGE_DURATION.labels(current[0], name).observe(duration)
+            current[1] += duration
@@ -0,0 +1,72 @@
+'''
+This file contains the checks of the parameters of the analytics functionalities, shared by the endpoints of the api and by the
+background jobs (see jobs.py), which receive the same parameters in a JSON object instead of the query string.
+Each check returns the error message of an invalid value, or None if the value is valid.
+'''
+import associations
+import ip_index
+
+MAX_PAGE_SIZE = 1000
+MAX_SEARCH_LENGTH = 100
+MAX_SEARCH_RESULTS = 100
+MAX_BOOTSTRAP = 10000
+IP_DISTRIBUTIONS = ("8", "16", "class", "range")
+
+def check_country(country):
+    if not isinstance(country, str) or not country or len(country) > 2:
+        return "Invalid parameter 'country'. This parameter cannot be empty and should be a string of at most 2 characters long."
+
+def check_ip_distribution(by):
+    if by not in IP_DISTRIBUTIONS:
+        return "Invalid parameter 'by'. This parameter should be '8', '16', 'class' or 'range'."
+
+def check_network(network):
+    try:
+        ip_index.network_range(network if isinstance(network, str) else "")
+    except ValueError:
+        return "Invalid parameter 'network'. This parameter should be a network in CIDR notation (e.g., '10.0.0.0/8')."
+
+def check_search_text(q, name="q"):
+    if not isinstance(q, str) or not q.strip() or len(q) > MAX_SEARCH_LENGTH:
+        return f"Invalid parameter '{name}'. This parameter cannot be empty and should be a string of at most {MAX_SEARCH_LENGTH} characters long."
+
+def check_attributes(attributes):
+    if not isinstance(attributes, list) or any(a not in associations.ATTRIBUTES for a in attributes) or len(attributes) < 2 \
+            or len(set(attributes)) != len(attributes):
+        return f"Invalid parameter 'attributes'. This parameter should contain at least two attributes among {', '.join(associations.ATTRIBUTES)}."
+
+def check_integer(name, value, minimum, maximum):
+    # bool is a subclass of int, but true and false are not valid numbers
+    if not isinstance(value, int) or isinstance(value, bool) or not minimum <= value <= maximum:
+        return f"Invalid parameter '{name}'. This parameter should be an integer between {minimum} and {maximum}."
+
+def check_fraction(name, value, include_one=True):
+    if not isinstance(value, (int, float)) or isinstance(value, bool) or not (0 < value <= 1 if include_one else 0 < value < 1):
+        return f"Invalid parameter '{name}'. This parameter should be a number greater than 0 and {'at most' if include_one else 'less than'} 1."
+
+# Checks of the parameters of the functionalities that can be executed as jobs (the parameters not listed accept no value from the
+# clients, see jobs.INTERNAL_PARAMETERS)
+FUNCTION_CHECKS = {
+    "get_people_by_country": {"country": check_country},
+    "get_ip_address_distribution": {"by": check_ip_distribution},
+    "get_people_in_network": {"network": check_network,
+                              "limit": lambda limit: check_integer("limit", limit, 1, MAX_PAGE_SIZE)},
+    "search_people": {"query": lambda query: check_search_text(query, "query"),
+                      "limit": lambda limit: check_integer("limit", limit, 1, MAX_SEARCH_RESULTS),
+                      "min_similarity": lambda min_similarity: check_fraction("min_similarity", min_similarity)},
+    "get_association_matrix": {"attributes": check_attributes,
+                               "n_bootstrap": lambda n_bootstrap: check_integer("n_bootstrap", n_bootstrap, 0, MAX_BOOTSTRAP),
+                               "confidence": lambda confidence: check_fraction("confidence", confidence, include_one=False)}}
+
+def check_arguments(function_name, arguments):
+    '''
+        This function checks the arguments of a functionality (see FUNCTION_CHECKS).
+
+        RETURNS
+        The error message of the first invalid argument, or None if all the arguments are valid.
+    '''
+    for name, check in FUNCTION_CHECKS.get(function_name, {}).items():
+        if name in arguments:
+            error = check(arguments[name])
+            if error is not None:
+                return error
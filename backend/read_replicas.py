@@ -0,0 +1,184 @@
+'''
+This file contains the read replicas of the primary database: copies kept up to date by the replication of the database server
+(e.g., MySQL replicas, or any database containing the same tables), used to execute the read-only functionalities so that the
+full scans of the analytics do not slow down the writes on the primary database.
+- Each read is sent to one of the healthy replicas, chosen in turn (round_robin) or as the one with fewer reads in progress (least_busy);
+- a replica whose connection fails is excluded for 'health_check_interval' seconds, then it is tried again, and the health checks
+  (a 'SELECT 1' on each replica) exclude and readmit the replicas before the reads find them failing;
+- if no replica is available, the reads are executed on the primary database.
+Since the replicas may lag behind the primary database, a read can be pinned to the primary database (see database.py).
+'''
+import os
+import time
+import logging
+import threading
+import itertools
+import sqlalchemy
+from sqlalchemy.engine import make_url
+import metrics
+
+STRATEGIES = ("round_robin", "least_busy")
+
+def is_connection_error(error):
+    '''
+        This function tells whether an exception raised by a query is due to the database being unreachable (instead of the query).
+    '''
+    return isinstance(error, (sqlalchemy.exc.OperationalError, sqlalchemy.exc.InterfaceError)) or \
+           (isinstance(error, sqlalchemy.exc.DBAPIError) and error.connection_invalidated)
+
+class NoReplicaAvailable(Exception):
+    pass
+
+class Replica:
+    '''
+        This class represents a read replica: its engine and its state.
+    '''
+    def __init__(self, engine, name):
+        self.engine = engine
+        self.name = name
+        self.healthy = True
+        self.retry_at = 0 # Time after which an unhealthy replica is tried again
+        self.in_progress = 0 # Number of reads in progress
+        self.last_error = None
+
+class ReadReplicaSet:
+    '''
+        This class selects the replica used by each read and keeps track of the health of the replicas.
+    '''
+    def __init__(self, engines, strategy="round_robin", health_check_interval=10):
+        '''
+            PARAMETERS
+            engines -> A list of sqlalchemy engines, one for each replica.
+            strategy -> 'round_robin' or 'least_busy'.
+            health_check_interval -> The number of seconds between two health checks (and for which a failing replica is excluded).
+        '''
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown read strategy '{strategy}'. The strategy should be one of {', '.join(STRATEGIES)}.")
+        self.replicas = [Replica(engine, f"replica{i}") for i, engine in enumerate(engines)]
+        self.strategy = strategy
+        self.health_check_interval = health_check_interval
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+        for replica in self.replicas:
+            metrics.REPLICA_HEALTHY.labels(replica.name).set(1)
+
+    @classmethod
+    def from_env(cls):
+        '''
+            This function creates the replicas listed in the .env file ('db_read_urls', comma separated sqlalchemy urls), with the
+            strategy 'db_read_strategy' and the interval 'db_health_check_interval'.
+
+            RETURNS
+            A ReadReplicaSet, or None if no replica is configured.
+        '''
+        # Imported here since database.py imports this file
+        from database import get_pool_options
+
+        urls = [url.strip() for url in os.environ.get('db_read_urls', '').split(",") if url.strip()]
+        if not urls:
+            return None
+        engines = [sqlalchemy.create_engine(url, **get_pool_options(url)) for url in urls]
+        replicas = cls(engines, strategy=os.environ.get('db_read_strategy', 'round_robin'),
+                       health_check_interval=float(os.environ.get('db_health_check_interval', 10)))
+        for replica, url in zip(replicas.replicas, urls):
+            logging.info(f"Read replica {replica.name}: {make_url(url).render_as_string(hide_password=True)}")
+        return replicas
+
+    def _select(self):
+        # Called with the lock held: the healthy replicas, plus the unhealthy ones whose exclusion has expired
+        now = time.monotonic()
+        available = [r for r in self.replicas if r.healthy or now >= r.retry_at]
+        if not available:
+            return None
+        turn = next(self._turn)
+        # Rotating the list before choosing also breaks the ties of least_busy in turn
+        available = available[turn % len(available):] + available[:turn % len(available)]
+        if self.strategy == "least_busy":
+            return min(available, key=lambda r: r.in_progress)
+        return available[0]
+
+    def acquire(self):
+        '''
+            This function selects the replica of a read and counts the read as in progress on it (until release is called).
+
+            RETURNS
+            The Replica. Raises NoReplicaAvailable if there is no available replica.
+        '''
+        with self._lock:
+            replica = self._select()
+            if replica is None:
+                raise NoReplicaAvailable("No read replica is available.")
+            replica.in_progress += 1
+        return replica
+
+    def release(self, replica, error=None):
+        '''
+            This function ends a read started with acquire. If the read failed because the replica is unreachable, the replica is excluded.
+        '''
+        with self._lock:
+            replica.in_progress -= 1
+        if error is not None and is_connection_error(error):
+            self.mark_unhealthy(replica, error)
+        elif error is None and not replica.healthy:
+            self.mark_healthy(replica)
+
+    def run(self, function, *args, **kwargs):
+        '''
+            This function executes a read-only functionality on one of the replicas, passing it the engine of the replica as first
+            parameter.
+
+            RETURNS
+            The result of the functionality. Raises NoReplicaAvailable if there is no available replica or the selected one is
+            unreachable, so that the read can be executed on the primary database.
+        '''
+        replica = self.acquire()
+        try:
+            result = function(replica.engine, *args, **kwargs)
+        except Exception as e:
+            self.release(replica, e)
+            if is_connection_error(e):
+                raise NoReplicaAvailable(f"The read replica {replica.name} is not available.") from e
+            raise
+        self.release(replica)
+        return result
+
+    def mark_unhealthy(self, replica, error):
+        with self._lock:
+            if replica.healthy:
+                logging.error(f"Read replica {replica.name} excluded: {error}")
+            replica.healthy = False
+            replica.retry_at = time.monotonic() + self.health_check_interval
+            replica.last_error = str(error)
+        metrics.REPLICA_HEALTHY.labels(replica.name).set(0)
+
+    def mark_healthy(self, replica):
+        with self._lock:
+            if not replica.healthy:
+                logging.info(f"Read replica {replica.name} available again")
+            replica.healthy = True
+            replica.last_error = None
+        metrics.REPLICA_HEALTHY.labels(replica.name).set(1)
+
+    def check_health(self):
+        '''
+            This function executes a trivial query on each replica, excluding the replicas that do not answer and readmitting the others.
+
+            RETURNS
+            A dictionary {name of the replica: True if healthy}.
+        '''
+        for replica in self.replicas:
+            try:
+                with replica.engine.connect() as connection:
+                    connection.execute(sqlalchemy.text("SELECT 1"))
+                self.mark_healthy(replica)
+            except sqlalchemy.exc.SQLAlchemyError as e:
+                self.mark_unhealthy(replica, e)
+        return self.status()
+
+    def status(self):
+        with self._lock:
+            return {replica.name: replica.healthy for replica in self.replicas}
+
+    def dispose(self):
+        for replica in self.replicas:
+            replica.engine.dispose()
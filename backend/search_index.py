@@ -0,0 +1,287 @@
+'''
+This file contains the in-memory index used to search people by (partial) name or email.
+The fields of each person are split into words (e.g., 'g.rossi@posta.org' into 'g', 'rossi', 'posta' and 'org') and each word into
+trigrams (sequences of 3 bytes, with two spaces added at the beginning as in pg_trgm, but none at the end, so that a word of the
+query may also be the beginning of a word, e.g. 'ros' of 'rossi'). The index keeps for each trigram the sorted list of the words
+containing it (inverted index). All the posting lists are stored in a single NumPy array (CSR layout: the postings of the i-th
+trigram are docs[offsets[i]:offsets[i + 1]]).
+As the word similarity of pg_trgm, each word of the query is compared with the most similar word of a person: the similarity of two
+words is the number of trigrams they share divided by the number of distinct trigrams of both, so the extra trigrams of a longer
+word lower it, while small typos (which change only a few trigrams) still match. People similar enough are returned ranked by
+similarity.
+'''
+import re
+import threading
+import numpy as np
+import pandas as pd
+from sqlalchemy import select
+from database import Session
+from db_management.db_entities import Person
+
+FIELDS = ("first_name", "last_name", "email")
+# New people are kept in a small separate index, merged into the main one when it reaches this number of postings
+MAX_DELTA_POSTINGS = 200000
+# Trigrams contained in more than this fraction of the people (e.g., 'com') are not used to find the candidates, only to rank them
+COMMON_TRIGRAM_FRACTION = 0.05
+# Number of strings whose trigrams are extracted at once (bounds the memory used by the vectorized extraction)
+EXTRACTION_CHUNK_SIZE = 20000
+# Up to this number of strings (e.g., the fields of a single new person or a query), the trigrams are extracted one string at a time
+SMALL_INPUT = 16
+# Separators of the words of the fields and of the query (the characters other than letters and digits)
+WORD_SEPARATOR = re.compile(r"[\W_]+")
+# The words (and the ends of the strings, marked with new lines) of many strings joined together
+WORD_OR_END = re.compile(r"[^\W_]+|\n")
+
+def trigrams(texts, prefix="  ", suffix=" "):
+    '''
+        This function extracts the trigrams of many strings with vectorized operations on their bytes.
+
+        PARAMETERS
+        texts -> A sequence of strings (they are converted to lower case).
+        prefix, suffix -> The padding added at the beginning and at the end of each string.
+
+        RETURNS
+        Two NumPy arrays of the same length: the position of the string in the sequence and the trigram (the 3 bytes as an integer).
+    '''
+    if len(texts) <= SMALL_INPUT:
+        positions, codes = [], []
+        for position, text in enumerate(texts):
+            data = (prefix + (text.lower() if isinstance(text, str) else "") + suffix).encode("utf-8")
+            codes.extend((data[i] << 16) | (data[i + 1] << 8) | data[i + 2] for i in range(len(data) - 2))
+            positions.extend([position] * max(len(data) - 2, 0))
+        return np.array(positions, dtype=np.int64), np.array(codes, dtype=np.int32)
+    texts = prefix + pd.Series(texts, dtype=object).fillna("").str.lower() + suffix
+    positions, codes = [], []
+    for start in range(0, len(texts), EXTRACTION_CHUNK_SIZE):
+        encoded = texts.iloc[start:start + EXTRACTION_CHUNK_SIZE].str.encode("utf-8")
+        lengths = encoded.str.len().to_numpy()
+        if len(encoded) == 0 or lengths.max() < 3:
+            continue
+        array = np.array(encoded.tolist(), dtype=f"S{lengths.max()}")
+        values = array.view(np.uint8).reshape(len(array), array.dtype.itemsize).astype(np.int32)
+        chunk_codes = (values[:, :-2] << 16) | (values[:, 1:-1] << 8) | values[:, 2:]
+        valid = np.arange(chunk_codes.shape[1])[None, :] < (lengths - 2)[:, None]
+        rows, _ = np.nonzero(valid)
+        positions.append(rows + start)
+        codes.append(chunk_codes[valid])
+    if not positions:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)
+    return np.concatenate(positions), np.concatenate(codes)
+
+class _Postings:
+    '''
+        This class contains posting lists in CSR layout, with the documents of each trigram sorted.
+    '''
+    def __init__(self, docs, codes):
+        # Each pair <trigram, document> is kept once, sorted by trigram and then by document
+        # (sorting and dropping the adjacent duplicates is much faster than np.unique on tens of millions of keys)
+        keys = np.sort((codes.astype(np.int64) << 32) | docs.astype(np.int64))
+        keys = keys[np.r_[True, keys[1:] != keys[:-1]]] if len(keys) else keys
+        codes = (keys >> 32).astype(np.int32)
+        self.docs = (keys & 0xFFFFFFFF).astype(np.int32)
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]]) if len(codes) else np.zeros(0, dtype=np.int64)
+        self.trigrams = codes[starts]
+        self.offsets = np.append(starts, len(codes)).astype(np.int64)
+
+    def __len__(self):
+        return len(self.docs)
+
+    def lists(self, codes):
+        '''
+            This function returns the posting list of each of the given trigrams (empty for the trigrams not in the index).
+        '''
+        positions = np.searchsorted(self.trigrams, codes)
+        lists = []
+        for code, position in zip(codes, positions):
+            found = position < len(self.trigrams) and self.trigrams[position] == code
+            lists.append(self.docs[self.offsets[position]:self.offsets[position + 1]] if found else self.docs[:0])
+        return lists
+
+def split_words(texts):
+    '''
+        This function splits strings into words (lower case, without separators).
+
+        PARAMETERS
+        texts -> A sequence of strings.
+
+        RETURNS
+        A NumPy array of words and a NumPy array with the position of the string of each word in the sequence.
+    '''
+    texts = [text.lower() if isinstance(text, str) else "" for text in texts]
+    if len(texts) > SMALL_INPUT:
+        # A single pass of the regular expression on all the strings, each one followed by a new line (unless a string
+        # contains one, which would be taken for the end of the string)
+        joined = "\n".join(texts) + "\n"
+        if joined.count("\n") == len(texts):
+            tokens = np.array(WORD_OR_END.findall(joined), dtype=object)
+            is_end = tokens == "\n"
+            return tokens[~is_end], (np.cumsum(is_end) - is_end)[~is_end]
+    words = [[word for word in WORD_SEPARATOR.split(text) if word] for text in texts]
+    return np.array([word for text_words in words for word in text_words], dtype=object), \
+           np.repeat(np.arange(len(words)), [len(w) for w in words])
+
+class TrigramIndex:
+    '''
+        This class implements the trigram index of the words of the fields first_name, last_name and email of the people.
+        People are identified inside the index by their position, mapped to their id by the array 'ids'; the words (the documents
+        of the posting lists) are mapped to the position of their person.
+    '''
+    def __init__(self):
+        self.size = 0
+        self._ids = np.zeros(0, dtype=np.int64)
+        self._fields = {field: np.zeros(0, dtype=object) for field in FIELDS}
+        self._n_trigrams = np.zeros(0, dtype=np.int32) # Number of trigrams of the words of each person
+        self._word_people = np.zeros(0, dtype=np.int32) # Person of each word
+        self._word_sizes = np.zeros(0, dtype=np.int32) # Number of distinct trigrams of each word
+        self._main = _Postings(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32))
+        self._delta = _Postings(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32))
+        self._delta_pairs = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32))
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_engine(cls, engine, chunk_size=100000, max_id=None):
+        '''
+            This function creates the index of all the people of the database (up to max_id, if given).
+        '''
+        index = cls()
+        query = select(Person.id, Person.first_name, Person.last_name, Person.email).order_by(Person.id)
+        if max_id is not None:
+            query = query.where(Person.id <= max_id)
+        batches = []
+        with Session(bind=engine) as session:
+            result = session.execute(query, execution_options={"yield_per": chunk_size})
+            for rows in result.partitions():
+                batches.append(pd.DataFrame.from_records(rows, columns=list(result.keys())))
+        if batches:
+            index.append(pd.concat(batches, ignore_index=True), merge=True)
+        return index
+
+    def append(self, people, merge=False):
+        '''
+            This function adds new people to the index.
+
+            PARAMETERS
+            people -> A Pandas DataFrame with columns id, first_name, last_name and email (other columns are ignored, and
+                      people appearing in more than one row are indexed once).
+            merge -> If True, the new people are merged directly into the main index (e.g., when the index is built).
+        '''
+        people = people.drop_duplicates("id")
+        if len(people) == 0:
+            return
+        words, word_people = split_words([text for field in FIELDS for text in people[field].tolist()])
+        # The words of each person are consecutive, so the sorted lists of words are also sorted by person
+        order = np.argsort(word_people % len(people), kind="stable")
+        words, word_people = words[order], word_people[order] % len(people)
+        docs, codes = trigrams(words, suffix="")
+        word_sizes = np.bincount(_Postings(docs, codes).docs, minlength=len(words)).astype(np.int32)
+        n_trigrams = np.bincount(word_people, weights=word_sizes, minlength=len(people)).astype(np.int32)
+
+        with self._lock:
+            docs = docs + len(self._word_people)
+            delta_docs, delta_codes = self._delta_pairs
+            delta_docs, delta_codes = np.concatenate([delta_docs, docs]), np.concatenate([delta_codes, codes])
+            if merge or len(delta_docs) > MAX_DELTA_POSTINGS:
+                # The main index is rebuilt with its postings and the ones of the delta
+                posting_trigrams = np.repeat(self._main.trigrams, np.diff(self._main.offsets))
+                self._main = _Postings(np.concatenate([self._main.docs, delta_docs]), np.concatenate([posting_trigrams, delta_codes]))
+                delta_docs, delta_codes = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int32)
+            self._delta = _Postings(delta_docs, delta_codes)
+            self._delta_pairs = (delta_docs, delta_codes)
+            self._word_people = np.concatenate([self._word_people, (word_people + self.size).astype(np.int32)])
+            self._word_sizes = np.concatenate([self._word_sizes, word_sizes])
+            self._ids = np.concatenate([self._ids, people["id"].to_numpy(dtype=np.int64)])
+            for field in FIELDS:
+                self._fields[field] = np.concatenate([self._fields[field], people[field].to_numpy(dtype=object)])
+            self._n_trigrams = np.concatenate([self._n_trigrams, n_trigrams])
+            self.size += len(people) # Readers only look at the first 'size' people
+
+    def search(self, query, limit=20, min_similarity=0.3):
+        '''
+            This function searches the people whose name or email is similar to a text.
+
+            PARAMETERS
+            query -> The text to search (e.g., a part of the name or of the email, possibly with some typos).
+            limit -> The maximum number of people returned.
+            min_similarity -> The minimum similarity of the people returned.
+
+            RETURNS
+            A Pandas DataFrame with columns id, first_name, last_name, email and score, sorted by score. The score is the similarity
+            of each word of the query with the most similar word of the person (shared trigrams / distinct trigrams of both words),
+            averaged over the words of the query weighted by their number of trigrams. People with the same score are sorted by
+            number of trigrams, so that the shortest fields (i.e., the closest to the query) come first.
+        '''
+        with self._lock:
+            size, main, delta = self.size, self._main, self._delta
+            ids, fields, n_trigrams = self._ids, self._fields, self._n_trigrams
+            word_people, word_sizes = self._word_people, self._word_sizes
+        # A word of the query that is the beginning of a word of the person (e.g., 'ros' of 'rossi') has a similarity lowered
+        # by the missing part
+        query_words = split_words([query])[0]
+        query_codes = [np.unique(trigrams([word], suffix="")[1]) for word in query_words]
+        columns = ["id", *FIELDS, "score"]
+        if size == 0 or sum(len(codes) for codes in query_codes) == 0:
+            return pd.DataFrame(columns=columns)
+        total = sum(len(codes) for codes in query_codes)
+
+        # For each word of the query: the candidate words, with the number of trigrams they share with it so far, and the
+        # posting lists of its common trigrams, which are looked up only for the candidates that can reach the minimum similarity
+        matches = []
+        for codes in query_codes:
+            # The documents of the delta follow the ones of the main index, so the concatenated lists are still sorted
+            lists = [np.concatenate([m, d]) if len(d) else m for m, d in zip(main.lists(codes), delta.lists(codes))]
+            # Candidates are taken from the selective trigrams only (or from the most selective one, if all of them are common)
+            is_common = np.array([len(l) > COMMON_TRIGRAM_FRACTION * size for l in lists])
+            if is_common.all():
+                is_common[np.argmin([len(l) for l in lists])] = False
+            # The number of selective trigrams of each candidate is the length of its run in the sorted concatenation of their lists
+            docs = np.sort(np.concatenate([l for l, common in zip(lists, is_common) if not common]))
+            starts = np.flatnonzero(np.r_[True, docs[1:] != docs[:-1]]) if len(docs) else np.zeros(0, dtype=np.int64)
+            matches.append((docs[starts], np.diff(np.append(starts, len(docs))), len(codes), [l for l, common in zip(lists, is_common) if common]))
+
+        # People that cannot reach the minimum similarity even if their words contain all the common trigrams are discarded
+        bounds = []
+        for candidates, shared, n_codes, common_lists in matches:
+            best = np.minimum(shared + len(common_lists), np.minimum(n_codes, word_sizes[candidates]))
+            bounds.append(_max_by_person(word_people[candidates], n_codes * _similarity(best, n_codes, word_sizes[candidates])))
+        people, bounds = _sum_by_person(bounds)
+        reachable = np.zeros(size, dtype=bool)
+        reachable[people[bounds >= min_similarity * total - 1e-9]] = True
+
+        scores = []
+        for candidates, shared, n_codes, common_lists in matches:
+            selected = reachable[word_people[candidates]]
+            candidates, shared = candidates[selected], shared[selected]
+            for postings in common_lists:
+                if len(postings):
+                    positions = np.minimum(np.searchsorted(postings, candidates), len(postings) - 1)
+                    shared += postings[positions] == candidates
+            # The similarity of a word of the query is the one of the most similar word of each person
+            scores.append(_max_by_person(word_people[candidates], n_codes * _similarity(shared, n_codes, word_sizes[candidates])))
+        people, scores = _sum_by_person(scores)
+        scores = scores / total
+        # The scores are compared with a small tolerance, since a score equal to min_similarity may be rounded below it
+        selected = scores >= min_similarity - 1e-9
+        people, scores = people[selected], scores[selected]
+        if len(people) == 0:
+            return pd.DataFrame(columns=columns)
+        order = np.lexsort((n_trigrams[people], -scores))[:limit]
+        docs = people[order]
+        return pd.DataFrame({"id": ids[docs], **{field: fields[field][docs] for field in FIELDS}, "score": scores[order]})
+
+def _similarity(shared, n_query_trigrams, n_word_trigrams):
+    # Shared trigrams divided by the distinct trigrams of the two words (as the similarity of pg_trgm)
+    return shared / (n_query_trigrams + n_word_trigrams - shared)
+
+def _max_by_person(people, values):
+    # The people and the maximum of the values of each of them (the people are sorted, see TrigramIndex.append)
+    if len(people) == 0:
+        return people, values
+    starts = np.flatnonzero(np.r_[True, people[1:] != people[:-1]])
+    return people[starts], np.maximum.reduceat(values, starts)
+
+def _sum_by_person(parts):
+    # The people (sorted) and the sum of their values in the given pairs <people, values>
+    if len(parts) == 1:
+        return parts[0]
+    people, inverse = np.unique(np.concatenate([p for p, _ in parts]), return_inverse=True)
+    return people, np.bincount(inverse, weights=np.concatenate([v for _, v in parts]), minlength=len(people))
@@ -0,0 +1,385 @@
+'''
+This file contains the sketches used to answer the analytics on the email domains approximately, in constant memory:
+- SpaceSaving: the most frequent domains, with a lower and an upper bound of the number of people of each domain;
+- CountMinSketch: an estimate (upper bound) of the number of people of any domain;
+- HyperLogLog: the number of distinct domains, kept for each country and for each gender.
+All the sketches are mergeable (the sketch of the union of two sets of people is obtained from the sketches of the two sets),
+are updated in batches with vectorized operations, and can be saved to a file so that they survive the restarts of the api.
+'''
+import os
+import threading
+import numpy as np
+import pandas as pd
+from sqlalchemy import select
+from database import Session
+from db_management.db_entities import Person, Country
+from db_management.summaries import count_people
+
+def hash_values(values):
+    '''
+        This function computes a 64 bit hash of each value, stable across processes (unlike the builtin hash of Python).
+    '''
+    return pd.util.hash_array(np.asarray(values, dtype=object))
+
+def _bit_length(values):
+    # Exact number of bits of 64 bit integers: each half is converted to float without any rounding
+    high = (values >> np.uint64(32)).astype(np.float64)
+    low = (values & np.uint64(0xFFFFFFFF)).astype(np.float64)
+    return np.where(high > 0, 32 + np.frexp(high)[1], np.frexp(low)[1])
+
+class SpaceSaving:
+    '''
+        This class implements the Space-Saving algorithm, which keeps at most 'capacity' counters.
+        For each monitored item, 'count' is an upper bound of the true number of occurrences and 'count - error' a lower bound;
+        an item that is not monitored occurs at most min_count() times. The error of every count is at most total/capacity.
+    '''
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.total = 0
+        self.counters = pd.DataFrame({"count": np.zeros(0, dtype=np.int64), "error": np.zeros(0, dtype=np.int64)},
+                                     index=pd.Index([], dtype=object))
+
+    def min_count(self):
+        '''
+            This function returns the maximum number of occurrences of an item that is not monitored.
+        '''
+        return int(self.counters["count"].min()) if len(self.counters) >= self.capacity else 0
+
+    def _merge_counters(self, counters, min_count, total):
+        # Mergeable summaries (Agarwal et al.): an item missing from a summary is counted with the bound of that summary,
+        # then the 'capacity' largest counters are kept
+        own_min_count = self.min_count()
+        union = self.counters.index.union(counters.index)
+        own = self.counters.reindex(union, fill_value=own_min_count)
+        other = counters.reindex(union, fill_value=min_count)
+        merged = own + other
+        if len(merged) > self.capacity:
+            merged = merged.nlargest(self.capacity, "count", keep="first")
+        self.counters = merged.astype(np.int64)
+        self.total += total
+
+    def update(self, values):
+        '''
+            This function adds a batch of occurrences (a sequence of items) to the sketch.
+        '''
+        counts = pd.Series(values, dtype=object).value_counts()
+        if len(counts) == 0:
+            return
+        # The batch is summarised exactly, keeping only the largest counts if there are more than 'capacity' items
+        batch_min_count = 0
+        if len(counts) > self.capacity:
+            counts = counts.iloc[:self.capacity]
+            batch_min_count = int(counts.iloc[-1])
+        batch = pd.DataFrame({"count": counts.to_numpy(dtype=np.int64), "error": np.zeros(len(counts), dtype=np.int64)}, index=counts.index)
+        self._merge_counters(batch, batch_min_count, int(len(values)))
+
+    def merge(self, other):
+        '''
+            This function adds to the sketch the occurrences summarised by another SpaceSaving.
+        '''
+        self._merge_counters(other.counters, other.min_count(), other.total)
+
+    def top(self, k):
+        '''
+            This function returns the k items with the largest counts.
+
+            RETURNS
+            A Pandas Dataframe, indexed by item and sorted by count, with columns count (upper bound) and error.
+        '''
+        return self.counters.sort_values("count", ascending=False, kind="stable").iloc[:k]
+
+    def state(self):
+        return {"capacity": np.int64(self.capacity), "total": np.int64(self.total),
+                "items": self.counters.index.to_numpy(dtype=str), "counts": self.counters["count"].to_numpy(), "errors": self.counters["error"].to_numpy()}
+
+    @classmethod
+    def from_state(cls, state):
+        sketch = cls(int(state["capacity"]))
+        sketch.total = int(state["total"])
+        sketch.counters = pd.DataFrame({"count": state["counts"].astype(np.int64), "error": state["errors"].astype(np.int64)},
+                                       index=pd.Index(state["items"].astype(object), dtype=object))
+        return sketch
+
+class CountMinSketch:
+    '''
+        This class implements a Count-Min sketch with 'depth' rows of 'width' counters.
+        The estimate of an item is never lower than its true count, and exceeds it by at most e * total / width
+        with probability 1 - exp(-depth).
+    '''
+    def __init__(self, width=2048, depth=5):
+        self.width = width
+        self.depth = depth
+        self.total = 0
+        self.table = np.zeros((depth, width), dtype=np.int64)
+
+    def _columns(self, values):
+        # Column of each item in each row, with the double hashing of Kirsch and Mitzenmacher: h1 + i * h2
+        hashes = hash_values(values)
+        h1 = (hashes & np.uint64(0xFFFFFFFF)).astype(np.int64)
+        h2 = (hashes >> np.uint64(32)).astype(np.int64) | 1
+        return (h1[None, :] + np.arange(self.depth)[:, None] * h2[None, :]) % self.width
+
+    def update(self, values):
+        '''
+            This function adds a batch of occurrences (a sequence of items) to the sketch.
+        '''
+        if len(values) == 0:
+            return
+        columns = self._columns(values)
+        rows = np.broadcast_to(np.arange(self.depth)[:, None], columns.shape)
+        np.add.at(self.table, (rows, columns), 1)
+        self.total += len(values)
+
+    def estimate(self, values):
+        '''
+            This function returns a NumPy array with the estimated number of occurrences of each of the given items.
+        '''
+        if len(values) == 0:
+            return np.zeros(0, dtype=np.int64)
+        columns = self._columns(values)
+        return self.table[np.arange(self.depth)[:, None], columns].min(axis=0)
+
+    def error_bound(self):
+        '''
+            This function returns the maximum overestimate (with probability 1 - exp(-depth)).
+        '''
+        return np.e * self.total / self.width
+
+    def merge(self, other):
+        if self.table.shape != other.table.shape:
+            raise ValueError("Count-Min sketches with different sizes cannot be merged")
+        self.table += other.table
+        self.total += other.total
+
+    def state(self):
+        return {"total": np.int64(self.total), "table": self.table}
+
+    @classmethod
+    def from_state(cls, state):
+        depth, width = state["table"].shape
+        sketch = cls(width, depth)
+        sketch.total = int(state["total"])
+        sketch.table = state["table"].astype(np.int64)
+        return sketch
+
+class HyperLogLog:
+    '''
+        This class implements HyperLogLog sketches estimating the number of distinct items of many groups (e.g., of each country).
+        Each group uses 2^precision registers of one byte, and the relative standard error of the estimates is 1.04 / sqrt(2^precision).
+    '''
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = {}
+
+    def update(self, groups, values):
+        '''
+            This function adds a batch of items to the sketches.
+
+            PARAMETERS
+            groups -> A sequence with the group of each item (items whose group is None are ignored).
+            values -> A sequence of items.
+        '''
+        groups = pd.Series(groups, dtype=object)
+        valid = groups.notna().to_numpy()
+        if not valid.any():
+            return
+        hashes = hash_values(np.asarray(values, dtype=object)[valid])
+        bits = 64 - self.precision
+        # The first bits select the register, which keeps the maximum position of the first 1 in the remaining bits
+        indexes = (hashes >> np.uint64(bits)).astype(np.int64)
+        ranks = (bits + 1 - _bit_length(hashes & np.uint64((1 << bits) - 1))).astype(np.uint8)
+        codes, uniques = pd.factorize(groups[valid])
+        for code, group in enumerate(uniques):
+            mask = codes == code
+            registers = self.registers.setdefault(group, np.zeros(self.m, dtype=np.uint8))
+            np.maximum.at(registers, indexes[mask], ranks[mask])
+
+    def estimate(self, group):
+        '''
+            This function returns the estimated number of distinct items of a group.
+        '''
+        registers = self.registers.get(group)
+        if registers is None:
+            return 0.0
+        alpha = 0.7213 / (1 + 1.079 / self.m)
+        estimate = alpha * self.m ** 2 / np.sum(np.ldexp(1.0, -registers.astype(np.int64)))
+        zeros = np.count_nonzero(registers == 0)
+        if estimate <= 2.5 * self.m and zeros > 0:
+            # Small cardinalities: linear counting
+            estimate = self.m * np.log(self.m / zeros)
+        return float(estimate)
+
+    def estimates(self):
+        '''
+            This function returns a dictionary {group: estimated number of distinct items}.
+        '''
+        return {group: self.estimate(group) for group in self.registers}
+
+    def relative_error(self):
+        return 1.04 / np.sqrt(self.m)
+
+    def merge(self, other):
+        if self.precision != other.precision:
+            raise ValueError("HyperLogLog sketches with different precisions cannot be merged")
+        for group, registers in other.registers.items():
+            np.maximum(self.registers.setdefault(group, np.zeros(self.m, dtype=np.uint8)), registers, out=self.registers[group])
+
+    def state(self):
+        groups = list(self.registers)
+        return {"precision": np.int64(self.precision), "groups": np.array(groups, dtype=str),
+                "registers": np.array([self.registers[g] for g in groups], dtype=np.uint8).reshape(len(groups), self.m)}
+
+    @classmethod
+    def from_state(cls, state):
+        sketch = cls(int(state["precision"]))
+        sketch.registers = {group: registers.copy() for group, registers in zip(state["groups"].tolist(), state["registers"])}
+        return sketch
+
+class DomainSketches:
+    '''
+        This class keeps the sketches of the email domains: the most frequent domains (SpaceSaving and CountMinSketch, counting each
+        person once) and the number of distinct domains of each country and of each gender (HyperLogLog).
+        The sketches are built from the database and then updated with the people created through the api.
+    '''
+    SKETCHES = {"top_domains": SpaceSaving, "domain_counts": CountMinSketch, "domains_by_country": HyperLogLog, "domains_by_gender": HyperLogLog}
+
+    def __init__(self, capacity=1000, width=2048, depth=5, precision=12):
+        self.top_domains = SpaceSaving(capacity)
+        self.domain_counts = CountMinSketch(width, depth)
+        self.domains_by_country = HyperLogLog(precision)
+        self.domains_by_gender = HyperLogLog(precision)
+        self.n_people = 0
+        self._last_id = 0
+        self._lock = threading.Lock()
+
+    def update(self, people):
+        '''
+            This function adds new people to the sketches.
+
+            PARAMETERS
+            people -> A Pandas DataFrame with columns id, email, gender and country (one row for each pair <person, country>,
+                      a missing country being None). The rows of the same person must be consecutive.
+        '''
+        if len(people) == 0:
+            return
+        ids = people["id"].to_numpy(dtype=np.int64)
+        domains = people["email"].str.split("@", n=1).str[-1].to_numpy(dtype=object)
+        with self._lock:
+            person_row = np.ones(len(ids), dtype=bool)
+            person_row[1:] = ids[1:] != ids[:-1]
+            person_row[0] = ids[0] != self._last_id
+            self.top_domains.update(domains[person_row])
+            self.domain_counts.update(domains[person_row])
+            self.domains_by_gender.update(people["gender"].to_numpy(dtype=object)[person_row], domains[person_row])
+            self.domains_by_country.update(people["country"].to_numpy(dtype=object), domains)
+            self.n_people += int(person_row.sum())
+            self._last_id = int(ids[-1])
+
+    def merge(self, other):
+        '''
+            This function adds to the sketches the people summarised by other DomainSketches (e.g., built by another process).
+        '''
+        with self._lock:
+            for name in self.SKETCHES:
+                getattr(self, name).merge(getattr(other, name))
+            self.n_people += other.n_people
+            self._last_id = max(self._last_id, other._last_id)
+
+    def update_from_engine(self, engine, chunk_size=100000, max_id=None):
+        '''
+            This function adds to the sketches the people of the database not seen yet (i.e., with a greater id than the last one),
+            up to max_id if given.
+        '''
+        query = select(Person.id, Person.email, Person.gender, Country.country).outerjoin(Country)\
+                    .where(Person.id > self._last_id).order_by(Person.id)
+        if max_id is not None:
+            query = query.where(Person.id <= max_id)
+        with Session(bind=engine) as session:
+            result = session.execute(query, execution_options={"yield_per": chunk_size})
+            for rows in result.partitions():
+                self.update(pd.DataFrame.from_records(rows, columns=list(result.keys())))
+
+    @classmethod
+    def from_engine(cls, engine, chunk_size=100000, max_id=None):
+        '''
+            This function creates the sketches of all the people of the database (up to max_id, if given).
+        '''
+        sketches = cls()
+        sketches.update_from_engine(engine, chunk_size, max_id)
+        return sketches
+
+    @classmethod
+    def restore(cls, engine, filename, max_id=None):
+        '''
+            This function loads the sketches saved in a file and adds the people inserted in the database afterwards.
+            If the file does not exist or does not match the database (e.g., the database has been initialized again), the sketches
+            are built from the whole database.
+
+            PARAMETERS
+            engine -> A sqlalchemy engine (or connection) to interact with the database.
+            filename -> The path of the file written by save().
+            max_id -> If given, only the people with an id up to max_id are added (see catch_up.py).
+        '''
+        sketches = cls.load(filename) if os.path.exists(filename) else None
+        if sketches is not None:
+            sketches.update_from_engine(engine, max_id=max_id)
+            with Session(bind=engine) as session:
+                n_people = count_people(session, max_id)
+            if n_people == sketches.n_people:
+                return sketches
+        return cls.from_engine(engine, max_id=max_id)
+
+    def save(self, filename):
+        '''
+            This function writes the sketches to a file (NumPy .npz format), replacing it atomically.
+        '''
+        with self._lock:
+            arrays = {"n_people": np.int64(self.n_people), "last_id": np.int64(self._last_id)}
+            for name in self.SKETCHES:
+                arrays.update({f"{name}.{key}": value for key, value in getattr(self, name).state().items()})
+            temporary_filename = filename + ".tmp"
+            with open(temporary_filename, "wb") as file:
+                np.savez(file, **arrays)
+            os.replace(temporary_filename, filename)
+
+    @classmethod
+    def load(cls, filename):
+        '''
+            This function reads the sketches written by save().
+        '''
+        with np.load(filename, allow_pickle=False) as arrays:
+            sketches = cls()
+            for name, sketch_class in cls.SKETCHES.items():
+                state = {key.split(".", 1)[1]: arrays[key] for key in arrays.files if key.startswith(name + ".")}
+                setattr(sketches, name, sketch_class.from_state(state))
+            sketches.n_people = int(arrays["n_people"])
+            sketches._last_id = int(arrays["last_id"])
+        return sketches
+
+    def top_domains_with_bounds(self, k):
+        '''
+            This function returns the k most frequent domains.
+
+            RETURNS
+            A list of dictionaries with the domain, the estimated number of people and a lower and an upper bound of the true number.
+            The upper bound is the smallest one of SpaceSaving and Count-Min; 'guaranteed' is True if the domain is certainly among
+            the k most frequent ones (its lower bound is not smaller than the upper bound of the domains that follow).
+        '''
+        with self._lock:
+            top = self.top_domains.top(k + 1)
+            upper = np.minimum(top["count"].to_numpy(), self.domain_counts.estimate(top.index.to_numpy()))
+            unmonitored = self.top_domains.min_count()
+        lower = top["count"].to_numpy() - top["error"].to_numpy()
+        next_upper = max(int(upper[k]) if len(top) > k else 0, unmonitored)
+        return [{"domain": domain, "count": int(upper[i]), "lower_bound": int(lower[i]), "upper_bound": int(upper[i]),
+                 "guaranteed": bool(lower[i] >= next_upper)}
+                for i, domain in enumerate(top.index[:k])]
+
+    def distinct_domains(self, by):
+        '''
+            This function returns the estimated number of distinct domains of each country ('by' equal to 'country') or of each gender.
+        '''
+        with self._lock:
+            sketch = self.domains_by_country if by == "country" else self.domains_by_gender
+            return {group: round(estimate) for group, estimate in sorted(sketch.estimates().items())}
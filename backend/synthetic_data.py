@@ -0,0 +1,131 @@
+'''
+This file contains a generator of synthetic data for the tables 'person' and 'country'.
+The values are sampled from the distributions observed in the csv files in the folder data (email domains, genders, countries,
+first number of the ip addresses and number of countries of each person), so that data of any size behaves like the real one.
+'''
+import os
+import numpy as np
+import pandas as pd
+
+PERSONS_DATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "persons.csv")
+COUNTRIES_DATA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "countries.csv")
+
+BASE36_DIGITS = np.array(list("0123456789abcdefghijklmnopqrstuvwxyz"))
+
+def _frequencies(values):
+    counts = pd.Series(values).value_counts()
+    return counts.index.to_numpy(dtype=object), (counts / counts.sum()).to_numpy()
+
+def _base36(numbers):
+    '''
+        This function converts an array of non negative integers into their base 36 representation (as in the emails of the csv files).
+    '''
+    numbers = np.asarray(numbers, dtype=np.int64)
+    digits = BASE36_DIGITS[numbers % 36].astype(object)
+    remaining = numbers // 36
+    while remaining.any():
+        longer = remaining > 0
+        digits[longer] = BASE36_DIGITS[remaining[longer] % 36].astype(object) + digits[longer]
+        remaining //= 36
+    return digits
+
+class SyntheticDataGenerator:
+    '''
+        This class generates people and countries with the same distributions of the csv files in the folder data.
+    '''
+    def __init__(self, persons_data_file=PERSONS_DATA_FILE, countries_data_file=COUNTRIES_DATA_FILE, seed=0):
+        # N.B. keep_default_na is set to 'False' since in the data there is a country named 'NA' which otherwise is considered as NaN
+        persons = pd.read_csv(persons_data_file, sep=",", keep_default_na=False)
+        countries = pd.read_csv(countries_data_file, sep=",", keep_default_na=False)
+
+        self.first_names = persons["first_name"].to_numpy(dtype=object)
+        self.last_names = persons["last_name"].to_numpy(dtype=object)
+        self.domains, self.domain_probabilities = _frequencies(persons["email"].str.split("@").str[1])
+        self.genders, self.gender_probabilities = _frequencies(persons["gender"])
+        self.countries, self.country_probabilities = _frequencies(countries["country"])
+
+        # Number of countries of each person (people without any country are possible as well)
+        countries_per_person = countries["person_id"].value_counts().reindex(persons["id"], fill_value=0)
+        self.n_countries, self.n_countries_probabilities = _frequencies(countries_per_person.to_numpy())
+        self.n_countries = self.n_countries.astype(np.int64)
+
+        octets = persons["ip_address"].str.extract(r"^(\d{1,3})\.")[0].dropna().astype(np.int64)
+        self.first_octet_probabilities = np.bincount(octets, minlength=256) / len(octets)
+
+        self.random = np.random.default_rng(seed)
+
+    def people(self, first_id, n):
+        '''
+            This function generates new people.
+
+            PARAMETERS
+            first_id -> The id of the first person (the ids are consecutive).
+            n -> The number of people.
+
+            RETURNS
+            A Pandas DataFrame with the columns of the file persons.csv.
+        '''
+        ids = np.arange(first_id, first_id + n, dtype=np.int64)
+        first_names = self.random.choice(self.first_names, n)
+        last_names = self.random.choice(self.last_names, n)
+        # As in the csv file, the email is the initial of the first name, the last name and the position of the person in base 36
+        local_parts = pd.Series(first_names).str[0].str.cat(pd.Series(last_names)).str.lower().str.replace(r"[^a-z0-9]", "", regex=True)
+        domains = self.random.choice(self.domains, n, p=self.domain_probabilities)
+        emails = local_parts + pd.Series(_base36(ids - 1)) + "@" + pd.Series(domains)
+
+        octets = np.column_stack([self.random.choice(256, n, p=self.first_octet_probabilities)] +
+                                 [self.random.integers(0, 256, n) for _ in range(3)]).astype(str)
+        ip_addresses = pd.Series(octets[:, 0]).str.cat([pd.Series(octets[:, i]) for i in range(1, 4)], sep=".")
+
+        return pd.DataFrame({"id": ids,
+                             "first_name": first_names,
+                             "last_name": last_names,
+                             "email": emails.to_numpy(dtype=object),
+                             "gender": self.random.choice(self.genders, n, p=self.gender_probabilities),
+                             "ip_address": ip_addresses.to_numpy(dtype=object)})
+
+    def sample_countries(self, n):
+        '''
+            This function samples n countries (e.g., the countries of new people created through the api).
+        '''
+        return self.random.choice(self.countries, n, p=self.country_probabilities)
+
+    def countries_of(self, person_ids, first_id):
+        '''
+            This function generates the countries of some people.
+
+            PARAMETERS
+            person_ids -> A NumPy array with the ids of the people.
+            first_id -> The id of the first row of the table 'country'.
+
+            RETURNS
+            A Pandas DataFrame with the columns of the file countries.csv.
+        '''
+        repeats = self.random.choice(self.n_countries, len(person_ids), p=self.n_countries_probabilities)
+        person_ids = np.repeat(person_ids, repeats)
+        n = len(person_ids)
+        return pd.DataFrame({"id": np.arange(first_id, first_id + n, dtype=np.int64),
+                             "person_id": person_ids,
+                             "country": self.sample_countries(n)})
+
+    def write_csv(self, n_people, persons_data_file, countries_data_file, chunk_size=100000):
+        '''
+            This function writes the csv files of a synthetic dataset, generating at most chunk_size people at a time.
+
+            PARAMETERS
+            n_people -> The number of people.
+            persons_data_file, countries_data_file -> The paths of the csv files to create.
+            chunk_size -> The number of people generated at a time.
+
+            RETURNS
+            A tuple (number of people, number of countries).
+        '''
+        n_countries = 0
+        for first_id in range(1, n_people + 1, chunk_size):
+            people = self.people(first_id, min(chunk_size, n_people + 1 - first_id))
+            countries = self.countries_of(people["id"].to_numpy(), n_countries + 1)
+            header = first_id == 1
+            people.to_csv(persons_data_file, mode="w" if header else "a", header=header, index=False)
+            countries.to_csv(countries_data_file, mode="w" if header else "a", header=header, index=False)
+            n_countries += len(countries)
+        return n_people, n_countries
@@ -0,0 +1,30 @@
+'''
+Configuration of the tests (run with 'python -m pytest tests' from the folder backend): the modules of the backend are imported
+as in the api (e.g., 'import contingency').
+The tests that need a database use a local SQLite database with synthetic people (see synthetic_data.py), loaded as initialize_db.py does.
+'''
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqlalchemy
+import initialize_db
+from synthetic_data import SyntheticDataGenerator
+
+N_PEOPLE = 1000
+
+@pytest.fixture(scope="session")
+def synthetic_data(tmp_path_factory):
+    folder = tmp_path_factory.mktemp("data")
+    persons_data_file, countries_data_file = str(folder / "persons.csv"), str(folder / "countries.csv")
+    SyntheticDataGenerator(seed=0).write_csv(N_PEOPLE, persons_data_file, countries_data_file)
+    return persons_data_file, countries_data_file
+
+@pytest.fixture
+def engine(tmp_path, synthetic_data):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'people.db'}")
+    initialize_db.bulk_export_data_to_db(engine, *synthetic_data)
+    yield engine
+    engine.dispose()
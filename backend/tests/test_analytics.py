@@ -0,0 +1,85 @@
+'''
+Tests of the embedded analytics copy (analytics.py): the functionalities executed on the copy give the results of the primary database,
+also after people have been created through the api.
+'''
+import os
+import pandas as pd
+import pytest
+import sqlalchemy
+import analytics
+import api_functionalities
+
+ANALYTICS = [("get_people_count_by_country", {}), ("get_people_gender_distribution", {}), ("get_ip_address_distribution", {"by": "16"}),
+             ("get_ip_address_distribution", {"by": "range"}), ("get_people_in_network", {"network": "10.0.0.0/8"}),
+             ("get_country_domain_correlation", {}), ("get_gender_distribution_by_country", {}), ("get_people", {"country": "CN"})]
+
+def new_people(n):
+    return pd.DataFrame({"first_name": ["Ann"] * n, "last_name": ["Smith"] * n, "email": [f"analytics{i}@example.com" for i in range(n)],
+                         "gender": ["Female", "Male"] * (n // 2) + ["Female"] * (n % 2),
+                         "ip_address": [f"10.2.{i}.1" if i % 2 else f"2001:db8::{i:x}" for i in range(n)],
+                         "country": ["CN", "FR"] * (n // 2) + ["CN"] * (n % 2)})
+
+@pytest.fixture(params=["sqlite", "duckdb"])
+def replica(request, tmp_path):
+    if request.param == "duckdb":
+        pytest.importorskip("duckdb_engine")
+    replica = analytics.AnalyticsReplica(sqlalchemy.create_engine(analytics.get_analytics_url(request.param, str(tmp_path / "analytics.db"))))
+    yield replica
+    replica.dispose()
+
+def sorted_rows(df):
+    # The rows with the same sort key can be returned in any order
+    df = df.reset_index(drop=pd.api.types.is_integer_dtype(df.index))
+    return df.sort_values(list(df.columns), ignore_index=True)
+
+def assert_same_result(result, expected):
+    if isinstance(expected, tuple): # e.g., a page of people and the cursor of the next one
+        for r, e in zip(result, expected, strict=True):
+            assert_same_result(r, e)
+    elif isinstance(expected, pd.DataFrame):
+        pd.testing.assert_frame_equal(sorted_rows(result), sorted_rows(expected), check_dtype=False)
+    elif isinstance(expected, float): # e.g., a correlation
+        assert result == pytest.approx(expected)
+    else:
+        assert result == expected
+
+def assert_same_results(replica, engine):
+    for function_name, arguments in ANALYTICS:
+        function = getattr(api_functionalities, function_name)
+        assert_same_result(function(replica.engine, **arguments), function(engine, **arguments))
+
+def test_copy_gives_the_results_of_the_primary_database(engine, replica):
+    with engine.connect() as connection:
+        n_people = connection.exec_driver_sql("SELECT COUNT(*) FROM person").scalar()
+    assert replica.load_from(engine, chunk_size=100) == n_people
+    assert_same_results(replica, engine)
+    # The new people are forwarded to the copy along with the summary tables
+    api_functionalities.create_new_people(engine, new_people(20), replica=replica)
+    api_functionalities.create_new_person(engine, "Bob", "Brown", "bob.brown@example.com", "Male", "10.3.0.1", "IT", replica=replica)
+    assert_same_results(replica, engine)
+    # Loading the copy again replaces its content
+    assert replica.load_from(engine) == n_people + 21
+    assert_same_results(replica, engine)
+
+def test_copy_up_to_an_id(engine, replica):
+    assert replica.load_from(engine, max_id=100) == 100
+    with replica.engine.connect() as connection:
+        assert connection.exec_driver_sql("SELECT MAX(person_id) FROM country").scalar() == 100
+        assert connection.exec_driver_sql("SELECT SUM(count) FROM gender_count").scalar() == 100
+
+def test_backend_of_the_environment(engine, monkeypatch, tmp_path):
+    monkeypatch.setenv("analytics_backend", "none")
+    assert analytics.AnalyticsReplica.from_env() is None
+    monkeypatch.setenv("analytics_backend", "sqlite")
+    tmp_path = tmp_path / "analytics"
+    tmp_path.mkdir()
+    monkeypatch.setenv("analytics_path", str(tmp_path / "analytics.db"))
+    replica = analytics.AnalyticsReplica.from_env()
+    # Each process has its own temporary copy
+    assert replica.engine.url.database == str(tmp_path / f"analytics.{os.getpid()}.db")
+    replica.load_from(engine)
+    assert os.path.exists(replica.engine.url.database)
+    replica.dispose()
+    assert os.listdir(tmp_path) == []
+    with pytest.raises(ValueError):
+        analytics.get_analytics_url("clickhouse", "analytics.db")
@@ -0,0 +1,34 @@
+'''
+Tests of the association matrix (associations.py): the attributes read from the database or from the column store give the same
+matrix, and the bootstrap computed by the pool of processes gives the same intervals as the one computed in the current process.
+'''
+import pytest
+import api_functionalities
+import associations
+from column_store import ColumnStore
+
+ATTRIBUTES = ["country", "gender", "domain", "ip_class", "tld"]
+
+def test_store_and_database_give_the_same_matrix(engine):
+    matrix, _ = api_functionalities.get_association_matrix(engine, ATTRIBUTES)
+    store_matrix, _ = api_functionalities.get_association_matrix(engine, ATTRIBUTES, store=ColumnStore.from_engine(engine))
+    assert matrix.to_numpy() == pytest.approx(store_matrix.to_numpy(), nan_ok=True)
+    for a in ATTRIBUTES:
+        for b in ATTRIBUTES:
+            assert matrix.loc[a, b] == matrix.loc[b, a]
+
+def test_parallel_bootstrap(engine, monkeypatch):
+    codes = associations.AttributeCodes.from_store(ColumnStore.from_engine(engine))
+    matrix, intervals = associations.association_matrix(codes, ["country", "gender"], n_bootstrap=200, seed=0, parallel=False)
+    monkeypatch.setenv("bootstrap_processes", "2")
+    monkeypatch.setattr(associations, "PARALLEL_MIN_CELLS", 0)
+    try:
+        parallel_matrix, parallel_intervals = associations.association_matrix(codes, ["country", "gender"], n_bootstrap=200, seed=0)
+        assert associations._executor is not None
+    finally:
+        associations.shutdown_executor()
+    assert parallel_matrix.equals(matrix)
+    # The replicates are split in chunks with their own seeds, so the intervals are close but not equal
+    (lower, upper), (parallel_lower, parallel_upper) = intervals[("country", "gender")], parallel_intervals[("country", "gender")]
+    assert lower <= upper and parallel_lower <= parallel_upper
+    assert parallel_lower == pytest.approx(lower, abs=0.05) and parallel_upper == pytest.approx(upper, abs=0.05)
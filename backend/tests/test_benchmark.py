@@ -0,0 +1,50 @@
+'''
+Tests of the benchmark (benchmark.py): a small run measures every functionality on both the backends and only leaves the JSON file
+of the results, which can be compared with the one of a previous run.
+'''
+import json
+import os
+import time
+import pytest
+import benchmark
+
+def test_measure():
+    calls = []
+    def setup():
+        calls.append("setup")
+        return len(calls)
+    def function(argument):
+        calls.append(argument)
+        time.sleep(0.01 * argument) # The first execution is the fastest one
+        return bytearray(10**6)
+    measures = benchmark.measure(function, repeat=2, setup=setup)
+    # The setup is executed before each execution, also before the one measuring the memory
+    assert calls == ["setup", 1, "setup", 3, "setup", 5]
+    assert 0.01 <= measures["wall_time"] < 0.03
+    assert measures["peak_memory"] >= 10**6
+
+def test_run_benchmark(tmp_path, capsys):
+    output = str(tmp_path / "results.json")
+    report = benchmark.run_benchmark(rows=[200], work_dir=str(tmp_path), output=output, repeat=1)
+    assert os.listdir(tmp_path) == ["results.json"]
+    with open(output, encoding="utf-8") as f:
+        assert json.load(f) == report
+    measured = {(r["function"], r["backend"]) for r in report["results"]}
+    assert {("bulk_export_data_to_db", "database"), ("export_data_to_db", "database"), ("search_people", "search_index"),
+            ("create_new_people", "column_store"), ("create_new_person", "database")} <= measured
+    for function in ["get_people_by_country", "get_association_matrix", "get_email_pattern_counts"]:
+        assert {(function, "database"), (function, "column_store")} <= measured
+    for result in report["results"]:
+        assert result["rows"] == 200 and result["wall_time"] > 0 and result["peak_memory"] >= 0 and result["rows_per_sec"] > 0
+
+def test_compare_results():
+    previous = [{"rows": 10, "function": "f", "backend": "database", "wall_time": 1.0},
+                {"rows": 10, "function": "g", "backend": "database", "wall_time": 1.0},
+                {"rows": 10, "function": "removed", "backend": "database", "wall_time": 1.0}]
+    results = [{"rows": 10, "function": "f", "backend": "database", "wall_time": 1.1},
+               {"rows": 10, "function": "g", "backend": "database", "wall_time": 1.5},
+               {"rows": 10, "function": "new", "backend": "database", "wall_time": 1.0}]
+    comparison = benchmark.compare_results(results, previous, threshold=1.2)
+    assert comparison["function"].tolist() == ["g", "f"]
+    assert comparison["ratio"].tolist() == pytest.approx([1.5, 1.1])
+    assert comparison["regression"].tolist() == [True, False]
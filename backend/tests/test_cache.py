@@ -0,0 +1,96 @@
+'''
+Tests of the cache of the responses (cache.py): a response is computed once until the data changes, its ETag gives '304 Not Modified'
+to the clients already having it, and each format has its own entry.
+'''
+import pandas as pd
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from cache import ResultCache, cached
+from database import read_your_writes_var
+
+@pytest.fixture
+def cache():
+    return ResultCache(max_entries=2)
+
+@pytest.fixture
+def computed():
+    return []
+
+@pytest.fixture
+def client(cache, computed):
+    app = FastAPI()
+
+    @app.middleware("http")
+    async def read_your_writes(request, call_next):
+        token = read_your_writes_var.set(request.headers.get("x-read-your-writes") == "true")
+        try:
+            return await call_next(request)
+        finally:
+            read_your_writes_var.reset(token)
+
+    @app.get("/distribution")
+    @cached(cache)
+    async def distribution(n: int = 1):
+        computed.append(n)
+        return pd.DataFrame({"Value": list(range(n)), "Count": [cache.data_version] * n})
+
+    @app.get("/write")
+    async def write():
+        cache.bump_version()
+
+    return TestClient(app)
+
+def test_response_is_computed_once_until_the_data_changes(client, computed):
+    response = client.get("/distribution", params={"n": 3})
+    assert response.status_code == 200 and computed == [3]
+    etag = response.headers["etag"]
+    assert response.headers["cache-control"] == "no-cache"
+    # From the cache, or without a body for the clients already having it
+    assert client.get("/distribution", params={"n": 3}).content == response.content
+    not_modified = client.get("/distribution", params={"n": 3}, headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304 and not_modified.content == b"" and not_modified.headers["etag"] == etag
+    assert computed == [3]
+    # Other arguments have another entry and another ETag
+    other = client.get("/distribution", params={"n": 2})
+    assert other.headers["etag"] != etag and computed == [3, 2]
+
+    client.get("/write")
+    changed = client.get("/distribution", params={"n": 3}, headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["etag"] != etag and computed == [3, 2, 3]
+    assert changed.json() != response.json()
+
+def test_each_format_has_its_own_entry(client, computed):
+    json_response = client.get("/distribution")
+    arrow_response = client.get("/distribution", params={"format": "arrow"})
+    accept_response = client.get("/distribution", headers={"Accept": "application/vnd.apache.arrow.stream"})
+    assert json_response.headers["content-type"].startswith("application/json")
+    assert arrow_response.headers["content-type"] == "application/vnd.apache.arrow.stream" and arrow_response.headers["vary"] == "Accept"
+    assert accept_response.content == arrow_response.content and accept_response.headers["etag"] == arrow_response.headers["etag"]
+    assert json_response.headers["etag"] != arrow_response.headers["etag"]
+    assert computed == [1, 1]
+    assert client.get("/distribution", params={"format": "csv"}).status_code == 406
+
+def test_least_recently_used_entries_are_evicted(client, computed):
+    for n in [1, 2, 1, 3, 1, 2]:
+        client.get("/distribution", params={"n": n})
+    # The cache keeps 2 entries: 2 is evicted by 3 since 1 has been used more recently
+    assert computed == [1, 2, 3, 2]
+
+def test_large_and_stale_responses_are_not_cached(cache):
+    cache.max_bytes = 10
+    cache.put("large", (b"x" * 11, "application/json"), cache.data_version)
+    version = cache.data_version
+    cache.bump_version() # The data changed while the response was computed
+    cache.put("stale", (b"x", "application/json"), version)
+    assert cache.get("large") is None and cache.get("stale") is None
+
+def test_reads_of_the_writes_are_not_cached(client, computed):
+    response = client.get("/distribution", headers={"X-Read-Your-Writes": "true"})
+    assert "etag" not in response.headers
+    client.get("/distribution", headers={"X-Read-Your-Writes": "true"})
+    assert computed == [1, 1]
+
+def test_etags_of_different_processes_differ():
+    # The data versions of two processes (or of a process after a restart) start from 0
+    assert ResultCache().etag("key", 0) != ResultCache().etag("key", 0)
@@ -0,0 +1,73 @@
+'''
+Tests of the catch-up of the in-memory copies (catch_up.py): the people created by the other processes are appended once, also when
+their transactions are committed out of order, and the watermark moves past a missing id only after the gap timeout.
+'''
+import pandas as pd
+import pytest
+import api_functionalities
+import catch_up
+from catch_up import CatchUp
+from column_store import ColumnStore
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(catch_up.time, "monotonic", lambda: now[0])
+    return now
+
+def insert_people(engine, ids):
+    # As a transaction of another process committing the people with the given ids
+    with engine.begin() as connection:
+        for id in ids:
+            connection.exec_driver_sql("INSERT INTO person (id, first_name, last_name, email, gender, ip_address) "
+                                       f"VALUES ({id}, 'Ann', 'Smith', 'catchup{id}@example.com', 'Female', '10.0.0.{id % 256}')")
+            connection.exec_driver_sql(f"INSERT INTO country (person_id, country) VALUES ({id}, 'IT')")
+
+def new_ids(catch_up, engine):
+    return catch_up.new_people(engine)["id"].tolist()
+
+def test_out_of_order_commits(engine, clock):
+    catch_up = CatchUp.from_engine(engine, gap_timeout=60)
+    assert catch_up.watermark == 1000
+    insert_people(engine, [1002, 1003])
+    assert new_ids(catch_up, engine) == [1002, 1003]
+    assert catch_up.watermark == 1000 # 1001 may still be committed
+    clock[0] += 30
+    insert_people(engine, [1001])
+    assert new_ids(catch_up, engine) == [1001]
+    assert catch_up.watermark == 1003
+    assert new_ids(catch_up, engine) == []
+
+def test_gaps_are_skipped_after_the_timeout(engine, clock):
+    catch_up = CatchUp.from_engine(engine, gap_timeout=60)
+    insert_people(engine, [1003, 1006])
+    assert new_ids(catch_up, engine) == [1003, 1006]
+    clock[0] += 40
+    # The second gap is partly filled, the remaining ids keep the time when the gap has been found
+    insert_people(engine, [1004])
+    assert new_ids(catch_up, engine) == [1004]
+    assert catch_up.watermark == 1000
+    clock[0] += 30
+    assert new_ids(catch_up, engine) == []
+    assert catch_up.watermark == 1006 # 1001, 1002 and 1005 have been rolled back
+    # A late commit of a skipped id is not read again (the ids of the transactions rolled back are never used)
+    insert_people(engine, [1007])
+    assert new_ids(catch_up, engine) == [1007] and catch_up.watermark == 1007
+
+def test_people_of_this_process_are_not_appended_again(engine, clock):
+    # The copies of two processes, loaded when they start
+    catch_up, store = CatchUp.from_engine(engine), ColumnStore.from_engine(engine)
+    other_catch_up, other_store = CatchUp.from_engine(engine), ColumnStore.from_engine(engine)
+    people = pd.DataFrame({"first_name": ["Ann", "Bob"], "last_name": ["Smith", "Brown"], "email": ["ann@catchup.org", "bob@catchup.org"],
+                           "gender": ["Female", "Male"], "ip_address": ["10.0.0.1", "10.0.0.2"], "country": ["IT", "FR"]})
+    ids, _ = api_functionalities.create_new_people(engine, people, store=store, catch_up=catch_up)
+    # The other process creates a person
+    api_functionalities.create_new_person(engine, "Eve", "White", "eve@catchup.org", "Female", "10.0.0.3", "ES", store=other_store,
+                                          catch_up=other_catch_up)
+    assert api_functionalities.catch_up_people(engine, catch_up, store=store) == 1
+    assert api_functionalities.catch_up_people(engine, other_catch_up, store=other_store) == 2
+    expected = ColumnStore.from_engine(engine)
+    for s in (store, other_store):
+        assert s.n_people == expected.n_people
+        assert sorted(s.count_by("country")) == sorted(expected.count_by("country"))
+    assert catch_up.watermark == other_catch_up.watermark == max(ids) + 1
@@ -0,0 +1,66 @@
+'''
+Tests of the column store (column_store.py): a store loaded from a snapshot and then updated with new people must answer as a store
+loaded from the whole database.
+'''
+import numpy as np
+import pandas as pd
+import pytest
+import api_functionalities
+from column_store import ColumnStore
+
+NETWORKS = ["10.0.0.0/8", "0.0.0.0/1", "128.0.0.0/2", "2001:db8::/32", "::/0"]
+
+def new_people(n, offset=0):
+    return pd.DataFrame({"first_name": ["Ann"] * n, "last_name": ["Smith"] * n, "email": [f"store{offset + i}@example.com" for i in range(n)],
+                         "gender": ["Female", "Male"] * (n // 2) + ["Female"] * (n % 2),
+                         "ip_address": [f"10.0.{i % 256}.{i % 7}" if i % 4 else f"2001:db8::{i:x}" for i in range(n)],
+                         "country": ["IT", "ZZ"] * (n // 2) + ["IT"] * (n % 2)})
+
+def assert_same_content(store, expected):
+    assert store.size == expected.size and store.n_people == expected.n_people
+    for attributes in [("country",), ("gender",), ("domain",), ("country", "gender")]:
+        assert sorted(store.count_by(*attributes)) == sorted(expected.count_by(*attributes))
+    for attributes in [("domain", "country"), ("gender", "country"), ("domain", "gender")]:
+        table, expected_table = store.contingency_table(*attributes), expected.contingency_table(*attributes)
+        assert (table.n, table.nnz) == (expected_table.n, expected_table.nnz) and table.chi2() == pytest.approx(expected_table.chi2())
+    assert store.ip_first_octet_counts().tolist() == expected.ip_first_octet_counts().tolist()
+    assert store.ip_range_counts().to_dict() == expected.ip_range_counts().to_dict()
+    for country in ["IT", "ZZ", "CN"]:
+        people = store.people_by_country(country).sort_values("id", ignore_index=True)
+        pd.testing.assert_frame_equal(people, expected.people_by_country(country).sort_values("id", ignore_index=True), check_dtype=False)
+    for network in NETWORKS:
+        count, people = store.people_in_network(network)
+        expected_count, expected_people = expected.people_in_network(network)
+        assert count == expected_count
+        assert sorted(people["id"].tolist()) == sorted(expected_people["id"].tolist())
+
+def test_snapshot_with_appended_people(engine, tmp_path):
+    ColumnStore.from_engine(engine).save(tmp_path / "snapshot")
+    store = ColumnStore.load(tmp_path / "snapshot")
+    # The index of the ip addresses is built before the appends, which add the new addresses to it
+    store.people_in_network("10.0.0.0/8")
+    api_functionalities.create_new_people(engine, new_people(40), store=store)
+    api_functionalities.create_new_person(engine, "Bob", "Smith", "store.single@example.com", "Male", "10.9.9.9", "ZZ", store=store)
+    assert len(store._parts("id")[0][1]) == 41 # The snapshot is mapped and only the new rows are in memory
+    assert_same_content(store, ColumnStore.from_engine(engine))
+
+def test_restore_appends_the_people_inserted_afterwards(engine, tmp_path):
+    ColumnStore.from_engine(engine).save(tmp_path / "snapshot")
+    api_functionalities.create_new_people(engine, new_people(25))
+    store = ColumnStore.restore(engine, tmp_path / "snapshot")
+    assert store._base_size > 0
+    assert_same_content(store, ColumnStore.from_engine(engine))
+    # Up to a given id, as when the copies of the api are loaded (see catch_up.py)
+    max_id = int(store.person_columns("id")[0].max()) - 10
+    assert ColumnStore.restore(engine, tmp_path / "snapshot", max_id=max_id).person_columns("id")[0].max() == max_id
+
+def test_snapshot_of_another_database_is_not_used(engine, tmp_path):
+    ColumnStore.from_engine(engine).save(tmp_path / "snapshot")
+    with engine.begin() as connection:
+        connection.exec_driver_sql("DELETE FROM country WHERE person_id > 900")
+        connection.exec_driver_sql("DELETE FROM person WHERE id > 900")
+        connection.exec_driver_sql("DELETE FROM gender_count")
+        connection.exec_driver_sql("INSERT INTO gender_count SELECT gender, COUNT(*) FROM person GROUP BY gender")
+    store = ColumnStore.restore(engine, tmp_path / "snapshot")
+    assert store._base_size == 0 and store.n_people == 900
+    assert np.array_equal(np.sort(store.person_columns("id")[0]), np.arange(1, 901))
@@ -0,0 +1,77 @@
+'''
+Tests of the sparse contingency tables (contingency.py) and of Cramer's V, compared with the dense computation of scipy.
+'''
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats
+import contingency
+from contingency import SparseContingencyTable
+from api_functionalities import compute_cramer_V_correlation
+
+def dense_cramer_V(table):
+    # Cramer's V with bias correction computed on the dense table, as it was done before the sparse tables
+    chi2 = stats.chi2_contingency(table, correction=False)[0]
+    n = table.sum()
+    r, k = table.shape
+    phi2_tilde = max(0, chi2 / n - (k - 1) * (r - 1) / (n - 1))
+    k_tilde = k - (k - 1) ** 2 / (n - 1)
+    r_tilde = r - (r - 1) ** 2 / (n - 1)
+    return np.sqrt(phi2_tilde / min(k_tilde - 1, r_tilde - 1))
+
+def random_values(seed, n=5000, n_rows=12, n_columns=40):
+    # Skewed and dependent variables, so that many cells of the table are empty
+    random = np.random.default_rng(seed)
+    rows = random.zipf(1.5, n) % n_rows
+    columns = (rows * 7 + random.zipf(2.0, n)) % n_columns
+    return pd.Series(rows).map(lambda v: f"r{v}"), pd.Series(columns).map(lambda v: f"c{v}")
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_chi2_matches_scipy(seed):
+    rows, columns = random_values(seed)
+    dense = pd.crosstab(rows, columns).to_numpy()
+    expected = stats.chi2_contingency(dense, correction=False)[0]
+    table = SparseContingencyTable.from_values(rows, columns)
+    assert table.shape == dense.shape
+    assert table.n == dense.sum()
+    assert table.chi2() == pytest.approx(expected, rel=1e-9)
+    assert np.array_equal(np.sort(table.to_dense(), axis=None), np.sort(dense, axis=None))
+
+def test_constructors_give_the_same_table():
+    rows, columns = random_values(3)
+    dense = pd.crosstab(rows, columns)
+    counts = dense.stack()
+    counts = counts[counts > 0]
+    tables = [SparseContingencyTable.from_values(rows, columns),
+              SparseContingencyTable.from_dense(dense.to_numpy()),
+              SparseContingencyTable.from_counts(counts.index.get_level_values(0), counts.index.get_level_values(1), counts.to_numpy())]
+    expected = stats.chi2_contingency(dense.to_numpy(), correction=False)[0]
+    for table in tables:
+        assert table.shape == dense.shape
+        assert table.chi2() == pytest.approx(expected, rel=1e-9)
+
+def test_sorted_accumulation(monkeypatch):
+    # Tables with many cells accumulate the counts sorting the keys instead of np.bincount
+    rows, columns = random_values(4)
+    expected = SparseContingencyTable.from_values(rows, columns).chi2()
+    monkeypatch.setattr(contingency, "DENSE_ACCUMULATION_LIMIT", 0)
+    assert SparseContingencyTable.from_values(rows, columns).chi2() == pytest.approx(expected, rel=1e-12)
+
+def test_empty_rows_and_columns_are_dropped():
+    # As with pd.crosstab, codes without any observation are not part of the table
+    table = SparseContingencyTable.from_codes(np.array([0, 0, 5, 5]), np.array([1, 3, 1, 9]), n_rows=10, n_columns=20)
+    assert table.shape == (2, 3)
+    assert table.chi2() == pytest.approx(stats.chi2_contingency(table.to_dense(), correction=False)[0])
+
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_cramer_V_matches_dense_computation(seed):
+    rows, columns = random_values(seed)
+    dense = pd.crosstab(rows, columns).to_numpy()
+    expected = dense_cramer_V(dense)
+    assert compute_cramer_V_correlation(SparseContingencyTable.from_values(rows, columns)) == pytest.approx(expected, rel=1e-9)
+    assert compute_cramer_V_correlation(dense) == pytest.approx(expected, rel=1e-9)
+
+def test_cramer_V_limits():
+    # Independent variables (every cell has the same count) and a variable determined by the other
+    assert compute_cramer_V_correlation(np.full((3, 4), 25)) == pytest.approx(0.0)
+    assert compute_cramer_V_correlation(np.diag([30, 40, 50])) == pytest.approx(1.0)
@@ -0,0 +1,73 @@
+'''
+Tests of the creation of people (create_new_people and create_new_person in api_functionalities.py): the ids returned, the duplicates
+and the summary tables are checked against the content of the database.
+'''
+import pandas as pd
+import pytest
+from sqlalchemy import select
+from database import Session
+from db_management.db_entities import Person, Country, derived_columns
+from db_management.summaries import verify_summaries
+from dedup import BloomFilter
+import api_functionalities
+
+def new_people(n, offset=0):
+    return pd.DataFrame({"first_name": ["aNN"] * n, "last_name": ["o'brien"] * n,
+                         "email": [f"New.Person{offset + i}@Example.com" for i in range(n)], "gender": ["female"] * n,
+                         "ip_address": [f"10.{i % 256}.1.2" if i % 3 else f"2001:db8::{i:x}" for i in range(n)], "country": ["it"] * n})
+
+def stored_people(engine, ids):
+    query = select(Person.id, Person.first_name, Person.last_name, Person.email, Person.gender, Person.ip_address, Person.ip_packed,
+                   Person.email_domain, Person.ip_first_octet, Country.country).join(Country).where(Person.id.in_([int(id) for id in ids]))
+    with Session(bind=engine) as session:
+        result = session.execute(query)
+        return pd.DataFrame.from_records(result.all(), columns=list(result.keys())).set_index("id")
+
+@pytest.mark.parametrize("returning", [True, False])
+def test_ids_match_the_database(engine, monkeypatch, returning):
+    # Without RETURNING (e.g., MySQL) the ids are computed from the id of the first row of the insert
+    monkeypatch.setattr(engine.dialect, "insert_executemany_returning", returning)
+    people = new_people(50)
+    ids, created = api_functionalities.create_new_people(engine, people)
+    assert created.all()
+    stored = stored_people(engine, ids)
+    assert stored.loc[ids, "email"].tolist() == people["email"].str.lower().tolist()
+    assert stored.loc[ids, "first_name"].unique().tolist() == ["Ann"] and stored.loc[ids, "country"].unique().tolist() == ["IT"]
+    with Session(bind=engine) as session:
+        assert all(count == 0 for count in verify_summaries(session).values())
+
+def test_duplicates_return_the_existing_ids(engine):
+    first_ids, _ = api_functionalities.create_new_people(engine, new_people(10))
+    # Five emails already in the database (in a different case) and a duplicated email in the same batch
+    people = pd.concat([new_people(5).assign(email=lambda p: p["email"].str.upper()), new_people(5, offset=100), new_people(1, offset=100)],
+                       ignore_index=True)
+    ids, created = api_functionalities.create_new_people(engine, people)
+    assert created.tolist() == [False] * 5 + [True] * 5 + [False]
+    assert ids[:5].tolist() == first_ids[:5].tolist()
+    assert ids[10] == ids[5]
+    with Session(bind=engine) as session:
+        assert all(count == 0 for count in verify_summaries(session).values())
+
+def test_duplicate_missed_by_the_email_filter_is_retried(engine):
+    first_ids, _ = api_functionalities.create_new_people(engine, new_people(3))
+    # An empty filter does not know the emails inserted by another process: the unique index rejects the insert, which is repeated
+    ids, created = api_functionalities.create_new_people(engine, new_people(4), email_filter=BloomFilter())
+    assert created.tolist() == [False, False, False, True]
+    assert ids[:3].tolist() == first_ids.tolist()
+    id, created = api_functionalities.create_new_person(engine, "Ann", "O'Brien", "new.person0@example.com", "Female", "10.0.1.2", "IT",
+                                                        email_filter=BloomFilter())
+    assert (id, created) == (first_ids[0], False)
+
+def test_single_person_is_stored_as_in_a_batch(engine):
+    people = new_people(6)
+    batch_ids, _ = api_functionalities.create_new_people(engine, people.iloc[:3])
+    single_ids = [api_functionalities.create_new_person(engine, *person) for person in people.iloc[3:].itertuples(index=False, name=None)]
+    assert all(created for _, created in single_ids)
+    stored = stored_people(engine, [*batch_ids, *[id for id, _ in single_ids]])
+    expected = derived_columns(people.assign(first_name="Ann", last_name="O'Brien", email=people["email"].str.lower(), gender="Female",
+                                             country="IT"))
+    expected.index = stored.index
+    pd.testing.assert_frame_equal(stored[expected.columns], expected, check_dtype=False)
+    assert api_functionalities.create_new_person(engine, *people.iloc[4]) == (single_ids[1][0], False)
+    with Session(bind=engine) as session:
+        assert all(count == 0 for count in verify_summaries(session).values())
@@ -0,0 +1,34 @@
+'''
+Tests of the execution of the functionalities (database.py): with the asynchronous engine, the queries are awaited on the event loop
+while the CPU-bound stages are executed in the threadpool.
+'''
+import asyncio
+import threading
+import pytest
+from sqlalchemy import text
+from database import Database, offload
+
+def test_offload_without_event_loop_is_direct():
+    assert offload(threading.get_ident) == threading.get_ident()
+
+def test_async_run_offloads_the_cpu_stages(tmp_path):
+    pytest.importorskip("greenlet")
+    pytest.importorskip("aiosqlite")
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    def functionality(connection, value):
+        loop_thread = threading.get_ident()
+        count = connection.execute(text("SELECT :value"), {"value": value}).scalar()
+        # A nested stage is executed directly in the thread of the outer one
+        return loop_thread, offload(lambda: (threading.get_ident(), offload(threading.get_ident))), count
+
+    async def main():
+        database = Database(async_engine=create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'async.db'}"))
+        try:
+            return threading.get_ident(), await database.run(functionality, 3)
+        finally:
+            await database.dispose()
+
+    event_loop_thread, (loop_thread, (stage_thread, nested_thread), count) = asyncio.run(main())
+    assert loop_thread == event_loop_thread and stage_thread != event_loop_thread
+    assert nested_thread == stage_thread and count == 3
@@ -0,0 +1,51 @@
+'''
+Tests of the detection of duplicate people (dedup.py): the Bloom filter of the emails and the likely duplicates found with MinHash
+and LSH, also on an empty database.
+'''
+import pandas as pd
+import sqlalchemy
+from db_management import db_entities
+import dedup
+import api_functionalities
+
+def test_bloom_filter_has_no_false_negatives_and_bounded_false_positives():
+    bloom_filter = dedup.BloomFilter(capacity=1000, error_rate=0.01)
+    emails = [f"person{i}@example.com" for i in range(20000)] # The filter grows well beyond its first capacity
+    bloom_filter.add(emails)
+    assert bloom_filter.might_contain(emails).all()
+    assert bloom_filter.might_contain([f"other{i}@example.com" for i in range(20000)]).mean() <= 0.01
+
+def test_empty_database(tmp_path):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'empty.db'}")
+    db_entities.Base.metadata.create_all(engine)
+    assert dedup.find_duplicates_in_database(engine).empty
+    # The filter of an empty database starts with the default capacity, not with room for no email
+    bloom_filter = dedup.BloomFilter.from_engine(engine)
+    bloom_filter.add([f"person{i}@example.com" for i in range(100000)])
+    assert bloom_filter.might_contain([f"other{i}@example.com" for i in range(100000)]).mean() <= 0.01
+    engine.dispose()
+
+def test_likely_duplicates():
+    people = pd.DataFrame({"id": [1, 2, 3, 4, 5],
+                           "first_name": ["John", "Jon", "Mary", "Zoe", "Paul"],
+                           "last_name": ["Doe", "Doe", "Smith", "Young", "Brown"],
+                           "email": ["john.doe@mail.com", "johndoe+shop@mail.com", "mary.smith@site.org", "zyoung@other.net",
+                                     "MARY.SMITH@site.org"]})
+    duplicates = dedup.find_duplicates(people)
+    assert duplicates[["id_1", "id_2"]].values.tolist() == [[1, 2], [3, 5]]
+    assert (duplicates["similarity"] == 1.0).all() # Same normalized email
+    groups = dedup.duplicate_groups(duplicates)
+    assert groups.to_dict() == {1: 0, 2: 0, 3: 1, 5: 1}
+    assert dedup.find_duplicates(people.iloc[:1]).empty
+
+def test_duplicates_in_database(engine):
+    with engine.connect() as connection:
+        id, first_name, last_name, email = connection.exec_driver_sql("SELECT id, first_name, last_name, email FROM person WHERE id = 1").one()
+    local, domain = email.split("@")
+    # The same person with a tag in the email (the unique index only rejects the same email)
+    new_id, created = api_functionalities.create_new_person(engine, first_name, last_name, f"{local}+news@{domain}", "Male", "10.0.0.1", "IT")
+    assert created
+    report = dedup.find_duplicates_in_database(engine)
+    groups = report.groupby("group")["id"].apply(list)
+    assert [id, new_id] in groups.tolist()
+    assert report["id"].is_unique
@@ -0,0 +1,68 @@
+'''
+Tests of the engine of the email patterns (email_patterns.py): the patterns of the catalogue, evaluated together on arrays, match as a
+check of each email on its own, and the counts do not depend on the chunks.
+'''
+import json
+import os
+import re
+import pandas as pd
+import pytest
+import api_functionalities
+import email_patterns
+
+PEOPLE = pd.DataFrame({"first_name": ["John", "John", "John", "John", "Mary", "Mary", "Sean", "Ann", "Ann", "Zoe"],
+                       "last_name": ["Doe", "Doe", "Doe", "Doe", "Smith", "Smith", "O'Brien", "Lee-Park", "Lee", "Young"],
+                       "email": ["john.doe@a.com", "jdoe@a.com", "johnd7@b.com", "john@b.com", "smith.mary@a.com", "mary.s@b.com",
+                                 "obrien@c.org", "annleepark@c.org", "ANN.LEE@c.org", "zy@c.org"]})
+EXPECTED_PATTERNS = [{"first.last"}, {"flast"}, {"firstl"}, {"first"}, {"last.first"}, {"first.l"}, {"last"}, {"firstlast"}, set(), set()]
+
+def matched_patterns(person, catalogue):
+    # Check of a single email: the patterns are checked in the order of the catalogue, excluding the ones already matched
+    first, last = person["first_name"].lower(), re.sub(r"[ .\-']", "", person["last_name"].lower())
+    local_part = person["email"].split("@")[0]
+    matched = set()
+    for pattern in catalogue:
+        prefix = pattern["template"].format(first=first, last=last, f=first[:1], l=last[:1])
+        if local_part.startswith(prefix) and not matched.intersection(pattern["exclude"]):
+            matched.add(pattern["name"])
+    return matched
+
+def test_patterns_of_each_email():
+    catalogue = email_patterns.load_catalogue(email_patterns.DEFAULT_CATALOGUE_FILE)
+    matches = email_patterns.match_email_patterns(PEOPLE["first_name"], PEOPLE["last_name"], PEOPLE["email"].str.split("@").str[0], catalogue)
+    names = [pattern["name"] for pattern in catalogue]
+    # N.B. the emails are not lowercased, as in the previous version
+    assert [{names[i] for i in range(len(names)) if matches[i, j]} for j in range(len(PEOPLE))] == EXPECTED_PATTERNS
+    assert [matched_patterns(person, catalogue) for _, person in PEOPLE.iterrows()] == EXPECTED_PATTERNS
+
+def test_counts_of_the_database(engine, monkeypatch):
+    catalogue = email_patterns.load_catalogue(email_patterns.DEFAULT_CATALOGUE_FILE)
+    people = pd.read_sql("SELECT first_name, last_name, email FROM person", engine)
+    expected = pd.DataFrame([{name: name in matched_patterns(person, catalogue) for name in [p["name"] for p in catalogue]}
+                             for _, person in people.iterrows()]).astype(int)
+    expected = expected.groupby(people["email"].str.split("@").str[1].rename("Domain"), sort=False).sum()
+    counts = api_functionalities.get_email_pattern_counts(engine)
+    pd.testing.assert_frame_equal(counts, expected, check_index_type=False, check_dtype=False)
+    # Counted in chunks
+    monkeypatch.setattr(email_patterns, "CHUNK_SIZE", 7)
+    pd.testing.assert_frame_equal(email_patterns.count_email_patterns(people, catalogue), counts)
+
+def test_catalogue_file(engine, tmp_path):
+    path = tmp_path / "patterns.json"
+    path.write_text(json.dumps([{"name": "f.l", "template": "{f}.{l}"}, {"name": "f", "template": "{f}", "exclude": ["f.l"]}]))
+    counts = api_functionalities.get_email_pattern_counts(engine, catalogue_file=str(path))
+    assert list(counts.columns) == ["f.l", "f"]
+    assert counts.sum().sum() > 0
+    # The catalogue is read again when the file changes
+    path.write_text(json.dumps([{"name": "last", "template": "{last}"}]))
+    os.utime(path, (0, 0))
+    assert [pattern["name"] for pattern in email_patterns.load_catalogue(str(path))] == ["last"]
+
+@pytest.mark.parametrize("catalogue", [[{"name": "middle", "template": "{middle}"}],
+                                       [{"name": "first", "template": "{first}", "exclude": ["firstlast"]},
+                                        {"name": "firstlast", "template": "{first}{last}"}]])
+def test_invalid_catalogue(tmp_path, catalogue):
+    path = tmp_path / "patterns.json"
+    path.write_text(json.dumps(catalogue))
+    with pytest.raises(ValueError):
+        email_patterns.load_catalogue(str(path))
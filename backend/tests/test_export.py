@@ -0,0 +1,65 @@
+'''
+Tests of the export of the people (export.py): every format contains the rows of the join between 'person' and 'country' matching the
+filters, encoded in a part for each chunk read from the database.
+'''
+import io
+import pandas as pd
+import pytest
+import export
+
+def expected_rows(engine, country=None, gender=None):
+    rows = pd.read_sql("SELECT p.id, p.first_name, p.last_name, p.email, p.gender, p.ip_address, c.country "
+                       "FROM person p LEFT JOIN country c ON c.person_id = p.id ORDER BY p.id, c.id", engine)
+    if country:
+        rows = rows[rows["country"] == country.upper()]
+    if gender:
+        rows = rows[rows["gender"] == gender.title()]
+    return rows.reset_index(drop=True)
+
+def comparable(rows):
+    # The missing countries are None or NaN depending on the reader
+    return rows.astype(object).where(rows.notna(), None)
+
+def decode(parts, format):
+    body = b"".join(parts)
+    if format == "csv":
+        rows = pd.read_csv(io.BytesIO(body), keep_default_na=False, dtype=str)
+        rows["country"] = rows["country"].mask(rows["country"] == "") # An empty value is a missing country
+        return rows.astype({"id": "int64"})
+    if format == "ndjson":
+        return pd.read_json(io.BytesIO(body), lines=True, dtype={"ip_address": str}) if body else pd.DataFrame(columns=export.COLUMNS)
+    return pd.read_parquet(io.BytesIO(body))
+
+@pytest.fixture
+def special_people(engine):
+    with engine.begin() as connection:
+        # A person without a country, one with two countries and values that must be escaped
+        connection.exec_driver_sql("INSERT INTO person (id, first_name, last_name, email, gender, ip_address) VALUES "
+                                   "(2001, 'Zoë', 'O\"Neil, Jr', 'zoe@example.com', 'Female', '2001:db8::1'), "
+                                   "(2002, 'Ann', 'Lee', 'ann@example.com', 'Female', '10.0.0.1')")
+        connection.exec_driver_sql("INSERT INTO country (person_id, country) VALUES (2002, 'NA'), (2002, 'IT')")
+
+@pytest.mark.parametrize("format", ["csv", "ndjson", "parquet"])
+@pytest.mark.parametrize("filters", [{}, {"country": "it", "gender": "female"}])
+def test_export_contains_the_rows(engine, special_people, format, filters):
+    if format == "parquet":
+        pytest.importorskip("pyarrow")
+    expected = expected_rows(engine, **filters)
+    parts = list(export.encode(export.read_chunks(engine, export.people_query(**filters), chunk_size=128), format))
+    # A part for each chunk (and the metadata at the end of a parquet file)
+    assert len(parts) == -(-len(expected) // 128) + (format == "parquet")
+    pd.testing.assert_frame_equal(comparable(decode(parts, format)), comparable(expected), check_dtype=False)
+
+@pytest.mark.parametrize("format", ["csv", "ndjson", "parquet"])
+def test_empty_export(engine, format):
+    if format == "parquet":
+        pytest.importorskip("pyarrow")
+    parts = list(export.encode(export.read_chunks(engine, export.people_query(country="ZZ")), format))
+    assert decode(parts, format).empty
+    if format == "csv":
+        assert b"".join(parts) == (",".join(export.COLUMNS) + "\n").encode()
+
+def test_read_chunks(engine):
+    chunks = list(export.read_chunks(engine, export.people_query(), chunk_size=300))
+    assert [len(chunk) for chunk in chunks] == [300, 300, 300, len(expected_rows(engine)) - 900]
+    assert [row[0] for chunk in chunks for row in chunk] == expected_rows(engine)["id"].tolist()
@@ -0,0 +1,61 @@
+'''
+Tests of the formats of the responses (formats.py): every format must contain the same table, and the index must be a column only
+when it contains information.
+'''
+import numpy as np
+import orjson
+import pandas as pd
+import pytest
+from starlette.requests import Request
+import formats
+
+def distribution():
+    # As the distributions of the api: an unnamed integer index, not in order after sort_values
+    df = pd.DataFrame({"Gender": ["Male", "Female", "Agender/other"], "Count": [3, 5, 1]})
+    df["Distribution (%)"] = df["Count"] / df["Count"].sum() * 100
+    return df.sort_values("Count", ascending=False)
+
+def request(query_string="", accept=None):
+    headers = [(b"accept", accept.encode())] if accept else []
+    return Request({"type": "http", "method": "GET", "path": "/", "query_string": query_string.encode(), "headers": headers})
+
+def test_records_and_columns_contain_the_table():
+    df = distribution()
+    records = orjson.loads(formats.render(df, "records")[0])
+    assert records == [{"Gender": g, "Count": c, "Distribution (%)": pytest.approx(d)} for g, c, d in df.itertuples(index=False)]
+    columns = orjson.loads(formats.render(df, "columns")[0])
+    assert columns["columns"] == ["Gender", "Count", "Distribution (%)"]
+    assert columns["data"][0] == df["Gender"].tolist() and columns["data"][1] == df["Count"].tolist()
+
+def test_index_is_kept_only_with_information():
+    named = distribution().set_index("Gender")
+    assert list(orjson.loads(formats.to_records(named))[0]) == ["Gender", "Count", "Distribution (%)"]
+    labels = pd.DataFrame({"Count": [2, 1]}, index=["10.0.0.0/8", "::/0"])
+    assert orjson.loads(formats.to_records(labels)) == [{"index": "10.0.0.0/8", "Count": 2}, {"index": "::/0", "Count": 1}]
+    assert orjson.loads(formats.to_columns(labels))["columns"] == ["index", "Count"]
+
+def test_missing_values_and_escapes():
+    df = pd.DataFrame({"text": ["a/b", "back\\slash/", None, "ü"], "value": [1.5, np.nan, 2.0, 0.1 + 0.2]})
+    records = orjson.loads(formats.to_records(df))
+    assert [r["text"] for r in records] == ["a/b", "back\\slash/", None, "ü"]
+    assert [r["value"] for r in records] == [1.5, None, 2.0, pytest.approx(0.3)]
+    assert formats.to_records(df.iloc[:0]) == b"[]"
+
+@pytest.mark.parametrize("format", ["arrow", "parquet"])
+def test_binary_formats_contain_the_table(format):
+    pa = pytest.importorskip("pyarrow")
+    import pyarrow.parquet as pq
+    df = distribution()
+    body, _ = formats.render(df, format)
+    table = pa.ipc.open_stream(body).read_all() if format == "arrow" else pq.read_table(pa.BufferReader(body))
+    assert table.column_names == ["Gender", "Count", "Distribution (%)"]
+    assert table.column("Gender").to_pylist() == df["Gender"].tolist()
+
+def test_negotiate():
+    assert formats.negotiate(request("format=columns", "application/vnd.apache.arrow.stream")) == "columns"
+    assert formats.negotiate(request(accept="application/json;q=0.5, application/vnd.apache.parquet")) == "parquet"
+    assert formats.negotiate(request(accept="text/html, application/vnd.apache.arrow.stream;q=0")) == "json"
+    with pytest.raises(formats.UnsupportedFormat):
+        formats.negotiate(request("format=xml"))
+    # Contents that are not tables are always JSON
+    assert formats.render("No result found in the database.", "parquet") == (b'"No result found in the database."', "application/json")
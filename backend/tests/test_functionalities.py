@@ -0,0 +1,108 @@
+'''
+Tests of the functionalities of the api (api_functionalities.py): the results computed on the column store must be the same as the
+ones computed on the database, also after people have been created through the api. The pages of get_people contain each person
+matching the filters exactly once.
+'''
+import pandas as pd
+import pytest
+import api_functionalities
+from column_store import ColumnStore
+
+FUNCTIONALITIES = [
+    ("get_people_by_country", {"country": "cn"}),
+    ("get_people_by_country", {"country": "ZZ"}), # No people
+    ("get_people_count_by_country", {}),
+    ("get_people_gender_distribution", {}),
+    ("get_ip_address_distribution", {"by": "class"}),
+    ("get_ip_address_distribution", {"by": "8"}),
+    ("get_ip_address_distribution", {"by": "16"}),
+    ("get_ip_address_distribution", {"by": "range"}),
+    ("get_people_in_network", {"network": "10.0.0.0/8", "limit": 5}),
+    ("get_people_in_network", {"network": "::/0", "limit": 1000}),
+    ("get_most_common_domain", {}),
+    ("get_country_domain_correlation", {}),
+    ("get_gender_domain_correlation", {}),
+    ("get_gender_country_correlation", {}),
+    ("get_gender_distribution_by_country", {}),
+    ("get_common_email_patterns", {}),
+]
+
+def normalized(result):
+    # The rows with the same sort key (e.g., countries with the same count) can be returned in any order, and an index of
+    # positions carries no information
+    if isinstance(result, pd.DataFrame):
+        result = result.reset_index(drop=pd.api.types.is_integer_dtype(result.index)).astype({c: "float64" for c in result.select_dtypes("number").columns})
+        return result.sort_values(list(result.columns), ignore_index=True)
+    if isinstance(result, tuple):
+        return tuple(normalized(r) for r in result)
+    if isinstance(result, list): # e.g., the most common domains
+        return sorted(result)
+    return result
+
+def assert_same_result(result, expected):
+    if isinstance(expected, pd.DataFrame):
+        pd.testing.assert_frame_equal(result, expected, check_dtype=False, check_index_type=False)
+    elif isinstance(expected, tuple):
+        assert len(result) == len(expected)
+        for r, e in zip(result, expected):
+            assert_same_result(r, e)
+    elif isinstance(expected, float):
+        assert result == pytest.approx(expected, nan_ok=True)
+    else:
+        assert result == expected
+
+def new_people(n):
+    return pd.DataFrame({"first_name": ["Ann"] * n, "last_name": ["Smith"] * n, "email": [f"parity{i}@example.com" for i in range(n)],
+                         "gender": ["Female", "Male", "Non-binary"] * (n // 3) + ["Female"] * (n % 3),
+                         "ip_address": [f"10.1.{i % 256}.1" if i % 3 else f"2001:db8::{i:x}" for i in range(n)],
+                         "country": ["CN", "ZZ", "FR"] * (n // 3) + ["CN"] * (n % 3)})
+
+@pytest.fixture
+def store(engine):
+    return ColumnStore.from_engine(engine)
+
+@pytest.mark.parametrize("function_name, arguments", FUNCTIONALITIES)
+def test_store_and_database_give_the_same_result(engine, store, function_name, arguments):
+    function = getattr(api_functionalities, function_name)
+    assert_same_result(normalized(function(engine, **arguments, store=store)), normalized(function(engine, **arguments)))
+
+@pytest.mark.parametrize("function_name, arguments", FUNCTIONALITIES)
+def test_store_updated_with_new_people(engine, store, function_name, arguments):
+    api_functionalities.create_new_people(engine, new_people(30), store=store)
+    assert store.n_people == ColumnStore.from_engine(engine).n_people
+    function = getattr(api_functionalities, function_name)
+    assert_same_result(normalized(function(engine, **arguments, store=store)), normalized(function(engine, **arguments)))
+
+def all_pages(engine, limit, **filters):
+    people, after_id, n_pages = [], 0, 0
+    while after_id is not None:
+        page, after_id = api_functionalities.get_people(engine, **filters, after_id=after_id, limit=limit)
+        assert len(page) <= limit and (after_id is None or after_id == page[-1]["id"])
+        people.extend(page)
+        n_pages += 1
+    return pd.DataFrame(people), n_pages
+
+@pytest.mark.parametrize("filters", [{}, {"country": "cn"}, {"gender": "female"}, {"domain": "Sina.com.cn"}, {"ip_prefix": "1"},
+                                     {"country": "CN", "gender": "Male"}, {"ip_prefix": "1%"}])
+def test_pages_contain_the_filtered_people_once(engine, filters):
+    with engine.begin() as connection:
+        # A person with two countries is returned once
+        connection.exec_driver_sql("INSERT INTO country (person_id, country) SELECT person_id, 'CN' FROM country WHERE country != 'CN' LIMIT 5")
+    people = pd.read_sql("SELECT id, first_name, last_name, email, gender, ip_address FROM person ORDER BY id", engine)
+    countries = pd.read_sql("SELECT person_id, country FROM country", engine)
+    expected = people
+    if "country" in filters:
+        expected = expected[expected["id"].isin(countries.loc[countries["country"] == filters["country"].upper(), "person_id"])]
+    if "gender" in filters:
+        expected = expected[expected["gender"] == filters["gender"].title()]
+    if "domain" in filters:
+        expected = expected[expected["email"].str.endswith("@" + filters["domain"].lower())]
+    if "ip_prefix" in filters:
+        expected = expected[expected["ip_address"].str.startswith(filters["ip_prefix"])]
+
+    result, n_pages = all_pages(engine, 7, **filters)
+    assert n_pages == max(1, -(-len(expected) // 7))
+    if expected.empty:
+        assert result.empty
+    else:
+        pd.testing.assert_frame_equal(result, expected.reset_index(drop=True))
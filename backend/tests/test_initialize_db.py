@@ -0,0 +1,63 @@
+'''
+Tests of the loading of the data (initialize_db.py): the bulk loader, streaming the csv files in chunks, stores the same data of the
+loader keeping the whole files in memory, also when it resumes an interrupted load.
+'''
+import pandas as pd
+import sqlalchemy
+from db_management import db_entities
+import initialize_db
+
+def create_engine(tmp_path, name):
+    return sqlalchemy.create_engine(f"sqlite:///{tmp_path / name}")
+
+def table_contents(engine):
+    with engine.connect() as connection:
+        return {table.name: pd.read_sql(sqlalchemy.select(table).order_by(*table.primary_key.columns), connection)
+                for table in db_entities.Base.metadata.sorted_tables}
+
+def assert_same_tables(engine, expected_engine):
+    contents, expected = table_contents(engine), table_contents(expected_engine)
+    assert contents.keys() == expected.keys()
+    for name in expected:
+        pd.testing.assert_frame_equal(contents[name], expected[name], obj=name)
+
+def load_in_memory(tmp_path, synthetic_data):
+    persons_data_file, countries_data_file = synthetic_data
+    engine = create_engine(tmp_path, "in_memory.db")
+    initialize_db.export_data_to_db(engine, {"person": pd.read_csv(persons_data_file, keep_default_na=False),
+                                             "country": pd.read_csv(countries_data_file, keep_default_na=False)})
+    return engine
+
+def test_bulk_load_stores_the_same_data(tmp_path, synthetic_data):
+    # Namibia ('NA') must not be read as a missing value
+    persons_data_file, countries_data_file = synthetic_data
+    countries = pd.read_csv(countries_data_file, keep_default_na=False)
+    countries.loc[0, "country"] = "NA"
+    countries_data_file = str(tmp_path / "countries.csv")
+    countries.to_csv(countries_data_file, index=False)
+    synthetic_data = persons_data_file, countries_data_file
+
+    expected = load_in_memory(tmp_path, synthetic_data)
+    engine = create_engine(tmp_path, "bulk.db")
+    initialize_db.bulk_export_data_to_db(engine, *synthetic_data, chunk_size=128)
+    assert_same_tables(engine, expected)
+    assert table_contents(engine)["country"]["country"].iloc[0] == "NA"
+    engine.dispose()
+    expected.dispose()
+
+def test_bulk_load_resumes_after_the_last_committed_id(tmp_path, synthetic_data):
+    persons_data_file, countries_data_file = synthetic_data
+    expected = load_in_memory(tmp_path, synthetic_data)
+    engine = create_engine(tmp_path, "resumed.db")
+    # A load interrupted after the first chunks of the people
+    db_entities.Base.metadata.create_all(engine)
+    partial_file = str(tmp_path / "partial.csv")
+    pd.read_csv(persons_data_file, keep_default_na=False).head(300).to_csv(partial_file, index=False)
+    assert initialize_db.bulk_load_table(engine, db_entities.Person.__table__, partial_file, chunk_size=128) == 300
+    assert initialize_db.bulk_load_table(engine, db_entities.Person.__table__, persons_data_file, chunk_size=128) \
+        == len(pd.read_csv(persons_data_file)) - 300
+    # Loading everything again only adds the missing rows, the summary tables are computed on all of them
+    initialize_db.bulk_export_data_to_db(engine, *synthetic_data, chunk_size=128)
+    assert_same_tables(engine, expected)
+    engine.dispose()
+    expected.dispose()
@@ -0,0 +1,108 @@
+'''
+Tests of the index of the ip addresses (ip_index.py): the range lookups are compared with the membership tests of the module ipaddress.
+'''
+import ipaddress
+import numpy as np
+import pandas as pd
+import pytest
+import sqlalchemy
+from sqlalchemy import select
+import initialize_db
+import ip_index
+from database import Session
+from db_management.db_entities import Person
+from ip_index import encode_ip, network_range, IpRangeIndex, packed_ip_address, packed_ip_addresses
+
+def random_addresses(seed, n=3000):
+    random = np.random.default_rng(seed)
+    ipv4 = [str(ipaddress.IPv4Address(int(v))) for v in random.integers(0, 2 ** 32, n)]
+    # Addresses concentrated in a few networks, so that the lookups find many of them
+    ipv4 += [f"10.{a}.{b}.{c}" for a, b, c in random.integers(0, 256, (n // 3, 3))]
+    ipv4 += [f"192.168.{a}.{b}" for a, b in random.integers(0, 256, (n // 3, 2))]
+    ipv6 = [str(ipaddress.IPv6Address((0x20010db8 << 96) | int(v))) for v in random.integers(0, 2 ** 48, n // 3)]
+    return np.array(ipv4 + ipv6 + ["10.0.0.0", "10.255.255.255", "11.0.0.0", "::ffff:10.1.2.3", "::1"], dtype=object)
+
+@pytest.fixture(scope="module")
+def addresses():
+    return random_addresses(0)
+
+@pytest.fixture(scope="module")
+def index(addresses):
+    keys, versions = encode_ip(addresses)
+    valid = versions > 0
+    return IpRangeIndex(keys[valid], np.flatnonzero(valid))
+
+def mapped(address):
+    # IPv4 addresses are mapped into IPv6 (::ffff:0:0/96), as in the keys
+    address = ipaddress.ip_address(address)
+    return ipaddress.IPv6Address((0xFFFF << 32) | int(address)) if address.version == 4 else address
+
+def expected_rows(addresses, network):
+    network = ipaddress.ip_network(network, strict=False)
+    if network.version == 4:
+        network = ipaddress.IPv6Network(f"{mapped(network.network_address)}/{96 + network.prefixlen}")
+    return [row for row, address in enumerate(addresses) if mapped(address) in network]
+
+@pytest.mark.parametrize("network", ["10.0.0.0/8", "10.1.2.3/8", "192.168.0.0/16", "192.168.7.0/24", "10.20.30.40", "0.0.0.0/0",
+                                     "2001:db8::/32", "2001:db8::/100", "::/0", "::ffff:0:0/96", "::1/128", "172.16.0.0/12"])
+def test_lookup_matches_ipaddress(addresses, index, network):
+    first, last = network_range(network)
+    rows = index.lookup(first, last)
+    assert sorted(rows.tolist()) == expected_rows(addresses, network)
+    assert index.count(first, last) == len(rows)
+
+def test_lookup_is_sorted_and_limited(addresses, index):
+    first, last = network_range("10.0.0.0/8")
+    rows = index.lookup(first, last)
+    numbers = [int(mapped(address)) for address in addresses[rows]]
+    assert numbers == sorted(numbers)
+    assert index.lookup(first, last, limit=10).tolist() == rows[:10].tolist()
+
+def test_network_boundaries_are_included(addresses, index):
+    rows = index.lookup(*network_range("10.0.0.0/8"))
+    found = set(addresses[rows])
+    assert {"10.0.0.0", "10.255.255.255", "::ffff:10.1.2.3"} <= found
+    assert "11.0.0.0" not in found
+
+def test_invalid_addresses_are_not_encoded():
+    keys, versions = encode_ip(["1.2.3.4", "not an address", "2001:db8::1", "256.1.1.1"])
+    assert versions.tolist() == [4, 0, 6, 0]
+    with pytest.raises(ValueError):
+        network_range("10.0.0.0/33")
+
+def test_small_inputs_are_encoded_as_large_ones(addresses, monkeypatch):
+    # A few addresses are parsed one by one (e.g., for a single new person): the keys must be the same of the vectorized parsing
+    sample = [*addresses[::200], "01.2.3.4", "1.2.3.4 ", "fe80::1%eth0", "::ffff:1.2.3.4", None]
+    keys, versions = encode_ip(sample)
+    monkeypatch.setattr(ip_index, "SMALL_INPUT", len(sample))
+    small_keys, small_versions = encode_ip(sample)
+    assert small_keys.tolist() == keys.tolist() and small_versions.tolist() == versions.tolist()
+    assert [packed_ip_address(address) for address in sample] == packed_ip_addresses(sample)
+
+def test_loaded_people_have_the_same_packed_addresses(engine, synthetic_data, tmp_path):
+    # export_data_to_db (people created as objects) and the bulk load (fill_packed_ip_addresses) store the same values
+    data = {"person": pd.read_csv(synthetic_data[0], keep_default_na=False), "country": pd.read_csv(synthetic_data[1], keep_default_na=False)}
+    other_engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'objects.db'}")
+    initialize_db.export_data_to_db(other_engine, data)
+    query = select(Person.id, Person.ip_packed).order_by(Person.id)
+    with Session(bind=engine) as session, Session(bind=other_engine) as other_session:
+        assert session.execute(query).all() == other_session.execute(query).all()
+    other_engine.dispose()
+
+@pytest.mark.parametrize("max_delta_keys", [100000, 50])
+def test_appended_keys_are_found(addresses, monkeypatch, max_delta_keys):
+    # Keys appended in batches (kept in the delta, or merged into the main array when it grows) give the same results of an index
+    # built with all the keys at once
+    monkeypatch.setattr(ip_index, "MAX_DELTA_KEYS", max_delta_keys)
+    keys, versions = encode_ip(addresses)
+    rows = np.flatnonzero(versions > 0)
+    index = IpRangeIndex(keys[rows[:1000]], rows[:1000])
+    for start in range(1000, len(rows), 300):
+        index.append(keys[rows[start:start + 300]], rows[start:start + 300])
+    assert len(index) == len(rows)
+    for network in ["10.0.0.0/8", "192.168.7.0/24", "2001:db8::/32", "::/0"]:
+        first, last = network_range(network)
+        assert sorted(index.lookup(first, last).tolist()) == expected_rows(addresses, network)
+        assert index.count(first, last) == len(expected_rows(addresses, network))
+        found = [int(mapped(address)) for address in addresses[index.lookup(first, last, limit=25)]]
+        assert found == sorted(int(mapped(address)) for address in addresses[expected_rows(addresses, network)])[:25]
@@ -0,0 +1,52 @@
+'''
+Tests of the background jobs (jobs.py): the arguments are checked as the endpoints do before the job is submitted, identical jobs
+are shared, and a job executed by the pool of processes returns the same content of the endpoint of its functionality.
+'''
+import asyncio
+import pandas as pd
+import pytest
+import api_functionalities
+import formats
+import jobs
+
+@pytest.mark.parametrize("function_name, arguments", [
+    ("get_ip_address_distribution", {"by": "bogus"}),
+    ("get_people_by_country", {"country": "ITA"}),
+    ("get_people_by_country", {"country": 39}),
+    ("get_people_in_network", {"network": "10.0.0.0/33"}),
+    ("get_people_in_network", {"network": 5}),
+    ("get_people_in_network", {"network": "10.0.0.0/8", "limit": 0}),
+    ("search_people", {"query": " "}),
+    ("search_people", {"query": "ann", "limit": True}),
+    ("search_people", {"query": "ann", "min_similarity": 1.5}),
+    ("get_association_matrix", {"attributes": ["country"]}),
+    ("get_association_matrix", {"attributes": ["country", "planet"]}),
+    ("get_association_matrix", {"attributes": ["country", "gender"], "confidence": 1}),
+    ("get_association_matrix", {"attributes": ["country", "gender"], "n_bootstrap": 10001}),
+    ("get_people_by_country", {}), # Missing argument
+    ("get_people_by_country", {"country": "IT", "store": None}), # Internal parameter
+    ("create_new_person", {}), # Not a job
+])
+def test_invalid_jobs_are_refused(function_name, arguments):
+    with pytest.raises(jobs.JobError):
+        jobs.JobManager.bind_arguments(function_name, arguments)
+
+def test_arguments_with_defaults():
+    assert jobs.JobManager.bind_arguments("search_people", {"query": "ann"}) == {"query": "ann", "limit": 20, "min_similarity": 0.3}
+    assert jobs.JobManager.bind_arguments("get_association_matrix", {"attributes": ["tld", "domain"], "n_bootstrap": 10}) \
+        == {"attributes": ["tld", "domain"], "n_bootstrap": 10, "confidence": 0.95}
+
+def test_job_returns_the_content_of_the_endpoint(engine, monkeypatch):
+    # The workers are started with 'spawn' and connect to the database of the environment
+    monkeypatch.setenv("db_url", str(engine.url))
+    monkeypatch.delenv("db_read_urls", raising=False)
+    manager = jobs.JobManager(processes=1, timeout=60)
+    try:
+        job = manager.submit("get_ip_address_distribution", {"by": "range"})
+        assert manager.submit("get_ip_address_distribution", {"by": "range"}) is job
+        job = asyncio.run(manager.wait(job.id, 60))
+        assert job.status == "done"
+        expected = formats.shape_result("get_ip_address_distribution", api_functionalities.get_ip_address_distribution(engine, "range"))
+        pd.testing.assert_frame_equal(job.result, expected)
+    finally:
+        manager.shutdown()
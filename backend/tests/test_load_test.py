@@ -0,0 +1,100 @@
+'''
+Tests of the load test (load_test.py): the mixes, the generation of the requests in open and closed loop, the statistics of the results
+and a short run against the api executed in process.
+'''
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+import httpx
+import pytest
+import load_test
+
+PEOPLE = [{"first_name": "Ann", "last_name": "Smith", "gender": "Female", "ip_address": "10.1.2.3"},
+          {"first_name": "Bob", "last_name": "Brown", "gender": "Male", "ip_address": "2001:db8::1"}]
+
+def test_load_mix(tmp_path):
+    assert load_test.load_mix("write") == {"create_person": 1}
+    assert sum(load_test.load_mix("mixed").values()) == 100
+    path = tmp_path / "mix.json"
+    path.write_text(json.dumps({"get_people": 3, "create_person": 1}))
+    assert load_test.load_mix(str(path)) == {"get_people": 3, "create_person": 1}
+    for weights in [{"get_planets": 1}, {"get_people": -1}, {"get_people": 0}, {}, ["get_people"]]:
+        path.write_text(json.dumps(weights))
+        with pytest.raises(ValueError):
+            load_test.load_mix(str(path))
+    with pytest.raises(ValueError):
+        load_test.load_mix("unknown")
+
+def test_traffic_sample():
+    sample = load_test.TrafficSample(PEOPLE, ["IT", "FR"], seed=0)
+    people = [sample.new_person() for _ in range(100)]
+    assert len({person["email"] for person in people}) == 100
+    assert {person["country"] for person in people} == {"IT", "FR"}
+    assert {sample.network() for _ in range(100)} == {"10.1.0.0/16", "10.0.0.0/8"}
+    with pytest.raises(ValueError):
+        load_test.TrafficSample([], ["IT"])
+
+def run_generator(loop, **kwargs):
+    requests = []
+    async def handler(request):
+        requests.append(request.url.path)
+        await asyncio.sleep(0.01)
+        if request.url.path == "/create_person":
+            return httpx.Response(200, json=load_test.CREATED_MESSAGE if len(requests) % 2 else "Duplicate")
+        return httpx.Response(500 if request.url.path == "/get_people" else 200, json={})
+
+    async def main():
+        async with httpx.AsyncClient(base_url="http://test", transport=httpx.MockTransport(handler)) as client:
+            generator = load_test.LoadGenerator(client, load_test.TrafficSample(PEOPLE, ["IT"]), {"get_people": 1, "create_person": 1, "get_top_domains": 2})
+            start = time.perf_counter()
+            await getattr(generator, loop)(**kwargs, end=start + 1)
+            return generator, start
+    return asyncio.run(main()), requests
+
+def test_closed_loop():
+    (generator, start), requests = run_generator("closed_loop", concurrency=4)
+    # Each client waits for a response (about 10 ms) before sending the next request
+    assert 200 <= len(generator.results) == len(requests) <= 400
+    summary = {s["route"]: s for s in load_test.summarize(generator.results, start, 1)}
+    assert summary["get_people"]["error_rate"] == 1 and summary["get_people"]["status_codes"] == {"500": summary["get_people"]["requests"]}
+    assert 0.3 < summary["create_person"]["error_rate"] < 0.7 # Every other person is not created
+    assert summary["get_top_domains"]["errors"] == 0 and summary["get_top_domains"]["latency_p50"] >= 10
+    # The requests started after the measured interval are not counted
+    assert len(requests) - 4 <= summary["total"]["requests"] <= len(requests)
+
+def test_open_loop():
+    (generator, start), requests = run_generator("open_loop", rps=200, max_in_flight=1)
+    # The requests are sent on schedule, the ones beyond the maximum in progress are errors
+    assert 120 <= len(generator.results) <= 280
+    too_many = [r for r in generator.results if r[4] == "too many requests in progress"]
+    assert too_many and len(requests) == len(generator.results) - len(too_many)
+
+def test_summarize_and_compare():
+    results = [("get_people", 0.5, 0.2, 200, None)] + [("get_people", 1 + i / 100, (i + 1) / 1000, 200, None) for i in range(100)] + \
+              [("create_person", 1.5, 0.05, 500, "HTTP 500")]
+    summary = {s["route"]: s for s in load_test.summarize(results, start=1, duration=1)}
+    # The request of the warmup is not counted
+    assert summary["get_people"]["requests"] == 100 and summary["get_people"]["latency_max"] == pytest.approx(100)
+    assert summary["get_people"]["latency_p50"] == pytest.approx(50.5) and summary["get_people"]["throughput"] == 100
+    assert summary["create_person"]["error_types"] == {"HTTP 500": 1} and summary["create_person"]["category"] == "write"
+    assert summary["total"]["requests"] == 101 and summary["total"]["category"] is None
+    previous = [{**s, "latency_p95": s["latency_p95"] / 2} if s["route"] == "get_people" else {**s, "error_rate": 0}
+                for s in summary.values()]
+    comparison = load_test.compare_reports(list(summary.values()), previous).set_index("route")
+    assert comparison["regression"].to_dict() == {"get_people": True, "create_person": True, "total": True}
+    assert not load_test.compare_reports(list(summary.values()), list(summary.values()))["regression"].any()
+
+def test_run_against_the_api_in_process(tmp_path):
+    # In another process, since the api reads its configuration from the environment when it is imported
+    output = tmp_path / "results.json"
+    subprocess.run([sys.executable, "load_test.py", "--rows", "300", "--concurrency", "2", "--duration", "2", "--warmup", "0.5",
+                    "--work-dir", str(tmp_path), "--output", str(output)],
+                   cwd=os.path.dirname(os.path.abspath(load_test.__file__)), check=True, capture_output=True, timeout=300)
+    assert os.listdir(tmp_path) == ["results.json"]
+    report = json.loads(output.read_text())
+    assert report["people"] == 300 and report["mode"] == "closed loop"
+    summary = {s["route"]: s for s in report["results"]}
+    assert summary["total"]["requests"] > 0 and summary["total"]["errors"] == 0
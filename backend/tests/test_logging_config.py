@@ -0,0 +1,86 @@
+'''
+Tests of the configuration of the logs (logging_config.py): the records are written as JSON lines by the background thread, with the
+request of the thread that produced them, in the file of their logger and at the level of their module.
+'''
+import atexit
+import json
+import logging
+import threading
+import pytest
+import logging_config
+
+@pytest.fixture
+def setup_logging(tmp_path):
+    # The configuration replaces the handlers of the root logger, which are restored at the end of the test
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    listeners, loggers = [], []
+
+    def setup(**kwargs):
+        loggers.extend(kwargs.get("module_levels", {}))
+        listeners.append(logging_config.setup_logging(str(tmp_path / "logs.log"), **kwargs))
+        return listeners[-1]
+    yield setup
+    for listener in listeners:
+        # The tests stop the listeners to read the files, and a listener cannot be stopped twice
+        atexit.unregister(listener.stop)
+        if listener._thread is not None:
+            listener.stop()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+    for name in loggers:
+        logging.getLogger(name).setLevel(logging.NOTSET)
+
+def read_lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+def test_records_are_json_lines_with_the_request(setup_logging, tmp_path):
+    listener = setup_logging()
+    request_id_token = logging_config.request_id_var.set("abc")
+    endpoint_token = logging_config.endpoint_var.set("/get_people")
+    try:
+        logging.getLogger("api.access").info("%s %s", "GET", "/get_people", extra={"status": 200, "duration": 0.25})
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            logging.exception("Failed")
+    finally:
+        logging_config.request_id_var.reset(request_id_token)
+        logging_config.endpoint_var.reset(endpoint_token)
+    # A record produced out of a request (the thread does not share the context of the request)
+    thread = threading.Thread(target=lambda: logging.warning("Out of a request"))
+    thread.start()
+    thread.join()
+    listener.stop()
+
+    access, error, warning = read_lines(tmp_path / "logs.log")
+    assert {key: access[key] for key in access if key != "time"} == {"level": "INFO", "logger": "api.access", "message": "GET /get_people",
+                                                                     "request_id": "abc", "endpoint": "/get_people", "status": 200, "duration": 0.25}
+    assert error["message"] == "Failed" and error["request_id"] == "abc" and "ZeroDivisionError" in error["exception"]
+    assert warning["message"] == "Out of a request" and "request_id" not in warning and "endpoint" not in warning
+
+def test_separate_files_and_module_levels(setup_logging, tmp_path):
+    listener = setup_logging(module_levels={"sqlalchemy.engine": "WARNING"}, separate_files={"slow_queries": str(tmp_path / "slow.log")})
+    logging.getLogger("slow_queries").warning("SELECT 1", extra={"duration": 1.5})
+    logging.getLogger("sqlalchemy.engine").info("Not written")
+    logging.getLogger("sqlalchemy.engine").warning("Written")
+    logging.debug("Not written")
+    listener.stop()
+    assert [line["message"] for line in read_lines(tmp_path / "logs.log")] == ["Written"]
+    assert [(line["message"], line["duration"]) for line in read_lines(tmp_path / "slow.log")] == [("SELECT 1", 1.5)]
+
+def test_files_are_rotated(setup_logging, tmp_path):
+    listener = setup_logging(max_bytes=1000, backup_count=2)
+    for i in range(100):
+        logging.info(f"Record {i}")
+    listener.stop()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["logs.log", "logs.log.1", "logs.log.2"]
+    assert read_lines(tmp_path / "logs.log")[-1]["message"] == "Record 99"
+
+def test_parse_levels():
+    assert logging_config.parse_levels(" sqlalchemy.engine = warning,api.access=INFO,,invalid") == {"sqlalchemy.engine": "WARNING", "api.access": "INFO"}
+    assert logging_config.parse_levels(None) == {}
@@ -0,0 +1,71 @@
+'''
+Tests of the metrics (metrics.py): the queries of an instrumented engine and the stages of the functionalities are recorded, and the
+queries slower than the threshold are logged.
+'''
+import logging
+import time
+import uuid
+import pytest
+import sqlalchemy
+from prometheus_client import REGISTRY
+import api_functionalities
+import metrics
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+@pytest.fixture
+def database(tmp_path):
+    # A label of its own, so that the values recorded by the other tests are not counted
+    database = f"test_{uuid.uuid4().hex[:8]}"
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'metrics.db'}")
+    metrics.instrument_engine(engine, database)
+    yield engine, database
+    engine.dispose()
+
+def test_queries_are_recorded(database, monkeypatch, caplog):
+    engine, database = database
+    with engine.begin() as connection:
+        connection.exec_driver_sql("CREATE TABLE t (x INTEGER)")
+        connection.exec_driver_sql("INSERT INTO t VALUES (1), (2), (3)")
+        connection.exec_driver_sql("SELECT x FROM t").all()
+    assert sample("db_query_duration_seconds_count", database=database, statement="SELECT") == 1
+    assert sample("db_query_rows_sum", database=database, statement="INSERT") == 3
+    assert sample("db_pool_checkout_wait_seconds_count", database=database) >= 1
+    assert sample("db_slow_queries_total", database=database, statement="SELECT") == 0
+
+    monkeypatch.setattr(metrics, "slow_query_threshold", 0.0)
+    with caplog.at_level(logging.WARNING, logger="slow_queries"), engine.connect() as connection:
+        connection.exec_driver_sql("SELECT   x\n FROM t").all()
+    assert sample("db_slow_queries_total", database=database, statement="SELECT") == 1
+    assert [record.getMessage() for record in caplog.records] == [f"[{database}] SELECT x FROM t"]
+    assert caplog.records[0].duration >= 0
+
+def test_stages_of_the_functionalities(engine):
+    before = {stage: sample("functionality_stage_duration_seconds_count", functionality="get_people_by_country", stage=stage)
+              for stage in ["total", "query", "processing"]}
+    api_functionalities.get_people_by_country(engine, "CN")
+    for stage, count in before.items():
+        assert sample("functionality_stage_duration_seconds_count", functionality="get_people_by_country", stage=stage) == count + 1
+
+def test_nested_functionality_is_a_stage():
+    name = f"outer_{uuid.uuid4().hex[:8]}"
+
+    @metrics.instrumented
+    def inner():
+        time.sleep(0.05)
+
+    def outer():
+        with metrics.stage("query"):
+            time.sleep(0.05)
+        inner()
+    outer.__name__ = name
+    metrics.instrumented(outer)()
+    total = sample("functionality_stage_duration_seconds_sum", functionality=name, stage="total")
+    assert total >= 0.1
+    # The time of the stage and of the inner functionality is not processing of the outer one
+    assert sample("functionality_stage_duration_seconds_sum", functionality=name, stage="processing") < 0.05
+    assert sample("functionality_stage_duration_seconds_sum", functionality=name, stage="query") >= 0.05
+    # Outside of a functionality a stage records nothing
+    with metrics.stage("query"):
+        pass
@@ -0,0 +1,98 @@
+'''
+Tests of the migrations (db_management/migrations.py): a database created with the first version of the entities is updated to the
+current one, with the generated columns, the packed ip addresses, the indexes and the summary tables of a new database.
+'''
+import pandas as pd
+import sqlalchemy
+from db_management import db_entities, migrations
+import initialize_db
+
+# The tables of the first version of the entities (no generated columns, no indexes, ip addresses of at most 15 characters)
+FIRST_VERSION = ["CREATE TABLE person (id INTEGER NOT NULL PRIMARY KEY, first_name VARCHAR(30) NOT NULL, last_name VARCHAR(30) NOT NULL, "
+                 "email VARCHAR(254) NOT NULL, gender VARCHAR(20) NOT NULL, ip_address VARCHAR(15) NOT NULL)",
+                 "CREATE TABLE country (id INTEGER NOT NULL PRIMARY KEY, country VARCHAR(2) NOT NULL, person_id INTEGER NOT NULL "
+                 "REFERENCES person (id) ON DELETE CASCADE ON UPDATE CASCADE)"]
+# The generated column ip_first_octet of the following version, computed from any text before the first '.'
+OLD_IP_FIRST_OCTET = "CASE WHEN INSTR(ip_address, '.') > 0 THEN CAST(SUBSTR(ip_address, 1, INSTR(ip_address, '.') - 1) AS UNSIGNED) END"
+
+def read_data(synthetic_data):
+    persons_data_file, countries_data_file = synthetic_data
+    persons = pd.read_csv(persons_data_file, keep_default_na=False)
+    # Addresses that only start like an IPv4 address
+    persons.loc[:2, "ip_address"] = ["::ffff:1.2.3.4", "1234.5.6.7", "a1.2.3.4"]
+    return persons, pd.read_csv(countries_data_file, keep_default_na=False)
+
+def create_first_version(tmp_path, persons, countries, statements=FIRST_VERSION):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'first_version.db'}")
+    with engine.begin() as connection:
+        for statement in statements:
+            connection.exec_driver_sql(statement)
+    persons.to_sql("person", engine, if_exists="append", index=False)
+    countries.to_sql("country", engine, if_exists="append", index=False)
+    return engine
+
+def create_current_version(tmp_path, persons, countries):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path / 'current_version.db'}")
+    initialize_db.export_data_to_db(engine, {"person": persons, "country": countries})
+    return engine
+
+def table_contents(engine, table):
+    return pd.read_sql(sqlalchemy.select(table).order_by(*table.primary_key.columns), engine)
+
+def assert_same_data(engine, expected):
+    for table in db_entities.Base.metadata.sorted_tables:
+        pd.testing.assert_frame_equal(table_contents(engine, table), table_contents(expected, table), check_dtype=False, obj=table.name)
+
+def index_names(engine, table_name):
+    return {index["name"] for index in sqlalchemy.inspect(engine).get_indexes(table_name)}
+
+def test_migrate_the_first_version(tmp_path, synthetic_data):
+    persons, countries = read_data(synthetic_data)
+    engine = create_first_version(tmp_path, persons, countries)
+    expected = create_current_version(tmp_path, persons, countries)
+    migrations.migrate(engine)
+    assert_same_data(engine, expected)
+    assert index_names(engine, "person") == index_names(expected, "person")
+    assert index_names(engine, "country") == index_names(expected, "country")
+    # The generated columns follow the rule of derived_columns and are used by the aggregations on the indexes
+    people = table_contents(engine, db_entities.Person.__table__)
+    derived = db_entities.derived_columns(people[["email", "ip_address"]])
+    assert people["email_domain"].tolist() == derived["email_domain"].tolist()
+    assert people["ip_first_octet"].astype("Int64").tolist() == derived["ip_first_octet"].tolist()
+    assert people["ip_first_octet"].iloc[:3].isna().all()
+    with engine.connect() as connection:
+        plan = connection.exec_driver_sql("EXPLAIN QUERY PLAN SELECT email_domain, COUNT(*) FROM person GROUP BY email_domain").all()
+    assert "ix_person_email_domain" in str(plan)
+    # A second migration changes nothing
+    migrations.migrate(engine)
+    assert_same_data(engine, expected)
+    engine.dispose()
+    expected.dispose()
+
+def test_redefine_ip_first_octet(tmp_path, synthetic_data):
+    persons, countries = read_data(synthetic_data)
+    # The version with the first definition of the generated columns
+    statements = [FIRST_VERSION[0][:-1] + ", email_domain VARCHAR(254) GENERATED ALWAYS AS (SUBSTR(email, INSTR(email, '@') + 1)) STORED, "
+                  f"ip_first_octet INTEGER GENERATED ALWAYS AS ({OLD_IP_FIRST_OCTET}) STORED)",
+                  "CREATE INDEX ix_person_ip_first_octet ON person (ip_first_octet)", FIRST_VERSION[1]]
+    engine = create_first_version(tmp_path, persons, countries, statements)
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("SELECT ip_first_octet FROM person WHERE id = 1").scalar() == 0
+    expected = create_current_version(tmp_path, persons, countries)
+    migrations.migrate(engine)
+    assert_same_data(engine, expected)
+    assert "ix_person_ip_first_octet" in index_names(engine, "person")
+    assert not migrations.redefine_ip_first_octet(engine)
+    engine.dispose()
+    expected.dispose()
+
+def test_unique_email_index_with_duplicates(tmp_path, synthetic_data):
+    persons, countries = read_data(synthetic_data)
+    persons.loc[1, "email"] = persons.loc[0, "email"]
+    engine = create_first_version(tmp_path, persons, countries)
+    migrations.migrate(engine)
+    # The unique index is not created, the other ones are
+    assert "ix_person_email" not in index_names(engine, "person")
+    assert {"ix_person_email_domain", "ix_person_ip_packed"} <= index_names(engine, "person")
+    assert migrations.create_missing_indexes(engine, db_entities.Person.__table__) == ["ix_person_email"]
+    engine.dispose()
@@ -0,0 +1,95 @@
+'''
+Tests of the read replicas (read_replicas.py and Database.run_read): the reads are spread over the healthy replicas, a replica that
+cannot be reached is excluded and its reads are executed on the primary database, and it is readmitted once it answers again.
+'''
+import asyncio
+import shutil
+import pytest
+import sqlalchemy
+import read_replicas
+from database import Database, read_your_writes_var
+from read_replicas import ReadReplicaSet, NoReplicaAvailable
+
+def database_name(engine):
+    with engine.connect() as connection:
+        return connection.exec_driver_sql("SELECT name FROM source").scalar()
+
+@pytest.fixture
+def create_database(tmp_path):
+    engines = []
+    def create(name, path=None):
+        path = path or tmp_path / f"{name}.db"
+        engine = sqlalchemy.create_engine(f"sqlite:///{path}")
+        if path.parent.exists():
+            with engine.begin() as connection:
+                connection.exec_driver_sql("CREATE TABLE source (name TEXT)")
+                connection.exec_driver_sql(f"INSERT INTO source VALUES ('{name}')")
+        engines.append(engine)
+        return engine
+    yield create
+    for engine in engines:
+        engine.dispose()
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(read_replicas.time, "monotonic", lambda: now[0])
+    return now
+
+def test_round_robin_and_least_busy(create_database):
+    engines = [create_database("replica0"), create_database("replica1")]
+    replicas = ReadReplicaSet(engines)
+    assert [replicas.run(database_name) for _ in range(4)] == ["replica0", "replica1", "replica0", "replica1"]
+    replicas = ReadReplicaSet(engines, strategy="least_busy")
+    busy = replicas.acquire()
+    assert [replicas.run(database_name) for _ in range(3)] == [r for r in ["replica0", "replica1"] if r != busy.name] * 3
+    replicas.release(busy)
+    with pytest.raises(ValueError):
+        ReadReplicaSet([], strategy="random")
+
+def test_unreachable_replica_is_excluded_and_readmitted(create_database, tmp_path, clock):
+    # The file of the second replica cannot be opened until its folder exists
+    down_path = tmp_path / "down" / "replica1.db"
+    replicas = ReadReplicaSet([create_database("replica0"), create_database("replica1", down_path)], health_check_interval=10)
+    database = Database(engine=create_database("primary"), replicas=replicas)
+    assert asyncio.run(database.run_read(database_name)) == "replica0"
+    assert asyncio.run(database.run_read(database_name)) == "primary" # The replica failed, the read is executed again on the primary
+    assert replicas.status() == {"replica0": True, "replica1": False}
+    assert [asyncio.run(database.run_read(database_name)) for _ in range(3)] == ["replica0"] * 3
+
+    # Still failing when tried again after the interval, then readmitted by the health check
+    clock[0] += 10
+    assert sorted(asyncio.run(database.run_read(database_name)) for _ in range(2)) == ["primary", "replica0"]
+    down_path.parent.mkdir()
+    shutil.copy(tmp_path / "replica0.db", down_path)
+    assert replicas.check_health() == {"replica0": True, "replica1": True}
+    assert sorted(asyncio.run(database.run_read(database_name)) for _ in range(2)) == ["replica0", "replica0"] # A copy of replica0
+
+def test_no_replica_available(create_database, tmp_path, clock):
+    replicas = ReadReplicaSet([create_database("replica0", tmp_path / "down" / "replica0.db")])
+    database = Database(engine=create_database("primary"), replicas=replicas)
+    assert replicas.check_health() == {"replica0": False}
+    with pytest.raises(NoReplicaAvailable):
+        replicas.acquire()
+    assert asyncio.run(database.run_read(database_name)) == "primary"
+    assert list(database.stream_read(lambda engine: iter([database_name(engine)]))) == ["primary"]
+
+def test_pinned_reads_and_query_errors(create_database):
+    replicas = ReadReplicaSet([create_database("replica0")])
+    database = Database(engine=create_database("primary"), replicas=replicas)
+
+    async def pinned_read():
+        token = read_your_writes_var.set(True)
+        try:
+            return await database.run_read(database_name)
+        finally:
+            read_your_writes_var.reset(token)
+    assert asyncio.run(pinned_read()) == "primary"
+    assert list(database.stream_read(lambda engine: iter([database_name(engine)]), read_your_writes=True)) == ["primary"]
+    assert list(database.stream_read(lambda engine: iter([database_name(engine)]))) == ["replica0"]
+    # An error of the functionality is not an error of the replica
+    def failing_functionality(engine):
+        raise ValueError(database_name(engine))
+    with pytest.raises(ValueError, match="replica0"):
+        replicas.run(failing_functionality)
+    assert replicas.status() == {"replica0": True}
@@ -0,0 +1,108 @@
+'''
+Tests of the trigram index used to search people (search_index.py): the results are compared with the similarity computed
+on all the people without the index.
+'''
+import re
+import numpy as np
+import pandas as pd
+import pytest
+from search_index import TrigramIndex, FIELDS, COMMON_TRIGRAM_FRACTION
+
+SYLLABLES = ["an", "bel", "ca", "do", "el", "fra", "gio", "li", "ma", "no", "ri", "sa", "to", "va", "zi"]
+
+def random_people(seed, n=2000):
+    random = np.random.default_rng(seed)
+    def names(n_syllables):
+        return ["".join(random.choice(SYLLABLES, n_syllables)).title() for _ in range(n)]
+    first_names, last_names = names(2), names(3)
+    domains = random.choice(["example.com", "mail.it", "posta.org"], n)
+    return pd.DataFrame({"id": np.arange(1, n + 1) * 3,
+                         "first_name": first_names,
+                         "last_name": last_names,
+                         "email": [f"{f[0]}.{l}{i}@{d}".lower() for i, (f, l, d) in enumerate(zip(first_names, last_names, domains))]})
+
+def words(text):
+    return [word for word in re.split(r"[\W_]+", text.lower()) if word]
+
+def word_trigrams(word):
+    word = ("  " + word).encode("utf-8")
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+def expected_scores(people, query):
+    # For each word of the query, the similarity (shared trigrams / distinct trigrams of both) of the most similar word of each
+    # person, averaged over the words of the query weighted by their number of trigrams.
+    # As documented in search_index.py, the words are found through the trigrams of the word of the query that are not common (or
+    # through the rarest one, if all of them are common): the words containing only common trigrams of it are not compared
+    person_words = {person.id: [word_trigrams(w) for field in FIELDS for w in words(getattr(person, field))] for person in people.itertuples()}
+    all_words = [trigrams for trigrams_of_person in person_words.values() for trigrams in trigrams_of_person]
+    query_words = [word_trigrams(word) for word in words(query)]
+    total = sum(len(query_word) for query_word in query_words)
+    scores = pd.Series(0.0, index=list(person_words))
+    for query_word in query_words:
+        frequencies = {trigram: sum(trigram in trigrams for trigrams in all_words) for trigram in query_word}
+        selective = {trigram for trigram in query_word if frequencies[trigram] <= COMMON_TRIGRAM_FRACTION * len(people)}
+        if not selective:
+            selective = {min(sorted(query_word), key=frequencies.get)}
+        for id, trigrams_of_person in person_words.items():
+            similarities = [len(query_word & trigrams) / len(query_word | trigrams) for trigrams in trigrams_of_person if trigrams & selective]
+            scores[id] += len(query_word) * max(similarities, default=0) / total
+    return scores[scores > 0]
+
+@pytest.fixture(scope="module")
+def people():
+    return random_people(0)
+
+@pytest.fixture(scope="module")
+def index(people):
+    index = TrigramIndex()
+    index.append(people.iloc[:1500], merge=True)
+    # The last people are in the delta of the index, as the ones created through the api
+    index.append(people.iloc[1500:1800])
+    index.append(people.iloc[1800:])
+    return index
+
+@pytest.mark.parametrize("min_similarity", [0.3, 0.6, 1.0])
+def test_search_matches_full_scan(people, index, min_similarity):
+    for query in [people["last_name"].iloc[10], people["last_name"].iloc[1900][:-1] + "x", people["first_name"].iloc[5] + " " +
+                  people["last_name"].iloc[5][:4], people["email"].iloc[1700].split("@")[0], "example"]:
+        result = index.search(query, limit=len(people), min_similarity=min_similarity)
+        expected = expected_scores(people, query)
+        expected = expected[expected >= min_similarity - 1e-9]
+        assert sorted(result["id"].tolist()) == sorted(expected.index.tolist()), query
+        assert result["score"].to_numpy() == pytest.approx(expected[result["id"]].to_numpy())
+        assert (np.diff(result["score"].to_numpy()) <= 0).all()
+
+def test_search_finds_the_person_first(people, index):
+    person = people.iloc[1850]
+    result = index.search(f"{person['first_name']} {person['last_name']}", limit=5)
+    assert result["id"].iloc[0] == person["id"]
+    assert result["score"].iloc[0] == 1.0
+    assert len(index.search(person["last_name"], limit=3)) <= 3
+
+def test_delta_gives_the_same_results(people, index):
+    merged = TrigramIndex()
+    merged.append(people, merge=True)
+    for query in [people["last_name"].iloc[1600], "posta"]:
+        pd.testing.assert_frame_equal(index.search(query, limit=50), merged.search(query, limit=50))
+
+def test_search_without_results(index):
+    assert index.search("", limit=5).empty
+    assert index.search("qqqwww", limit=5).empty
+    assert TrigramIndex().search("anna").empty
+
+def test_people_are_indexed_once(people):
+    index = TrigramIndex()
+    index.append(pd.concat([people.iloc[:10], people.iloc[:10]]), merge=True)
+    assert index.size == 10
+
+def test_extra_trigrams_lower_the_score():
+    people = pd.DataFrame({"id": [1, 2, 3, 4], "first_name": ["Zoe", "Zachary", "Zelda", "Rossi"], "last_name": ["Young", "Zimmer", "Rossini", "Ross"],
+                           "email": ["zyoung@mail.com", "zach.zimmer@mail.com", "zelda.r@mail.com", "ross@mail.com"]})
+    index = TrigramIndex()
+    index.append(people, merge=True)
+    # The query shares only its first trigram with the names starting with z, whose other trigrams lower the similarity
+    assert index.search("ZZZZZZ").empty
+    result = index.search("rossi")
+    assert result["id"].tolist() == [4, 3] and result["score"].tolist() == pytest.approx([1.0, 5 / 7])
+    assert index.search("ros")["id"].tolist() == [4, 3] # 'ross' is closer to 'ros' than 'rossini'
+    assert index.search("zelda.r@mail")["id"].iloc[0] == 3
@@ -0,0 +1,132 @@
+'''
+Tests of the sketches of the email domains (sketches.py): the bounds of SpaceSaving and the merge of the sketches built on
+different parts of the data (e.g., by different processes), and the DomainSketches of the database, saved to a file and restored.
+'''
+import numpy as np
+import pandas as pd
+import pytest
+import api_functionalities
+from sketches import SpaceSaving, CountMinSketch, HyperLogLog, DomainSketches
+
+def zipf_items(seed, n, n_items=2000):
+    random = np.random.default_rng(seed)
+    return np.array([f"domain{v}.com" for v in random.zipf(1.3, n) % n_items], dtype=object)
+
+def assert_space_saving_bounds(sketch, items):
+    true_counts = pd.Series(items).value_counts()
+    counters = sketch.counters
+    monitored = true_counts.reindex(counters.index, fill_value=0)
+    assert (counters["count"] - counters["error"] <= monitored).all()
+    assert (monitored <= counters["count"]).all()
+    unmonitored = true_counts.drop(counters.index, errors="ignore")
+    assert (unmonitored <= sketch.min_count()).all()
+    assert sketch.total == len(items)
+
+def test_space_saving_is_exact_with_enough_counters():
+    first, second = zipf_items(0, 3000, 50), zipf_items(1, 2000, 50)
+    sketch, other = SpaceSaving(capacity=100), SpaceSaving(capacity=100)
+    sketch.update(first)
+    other.update(second)
+    sketch.merge(other)
+    expected = pd.Series(np.concatenate([first, second])).value_counts()
+    assert sketch.counters["count"].sort_index().to_dict() == expected.sort_index().to_dict()
+    assert (sketch.counters["error"] == 0).all()
+
+@pytest.mark.parametrize("capacity", [20, 100])
+def test_space_saving_merge_keeps_the_bounds(capacity):
+    parts = [zipf_items(seed, 4000) for seed in range(4)]
+    sketches = []
+    for part in parts:
+        sketch = SpaceSaving(capacity)
+        # Several batches, as the people created through the api
+        for batch in np.array_split(part, 5):
+            sketch.update(batch)
+        assert_space_saving_bounds(sketch, part)
+        sketches.append(sketch)
+    merged = sketches[0]
+    for sketch in sketches[1:]:
+        merged.merge(sketch)
+    items = np.concatenate(parts)
+    assert len(merged.counters) <= capacity
+    assert_space_saving_bounds(merged, items)
+    # The most frequent items of a skewed distribution are found
+    expected = pd.Series(items).value_counts().index[:5].tolist()
+    assert merged.top(5).index.tolist() == expected
+
+def test_count_min_merge_equals_sketch_of_all_items():
+    first, second = zipf_items(0, 3000), zipf_items(1, 3000)
+    sketch, other, whole = CountMinSketch(256, 4), CountMinSketch(256, 4), CountMinSketch(256, 4)
+    sketch.update(first)
+    other.update(second)
+    whole.update(np.concatenate([first, second]))
+    sketch.merge(other)
+    assert np.array_equal(sketch.table, whole.table)
+    assert sketch.total == whole.total
+    true_counts = pd.Series(np.concatenate([first, second])).value_counts()
+    estimates = sketch.estimate(true_counts.index.to_numpy())
+    assert (estimates >= true_counts.to_numpy()).all()
+    with pytest.raises(ValueError):
+        sketch.merge(CountMinSketch(128, 4))
+
+def test_hyperloglog_merge_equals_sketch_of_the_union():
+    random = np.random.default_rng(0)
+    groups = random.choice(["IT", "FR", "DE"], 30000)
+    values = np.array([f"domain{v}.com" for v in random.integers(0, 20000, len(groups))], dtype=object)
+    half = len(groups) // 2
+    sketch, other, whole = HyperLogLog(12), HyperLogLog(12), HyperLogLog(12)
+    sketch.update(groups[:half], values[:half])
+    other.update(groups[half:], values[half:])
+    whole.update(groups, values)
+    sketch.merge(other)
+    assert sketch.registers.keys() == whole.registers.keys()
+    for group in whole.registers:
+        assert np.array_equal(sketch.registers[group], whole.registers[group])
+    # The estimates are within 4 standard errors of the true numbers of distinct values
+    true_counts = pd.DataFrame({"group": groups, "value": values}).groupby("group")["value"].nunique()
+    for group, count in true_counts.items():
+        assert sketch.estimate(group) == pytest.approx(count, rel=4 * sketch.relative_error())
+    with pytest.raises(ValueError):
+        sketch.merge(HyperLogLog(10))
+
+def test_hyperloglog_ignores_missing_groups():
+    sketch = HyperLogLog(10)
+    sketch.update([None, "IT", None], ["a.com", "b.com", "c.com"])
+    assert list(sketch.registers) == ["IT"]
+    assert sketch.estimate("IT") == pytest.approx(1, abs=0.1)
+    assert sketch.estimate("FR") == 0.0
+
+def exact_domain_counts(engine):
+    people = pd.read_sql("SELECT p.id, p.email, p.gender, c.country FROM person p LEFT JOIN country c ON c.person_id = p.id", engine)
+    people["domain"] = people["email"].str.split("@", n=1).str[-1]
+    return people
+
+def test_domain_sketches_of_the_database(engine):
+    sketches = DomainSketches.from_engine(engine, chunk_size=100) # Many chunks, with the rows of a person possibly split
+    people = exact_domain_counts(engine)
+    counts = people.drop_duplicates("id")["domain"].value_counts()
+    assert sketches.n_people == people["id"].nunique()
+    # There are fewer domains than counters, so the most frequent domains are exact
+    for row in sketches.top_domains_with_bounds(5):
+        assert row["lower_bound"] == row["count"] == row["upper_bound"] == counts[row["domain"]]
+        assert row["guaranteed"] == (row["count"] >= counts.iloc[5])
+    for by in ["country", "gender"]:
+        distinct = people.dropna(subset=[by]).groupby(by)["domain"].nunique()
+        for group, estimate in sketches.distinct_domains(by).items():
+            # Two domains in the same register are counted once, also in the small groups
+            assert estimate == pytest.approx(distinct[group], rel=4 * sketches.domains_by_country.relative_error(), abs=1)
+
+def test_domain_sketches_restore(engine, tmp_path):
+    filename = str(tmp_path / "sketches.npz")
+    sketches = DomainSketches.from_engine(engine)
+    sketches.save(filename)
+    # A person created after the sketches have been saved is added when they are restored
+    api_functionalities.create_new_person(engine, "Ann", "Smith", "ann.smith@sketches.org", "Female", "10.0.0.1", "IT", sketches=sketches)
+    restored = DomainSketches.restore(engine, filename)
+    assert restored.n_people == sketches.n_people == DomainSketches.from_engine(engine).n_people
+    assert restored.top_domains_with_bounds(10) == sketches.top_domains_with_bounds(10)
+    assert restored.distinct_domains("country") == sketches.distinct_domains("country")
+    # Sketches of more people than the database (e.g., of a database initialized again) are built from the database
+    more_people = DomainSketches.from_engine(engine)
+    more_people.update(pd.DataFrame({"id": [10**9], "email": ["x@other.org"], "gender": ["Male"], "country": ["FR"]}))
+    more_people.save(filename)
+    assert DomainSketches.restore(engine, filename).n_people == sketches.n_people
@@ -0,0 +1,58 @@
+'''
+Tests of the summary tables (db_management/summaries.py): they stay consistent with the tables 'person' and 'country' after every kind
+of insert, and an inconsistency is found by the verification and removed by a rebuild.
+'''
+import pandas as pd
+from sqlalchemy import insert
+from db_management import summaries
+from db_management.db_entities import Person, Country, derived_columns
+import api_functionalities
+import initialize_db
+
+def assert_consistent(engine):
+    with engine.connect() as connection:
+        assert not any(summaries.verify_summaries(connection).values())
+
+def test_summaries_after_the_inserts(engine):
+    assert_consistent(engine)
+    people = pd.DataFrame({"first_name": ["Ann", "Bob", "Eve"], "last_name": ["Smith", "Brown", "White"],
+                           "email": ["ann@new-domain.org", "bob@new-domain.org", "eve@example.com"], "gender": ["Female", "Polygender", "Female"],
+                           "ip_address": ["10.0.0.1", "2001:db8::1", "::ffff:1.2.3.4"], "country": ["IT", "ZZ", "IT"]})
+    api_functionalities.create_new_people(engine, people)
+    api_functionalities.create_new_person(engine, "Joe", "Black", "joe@new-domain.org", "Male", "250.1.2.3", "ZZ")
+    assert_consistent(engine)
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("SELECT count FROM domain_count WHERE domain = 'new-domain.org'").scalar() == 3
+        assert connection.exec_driver_sql("SELECT count FROM country_gender_count WHERE country = 'ZZ' AND gender = 'Polygender'").scalar() == 1
+
+def test_people_with_many_countries_or_none(engine):
+    with engine.connect() as connection:
+        n_people = summaries.count_people(connection)
+    people = pd.DataFrame({"id": [5001, 5001, 5002], "email": ["a@multi.org", "a@multi.org", "b@multi.org"], "gender": ["Male", "Male", "Female"],
+                           "ip_address": ["1.1.1.1", "1.1.1.1", "2.2.2.2"], "country": ["IT", "FR", None]})
+    rows = derived_columns(people.assign(first_name="A", last_name="B")).drop_duplicates("id")
+    with engine.begin() as connection:
+        connection.execute(insert(Person.__table__), rows.drop(columns=["country", "email_domain", "ip_first_octet"]).to_dict("records"))
+        connection.execute(insert(Country.__table__), [{"person_id": 5001, "country": "IT"}, {"person_id": 5001, "country": "FR"}])
+        # A person is counted once in the summaries not depending on the country
+        summaries.update_summaries(connection, people)
+        connection.execute(insert(Person.__table__), {"id": 5003, "first_name": "C", "last_name": "D", "email": "c@multi.org",
+                                                       "gender": "Male", "ip_address": "3.3.3.3"})
+        summaries.add_person_to_summaries(connection, "c@multi.org", "Male", "3.3.3.3", None)
+    assert_consistent(engine)
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("SELECT count FROM domain_count WHERE domain = 'multi.org'").scalar() == 3
+        assert summaries.count_people(connection) == n_people + 3
+        assert summaries.count_people(connection, max_id=5001) == n_people + 1
+
+def test_verify_and_rebuild(engine):
+    with engine.begin() as connection:
+        connection.exec_driver_sql("UPDATE gender_count SET count = count + 1 WHERE gender = 'Female'")
+        connection.exec_driver_sql("DELETE FROM domain_count WHERE domain IN (SELECT domain FROM domain_count LIMIT 2)")
+        connection.exec_driver_sql("INSERT INTO country_count (country, count) VALUES ('XX', 1)")
+    with engine.connect() as connection:
+        errors = summaries.verify_summaries(connection)
+    assert errors == {"country_count": 1, "gender_count": 1, "country_gender_count": 0, "domain_count": 2, "ip_first_octet_count": 0}
+    assert not initialize_db.refresh_summaries(engine, verify_only=True)
+    assert not initialize_db.refresh_summaries(engine)
+    assert initialize_db.refresh_summaries(engine, verify_only=True)